@@ -0,0 +1,92 @@
+__author__ = 'Lindo Nkambule'
+
+import argparse
+import os
+import tempfile
+import time
+import hail as hl
+from gwaspy.preimp_qc.aggregators import variant_qc_aggregator
+from gwaspy.preimp_qc.annotations import annotate_sex_chromosomes, geno_y_excluded, geno_y_only, hwe_aut, hwe_sex
+
+
+def simulate(n_samples: int, n_variants: int, n_partitions: int) -> hl.MatrixTable:
+    """Balding-Nichols genotypes with 85% of the variants on chr1, 10% on chrX and 5% on chrY, and half the samples
+    female"""
+    mt = hl.balding_nichols_model(3, n_samples, n_variants, n_partitions=n_partitions)
+    # the model puts variant i at position i of the first contig, so the new loci are still sorted
+    position = mt.locus.position
+    contig = (hl.case()
+              .when(position <= 0.85 * n_variants, 'chr1')
+              .when(position <= 0.95 * n_variants, 'chrX')
+              .default('chrY'))
+    mt = mt.key_rows_by(locus=hl.locus(contig, position, reference_genome='GRCh38'), alleles=mt.alleles)
+    mt = mt.annotate_cols(is_female=mt.sample_idx % 2 == 0)
+
+    return mt.select_entries('GT').select_rows().select_globals()
+
+
+def legacy_masks(mt: hl.MatrixTable, chromx: str = 'chrX', chromy: str = 'chrY',
+                 chrommt: str = 'chrMT') -> hl.MatrixTable:
+    """The entry-level masks chained_qc annotated before annotate_sex_chromosomes"""
+    mt = mt.annotate_entries(
+        geno_y_excluded=hl.case().when(mt.locus.contig == chromy, False).default(True),
+        geno_y_only=hl.case().when(mt.locus.contig == chromy, mt.is_female == False).default(False))
+
+    return mt.annotate_entries(
+        hwe_aut=(hl.case().when(mt.locus.contig == chromx, False).when(mt.locus.contig == chromy, False)
+                 .when(mt.locus.contig == chrommt, False).default(True)),
+        hwe_sex=hl.case().when(mt.locus.contig == chromx, mt.is_female).default(False))
+
+
+def call_rate_and_hwe(mt: hl.MatrixTable, noy, y, aut, sex) -> hl.MatrixTable:
+    """The aggregations of the pre_geno/geno and hwe_all filters over the masks"""
+    return mt.annotate_rows(
+        cr_noy=hl.agg.filter(noy, variant_qc_aggregator(mt).call_rate),
+        cr_y=hl.agg.filter(y, variant_qc_aggregator(mt).call_rate),
+        p_hwe_aut=hl.agg.filter(aut, variant_qc_aggregator(mt).p_value_hwe),
+        p_hwe_sex=hl.agg.filter(sex, variant_qc_aggregator(mt).p_value_hwe))
+
+
+def entries_size(path: str) -> int:
+    """Bytes of the entries of a written MatrixTable"""
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(f'{path}/entries')
+               for name in names)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Entry size and filter time of the chrX/chrY masks of chained_qc, '
+                                                 'as entry fields (legacy) and as a row field crossed with is_female')
+    parser.add_argument('--samples', type=int, default=2000)
+    parser.add_argument('--variants', type=int, default=100000)
+    parser.add_argument('--partitions', type=int, default=16)
+    arg = parser.parse_args()
+
+    hl.init(default_reference='GRCh38', idempotent=True)
+    work_dir = tempfile.mkdtemp(prefix='gwaspy_entry_masks_', dir=os.getcwd())
+    mt = simulate(arg.samples, arg.variants, arg.partitions).checkpoint(f'{work_dir}/input.mt')
+
+    legacy = legacy_masks(mt)
+    factorised = annotate_sex_chromosomes(mt)
+    legacy_aggs = call_rate_and_hwe(legacy, legacy.geno_y_excluded, legacy.geno_y_only, legacy.hwe_aut,
+                                    legacy.hwe_sex)
+    factorised_aggs = call_rate_and_hwe(factorised, geno_y_excluded(factorised), geno_y_only(factorised),
+                                        hwe_aut(factorised), hwe_sex(factorised))
+
+    print('masks\tentry_fields\tentry_bytes\tbytes_per_entry\tfilter_seconds')
+    for name, masked, aggs in [('entry', legacy, legacy_aggs), ('row_x_col', factorised, factorised_aggs)]:
+        # what every downstream stage reads and writes when the masked matrix is checkpointed
+        masked.write(f'{work_dir}/{name}.mt')
+        size = entries_size(f'{work_dir}/{name}.mt')
+
+        start = time.perf_counter()
+        aggs.rows().write(f'{work_dir}/{name}.ht')
+        seconds = time.perf_counter() - start
+
+        print(f'{name}\t{len(masked.entry)}\t{size}\t{size / (arg.samples * arg.variants):.3f}\t{seconds:.1f}',
+              flush=True)
+
+    print(f'\nMatrices written to {work_dir}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+__author__ = 'Lindo Nkambule'
+
+import argparse
+import io
+import time
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from gwaspy.preimp_qc.plots import manhattan_render
+
+# GRCh38 chr1-22, X
+CONTIG_LENGTHS = [248956422, 242193529, 198295559, 190214555, 181538259, 170805979, 159345973, 145138636, 138394717,
+                  133797422, 135086622, 133275309, 114364328, 107043718, 101991189, 90338345, 83257441, 80373285,
+                  58617616, 64444167, 46709983, 50818468, 156040895]
+
+
+def simulate(n_points: int, seed: int = 0):
+    """Uniform p-values on positions spread over the genome, with a few association peaks"""
+    rng = np.random.default_rng(seed)
+    lengths = np.array(CONTIG_LENGTHS)
+    contig = rng.choice(len(lengths), size=n_points, p=lengths / lengths.sum())
+    position = (rng.random(n_points) * lengths[contig]).astype(np.int64) + 1
+    order = np.lexsort((position, contig))
+    contig, position = contig[order], position[order]
+    log_p = -np.log10(rng.random(n_points))
+    peaks = rng.choice(n_points, size=min(20, n_points), replace=False)
+    for peak in peaks:
+        window = slice(max(peak - 200, 0), peak + 200)
+        log_p[window] *= rng.uniform(2, 6)
+
+    return contig, position, log_p
+
+
+def legacy_manhattan(data: pd.DataFrame, significance_threshold: float = -np.log10(5E-08),
+                     figsize: tuple = (17, 11)):
+    """The per-chromosome pandas renderer manhattan_plot used before manhattan_render, from a locus/p DataFrame"""
+    data[['CHROM', 'POS']] = data.locus.str.split(":", expand=True)
+    data.columns = ['locus', 'p', 'chromosome', 'position']
+    data['position'] = data['position'].astype(int)
+    data['chromosome'] = data['chromosome'].astype(int)
+    data.dropna(subset=['p'], inplace=True)
+
+    data['-log10(p_value)'] = -np.log10(data['p'])
+    data.loc[data['-log10(p_value)'] > 199, '-log10(p_value)'] = 199
+    data['chromosome'] = data['chromosome'].astype('category')
+    data['ind'] = range(len(data))
+    data_grouped = data.groupby('chromosome', observed=True)
+
+    fig = plt.figure(figsize=figsize)
+    ax = fig.add_subplot()
+    colors = ['tab:orange', 'tab:blue']
+    for num, (name, group) in enumerate(data_grouped):
+        group.plot(kind='scatter', x='ind', y='-log10(p_value)', marker='o', color=colors[int(name) % len(colors)],
+                   ax=ax, s=10)
+    plt.axhline(y=significance_threshold, color='red', linestyle='--', linewidth=2)
+    plt.close()
+
+    return fig
+
+
+def timed(render, dpi: int) -> float:
+    start = time.perf_counter()
+    fig = render()
+    fig.savefig(io.BytesIO(), format='png', dpi=dpi)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the Manhattan plot renderers, including saving the PNG')
+    parser.add_argument('--sizes', type=str, default='1000000,10000000,50000000',
+                        help="comma-separated numbers of points")
+    parser.add_argument('--legacy-max', type=int, default=10000000,
+                        help="skip the legacy renderer above this many points")
+    parser.add_argument('--dpi', type=int, default=300)
+    arg = parser.parse_args()
+
+    print('points\trenderer\tseconds')
+    for n_points in [int(size) for size in arg.sizes.split(',')]:
+        contig, position, log_p = simulate(n_points)
+
+        seconds = timed(lambda: manhattan_render(contig, position, log_p, contig_lengths=CONTIG_LENGTHS,
+                                                 dpi=arg.dpi), arg.dpi)
+        print(f'{n_points}\tmanhattan_render\t{seconds:.1f}', flush=True)
+
+        if n_points <= arg.legacy_max:
+            data = pd.DataFrame({'locus': pd.Series(contig + 1).astype(str) + ':' + pd.Series(position).astype(str),
+                                 'p': 10 ** -log_p})
+            seconds = timed(lambda: legacy_manhattan(data), arg.dpi)
+            print(f'{n_points}\tlegacy\t{seconds:.1f}', flush=True)
+            del data
+
+
+if __name__ == '__main__':
+    main()
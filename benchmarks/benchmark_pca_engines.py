@@ -0,0 +1,81 @@
+__author__ = 'Lindo Nkambule'
+
+import argparse
+import os
+import tempfile
+import time
+import hail as hl
+import numpy as np
+from gwaspy.pca.pca_engine import PCAEngine
+
+
+def simulate(n_samples: int, n_variants: int, n_partitions: int, n_pops: int = 5) -> hl.MatrixTable:
+    """Balding-Nichols genotypes of n_pops populations, so the top PCs separate them"""
+    mt = hl.balding_nichols_model(n_pops, n_samples, n_variants, n_partitions=n_partitions)
+    mt = mt.key_cols_by(s=hl.str(mt.sample_idx))
+
+    return mt.select_entries('GT').select_rows().select_cols().select_globals()
+
+
+def score_matrix(scores: hl.Table) -> np.ndarray:
+    """Samples x PCs, in sample order"""
+    return np.array([row.scores for row in scores.order_by('s').collect()])
+
+
+def compare(exact: tuple, randomized: tuple) -> tuple:
+    """Largest relative eigenvalue error and smallest |correlation| of the PC scores of the two engines"""
+    evals_exact, evals_rand = np.array(exact[0]), np.array(randomized[0])
+    eval_err = np.max(np.abs(evals_rand - evals_exact) / evals_exact)
+    scores_exact, scores_rand = score_matrix(exact[1]), score_matrix(randomized[1])
+    # PCs are only defined up to their sign
+    corr = min(abs(np.corrcoef(scores_exact[:, i], scores_rand[:, i])[0, 1]) for i in range(scores_exact.shape[1]))
+
+    return eval_err, corr
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time and accuracy of the exact and randomized PCA engines')
+    parser.add_argument('--samples', type=str, default='10000,100000,500000',
+                        help='comma-separated numbers of samples to simulate')
+    parser.add_argument('--variants', type=int, default=20000)
+    parser.add_argument('--partitions', type=int, default=64)
+    parser.add_argument('--npcs', type=int, default=10)
+    parser.add_argument('--power-iterations', type=int, default=10)
+    parser.add_argument('--oversampling', type=int, default=None)
+    parser.add_argument('--block-size', type=int, default=128)
+    parser.add_argument('--exact-max-samples', type=int, default=100000,
+                        help='the exact engine holds a samples x samples matrix, so it is skipped above NUM samples')
+    arg = parser.parse_args()
+
+    hl.init(idempotent=True)
+    work_dir = tempfile.mkdtemp(prefix='gwaspy_pca_engines_', dir=os.getcwd())
+    engines = {'exact': PCAEngine('exact'),
+               'randomized': PCAEngine('randomized', oversampling=arg.oversampling,
+                                       power_iterations=arg.power_iterations, block_size=arg.block_size)}
+
+    print('samples\tengine\tseconds\tmax_eigenvalue_rel_error\tmin_abs_score_corr')
+    for n_samples in [int(n) for n in arg.samples.split(',')]:
+        mt = simulate(n_samples, arg.variants, arg.partitions).checkpoint(f'{work_dir}/{n_samples}.mt')
+
+        results = {}
+        for name, engine in engines.items():
+            if (name == 'exact') & (n_samples > arg.exact_max_samples):
+                print(f'{n_samples}\t{name}\tskipped\t\t', flush=True)
+                continue
+            start = time.perf_counter()
+            evals, scores, _ = engine.pca(mt.GT, k=arg.npcs)
+            scores = scores.checkpoint(f'{work_dir}/{n_samples}_{name}_scores.ht')
+            seconds = time.perf_counter() - start
+            results[name] = (evals, scores)
+
+            accuracy = ('', '')
+            if (name == 'randomized') & ('exact' in results):
+                eval_err, corr = compare(results['exact'], results['randomized'])
+                accuracy = (f'{eval_err:.2e}', f'{corr:.4f}')
+            print(f'{n_samples}\t{name}\t{seconds:.1f}\t{accuracy[0]}\t{accuracy[1]}', flush=True)
+
+    print(f'\nMatrices written to {work_dir}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+__author__ = 'Lindo Nkambule'
+
+import hail as hl
+from typing import Tuple
+from gwaspy.utils.stages import StageCache
+from gwaspy.utils.read_file import input_fingerprint, input_paths
+
+
+def pca_cache(out_dir: str) -> StageCache:
+    """Stage cache shared by the PCA runs of every dataset written to out_dir"""
+    return StageCache(f'{out_dir}GWASpy/PCA/cache')
+
+
+def data_key(input_type: str = None, dirname: str = None, basename: str = None, reference: str = 'GRCh38',
+             **filters) -> str:
+    """Key of the PCA input: the fingerprint of the input files, the reference build and the SNP filters applied"""
+    return StageCache.key('pca_input', input=input_fingerprint(input_paths(input_type, dirname, basename)),
+                          reference=reference.lower(), **filters)
+
+
+def shared_sites(ref_path: str, data_mt: hl.MatrixTable, cache: StageCache = None, upstream: str = None) -> hl.Table:
+    """
+    Sites (locus, alleles) of the reference that are also in the data, as a small keyed Table. It is computed from the
+    row keys only and, with a cache, stored once per (reference, input) fingerprint
+    """
+    ref_mt = hl.read_matrix_table(ref_path)
+
+    def compute():
+        return ref_mt.rows().select().semi_join(data_mt.rows().select())
+
+    if cache is None:
+        sites = compute().checkpoint(hl.utils.new_temp_file('shared_sites', 'ht'))
+    else:
+        key = cache.key('shared_sites', upstream=upstream, reference=input_fingerprint([ref_path]))
+        sites, _ = cache.table('shared_sites', key, compute)
+    print(f'\nsites in ref and data: {sites.count()}')
+
+    return sites
+
+
+def intersect_ref(
+        ref_dirname: str = 'gs://hgdp-1kg/hgdp_tgp/datasets_for_others/lindo/ds_without_outliers/',
+        ref_basename: str = 'unrelated',
+        data_mt: hl.MatrixTable = None,
+        cache: StageCache = None,
+        upstream: str = None) -> Tuple[hl.MatrixTable, hl.MatrixTable]:
+    """
+    Restrict the reference and the data to their shared sites, without writing either of them. Both MatrixTables and
+    the sites Table are keyed by locus and alleles, so the semi-joins are ordered merges that do not shuffle
+    :param ref_dirname: directory name where reference data is
+    :param ref_basename: base filename for reference data
+    :param data_mt: input data MatrixTable
+    :param cache: stage cache of the shared sites
+    :param upstream: key of the data, see data_key
+    :return: data restricted to the shared sites, reference restricted to the shared sites
+    """
+    ref_path = f'{ref_dirname}{ref_basename}.mt'
+    sites = shared_sites(ref_path, data_mt, cache=cache, upstream=upstream)
+    ref_mt = hl.read_matrix_table(ref_path)
+
+    return data_mt.semi_join_rows(sites), ref_mt.semi_join_rows(sites)
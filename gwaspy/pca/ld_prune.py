@@ -0,0 +1,153 @@
+__author__ = 'Lindo Nkambule'
+
+import os
+import time
+import hail as hl
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from gwaspy.utils.plink_bed import HOM_REF, HET, HOM_VAR, decode
+from gwaspy.utils.stages import StageCache
+from gwaspy.utils.timing import logger
+
+# MHC chr6:25-35Mb and chr8 inversion chr8:7-13Mb
+PCA_EXCLUDED_INTERVALS = ['chr6:25M-35M', 'chr8:7M-13M']
+STRAND_AMBIGUOUS = {('A', 'T'), ('T', 'A'), ('C', 'G'), ('G', 'C')}
+
+# dosage (alternate allele count) of each 2-bit genotype code, NaN for missing
+DOSAGE = np.full(4, np.nan, dtype=np.float32)
+DOSAGE[[HOM_REF, HET, HOM_VAR]] = [0, 1, 2]
+
+
+def parse_interval(interval: str):
+    """(contig, start, end) of an interval such as 'chr6:25M-35M', end excluded as in hl.parse_locus_interval"""
+    contig, bounds = interval.split(':')
+
+    def position(bound: str) -> int:
+        scale = {'K': 1e3, 'M': 1e6}.get(bound[-1].upper(), 1)
+        return int(float(bound.rstrip('KkMm')) * scale)
+
+    start, end = bounds.split('-')
+
+    return contig, position(start), position(end)
+
+
+def standardised(packed: np.ndarray, n_samples: int) -> np.ndarray:
+    """Dosages of every variant (row) centred and scaled to unit variance, with missing genotypes at the mean (0)"""
+    dosage = DOSAGE[decode(packed, n_samples)]
+    mean = np.nanmean(dosage, axis=1, keepdims=True)
+    dosage = np.where(np.isnan(dosage), mean, dosage) - mean
+    sd = np.sqrt((dosage ** 2).mean(axis=1, keepdims=True))
+
+    return np.divide(dosage, sd, out=np.zeros_like(dosage), where=sd > 0)
+
+
+def prune_contig(packed: np.ndarray, rows: np.ndarray, positions: np.ndarray, n_samples: int, r2: float,
+                 bp_window: int, chunk_size: int = 1024) -> List[int]:
+    """
+    Greedy windowed pruning of the variants of one contig, in position order: a variant is kept when its squared
+    correlation with every kept variant less than bp_window bp before it is below r2. Genotypes are decoded chunk by
+    chunk, and only the kept variants of the current window are held decoded, in a ring buffer of preallocated rows
+    that doubles when the window outgrows it
+    :return: the kept rows
+    """
+    kept = []
+    capacity = 256
+    window = np.empty((capacity, n_samples), dtype=DOSAGE.dtype)
+    window_positions = np.empty(capacity, dtype=np.int64)
+    head, size = 0, 0
+    for start in range(0, len(rows), chunk_size):
+        chunk_rows = rows[start:start + chunk_size]
+        z = standardised(packed[chunk_rows], n_samples)
+        for i, row in enumerate(chunk_rows):
+            position = positions[start + i]
+            while size and window_positions[head] < position - bp_window:
+                head = (head + 1) % capacity
+                size -= 1
+            if size:
+                # the window is window[head:end], wrapping around to the first rows of the buffer
+                end = head + size
+                r = window[head:min(end, capacity)] @ z[i]
+                if end > capacity:
+                    r = np.concatenate([r, window[:end - capacity] @ z[i]])
+                if np.any((r / n_samples) ** 2 >= r2):
+                    continue
+            kept.append(row)
+            if size == capacity:
+                order = (head + np.arange(size)) % capacity
+                window = np.concatenate([window[order], np.empty_like(window)])
+                window_positions = np.concatenate([window_positions[order], np.empty_like(window_positions)])
+                head, capacity = 0, 2 * capacity
+            tail = (head + size) % capacity
+            window[tail] = z[i]
+            window_positions[tail] = position
+            size += 1
+
+    return kept
+
+
+def local_ld_prune(genotype_cache: str, maf: float, call_rate: float, hwe: float, r2: float, bp_window: int,
+                   workers: int = None, reference: str = 'GRCh38') -> pd.DataFrame:
+    """
+    LD pruning of the variants of a genotype cache passing the PCA filters, on the packed genotypes and without Hail.
+    Contigs are pruned in parallel
+    :param reference: reference genome of the data, which the cache contigs are recoded for
+    :return: contig, position, ref and alt of the kept variants
+    """
+    from gwaspy.utils.genotype_cache import GenotypeCache
+
+    cache = GenotypeCache(genotype_cache, reference=reference)
+    bed = cache.bed
+    keep = cache.variants(maf=maf, call_rate=call_rate, hwe=hwe)
+    keep &= ~np.array([(a1, a2) in STRAND_AMBIGUOUS for a1, a2 in zip(bed.bim['a1'], bed.bim['a2'])], dtype=bool)
+    for contig, start, end in map(parse_interval, PCA_EXCLUDED_INTERVALS):
+        keep &= ~((bed.contig == contig) & (bed.position >= start) & (bed.position < end))
+
+    contigs = pd.unique(bed.contig[keep])
+
+    def prune(contig):
+        rows = np.flatnonzero(keep & (bed.contig == contig))
+        rows = rows[np.argsort(bed.position[rows], kind='stable')]
+        return prune_contig(bed.packed, rows, bed.position[rows], bed.n_samples, r2=r2, bp_window=bp_window)
+
+    with ThreadPoolExecutor(max_workers=workers if workers else os.cpu_count()) as pool:
+        kept = np.sort(np.concatenate([np.array(rows, dtype=np.int64) for rows in pool.map(prune, contigs)] or
+                                      [np.zeros(0, dtype=np.int64)]))
+
+    # hl.import_plink makes A2 the reference allele
+    return pd.DataFrame({'contig': bed.contig[kept], 'position': bed.position[kept],
+                         'ref': bed.bim['a2'].to_numpy()[kept], 'alt': bed.bim['a1'].to_numpy()[kept]})
+
+
+def pruned_sites(mt: hl.MatrixTable, ld_cor: float = 0.2, ld_window: int = 250000, cache: StageCache = None,
+                 upstream: str = None, genotype_cache: str = None, maf: float = None, call_rate: float = None,
+                 hwe: float = None) -> hl.Table:
+    """
+    Sites (locus, alleles) of mt kept by LD pruning. With a cache and the key of the sites of mt (upstream, see
+    data_key), the pruned sites are stored once per input site list and (ld_cor, ld_window), so PCA reruns with
+    other PCs or relatedness settings skip pruning. With a genotype cache, pruning runs on its packed genotypes
+    (local_ld_prune), otherwise with hl.ld_prune. The two keep different, equally valid, sets of variants
+    """
+    def compute():
+        if genotype_cache:
+            from gwaspy.utils.genotype_cache import sites_table
+            reference = mt.locus.dtype.reference_genome.name
+            df = local_ld_prune(genotype_cache, maf=maf, call_rate=call_rate, hwe=hwe, r2=ld_cor, bp_window=ld_window,
+                                reference=reference)
+            return sites_table(df, reference)
+
+        return hl.ld_prune(mt.GT, r2=ld_cor, bp_window_size=ld_window).select()
+
+    start = time.perf_counter()
+    if (cache is not None) & (upstream is not None):
+        key = cache.key('ld_prune', upstream=upstream, ld_cor=ld_cor, ld_window=ld_window,
+                        local=genotype_cache is not None)
+        sites, computed = cache.table('ld_prune', key, compute)
+    else:
+        sites, computed = compute().checkpoint(hl.utils.new_temp_file('ld_prune', 'ht')), True
+
+    if computed:
+        logger.info('LD pruning took %.1fs', time.perf_counter() - start)
+
+    return sites
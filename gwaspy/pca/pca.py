@@ -2,6 +2,8 @@ __author__ = 'Lindo Nkambule'
 
 import argparse
 import hail as hl
+from gwaspy.pca.pca_engine import PCA_ENGINES, PCAEngine
+from gwaspy.utils.timing import log_to_stdout
 
 
 def pca(
@@ -13,11 +15,16 @@ def pca(
         maf: float = 0.05, hwe: float = 1e-3, call_rate: float = 0.98,
         ld_cor: float = 0.2, ld_window: int = 250000, n_pcs: int = 20, run_relatedness_check: bool = True,
         include_kinself: bool = False, relatedness_method: str = 'pc_relate',
-        relatedness_thresh: float = 0.1, prob_threshold: float = 0.8, out_dir: str = None):
+        relatedness_thresh: float = 0.1, prob_threshold: float = 0.8, out_dir: str = None,
+        genotype_cache: str = None, ref_bundle: str = None, pca_engine: str = 'exact', oversampling: int = None,
+        power_iterations: int = 10, block_size: int = 128):
 
     if not out_dir:
         raise Exception('\nOutput directory where files will be saved is not specified')
 
+    engine = PCAEngine(name=pca_engine, oversampling=oversampling, power_iterations=power_iterations,
+                       block_size=block_size)
+
     if pca_type == 'project':
         print('\nRunning PCA using projection method')
 
@@ -27,7 +34,7 @@ def pca(
                         reference=reference, npcs=n_pcs, maf=maf, hwe=hwe, call_rate=call_rate,
                         relatedness_method=relatedness_method, run_relatedness_check=run_relatedness_check,
                         ld_cor=ld_cor, ld_window=ld_window, include_kinself=include_kinself,
-                        prob_threshold=prob_threshold)
+                        prob_threshold=prob_threshold, genotype_cache=genotype_cache, ref_bundle=ref_bundle)
 
     elif pca_type == 'joint':
         print('\nRunning PCA using joint method')
@@ -36,7 +43,7 @@ def pca(
                       data_basename=data_basename, out_dir=out_dir, input_type=input_type, reference=reference,
                       npcs=n_pcs, maf=maf, hwe=hwe, call_rate=call_rate, ld_cor=ld_cor, ld_window=ld_window,
                       relatedness_method=relatedness_method, relatedness_thresh=relatedness_thresh,
-                      prob_threshold=prob_threshold)
+                      prob_threshold=prob_threshold, genotype_cache=genotype_cache, pca_engine=engine)
 
     else:
         print('\nRunning PCA without a reference')
@@ -44,7 +51,8 @@ def pca(
         run_pca_normal(dirname=data_dirname, basename=data_basename, input_type=input_type, out_dir=out_dir,
                        reference=reference, maf=maf, hwe=hwe, call_rate=call_rate, ld_cor=ld_cor, ld_window=ld_window,
                        n_pcs=n_pcs, run_relatedness_check=run_relatedness_check, relatedness_method=relatedness_method,
-                       relatedness_thresh=relatedness_thresh, include_kinself=include_kinself)
+                       relatedness_thresh=relatedness_thresh, include_kinself=include_kinself,
+                       genotype_cache=genotype_cache, pca_engine=engine)
 
 
 def main():
@@ -55,11 +63,14 @@ def main():
     parser.add_argument('--ref-info', default='gs://hgdp-1kg/hgdp_tgp/gwaspy_pca_ref/hgdp_1kg_sample_info.unrelateds.pca_outliers_removed.with_project.tsv')
     parser.add_argument('--reference', type=str, default='GRCh38')
     parser.add_argument('--pca-type', type=str, default='normal', choices=['normal', 'project', 'joint'])
+    parser.add_argument('--ref-bundle', type=str, default=None,
+                        help='reference PCA loadings bundle built with pca_ref_bundle. Projection PCA projects the '
+                             'data on it instead of recomputing the reference PCs')
 
     # data args
     parser.add_argument('--data-dirname', type=str, required=True)
     parser.add_argument('--data-basename', type=str, required=True)
-    parser.add_argument('--input-type', type=str, required=True, choices=['vcf', 'plink', 'hail'])
+    parser.add_argument('--input-type', type=str, required=True, choices=['vcf', 'plink', 'bgen', 'hail'])
 
     # filter args
     parser.add_argument('--maf', type=float, default=0.05, help='include only SNPs with MAF >= NUM in PCA')
@@ -78,9 +89,22 @@ def main():
                         help='Threshold value to use in relatedness checks')
     parser.add_argument('--prob', type=float, default=0.8,
                         help='Minimum probability of belonging to a given population for the population to be set')
+    parser.add_argument('--pca-engine', type=str, default='exact', choices=PCA_ENGINES,
+                        help='PCA algorithm of normal and joint PCA: exact (hl.hwe_normalized_pca) or randomized '
+                             '(randomized block Lanczos, for large numbers of samples)')
+    parser.add_argument('--pca-oversampling', type=int, default=None,
+                        help='extra random vectors of the randomized engine. Default is the number of PCs')
+    parser.add_argument('--pca-power-iterations', type=int, default=10,
+                        help='power iterations of the randomized engine')
+    parser.add_argument('--pca-block-size', type=int, default=128,
+                        help='variants per genotype block of the randomized engine')
     parser.add_argument('--out-dir', type=str, required=True)
+    parser.add_argument('--genotype-cache', type=str, default=None,
+                        help='local directory of a genotype cache. It is written from the input on the first run and '
+                             'the MAF, HWE and call rate filters are then read from it')
 
     args = parser.parse_args()
+    log_to_stdout()
 
     if not args.prob:
         print(f'No prob value specified, {args.prob} will be used')
@@ -92,7 +116,10 @@ def main():
         data_basename=args.data_basename, maf=args.maf, hwe=args.hwe, call_rate=args.geno, ld_cor=args.ld_cor,
         ld_window=args.ld_window, n_pcs=args.npcs, run_relatedness_check=args.no_relatedness,
         include_kinself=args.include_kinself, relatedness_method=args.relatedness_method,
-        relatedness_thresh=args.relatedness_thresh, prob_threshold=args.prob, out_dir=args.out_dir)
+        relatedness_thresh=args.relatedness_thresh, prob_threshold=args.prob, out_dir=args.out_dir,
+        genotype_cache=args.genotype_cache, ref_bundle=args.ref_bundle, pca_engine=args.pca_engine,
+        oversampling=args.pca_oversampling, power_iterations=args.pca_power_iterations,
+        block_size=args.pca_block_size)
 
     print('\nDone running PCA')
 
@@ -0,0 +1,71 @@
+__author__ = 'Lindo Nkambule'
+
+import warnings
+import hail as hl
+from typing import Tuple
+
+PCA_ENGINES = ['exact', 'randomized']
+# first Hail version whose private randomized block Lanczos PCA has the arguments the randomized engine passes
+BLANCZOS_MIN_VERSION = (0, 2, 90)
+
+
+def hail_version() -> Tuple[int, ...]:
+    """e.g. (0, 2, 105) for Hail 0.2.105-acd89e80c345"""
+    return tuple(int(part) for part in hl.__version__.split('-')[0].split('.')[:3])
+
+
+def check_blanczos():
+    if hail_version() < BLANCZOS_MIN_VERSION:
+        raise ValueError(f'The randomized PCA engine needs Hail >= {".".join(map(str, BLANCZOS_MIN_VERSION))}, '
+                         f'this is Hail {hl.__version__}. Upgrade Hail or use the exact engine')
+
+
+def hwe_normalized_blanczos(call_expr: hl.CallExpression, k: int, compute_loadings: bool, power_iterations: int,
+                            oversampling: int, block_size: int):
+    """
+    Adapter for the private randomized block Lanczos PCA of Hail, the only place it is called from. Its arguments
+    are those of Hail >= BLANCZOS_MIN_VERSION
+    """
+    check_blanczos()
+    return hl._hwe_normalized_blanczos(call_expr, k=k, compute_loadings=compute_loadings,
+                                       q_iterations=power_iterations, oversampling_param=oversampling,
+                                       block_size=block_size)
+
+
+class PCAEngine:
+    """
+    HWE-normalised PCA used by normal and joint PCA.
+
+        exact       hl.hwe_normalized_pca, which computes the full sample-by-sample Gram matrix and its
+                    eigendecomposition. Its cost grows with the square of the number of samples
+        randomized  randomized block Lanczos (hwe_normalized_blanczos). The HWE-normalised genotypes are read in
+                    blocks of block_size variants and multiplied into a block of k + oversampling random vectors,
+                    power_iterations times, so the Gram matrix is never formed. More power iterations or oversampling
+                    give more accurate trailing PCs at the cost of one more pass over the genotypes each
+
+    Both return (eigenvalues, scores, loadings) as hl.hwe_normalized_pca does
+    """
+    def __init__(self, name: str = 'exact', oversampling: int = None, power_iterations: int = 10,
+                 block_size: int = 128):
+        if name not in PCA_ENGINES:
+            raise ValueError(f'PCA engine must be one of {PCA_ENGINES}, not {name}')
+        if name == 'randomized':
+            check_blanczos()
+        self.name = name
+        self.oversampling = oversampling
+        self.power_iterations = power_iterations
+        self.block_size = block_size
+
+    def pca(self, call_expr: hl.CallExpression, k: int = 10, compute_loadings: bool = False):
+        if self.name == 'exact':
+            return hl.hwe_normalized_pca(call_expr, k=k, compute_loadings=compute_loadings)
+
+        # oversampling defaults to k in Hail
+        return hwe_normalized_blanczos(call_expr, k=k, compute_loadings=compute_loadings,
+                                       power_iterations=self.power_iterations, oversampling=self.oversampling,
+                                       block_size=self.block_size)
+
+    def check_size(self, n_snps: int):
+        if (n_snps > 1000000) & (self.name == 'exact'):
+            warnings.warn(f'Too many SNPs to be used in PCA: {n_snps}. This will make PCA run longer. The '
+                          f'randomized PCA engine (--pca-engine randomized) scales better with large data')
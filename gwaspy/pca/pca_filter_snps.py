@@ -2,27 +2,45 @@ __author__ = 'Lindo Nkambule'
 
 import hail as hl
 import pandas as pd
+from gwaspy.pca.ld_prune import PCA_EXCLUDED_INTERVALS, pruned_sites
+from gwaspy.utils.stages import StageCache
 
 
-def pca_filter_mt(
+def pca_qc_mt(
         in_mt: hl.MatrixTable,
         maf: float = 0.05,
         hwe: float = 1e-3,
         call_rate: float = 0.98,
-        ld_cor: float = 0.2,
-        ld_window: int = 250000):
-
-    print("\nInitial number of SNPs before filtering: {}".format(in_mt.count_rows()))
-    mt = hl.variant_qc(in_mt)
-    print(f'\nFiltering out variants with MAF < {maf}')
-    mt_filt = mt.annotate_rows(maf=hl.min(mt.variant_qc.AF))
-    mt_filt = mt_filt.filter_rows(mt_filt.maf > maf)
+        genotype_cache: str = None,
+        source: list = None):
+    """
+    SNPs for PCA before LD pruning: MAF, HWE and call rate filters, no strand ambiguous SNPs or SNPs in the MHC and
+    the chr8 inversion
+    :param source: fingerprint of the input in_mt was read from (see input_source). With a genotype cache, the
+    variants passing the filters are taken from the statistics of the cache, so it has to be written from the same
+    input
+    """
+    if genotype_cache:
+        # the MAF, HWE and call rate filters use the statistics stored in the genotype cache, so in_mt (and its
+        # sample annotations) is only semi-joined with the variants passing them
+        from gwaspy.utils.genotype_cache import GenotypeCache
+        reference = in_mt.locus.dtype.reference_genome.name
+        if (source is None) or not GenotypeCache.is_current(genotype_cache, source, reference=reference):
+            raise ValueError(f'Genotype cache {genotype_cache} was not written from the input being filtered '
+                             f'({reference})')
+        sites = GenotypeCache(genotype_cache, reference=reference).sites(maf=maf, call_rate=call_rate, hwe=hwe)
+        mt_filt = in_mt.semi_join_rows(sites)
+    else:
+        mt = hl.variant_qc(in_mt)
+        print(f'\nFiltering out variants with MAF < {maf}')
+        mt_filt = mt.annotate_rows(maf=hl.min(mt.variant_qc.AF))
+        mt_filt = mt_filt.filter_rows(mt_filt.maf > maf)
 
-    print(f'\nFiltering out variants with HWE < {hwe:1e}')
-    mt_filt = mt_filt.filter_rows(mt_filt.variant_qc.p_value_hwe > hwe)
+        print(f'\nFiltering out variants with HWE < {hwe:1e}')
+        mt_filt = mt_filt.filter_rows(mt_filt.variant_qc.p_value_hwe > hwe)
 
-    print(f'\nFiltering out variants with Call Rate < {call_rate}')
-    mt_filt = mt_filt.filter_rows(mt_filt.variant_qc.call_rate >= call_rate)
+        print(f'\nFiltering out variants with Call Rate < {call_rate}')
+        mt_filt = mt_filt.filter_rows(mt_filt.variant_qc.call_rate >= call_rate)
 
     # no strand ambiguity
     print('\nFiltering out strand ambigous variants')
@@ -31,19 +49,59 @@ def pca_filter_mt(
     # MHC chr6:25-35Mb
     # chr8.inversion chr8:7-13Mb
     print('\nFiltering out variants in MHC [chr6:25M-35M] and chromosome 8 inversions [chr8:7M-13M]')
-    intervals = ['chr6:25M-35M', 'chr8:7M-13M']
-    mt_filt = hl.filter_intervals(mt_filt, [hl.parse_locus_interval(x, reference_genome='GRCh38') for x in intervals],
-                                  keep=False)
+    mt_filt = hl.filter_intervals(mt_filt, [hl.parse_locus_interval(x, reference_genome='GRCh38')
+                                            for x in PCA_EXCLUDED_INTERVALS], keep=False)
+
+    return mt_filt
 
-    # This step is expensive (on local machine)
+
+def pca_ld_prune_mt(
+        mt_filt: hl.MatrixTable,
+        ld_cor: float = 0.2,
+        ld_window: int = 250000,
+        genotype_cache: str = None,
+        cache: StageCache = None,
+        upstream: str = None,
+        maf: float = 0.05,
+        hwe: float = 1e-3,
+        call_rate: float = 0.98):
+    """
+    LD pruning of the SNPs of pca_qc_mt, filtered with the same maf, hwe, call_rate and genotype_cache
+    :param cache: stage cache of the LD-pruned sites
+    :param upstream: key of the input and its MAF, HWE and call rate filters (see data_key). With a cache, the pruned
+    sites are stored under it and reused by later runs
+    """
+    # This step is expensive (on local machine), so the pruned sites are cached
     print(f'\nLD pruning using correlation threshold of {ld_cor} and window size of {ld_window}')
-    mt_ld_prune = hl.ld_prune(mt_filt.GT, r2=ld_cor, bp_window_size=ld_window)
-    mt_ld_pruned = mt_filt.filter_rows(hl.is_defined(mt_ld_prune[mt_filt.row_key]))
-    print("\nNumber of SNPs after filtering: {}".format(mt_ld_pruned.count_rows()))
+    sites = pruned_sites(mt_filt, ld_cor=ld_cor, ld_window=ld_window, cache=cache, upstream=upstream,
+                         genotype_cache=genotype_cache, maf=maf, call_rate=call_rate, hwe=hwe)
+    # the sites are keyed like the rows, so this is an ordered merge
+    mt_ld_pruned = mt_filt.semi_join_rows(sites)
+    print("\nNumber of SNPs after filtering: {}".format(sites.count()))
 
     return mt_ld_pruned
 
 
+def pca_filter_mt(
+        in_mt: hl.MatrixTable,
+        maf: float = 0.05,
+        hwe: float = 1e-3,
+        call_rate: float = 0.98,
+        ld_cor: float = 0.2,
+        ld_window: int = 250000,
+        genotype_cache: str = None,
+        cache: StageCache = None,
+        upstream: str = None,
+        source: list = None):
+    """
+    SNPs for PCA: the filters of pca_qc_mt, then LD pruning (pca_ld_prune_mt)
+    """
+    mt_filt = pca_qc_mt(in_mt, maf=maf, hwe=hwe, call_rate=call_rate, genotype_cache=genotype_cache, source=source)
+
+    return pca_ld_prune_mt(mt_filt, ld_cor=ld_cor, ld_window=ld_window, genotype_cache=genotype_cache, cache=cache,
+                           upstream=upstream, maf=maf, hwe=hwe, call_rate=call_rate)
+
+
 def relatedness_check(
         in_mt: hl.MatrixTable = None,
         method: str = 'pc_relate',
@@ -2,6 +2,8 @@ __author__ = 'Lindo Nkambule'
 
 import hail as hl
 import pandas as pd
+from gwaspy.pca.intersect import data_key, intersect_ref, pca_cache
+from gwaspy.pca.pca_engine import PCAEngine
 from gwaspy.pca.pca_filter_snps import pca_filter_mt, relatedness_check
 import plotly.express as px
 
@@ -12,7 +14,9 @@ def joint_pca(
         in_mt: hl.MatrixTable = None,
         data_basename: str = None,
         npcs: int = 20,
-        out_dir: str = None):
+        out_dir: str = None,
+        pca_engine: PCAEngine = None,
+        upstream: str = None):
     """
     Merges input dataset with ref by [locus, alleles] and runs PCA on merged dataset
     :param ref_dirname: directory name where reference data is
@@ -21,30 +25,27 @@ def joint_pca(
     :param data_basename: base filename for input data
     :param npcs: number of principal components to be used in PCA
     :param out_dir: output directory where files are going to be saved to
+    :param pca_engine: PCA engine, default is hl.hwe_normalized_pca
+    :param upstream: key of the data, see data_key. The sites shared with the reference are cached under it
     :return:
     """
-    print('\nReading reference data mt')
-    ref_mt = hl.read_matrix_table(f'{ref_dirname}{ref_basename}.mt')
+    pca_engine = pca_engine if pca_engine else PCAEngine()
 
-    # We need to unkey the datasets and take only cols common between the two in order to be able to merge in Hail
-    ref_mt = ref_mt.key_cols_by().key_rows_by()
-    ref_downsampled = ref_mt.select_cols('s').select_rows('locus', 'alleles').select_entries('GT')
-    ref_downsampled = ref_downsampled.key_cols_by('s').key_rows_by('locus', 'alleles')
+    print('\nRestricting Data and Ref to their shared sites')
+    data_in_ref, ref_in_data = intersect_ref(ref_dirname=ref_dirname, ref_basename=ref_basename, data_mt=in_mt,
+                                             cache=pca_cache(out_dir), upstream=upstream)
 
-    data_mt = in_mt.key_cols_by().key_rows_by()
-    data_downsampled = data_mt.select_cols('s').select_rows('locus', 'alleles').select_entries('GT')
-    data_downsampled = data_downsampled.key_cols_by('s').key_rows_by('locus', 'alleles')
+    # both are keyed by locus, alleles and s already, so only the fields are dropped: rekeying would shuffle them
+    ref_downsampled = ref_in_data.select_globals().select_cols().select_rows().select_entries('GT')
+    data_downsampled = data_in_ref.select_globals().select_cols().select_rows().select_entries('GT')
 
     print('\nJoining Data with Ref by locus & alleles')
     joined = ref_downsampled.union_cols(data_downsampled)
 
-    pca_snps = joined.count_rows()
-    if pca_snps > 1000000:
-        import warnings
-        warnings.warn(f'Too many SNPs to be used in PCA: {pca_snps}. This will make PCA run longer')
+    pca_engine.check_size(joined.count_rows())
 
     print(f'\nRunning PCA with {npcs} principal components')
-    pca_evals, pca_scores, _ = hl.hwe_normalized_pca(joined.GT, k=npcs)
+    pca_evals, pca_scores, _ = pca_engine.pca(joined.GT, k=npcs)
 
     pca_scores = pca_scores.transmute(**{f'PC{i}': pca_scores.scores[i - 1] for i in range(1, npcs+1)})
     print(f'\nExporting PCA scores to {out_dir}')
@@ -121,7 +122,9 @@ def run_pca_joint(
         ld_window: int = 250000,
         relatedness_method: str = 'pc_relate',
         relatedness_thresh: float = 0.1,
-        prob_threshold: float = 0.8):
+        prob_threshold: float = 0.8,
+        genotype_cache: str = None,
+        pca_engine: PCAEngine = None):
     """
     Project samples into predefined PCA space
     :param ref_dirname: directory name where reference data is
@@ -139,8 +142,10 @@ def run_pca_joint(
     :param ld_cor: reference build
     :param ld_window: window size
     :param prob_threshold: a list of probability thresholds to use for classifying samples
+    :param genotype_cache: local directory of a GWASpy genotype cache to write the data to, or read it from
     :param relatedness_method: method to use for relatedness filtering
     :param relatedness_thresh: threshold to use for filtering out related individuals
+    :param pca_engine: PCA engine, default is hl.hwe_normalized_pca
     :return: a pandas Dataframe with data PCA scores projected on the same PCA space using the Human Genome Diversity
     """
     print('\nReading data mt')
@@ -152,18 +157,30 @@ def run_pca_joint(
         else:
             print(f'\nFound lifted-over over file: {lifted_over}')
             mt = hl.read_matrix_table(lifted_over)
+        if genotype_cache:
+            print('\nThe genotype cache is not used for lifted-over data')
+            genotype_cache = None
+        source = None
     else:
-        from gwaspy.utils.read_file import read_infile
-        mt = read_infile(input_type=input_type, dirname=data_dirname, basename=data_basename)
+        from gwaspy.utils.read_file import input_source, read_infile
+        source = input_source(input_type=input_type, dirname=data_dirname, basename=data_basename)
+        mt = read_infile(input_type=input_type, dirname=data_dirname, basename=data_basename,
+                         genotype_cache=genotype_cache)
 
     print("\nFiltering data mt")
-    data_mt = pca_filter_mt(in_mt=mt, maf=maf, hwe=hwe, call_rate=call_rate, ld_cor=ld_cor, ld_window=ld_window)
+    cache = pca_cache(out_dir)
+    sites_key = data_key(input_type=input_type, dirname=data_dirname, basename=data_basename, reference=reference,
+                         maf=maf, hwe=hwe, call_rate=call_rate)
+    data_mt = pca_filter_mt(in_mt=mt, maf=maf, hwe=hwe, call_rate=call_rate, ld_cor=ld_cor, ld_window=ld_window,
+                            genotype_cache=genotype_cache, cache=cache, upstream=sites_key, source=source)
 
-    data_mt = relatedness_check(in_mt=data_mt, method=relatedness_method, outdir=out_dir,
-                                kin_estimate=relatedness_thresh)
+    data_mt, _ = relatedness_check(in_mt=data_mt, method=relatedness_method, outdir=out_dir,
+                                   kin_estimate=relatedness_thresh)
 
+    upstream = cache.key('ld_prune', upstream=sites_key, ld_cor=ld_cor, ld_window=ld_window,
+                         local=genotype_cache is not None)
     joint_pca(ref_dirname=ref_dirname, ref_basename=ref_basename, in_mt=data_mt, data_basename=data_basename, npcs=npcs,
-              out_dir=out_dir)
+              out_dir=out_dir, pca_engine=pca_engine, upstream=upstream)
 
     scores_without_pop_label = f'{out_dir}GWASpy/PCA/{data_basename}/pca_joint/{data_basename}.{ref_basename}.joint.pca.scores.txt.bgz'
     scores_with_pop_label_df = add_ref_superpop_labels(joint_scores=scores_without_pop_label, ref_info=ref_info)
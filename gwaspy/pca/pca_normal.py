@@ -4,45 +4,10 @@ import hail as hl
 import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
+from gwaspy.pca.intersect import data_key, pca_cache
+from gwaspy.pca.pca_engine import PCAEngine
 from gwaspy.pca.pca_filter_snps import pca_filter_mt, relatedness_check
-
-
-def pc_project(
-        mt: hl.MatrixTable = None,
-        loadings_ht: hl.Table = None,
-        loading_location: str = 'loadings',
-        af_location: str = 'pca_af') -> hl.Table:
-    """
-    Projects samples in `mt` on pre-computed PCs.
-
-    :param mt: MT containing the samples to project
-    :param loadings_ht: HT containing the PCA loadings and allele frequencies used for the PCA
-    :param loading_location: Location of expression for loadings in `loadings_ht`
-    :param af_location: Location of expression for allele frequency in `loadings_ht`
-    :return: Table with scores calculated from loadings in column `scores`
-    """
-
-    n_variants = loadings_ht.count()
-
-    mt = mt.annotate_rows(
-        pca_loadings=loadings_ht[mt.row_key][loading_location],
-        pca_af=loadings_ht[mt.row_key][af_location],
-    )
-
-    mt = mt.filter_rows(
-        hl.is_defined(mt.pca_loadings)
-        & hl.is_defined(mt.pca_af)
-        & (mt.pca_af > 0)
-        & (mt.pca_af < 1)
-    )
-
-    gt_norm = (mt.GT.n_alt_alleles() - 2 * mt.pca_af) / hl.sqrt(
-        n_variants * 2 * mt.pca_af * (1 - mt.pca_af)
-    )
-
-    mt = mt.annotate_cols(scores=hl.agg.array_sum(mt.pca_loadings * gt_norm))
-
-    return mt.cols().select('scores')
+from gwaspy.pca.projection import pc_project
 
 
 def plot_pca(
@@ -113,7 +78,11 @@ def run_pca_normal(
         include_kinself: bool = False,
         relatedness_method: str = 'pc_relate',
         relatedness_thresh: float = 0.1,
-        out_dir: str = None):
+        out_dir: str = None,
+        genotype_cache: str = None,
+        pca_engine: PCAEngine = None):
+
+    pca_engine = pca_engine if pca_engine else PCAEngine()
 
     print('\nReading mt')
     if reference.lower() == 'grch37':
@@ -124,12 +93,20 @@ def run_pca_normal(
         else:
             print(f'\nFound lifted-over over file: {lifted_over}')
             mt = hl.read_matrix_table(lifted_over)
+        if genotype_cache:
+            print('\nThe genotype cache is not used for lifted-over data')
+            genotype_cache = None
+        source = None
     else:
-        from gwaspy.utils.read_file import read_infile
-        mt = read_infile(input_type=input_type, dirname=dirname, basename=basename)
+        from gwaspy.utils.read_file import input_source, read_infile
+        source = input_source(input_type=input_type, dirname=dirname, basename=basename)
+        mt = read_infile(input_type=input_type, dirname=dirname, basename=basename, genotype_cache=genotype_cache)
 
     print('\nFiltering mt')
-    mt = pca_filter_mt(in_mt=mt, maf=maf, hwe=hwe, call_rate=call_rate, ld_cor=ld_cor, ld_window=ld_window)
+    sites_key = data_key(input_type=input_type, dirname=dirname, basename=basename, reference=reference, maf=maf,
+                         hwe=hwe, call_rate=call_rate)
+    mt = pca_filter_mt(in_mt=mt, maf=maf, hwe=hwe, call_rate=call_rate, ld_cor=ld_cor, ld_window=ld_window,
+                       genotype_cache=genotype_cache, cache=pca_cache(out_dir), upstream=sites_key, source=source)
 
     if run_relatedness_check:
         out_dir = f'{out_dir}GWASpy/PCA/{basename}/pca_normal/'
@@ -149,10 +126,7 @@ def run_pca_normal(
             fail_samples = related['Sample'].to_list()
             print(f'''Found {len(fail_samples)} samples that failed relatedness checks and will be projected''')
 
-    pca_snps = mt.count_rows()
-    if pca_snps > 1000000:
-        import warnings
-        warnings.warn(f'Too many SNPs to be used in PCA: {pca_snps}. This will make PCA run longer')
+    pca_engine.check_size(mt.count_rows())
 
     print('\nRunning PCA on unrelated samples')
 
@@ -163,7 +137,7 @@ def run_pca_normal(
         unrelated_mt = mt
 
     # run PCA on unrelated samples
-    eigenvalues, pcs, loadings = hl.hwe_normalized_pca(unrelated_mt.GT, k=n_pcs, compute_loadings=True)
+    eigenvalues, pcs, loadings = pca_engine.pca(unrelated_mt.GT, k=n_pcs, compute_loadings=True)
     unrelated_scores = pcs.transmute(**{f'PC{i}': pcs.scores[i - 1] for i in range(1, n_pcs+1)})
     unrelated_scores = unrelated_scores.annotate(Projected='No - unrelated')
     # add AF annotation
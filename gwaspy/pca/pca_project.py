@@ -2,78 +2,12 @@ __author__ = 'Lindo Nkambule'
 
 import hail as hl
 import pandas as pd
-from gwaspy.pca.pca_filter_snps import pca_filter_mt, relatedness_check
+from gwaspy.pca.intersect import data_key, intersect_ref, pca_cache
+from gwaspy.pca.pca_filter_snps import pca_ld_prune_mt, pca_qc_mt, relatedness_check
+from gwaspy.pca.projection import pc_project
 import plotly.express as px
 
 
-def pc_project(
-        mt: hl.MatrixTable = None,
-        loadings_ht: hl.Table = None,
-        loading_location: str = 'loadings',
-        af_location: str = 'pca_af') -> hl.Table:
-    """
-    Projects samples in `mt` on pre-computed PCs.
-
-    :param mt: MT containing the samples to project
-    :param loadings_ht: HT containing the PCA loadings and allele frequencies used for the PCA
-    :param loading_location: Location of expression for loadings in `loadings_ht`
-    :param af_location: Location of expression for allele frequency in `loadings_ht`
-    :return: Table with scores calculated from loadings in column `scores`
-    """
-
-    n_variants = loadings_ht.count()
-
-    mt = mt.annotate_rows(
-        pca_loadings=loadings_ht[mt.row_key][loading_location],
-        pca_af=loadings_ht[mt.row_key][af_location],
-    )
-
-    mt = mt.filter_rows(
-        hl.is_defined(mt.pca_loadings)
-        & hl.is_defined(mt.pca_af)
-        & (mt.pca_af > 0)
-        & (mt.pca_af < 1)
-    )
-
-    gt_norm = (mt.GT.n_alt_alleles() - 2 * mt.pca_af) / hl.sqrt(
-        n_variants * 2 * mt.pca_af * (1 - mt.pca_af)
-    )
-
-    mt = mt.annotate_cols(scores=hl.agg.array_sum(mt.pca_loadings * gt_norm))
-
-    return mt.cols().select('scores')
-
-
-def intersect_ref(
-        ref_dirname: str = 'gs://hgdp-1kg/hgdp_tgp/datasets_for_others/lindo/ds_without_outliers/',
-        ref_basename: str = 'unrelated',
-        data_mt: hl.MatrixTable = None,
-        data_basename: str = None, out_dir: str = None):
-    """
-    Intersects reference panel with the data and writes intersections as matrix tables
-    :param ref_dirname: directory name where reference data is
-    :param ref_basename: base filename for reference data
-    :param data_mt: input data MatrixTable
-    :param data_basename: base filename for input data
-    :param out_dir: output directory where files are going to be saved to
-    :return:
-    """
-    print('Reading reference data mt')
-    ref_mt = hl.read_matrix_table(f'{ref_dirname}{ref_basename}.mt')
-
-    # filter data to sites in ref & array data
-    data_in_ref = data_mt.filter_rows(hl.is_defined(ref_mt.rows()[data_mt.row_key]))
-    print('\nsites in ref and data, inds in data: {}'.format(data_in_ref.count()))
-    data_in_ref.write(f'{out_dir}GWASpy/PCA/{data_basename}/pca_project/{data_basename}_intersect_{ref_basename}.mt',
-                      overwrite=True)
-
-    # filter ref to data sites
-    ref_in_data = ref_mt.filter_rows(hl.is_defined(data_mt.rows()[ref_mt.row_key]))
-    print('\nsites in ref and data, inds in ref: {}'.format(ref_in_data.count()))  #
-    ref_in_data.write(f'{out_dir}GWASpy/PCA/{data_basename}/pca_project/{ref_basename}_intersect_{data_basename}.mt',
-                      overwrite=True)
-
-
 def run_ref_pca(
         mt: hl.MatrixTable = None,
         npcs: int = 20):
@@ -143,7 +77,9 @@ def run_pca_project(
         include_kinself: bool = False,
         relatedness_method: str = 'pc_relate',
         relatedness_thresh: float = 0.1,
-        prob_threshold: float = 0.8):
+        prob_threshold: float = 0.8,
+        genotype_cache: str = None,
+        ref_bundle: str = None):
     """
     Project samples into predefined PCA space
     :param ref_dirname: directory name where reference data is
@@ -165,6 +101,9 @@ def run_pca_project(
     :param relatedness_method: method to use for relatedness filtering
     :param relatedness_thresh: threshold to use for filtering out related individuals
     :param prob_threshold: a list of probability thresholds to use for classifying samples
+    :param genotype_cache: local directory of a GWASpy genotype cache to write the data to, or read it from
+    :param ref_bundle: reference PCA loadings bundle (see ReferenceBundle). The data is projected on its loadings
+    instead of intersecting it with the reference and recomputing the reference PCs
     :return: a pandas Dataframe with data PCA scores projected on the same PCA space using reference data of choice
     """
     print('\nReading data mt')
@@ -176,12 +115,23 @@ def run_pca_project(
         else:
             print(f'\nFound lifted-over over file: {lifted_over}')
             mt = hl.read_matrix_table(lifted_over)
+        if genotype_cache:
+            print('\nThe genotype cache is not used for lifted-over data')
+            genotype_cache = None
+        source = None
     else:
-        from gwaspy.utils.read_file import read_infile
-        mt = read_infile(input_type=input_type, dirname=data_dirname, basename=data_basename)
+        from gwaspy.utils.read_file import input_source, read_infile
+        source = input_source(input_type=input_type, dirname=data_dirname, basename=data_basename)
+        mt = read_infile(input_type=input_type, dirname=data_dirname, basename=data_basename,
+                         genotype_cache=genotype_cache)
 
     print('\nFiltering data mt')
-    mt = pca_filter_mt(in_mt=mt, maf=maf, hwe=hwe, call_rate=call_rate, ld_cor=ld_cor, ld_window=ld_window)
+    cache = pca_cache(out_dir)
+    sites_key = data_key(input_type=input_type, dirname=data_dirname, basename=data_basename, reference=reference,
+                         maf=maf, hwe=hwe, call_rate=call_rate)
+    qc_mt = pca_qc_mt(in_mt=mt, maf=maf, hwe=hwe, call_rate=call_rate, genotype_cache=genotype_cache, source=source)
+    mt = pca_ld_prune_mt(qc_mt, ld_cor=ld_cor, ld_window=ld_window, genotype_cache=genotype_cache, cache=cache,
+                         upstream=sites_key, maf=maf, hwe=hwe, call_rate=call_rate)
 
     if run_relatedness_check:
         related_out_dir = f'{out_dir}GWASpy/PCA/{data_basename}/pca_project/'
@@ -190,15 +140,21 @@ def run_pca_project(
     else:
         print('Skipping relatedness checks')
 
-    # Intersect data with reference
-    intersect_ref(ref_dirname=ref_dirname, ref_basename=ref_basename, data_mt=mt, data_basename=data_basename,
-                  out_dir=out_dir)
-
-    ref_in_data = hl.read_matrix_table(f'{out_dir}GWASpy/PCA/{data_basename}/pca_project/{ref_basename}_intersect_{data_basename}.mt')
+    if ref_bundle:
+        from gwaspy.pca.reference_bundle import ReferenceBundle
+        print(f'\nProjecting on the reference PCs of bundle {ref_bundle}')
+        bundle = ReferenceBundle(ref_bundle)
+        ref_scores = bundle.reference_scores(npcs)
+    else:
+        # Intersect data with reference
+        upstream = cache.key('ld_prune', upstream=sites_key, ld_cor=ld_cor, ld_window=ld_window,
+                             local=genotype_cache is not None)
+        project_mt, ref_in_data = intersect_ref(ref_dirname=ref_dirname, ref_basename=ref_basename, data_mt=mt,
+                                                cache=cache, upstream=upstream)
 
-    print('\nComputing reference PCs')
-    ref_scores, pca_loadings = run_ref_pca(mt=ref_in_data, npcs=npcs)
-    ref_scores = ref_scores.key_by('s')  # make sure we key by s so we can annotate
+        print('\nComputing reference PCs')
+        ref_scores, pca_loadings = run_ref_pca(mt=ref_in_data, npcs=npcs)
+        ref_scores = ref_scores.key_by('s')  # make sure we key by s so we can annotate
 
     # annotate ref info with SuperPop and Project information
     ref_info = hl.import_table(ref_info, key='Sample')
@@ -208,10 +164,13 @@ def run_pca_project(
     ref_df = ref_annotated.to_pandas()
 
     # project data
-    project_mt = hl.read_matrix_table(f'{out_dir}GWASpy/PCA/{data_basename}/pca_project/{data_basename}_intersect_{ref_basename}.mt')
-
-    data_scores = pc_project(mt=project_mt, loadings_ht=pca_loadings)
-    data_scores = data_scores.transmute(**{f'PC{i}': data_scores.scores[i - 1] for i in range(1, npcs+1)})
+    if ref_bundle:
+        # the bundle loadings span every reference site, so the data is projected before LD pruning, on all of the
+        # QC'ed sites it shares with the reference
+        data_scores = bundle.project(qc_mt, npcs=npcs, cache=cache)
+    else:
+        data_scores = pc_project(mt=project_mt, loadings_ht=pca_loadings)
+        data_scores = data_scores.transmute(**{f'PC{i}': data_scores.scores[i - 1] for i in range(1, npcs+1)})
     data_df = data_scores.to_pandas()
 
     # merge data scores with ref scores
@@ -0,0 +1,104 @@
+__author__ = 'Lindo Nkambule'
+
+import hail as hl
+from typing import Dict
+from gwaspy.utils.stages import StageCache
+
+IMPUTE_METHODS = ['af', 'mean']
+
+
+class LoadingsProjector:
+    """
+    Projects samples on pre-computed PCs, shared by normal PCA (related samples), projection PCA and the reference
+    bundle. With U the loadings of the n_variants PCA variants and p their allele frequencies, the loadings are
+    normalised once, W[j, k] = U[j, k] / sqrt(n_variants * 2p(1 - p)), and kept (checkpointed, or stored in a
+    StageCache). PC k of a sample is then the sum over variants of W[j, k] * (dosage - 2p), one array_sum per sample
+    over the variants shared with the loadings, so the scores stay a distributed Table.
+    Missing genotypes are imputed with 2p (impute='af', they add nothing to the scores) or with the mean dosage of
+    the variant in the cohort (impute='mean')
+    """
+    def __init__(self, loadings_ht: hl.Table, loading_location: str = 'loadings', af_location: str = 'pca_af',
+                 n_variants: int = None, npcs: int = None, cache: StageCache = None, key: str = None):
+        self._loadings = loadings_ht
+        self._loading_location = loading_location
+        self._af_location = af_location
+        self._n_variants = n_variants
+        self._npcs = npcs
+        self._cache = cache
+        self._key = key
+        self._normalised = None
+
+    def normalised(self) -> hl.Table:
+        """Loadings keyed by locus and alleles: w (normalised loadings) and two_p, for 0 < p < 1"""
+        if self._normalised is not None:
+            return self._normalised
+
+        def compute():
+            n_variants = self._n_variants if self._n_variants else self._loadings.count()
+            ht = self._loadings
+            loadings, p = ht[self._loading_location], ht[self._af_location]
+            if self._npcs:
+                loadings = loadings[:self._npcs]
+            ht = ht.filter(hl.is_defined(loadings) & hl.is_defined(p) & (p > 0) & (p < 1))
+            return ht.select(w=loadings.map(lambda u: u / hl.sqrt(n_variants * 2 * p * (1 - p))), two_p=2 * p)
+
+        if (self._cache is not None) & (self._key is not None):
+            key = self._cache.key('normalised_loadings', upstream=self._key, n_variants=self._n_variants,
+                                  npcs=self._npcs)
+            self._normalised, _ = self._cache.table('normalised_loadings', key, compute)
+        else:
+            self._normalised = compute().checkpoint(hl.utils.new_temp_file('normalised_loadings', 'ht'))
+
+        return self._normalised
+
+    def project(self, mt: hl.MatrixTable, impute: str = 'af') -> hl.Table:
+        """Table keyed by the column key of mt with the scores of its samples in `scores`"""
+        if impute not in IMPUTE_METHODS:
+            raise ValueError(f'impute must be one of {IMPUTE_METHODS}, not {impute}')
+
+        w = self.normalised()
+        mt = mt.select_globals().select_rows().select_cols().select_entries(dosage=hl.float64(mt.GT.n_alt_alleles()))
+        mt = mt.annotate_rows(pca=w[mt.row_key])
+        mt = mt.filter_rows(hl.is_defined(mt.pca))
+        if impute == 'mean':
+            mt = mt.annotate_rows(fill=hl.if_else(hl.agg.count_where(hl.is_defined(mt.dosage)) > 0,
+                                                  hl.agg.mean(mt.dosage), mt.pca.two_p))
+            fill = mt.fill
+        else:
+            fill = mt.pca.two_p
+
+        x = hl.or_else(mt.dosage, fill) - mt.pca.two_p
+        mt = mt.annotate_cols(scores=hl.agg.array_sum(mt.pca.w * x))
+
+        return mt.cols().select('scores')
+
+    def project_many(self, mts: Dict[str, hl.MatrixTable], impute: str = 'af') -> Dict[str, hl.Table]:
+        """
+        Project several cohorts on the same loadings, which are only normalised once
+        :return: for each cohort, a Table keyed by the column key with the scores of its samples in `scores`
+        """
+        return {cohort: self.project(mt, impute=impute) for cohort, mt in mts.items()}
+
+
+def pc_project(
+        mt: hl.MatrixTable = None,
+        loadings_ht: hl.Table = None,
+        loading_location: str = 'loadings',
+        af_location: str = 'pca_af',
+        n_variants: int = None,
+        impute: str = 'af') -> hl.Table:
+    """
+    Projects samples in `mt` on pre-computed PCs.
+
+    :param mt: MT containing the samples to project
+    :param loadings_ht: HT containing the PCA loadings and allele frequencies used for the PCA
+    :param loading_location: Location of expression for loadings in `loadings_ht`
+    :param af_location: Location of expression for allele frequency in `loadings_ht`
+    :param n_variants: number of variants the PCA was run on. Default is the number of rows of `loadings_ht`
+    :param impute: missing genotypes are imputed with the PCA allele frequency (af) or the mean dosage (mean)
+    :return: Table with scores calculated from loadings in column `scores`
+    """
+    projector = LoadingsProjector(loadings_ht, loading_location=loading_location, af_location=af_location,
+                                  n_variants=n_variants)
+
+    return projector.project(mt, impute=impute)
@@ -0,0 +1,139 @@
+__author__ = 'Lindo Nkambule'
+
+import argparse
+import json
+import warnings
+import hail as hl
+from gwaspy.pca.projection import LoadingsProjector
+from gwaspy.utils.stages import StageCache
+from gwaspy.utils.read_file import input_fingerprint
+
+# version of the bundle layout. Bundles written with another version are rebuilt, not read
+BUNDLE_VERSION = 1
+
+
+class ReferenceBundle:
+    """
+    Reference PCA computed once over the full site list of a reference panel (e.g. HGDP+1KG), so pca_project only
+    makes one pass over the input instead of intersecting the reference with it and rerunning the reference PCA.
+    A bundle directory holds:
+
+        loadings.ht     keyed by locus and alleles: loadings (one per PC), pca_af (reference alternate allele
+                        frequency) and idx (index of the variant in the reference site list)
+        scores.ht       keyed by s: PC1..PCn of the reference samples
+        metadata.json   version, number of PCs and variants, eigenvalues and the fingerprint of the reference
+
+    The data is projected on the loadings of the shared sites. Loadings of the sites missing from the data are
+    dropped and every PC is rescaled by the share of its loadings that is left, see project()
+    """
+    def __init__(self, path: str):
+        self._path = path.rstrip('/')
+        with hl.hadoop_open(f'{self._path}/metadata.json', 'r') as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != BUNDLE_VERSION:
+            raise ValueError(f'Reference bundle {path} has version {self.meta["version"]}, rebuild it with version '
+                             f'{BUNDLE_VERSION}')
+        self.n_pcs = self.meta['n_pcs']
+        self.n_variants = self.meta['n_variants']
+        self.eigenvalues = self.meta['eigenvalues']
+        self.loadings = hl.read_table(f'{self._path}/loadings.ht')
+        self.scores = hl.read_table(f'{self._path}/scores.ht')
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return hl.hadoop_exists(f"{path.rstrip('/')}/metadata.json")
+
+    @staticmethod
+    def build(path: str, ref_dirname: str, ref_basename: str, npcs: int = 20) -> 'ReferenceBundle':
+        """Run the reference PCA over every site of the reference MatrixTable and write the bundle to path"""
+        path = path.rstrip('/')
+        ref_path = f'{ref_dirname}{ref_basename}.mt'
+        ref_mt = hl.read_matrix_table(ref_path)
+
+        print(f'\nComputing {npcs} reference PCs over all the sites of {ref_path}')
+        eigenvalues, scores, loadings = hl.hwe_normalized_pca(ref_mt.GT, k=npcs, compute_loadings=True)
+        af = ref_mt.annotate_rows(pca_af=hl.agg.mean(ref_mt.GT.n_alt_alleles()) / 2).rows()
+        loadings = loadings.annotate(pca_af=af[loadings.key].pca_af).add_index('idx')
+        loadings = loadings.checkpoint(f'{path}/loadings.ht', overwrite=True)
+
+        scores = scores.transmute(**{f'PC{i}': scores.scores[i - 1] for i in range(1, npcs + 1)})
+        scores.write(f'{path}/scores.ht', overwrite=True)
+
+        with hl.hadoop_open(f'{path}/metadata.json', 'w') as f:
+            json.dump({'version': BUNDLE_VERSION, 'n_pcs': npcs, 'n_variants': loadings.count(),
+                       'eigenvalues': eigenvalues, 'reference': input_fingerprint([ref_path])}, f, indent=2)
+
+        return ReferenceBundle(path)
+
+    def reference_scores(self, npcs: int) -> hl.Table:
+        """Scores of the reference samples on the first npcs PCs"""
+        self._check_npcs(npcs)
+        return self.scores.select(*[f'PC{i}' for i in range(1, npcs + 1)])
+
+    def _check_npcs(self, npcs: int):
+        if npcs > self.n_pcs:
+            raise ValueError(f'The reference bundle has {self.n_pcs} PCs, {npcs} were requested')
+
+    def project(self, mt: hl.MatrixTable, npcs: int, min_overlap: float = 0.5, cache: StageCache = None,
+                impute: str = 'af') -> hl.Table:
+        """
+        Project the samples of mt on the first npcs PCs of the reference, in one pass over its entries. With U the
+        loadings and S the reference sites present in mt, PC k of a sample is
+
+            sum over S of U[j, k] * x[j]  /  sum over S of U[j, k]^2
+
+        where x[j] is the genotype normalised as hl.hwe_normalized_pca does, over all n_variants reference sites, and
+        S only has the sites with a reference allele frequency strictly between 0 and 1, the ones the scores are
+        computed from. The denominator is 1 when no site is missing, and otherwise undoes the shrinkage from the
+        missing sites
+        :param min_overlap: warn when fewer than this fraction of the reference sites are in mt
+        :param cache: stage cache where the normalised loadings are kept between runs
+        :param impute: imputation of missing genotypes, see LoadingsProjector
+        :return: Table keyed by s with PC1..PCnpcs
+        """
+        self._check_npcs(npcs)
+        # only sites with 0 < pca_af < 1 are projected on (see LoadingsProjector.normalised), so the others are not
+        # part of the coverage either
+        loadings = self.loadings.filter(hl.is_defined(self.loadings.loadings) & hl.is_defined(self.loadings.pca_af) &
+                                        (self.loadings.pca_af > 0) & (self.loadings.pca_af < 1))
+        loadings = loadings.select(loadings=loadings.loadings[:npcs])
+
+        # the overlap only reads the row keys of mt
+        shared = mt.rows().select()
+        shared = shared.filter(hl.is_defined(loadings[shared.key]))
+        shared = shared.annotate(loadings=loadings[shared.key].loadings)
+        overlap = shared.aggregate(hl.struct(n=hl.agg.count(),
+                                             coverage=hl.agg.array_sum(shared.loadings.map(lambda u: u ** 2))))
+        if overlap.n == 0:
+            raise ValueError('None of the reference bundle sites are in the data')
+        print(f'\n{overlap.n} of the {self.n_variants} reference bundle sites are in the data')
+        if overlap.n < min_overlap * self.n_variants:
+            warnings.warn(f'Only {overlap.n / self.n_variants:.1%} of the reference sites are in the data, the '
+                          f'projected PCs will be noisy')
+
+        projector = LoadingsProjector(self.loadings, n_variants=self.n_variants, npcs=npcs, cache=cache,
+                                      key=StageCache.key('reference_bundle', version=self.meta['version'],
+                                                         reference=self.meta['reference']))
+        scores = projector.project(mt, impute=impute)
+        coverage = hl.literal(overlap.coverage)
+
+        return scores.select(**{f'PC{i}': scores.scores[i - 1] / coverage[i - 1] for i in range(1, npcs + 1)})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a reference PCA loadings bundle for pca --pca-type project')
+    parser.add_argument('--ref-dirname', default='gs://hgdp-1kg/hgdp_tgp/datasets_for_others/lindo/ds_without_outliers/')
+    parser.add_argument('--ref-basename', default='unrelated')
+    parser.add_argument('--reference', type=str, default='GRCh38')
+    parser.add_argument('--npcs', type=int, default=20, help='Number of PCs to compute')
+    parser.add_argument('--out', type=str, required=True, help='directory the bundle is written to')
+    args = parser.parse_args()
+
+    hl.init(default_reference=args.reference)
+    ReferenceBundle.build(args.out, ref_dirname=args.ref_dirname, ref_basename=args.ref_basename, npcs=args.npcs)
+
+    print(f'\nReference bundle written to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
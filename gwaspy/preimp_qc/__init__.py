@@ -1,2 +1,10 @@
-from gwaspy.preimp_qc import preimp_qc
-__all__ = ['preimp_qc']
+import importlib
+
+__all__ = ['preimp_qc', 'association']
+
+
+def __getattr__(name):
+    # submodules are imported on first use, so the Hail-free local engine (local_qc) can be imported without Hail
+    if name in __all__:
+        return importlib.import_module(f'{__name__}.{name}')
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -3,9 +3,40 @@ __author__ = 'Lindo Nkambule & Zan Koenig'
 import hail as hl
 from gwaspy.preimp_qc.aggregators import agg_call_rate, variant_qc_aggregator, impute_sex_aggregator
 from gwaspy.preimp_qc.plots import plt_hist, fstat_plot, qqplot, manhattan_plot
+from gwaspy.preimp_qc.association import AssociationScan
+from gwaspy.preimp_qc.family_index import FamilyIndex
 import pandas as pd
 
 
+def annotate_sex_chromosomes(mt: hl.MatrixTable, chromx: str = 'chrX', chromy: str = 'chrY',
+                             chrommt: str = 'chrMT') -> hl.MatrixTable:
+    """
+    Row field sex_chrom with the chromosome class of every variant. Which samples enter the call rate and HWE
+    aggregations of a variant only depends on its chromosome (row) and the sample sex (column), so the masks below are
+    built from sex_chrom and is_female inside the aggregations instead of being stored as entry fields
+    """
+    return mt.annotate_rows(sex_chrom=hl.struct(x=mt.locus.contig == chromx, y=mt.locus.contig == chromy,
+                                                mt=mt.locus.contig == chrommt))
+
+
+def geno_y_excluded(mt: hl.MatrixTable) -> hl.BooleanExpression:
+    # we need to compute call rate for chr1-23 and chrY separately since females have no chrY
+    return mt.sex_chrom.y == False
+
+
+def geno_y_only(mt: hl.MatrixTable) -> hl.BooleanExpression:
+    return mt.sex_chrom.y & (mt.is_female == False)
+
+
+def hwe_aut(mt: hl.MatrixTable) -> hl.BooleanExpression:
+    # for HWE, markers in: (1) autosomes - include males+females; (2) chrX - include ONLY females; (3) exclude chrY
+    return (mt.sex_chrom.x | mt.sex_chrom.y | mt.sex_chrom.mt) == False
+
+
+def hwe_sex(mt: hl.MatrixTable) -> hl.BooleanExpression:
+    return mt.sex_chrom.x & mt.is_female
+
+
 class BaseFilter:
     def __init__(self):
         pass
@@ -32,10 +63,10 @@ class pre_geno(BaseFilter):
 
         mt = mt.annotate_rows(**{
             'pre_geno_noy': hl.struct(
-                filters=hl.agg.filter(((pre_filter == False) & (mt.geno_y_excluded == True)),
+                filters=hl.agg.filter(((pre_filter == False) & geno_y_excluded(mt)),
                                       variant_qc_aggregator(mt).call_rate) < self._pre_geno_cr),
             'pre_geno_y': hl.struct(
-                filters=hl.agg.filter(((pre_filter == False) & (mt.geno_y_only == True)),
+                filters=hl.agg.filter(((pre_filter == False) & geno_y_only(mt)),
                                       variant_qc_aggregator(mt).call_rate) < self._pre_geno_cr)})
 
         mt = mt.annotate_rows(**{
@@ -71,7 +102,7 @@ class id_call_rate(BaseFilter):
         return mt
 
     def plot(self, mt):
-        global id_call_rate_plts
+        id_call_rate_plts = []
         mt = mt.annotate_cols(
             mind_cr_pre=hl.agg.filter(mt.pre_geno.filters == False, agg_call_rate(mt)))
 
@@ -242,10 +273,10 @@ class geno(BaseFilter):
 
         mt = mt.annotate_rows(**{
             'geno_noy': hl.struct(
-                filters=hl.agg.filter(((pre_filter == False) & (mt.geno_y_excluded == True)),
+                filters=hl.agg.filter(((pre_filter == False) & geno_y_excluded(mt)),
                                       variant_qc_aggregator(mt).call_rate) < self._geno),
             'geno_y': hl.struct(
-                filters=hl.agg.filter(((pre_filter == False) & (mt.geno_y_only == True)),
+                filters=hl.agg.filter(((pre_filter == False) & geno_y_only(mt)),
                                       variant_qc_aggregator(mt).call_rate) < self._geno)})
 
         mt = mt.annotate_rows(**{
@@ -257,7 +288,7 @@ class geno(BaseFilter):
         return mt
 
     def plot(self, mt):
-        global var_call_rate_plts
+        var_call_rate_plts = []
         mt = mt.annotate_rows(
             var_cr_pre=hl.agg.filter(mt.pre_geno.filters == False, agg_call_rate(mt)))
 
@@ -378,13 +409,13 @@ class hwe_con(BaseFilter):
                 filters=((row_filter == False) &
                          (hl.agg.filter(((pre_filter == False) &
                                          (mt.is_case == False) &
-                                         (mt.hwe_aut == True)),
+                                         hwe_aut(mt)),
                                         variant_qc_aggregator(mt).p_value_hwe) < self._hwe_th_co))),
             'hwe_con_sex': hl.struct(
                 filters=((row_filter == False) &
                          (hl.agg.filter(((pre_filter == False) &
                                          (mt.is_case == False) &
-                                         (mt.hwe_sex == True)),
+                                         hwe_sex(mt)),
                                         variant_qc_aggregator(mt).p_value_hwe) < self._hwe_th_co)))
         })
 
@@ -419,13 +450,13 @@ class hwe_cas(BaseFilter):
                 filters=((row_filter == False) &
                          (hl.agg.filter(((pre_filter == False) &
                                          (mt.is_case == True) &
-                                         (mt.hwe_aut == True)),
+                                         hwe_aut(mt)),
                                         variant_qc_aggregator(mt).p_value_hwe) < self._hwe_th_ca))),
             'hwe_cas_sex': hl.struct(
                 filters=((row_filter == False) &
                          (hl.agg.filter(((pre_filter == False) &
                                          (mt.is_case == True) &
-                                         (mt.hwe_sex == True)),
+                                         hwe_sex(mt)),
                                         variant_qc_aggregator(mt).p_value_hwe) < self._hwe_th_ca)))
         })
 
@@ -459,12 +490,12 @@ class hwe_all(BaseFilter):
             'hwe_all_aut': hl.struct(
                 filters=((row_filter == False) &
                          (hl.agg.filter(((pre_filter == False) &
-                                         (mt.hwe_aut == True)),
+                                         hwe_aut(mt)),
                                         variant_qc_aggregator(mt).p_value_hwe) < self._hwe_th_all))),
             'hwe_all_sex': hl.struct(
                 filters=((row_filter == False) &
                          (hl.agg.filter(((pre_filter == False) &
-                                         (mt.hwe_sex == True)),
+                                         hwe_sex(mt)),
                                         variant_qc_aggregator(mt).p_value_hwe) < self._hwe_th_all)))
         })
 
@@ -480,15 +511,96 @@ class hwe_all(BaseFilter):
         pass
 
 
+class mendel_id(BaseFilter):
+    def __init__(self, family_index: FamilyIndex, mendel_thresh: float = 0.05, pre_row_filter: str = None):
+        super().__init__()
+        self._index = family_index
+        self._mendel_thresh = mendel_thresh
+        self._row_filter = pre_row_filter
+
+    def filter(self, mt):
+        # Mendel errors implicating each trio member, per variant passing the row filter
+        errors_ht = self._index.sample_errors(mt, row_filter=self._row_filter)
+        errors = errors_ht[mt.col_key]
+
+        mt = mt.annotate_cols(id_mendel_errors=errors.n_errors, id_mendel_rate=errors.n_errors / errors.n_variants)
+        mt = mt.annotate_cols(**{
+            'mendel_id': hl.struct(
+                filters=hl.coalesce(mt.id_mendel_rate > self._mendel_thresh, False))})
+
+        return mt
+
+    def plot(self, mt):
+        pass
+
+
+class mendel_var(BaseFilter):
+    def __init__(self, family_index: FamilyIndex, mendel_thresh: float = 0.1, pre_row_filter: str = None,
+                 pre_col_filter: str = None):
+        super().__init__()
+        self._index = family_index
+        self._mendel_thresh = mendel_thresh
+        self._row_filter = pre_row_filter
+        self._col_filter = pre_col_filter
+
+    def filter(self, mt):
+        # trios with a member failing the column filter are not counted
+        mendel_ht = self._index.mendel_table(mt, row_filter=self._row_filter, col_filter=self._col_filter)
+        mendel = mendel_ht[mt.row_key]
+
+        mt = mt.annotate_rows(var_mendel_errors=mendel.n_errors, var_mendel_rate=mendel.n_errors / mendel.n_trios)
+        mt = mt.annotate_rows(**{
+            'mendel_var': hl.struct(
+                filters=hl.coalesce(mt.var_mendel_rate > self._mendel_thresh, False))})
+
+        return mt
+
+    def plot(self, mt):
+        pass
+
+
+class hwe_trio(BaseFilter):
+    def __init__(self, family_index: FamilyIndex, hwe_th_trio: float = 1e-06, pre_col_filter: str = None,
+                 pre_row_filter: str = None):
+        super().__init__()
+        self._index = family_index
+        self._hwe_th_trio = hwe_th_trio
+        self._col_filter = pre_col_filter
+        self._row_filter = pre_row_filter
+
+    def filter(self, mt):
+        row_filter = mt[self._row_filter].filters if self._row_filter else mt.exclude_row
+        col_filter = mt[self._col_filter].filters if self._col_filter else mt.exclude_col
+
+        # HWE over the founders only, as the genotypes of a child are not independent of its parents'
+        pre_filter = (row_filter | col_filter) | (self._index.founders(mt) == False)
+
+        mt = mt.annotate_rows(**{
+            'hwe_trio': hl.struct(
+                filters=((row_filter == False) &
+                         hl.coalesce((hl.agg.filter((pre_filter == False) & hwe_aut(mt),
+                                                    variant_qc_aggregator(mt).p_value_hwe) < self._hwe_th_trio) |
+                                     (hl.agg.filter((pre_filter == False) & hwe_sex(mt),
+                                                    variant_qc_aggregator(mt).p_value_hwe) < self._hwe_th_trio),
+                                     False)))
+        })
+
+        return mt
+
+    def plot(self, mt):
+        pass
+
+
 class manhattan(BaseFilter):
-    def __init__(self, qqtitle, mantitle):
+    def __init__(self, qqtitle, mantitle, scan: AssociationScan = None):
         super().__init__()
         self._qqtitle = qqtitle
         self._mantitle = mantitle
+        self._scan = scan if scan else AssociationScan()
 
     def filter(self, mt):
-        gwas = hl.linear_regression_rows(y=mt.is_case, x=mt.GT.n_alt_alleles(), covariates=[1.0])
-        n_sig_variants = gwas.filter(gwas.p_value < 5E-8).count()
+        gwas = self._scan.scan(mt)
+        n_sig_variants = AssociationScan.summary(gwas)['n_sig_variants']
 
         return gwas, n_sig_variants
 
@@ -0,0 +1,268 @@
+__author__ = 'Lindo Nkambule'
+
+import argparse
+import hashlib
+import hail as hl
+from typing import Dict, List, Optional, Tuple
+from gwaspy.utils.stages import StageCache
+
+
+def sample_set_key(mt: hl.MatrixTable) -> str:
+    """Hash of the sample IDs of mt, used to key the cached association statistics"""
+    samples = sorted(str(s) for s in mt.aggregate_cols(hl.agg.collect(mt.col_key[0])))
+
+    return hashlib.sha1('\n'.join(samples).encode()).hexdigest()[:16]
+
+
+class AssociationScan:
+    """
+    Linear regression of is_case on the genotype dosage (with an intercept, as in manhattan.filter) computed from
+    per-variant sufficient statistics. Missing genotypes are mean-imputed, as hl.linear_regression_rows does, which
+    only needs the sums over the called samples.
+
+    Post-QC samples and variants are a subset of the pre-QC ones, so the post-QC statistics are the pre-QC ones minus
+    the statistics of the removed samples (a downdate that only aggregates over those samples), restricted to the
+    post-QC variants. The pre-QC statistics are cached by sample set, so reruns with other thresholds reuse them.
+    With exact=True, both scans are recomputed with hl.linear_regression_rows.
+    """
+    def __init__(self, cache: StageCache = None, upstream: str = None, exact: bool = False):
+        self._cache = cache
+        self._upstream = upstream
+        self._exact = exact
+        # pre-QC sufficient statistics and sample sums of the last run, e.g. for the report call rates
+        self.pre_stats = None
+        self.pre_samples = None
+
+    @staticmethod
+    def _y(mt: hl.MatrixTable) -> hl.Float64Expression:
+        return hl.float64(mt.is_case)
+
+    def sufficient_stats(self, mt: hl.MatrixTable) -> hl.Table:
+        """Per-variant sums over the called samples with a phenotype"""
+        y = self._y(mt)
+        x = hl.float64(mt.GT.n_alt_alleles())
+        mt = mt.select_rows(stats=hl.agg.filter(hl.is_defined(y) & hl.is_defined(x), hl.struct(
+            n_called=hl.agg.count(),
+            sum_x=hl.agg.sum(x),
+            sum_xx=hl.agg.sum(x * x),
+            sum_xy=hl.agg.sum(x * y),
+            sum_y_called=hl.agg.sum(y))))
+        ht = mt.rows()
+
+        return ht.select(**ht.stats)
+
+    def sample_stats(self, mt: hl.MatrixTable) -> hl.Struct:
+        y = self._y(mt)
+        return mt.aggregate_cols(hl.agg.filter(hl.is_defined(y), hl.struct(n=hl.agg.count(), sum_y=hl.agg.sum(y),
+                                                                           sum_yy=hl.agg.sum(y * y))))
+
+    @staticmethod
+    def regression(ht: hl.Table, samples: hl.Struct) -> hl.Table:
+        """beta, standard_error, t_stat and p_value from the sufficient statistics"""
+        n = hl.float64(samples.n)
+        mean_x = ht.sum_x / ht.n_called
+        # missing genotypes are imputed with the mean of the called ones
+        s_x = n * mean_x
+        s_xx = ht.sum_xx + (n - ht.n_called) * mean_x * mean_x
+        s_xy = ht.sum_xy + mean_x * (samples.sum_y - ht.sum_y_called)
+        sxx = s_xx - s_x * s_x / n
+        sxy = s_xy - s_x * samples.sum_y / n
+        syy = samples.sum_yy - samples.sum_y * samples.sum_y / n
+        beta = sxy / sxx
+        df = samples.n - 2
+        standard_error = hl.sqrt((syy - beta * sxy) / df / sxx)
+        t_stat = beta / standard_error
+
+        return ht.select(n=samples.n, sum_x=s_x, y_transpose_x=s_xy, beta=beta, standard_error=standard_error,
+                         t_stat=t_stat, p_value=2 * hl.pT(-hl.abs(t_stat), df))
+
+    def _pre_stats(self, mt: hl.MatrixTable) -> hl.Table:
+        # the pre-QC statistics are used for both scans, so they are written once either way
+        if self._cache is None:
+            return self.sufficient_stats(mt).checkpoint(hl.utils.new_temp_file('assoc_stats', 'ht'))
+        key = self._cache.key('assoc_stats', upstream=self._upstream, samples=sample_set_key(mt))
+        ht, _ = self._cache.table('assoc_stats', key, lambda: self.sufficient_stats(mt))
+
+        return ht
+
+    def scan(self, mt: hl.MatrixTable) -> hl.Table:
+        if self._exact:
+            return hl.linear_regression_rows(y=mt.is_case, x=mt.GT.n_alt_alleles(), covariates=[1.0])
+
+        return self.regression(self._pre_stats(mt), self.sample_stats(mt))
+
+    def run(self, mt_pre: hl.MatrixTable, mt_post: hl.MatrixTable) -> Tuple[hl.Table, hl.Table]:
+        """
+        :param mt_pre: MatrixTable before QC
+        :param mt_post: mt_pre with the samples and variants that failed QC removed
+        :return: pre- and post-QC association results
+        """
+        if self._exact:
+            return self.scan(mt_pre), self.scan(mt_post)
+
+        pre_ht = self._pre_stats(mt_pre)
+        pre_samples = self.sample_stats(mt_pre)
+        gwas_pre = self.regression(pre_ht, pre_samples)
+        self.pre_stats, self.pre_samples = pre_ht, pre_samples
+
+        removed = mt_pre.filter_cols(hl.is_missing(mt_post.cols()[mt_pre.col_key]))
+
+        removed_ht = self.sufficient_stats(removed)
+        post_ht = pre_ht.semi_join(mt_post.rows())
+        removed_stats = removed_ht[post_ht.key]
+        post_ht = post_ht.select(**{field: post_ht[field] - removed_stats[field] for field in
+                                    ['n_called', 'sum_x', 'sum_xx', 'sum_xy', 'sum_y_called']})
+
+        removed_samples = self.sample_stats(removed)
+        post_samples = hl.Struct(**{field: pre_samples[field] - removed_samples[field] for field in pre_samples})
+        gwas_pos = self.regression(post_ht, post_samples)
+
+        return gwas_pre, gwas_pos
+
+    @staticmethod
+    def summary(ht: hl.Table) -> Dict[str, Optional[float]]:
+        """Number of genome-wide significant variants and lambda GC, in one aggregation"""
+        p_value = hl.or_missing(~hl.is_nan(ht.p_value), ht.p_value)
+        results = ht.aggregate(hl.struct(
+            n_sig_variants=hl.agg.count_where(p_value < 5E-8),
+            median_chisq=hl.agg.filter(hl.is_defined(p_value), hl.agg.approx_median(hl.qchisqtail(p_value, 1)))))
+
+        # without any defined p-value, e.g. when every sample is a case, there is no lambda GC
+        lambda_gc = None if results.median_chisq is None else \
+            round(results.median_chisq / hl.eval(hl.qchisqtail(0.5, 1)), 3)
+
+        return {'n_sig_variants': results.n_sig_variants, 'lambda_gc': lambda_gc}
+
+
+def import_pcs(pcs_file: str, n_pcs: int = 10) -> hl.Table:
+    """PC1..PC{n_pcs} from a gwaspy pca scores file (a TSV with an s column)"""
+    ht = hl.import_table(pcs_file, key='s', impute=True)
+
+    return ht.select(*[f'PC{i}' for i in range(1, n_pcs + 1)])
+
+
+class BatchedAssociation:
+    """
+    Logistic regression (Wald, likelihood ratio, score or Firth test) of several binary phenotypes over one or more
+    covariate sets. All phenotypes of a covariate set are fitted in a single hl.logistic_regression_rows call, so the
+    genotypes are read once per covariate set rather than once per trait. With more than one covariate set, the
+    dosages are first checkpointed in a compact MatrixTable, so the later calls do not decode the input again.
+
+    Samples missing any of the phenotypes or covariates are left out of the scan. The top PCs from a gwaspy pca scores
+    file are added to every covariate set.
+    """
+    def __init__(self, test: str = 'wald', phenotypes: List[str] = None, covariate_sets: Dict[str, List[str]] = None,
+                 pcs_file: str = None, n_pcs: int = 10, tmp_dir: str = None):
+        if test not in ['wald', 'lrt', 'score', 'firth']:
+            raise ValueError(f'Unknown logistic regression test {test}. Options: wald, lrt, score, firth')
+        self._test = test
+        self._phenotypes = phenotypes if phenotypes else ['is_case']
+        self._covariate_sets = covariate_sets if covariate_sets else {'base': []}
+        self._pcs_file = pcs_file
+        self._n_pcs = n_pcs
+        self._tmp_dir = tmp_dir
+
+    def _covariates(self, mt: hl.MatrixTable, covariates: List[str]) -> list:
+        names = covariates + ([f'PC{i}' for i in range(1, self._n_pcs + 1)] if self._pcs_file else [])
+
+        return [1.0] + [hl.float64(mt[name]) for name in names]
+
+    def scan_all(self, mt: hl.MatrixTable) -> Dict[str, hl.Table]:
+        """
+        :return: a Table per covariate set, with one struct (beta, standard_error, z_stat/chi_sq_stat, p_value, fit)
+        per phenotype
+        """
+        if self._pcs_file:
+            pcs = import_pcs(self._pcs_file, self._n_pcs)
+            mt = mt.annotate_cols(**pcs[mt.col_key])
+
+        if len(self._covariate_sets) > 1:
+            fields = set(self._phenotypes) | {name for names in self._covariate_sets.values() for name in names}
+            fields |= {f'PC{i}' for i in range(1, self._n_pcs + 1)} if self._pcs_file else set()
+            mt = mt.select_entries(x=hl.float64(mt.GT.n_alt_alleles())).select_rows().select_cols(*sorted(fields))
+            path = (f'{self._tmp_dir}/association_dosages.mt' if self._tmp_dir else
+                    hl.utils.new_temp_file('association_dosages', 'mt'))
+            mt = mt.checkpoint(path, overwrite=True)
+            x = mt.x
+        else:
+            x = hl.float64(mt.GT.n_alt_alleles())
+
+        results = {}
+        for name, covariates in self._covariate_sets.items():
+            ht = hl.logistic_regression_rows(test=self._test, y=[hl.float64(mt[pheno]) for pheno in self._phenotypes],
+                                             x=x, covariates=self._covariates(mt, covariates))
+            results[name] = ht.select(**{pheno: ht.logistic_regression[i]
+                                         for i, pheno in enumerate(self._phenotypes)})
+
+        return results
+
+    def scan(self, mt: hl.MatrixTable) -> hl.Table:
+        """Results of the first phenotype and covariate set"""
+        ht = self.scan_all(mt)[next(iter(self._covariate_sets))]
+
+        return ht.select(**ht[self._phenotypes[0]])
+
+    def run(self, mt_pre: hl.MatrixTable, mt_post: hl.MatrixTable) -> Tuple[hl.Table, hl.Table]:
+        """Pre- and post-QC results of the first phenotype and covariate set, for the report QQ/Manhattan plots"""
+        return self.scan(mt_pre), self.scan(mt_post)
+
+
+def association(input_type: str = None, dirname: str = None, basename: str = None, annotations_file: str = None,
+                pheno_file: str = None, phenotypes: List[str] = None, covariate_sets: Dict[str, List[str]] = None,
+                test: str = 'wald', pcs_file: str = None, n_pcs: int = 10, out_dir: str = None,
+                reference: str = 'GRCh38'):
+    from gwaspy.utils.read_file import read_infile
+
+    output_directory = out_dir if out_dir else dirname
+
+    hl.init(default_reference=reference)
+
+    mt = read_infile(input_type=input_type, dirname=dirname, basename=basename, annotations=annotations_file,
+                     annotations_cache=StageCache(f'{output_directory}GWASpy/Association/cache'))
+    if pheno_file:
+        phenos = hl.import_table(pheno_file, key='s', impute=True)
+        mt = mt.annotate_cols(**phenos[mt.col_key])
+
+    engine = BatchedAssociation(test=test, phenotypes=phenotypes, covariate_sets=covariate_sets, pcs_file=pcs_file,
+                                n_pcs=n_pcs, tmp_dir=f'{output_directory}GWASpy/Association/tmp')
+    for name, ht in engine.scan_all(mt).items():
+        out_file = f'{output_directory}GWASpy/Association/{basename}.{test}.{name}.tsv.bgz'
+        print(f'\nExporting {name} covariate set results to {out_file}')
+        ht.flatten().export(out_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Batched logistic regression of one or more phenotypes')
+    parser.add_argument('--dirname', type=str, required=True)
+    parser.add_argument('--basename', type=str, required=True)
+    parser.add_argument('--input-type', type=str, required=True, choices=['vcf', 'plink', 'bgen', 'hail'])
+    parser.add_argument('--annotations', type=str)
+    parser.add_argument('--pheno-file', type=str, default=None,
+                        help="TSV with an s column and the phenotypes/covariates as other columns")
+    parser.add_argument('--phenotypes', type=str, default='is_case',
+                        help="comma-separated binary phenotypes, all fitted in one pass")
+    parser.add_argument('--covariates', type=str, action='append', default=None,
+                        help="comma-separated covariates. Repeat for more covariate sets, e.g. --covariates age "
+                             "--covariates age,batch")
+    parser.add_argument('--test', type=str, default='wald', choices=['wald', 'lrt', 'score', 'firth'])
+    parser.add_argument('--pcs-file', type=str, default=None,
+                        help="PC scores file from gwaspy pca, whose top PCs are added to every covariate set")
+    parser.add_argument('--n-pcs', type=int, default=10)
+    parser.add_argument('--out-dir', type=str, default=None)
+    parser.add_argument('--reference', type=str, default='GRCh38')
+
+    arg = parser.parse_args()
+
+    covariate_sets = {'base': []}
+    if arg.covariates:
+        covariate_sets = {f'covariates{i + 1}': [c for c in covariates.split(',') if c]
+                          for i, covariates in enumerate(arg.covariates)}
+
+    association(input_type=arg.input_type, dirname=arg.dirname, basename=arg.basename,
+                annotations_file=arg.annotations, pheno_file=arg.pheno_file,
+                phenotypes=[p for p in arg.phenotypes.split(',') if p], covariate_sets=covariate_sets, test=arg.test,
+                pcs_file=arg.pcs_file, n_pcs=arg.n_pcs, out_dir=arg.out_dir, reference=arg.reference)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+__author__ = 'Lindo Nkambule'
+
+import argparse
+import json
+import time
+import traceback
+import hail as hl
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+from gwaspy.preimp_qc.preimp_qc import preimp_qc
+from gwaspy.utils.timing import log_to_stdout
+
+# manifest column: (preimp_qc argument, type). Column names are the preimp_qc CLI options, with - as _
+MANIFEST_COLUMNS = {
+    'dirname': ('dirname', str), 'basename': ('basename', str), 'input_type': ('input_type', str),
+    'annotations': ('annotations_file', str), 'export_type': ('export_type', str), 'out_dir': ('out_dir', str),
+    'engine': ('engine', str), 'assoc_test': ('assoc_test', str), 'pcs_file': ('pcs_file', str),
+    'n_pcs': ('n_pcs', int), 'pre_geno': ('pre_geno_thresh', float), 'mind': ('mind_thresh', float),
+    'fhet_aut': ('fhet_aut', float), 'fstat_x': ('fstat_x', float), 'fstat_y': ('fstat_y', float),
+    'geno': ('geno_thresh', float), 'midi': ('cr_diff_thresh', float), 'maf': ('maf_thresh', float),
+    'hwe_th_con': ('hwe_th_con_thresh', float), 'hwe_th_cas': ('hwe_th_cas_thresh', float),
+    'hwe_th_all': ('hwe_th_all_thresh', float), 'report_format': ('report_format', str),
+    'pedigree': ('pedigree', str), 'mendel_id': ('mendel_id_thresh', float), 'mendel_var': ('mendel_var_thresh', float),
+    'hwe_th_trio': ('hwe_th_trio_thresh', float)
+}
+
+
+def read_manifest(manifest: str) -> List[Dict[str, Any]]:
+    """
+    One cohort per row of a tab-separated manifest, with a cohort name (default: basename), dirname, basename,
+    input_type and optionally any column of MANIFEST_COLUMNS. Empty cells take the preimp_qc default
+    :return: the name and preimp_qc arguments of every cohort
+    """
+    with hl.hadoop_open(manifest, 'r') as f:
+        df = pd.read_csv(f, sep='\t', dtype=str, keep_default_na=False)
+
+    unknown = sorted(set(df.columns) - set(MANIFEST_COLUMNS) - {'cohort'})
+    if unknown:
+        raise ValueError(f'Unknown columns in manifest {manifest}: {unknown}. Expected cohort or one of '
+                         f'{sorted(MANIFEST_COLUMNS)}')
+    missing = [column for column in ['dirname', 'basename', 'input_type'] if column not in df.columns]
+    if missing:
+        raise ValueError(f'Required columns are missing from manifest {manifest}: {missing}')
+
+    cohorts = []
+    for _, row in df.iterrows():
+        kwargs = {MANIFEST_COLUMNS[column][0]: MANIFEST_COLUMNS[column][1](value.strip())
+                  for column, value in row.items() if (column != 'cohort') & (value.strip() != '')}
+        # as with the preimp_qc CLI, the local engine exports PLINK by default
+        if kwargs.get('engine') == 'local':
+            kwargs.setdefault('export_type', 'plink')
+        name = row['cohort'].strip() if 'cohort' in row and row['cohort'].strip() else kwargs['basename']
+        cohorts.append({'cohort': name, 'kwargs': kwargs})
+
+    names = [cohort['cohort'] for cohort in cohorts]
+    duplicated = sorted({name for name in names if names.count(name) > 1})
+    if duplicated:
+        raise ValueError(f'Duplicate cohort names in manifest {manifest}: {duplicated}')
+
+    return cohorts
+
+
+class BatchQC:
+    """
+    Runs preimp_qc on every cohort of a manifest in one Hail session, with at most `workers` cohorts at a time. The
+    reference genome and the stage cache are shared by all cohorts. A cohort that fails is recorded and does not stop
+    the others. Every finished cohort writes a status file under status_dir, and a rerun skips the cohorts that
+    finished with the same arguments
+    """
+    def __init__(self, out_dir: str, reference: str = 'GRCh38', workers: int = 2, cache_dir: str = None,
+                 report: bool = True):
+        self._out_dir = out_dir
+        self._reference = reference
+        self._workers = workers
+        self._cache_dir = cache_dir if cache_dir else f'{out_dir}GWASpy/Preimp_QC/cache'
+        self._report = report
+        self.status_dir = f'{out_dir}GWASpy/Preimp_QC/batch'
+
+    def _status_file(self, cohort: str) -> str:
+        return f'{self.status_dir}/{cohort}.json'
+
+    def _finished(self, cohort: Dict[str, Any]) -> Dict[str, Any]:
+        """The status of a cohort that already finished with the same arguments, otherwise None"""
+        status_file = self._status_file(cohort['cohort'])
+        if not hl.hadoop_exists(status_file):
+            return None
+        with hl.hadoop_open(status_file, 'r') as f:
+            status = json.load(f)
+
+        return status if (status['status'] == 'done') & (status['kwargs'] == cohort['kwargs']) else None
+
+    def run_cohort(self, cohort: Dict[str, Any]) -> Dict[str, Any]:
+        """QC one cohort, catching its errors so they are reported in the summary instead of stopping the batch"""
+        status = self._finished(cohort)
+        if status:
+            print(f'\nSkipping cohort {cohort["cohort"]}: already QC\'ed')
+            return {**status, 'status': 'skipped'}
+
+        start = time.perf_counter()
+        kwargs = {'out_dir': self._out_dir, 'report': self._report, **cohort['kwargs']}
+        try:
+            run = preimp_qc(reference=self._reference, cache_dir=self._cache_dir, **kwargs)
+            man_table = run.man_table()
+            status = {'status': 'done', 'data_type': run.data_type,
+                      'n_samples_pre': run.pre_qc_counts['n_samples'],
+                      'n_samples_post': run.pos_qc_counts['n_samples'],
+                      'n_variants_pre': run.pre_qc_counts['n_variants'],
+                      'n_variants_post': run.pos_qc_counts['n_variants'],
+                      'lambda_gc_pre': man_table[2] if man_table else None,
+                      'lambda_gc_post': man_table[3] if man_table else None,
+                      'metrics': run.metrics_dir, 'error': None}
+        except Exception as e:
+            traceback.print_exc()
+            status = {'status': 'failed', 'error': f'{type(e).__name__}: {e}'}
+        status.update(cohort=cohort['cohort'], kwargs=cohort['kwargs'],
+                      seconds=round(time.perf_counter() - start, 1))
+
+        # failed cohorts are recorded too, but only a done status is skipped on the next run
+        with hl.hadoop_open(self._status_file(cohort['cohort']), 'w') as f:
+            json.dump(status, f, default=str)
+
+        return status
+
+    def run(self, cohorts: List[Dict[str, Any]]) -> pd.DataFrame:
+        """
+        :return: the cross-cohort summary, also written to OUT_DIR/GWASpy/Preimp_QC/preimp_qc_batch.summary.tsv
+        """
+        outputs = [(cohort['kwargs'].get('out_dir', self._out_dir), cohort['kwargs']['basename'])
+                   for cohort in cohorts]
+        clashes = sorted({f'{out_dir}{basename}' for out_dir, basename in outputs
+                          if outputs.count((out_dir, basename)) > 1})
+        if clashes:
+            raise ValueError(f'Cohorts with the same basename need different out_dir values, their outputs would '
+                             f'overwrite each other: {clashes}')
+
+        hl.init(default_reference=self._reference, idempotent=True)
+        print(f'\nRunning QC on {len(cohorts)} cohorts, {self._workers} at a time')
+
+        with ThreadPoolExecutor(max_workers=self._workers) as pool:
+            statuses = list(pool.map(self.run_cohort, cohorts))
+
+        columns = ['cohort', 'status', 'data_type', 'n_samples_pre', 'n_samples_post', 'n_variants_pre',
+                   'n_variants_post', 'lambda_gc_pre', 'lambda_gc_post', 'seconds', 'metrics', 'error']
+        summary = pd.DataFrame(statuses).reindex(columns=columns)
+        summary_file = f'{self._out_dir}GWASpy/Preimp_QC/preimp_qc_batch.summary.tsv'
+        with hl.hadoop_open(summary_file, 'w') as f:
+            summary.to_csv(f, sep='\t', index=False)
+
+        print(summary.to_string(index=False))
+        print(f'\nBatch summary written to {summary_file}')
+        n_failed = int((summary['status'] == 'failed').sum())
+        if n_failed:
+            print(f'{n_failed} of {len(cohorts)} cohorts failed. Rerun the batch to retry them')
+
+        return summary
+
+
+def preimp_qc_batch(manifest: str = None, out_dir: str = None, reference: str = 'GRCh38', workers: int = 2,
+                    cache_dir: str = None, report: bool = True) -> pd.DataFrame:
+    return BatchQC(out_dir=out_dir, reference=reference, workers=workers, cache_dir=cache_dir,
+                   report=report).run(read_manifest(manifest))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='preimp_qc_batch')
+    parser.add_argument('--manifest', type=str, required=True,
+                        help="tab-separated file with one cohort per row: dirname, basename, input_type and, "
+                             "optionally, cohort and per-cohort preimp_qc options (e.g. mind, geno, annotations)")
+    parser.add_argument('--out-dir', type=str, required=True)
+    parser.add_argument('--reference', type=str, default='GRCh38')
+    parser.add_argument('--workers', type=int, default=2, help="number of cohorts QC'ed at the same time")
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help="stage cache shared by all cohorts. Default is OUT_DIR/GWASpy/Preimp_QC/cache")
+    parser.add_argument('--report', action='store_false')
+
+    arg = parser.parse_args()
+    log_to_stdout()
+
+    preimp_qc_batch(manifest=arg.manifest, out_dir=arg.out_dir, reference=arg.reference, workers=arg.workers,
+                    cache_dir=arg.cache_dir, report=arg.report)
+
+
+if __name__ == '__main__':
+    main()
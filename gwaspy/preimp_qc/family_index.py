@@ -0,0 +1,133 @@
+__author__ = 'Lindo Nkambule'
+
+import hail as hl
+from typing import Dict
+from gwaspy.utils.stages import StageCache
+
+# Mendel error codes of hl.mendel_error_code that implicate the father and the mother. Every error implicates the child
+DAD_CODES = [1, 2, 3, 6, 11, 12]
+MOM_CODES = [1, 2, 4, 7, 9, 10]
+
+
+class FamilyIndex:
+    """
+    Complete trios of a pedigree (PLINK .fam format) as column indices of a MatrixTable. With the entries of a variant
+    localized as an array, the genotypes of every trio are read by index in one pass over the data, instead of joining
+    the MatrixTable to itself for each family member as hl.trio_matrix does. The Mendel errors of a variant are
+    stored sparsely, as (trio, code) pairs, so the per-variant table stays small with tens of thousands of trios.
+
+    Filters using the index must get a MatrixTable with the same columns, in the same order, as the one it was built
+    from.
+    """
+    def __init__(self, pedigree_file: str, mt: hl.MatrixTable, cache: StageCache = None, upstream: str = None):
+        self._cache = cache
+        self._upstream = upstream
+        self._tables = {}
+
+        cols = mt.add_col_index('col_idx').cols()
+        cols = cols.select('col_idx', *[field for field in ['is_female'] if field in cols.row]).collect()
+        index = {col.s: col for col in cols}
+
+        pedigree = hl.Pedigree.read(pedigree_file)
+        self.trios = [trio for trio in pedigree.complete_trios()
+                      if (trio.s in index) & (trio.pat_id in index) & (trio.mat_id in index)]
+        self.n_trios = len(self.trios)
+        self.kids = {trio.s for trio in self.trios}
+        # the sex of the child in the data, as used by the sex checks, unless it is missing
+        self._members = [{'trio': i, 'kid': index[trio.s].col_idx, 'dad': index[trio.pat_id].col_idx,
+                          'mom': index[trio.mat_id].col_idx,
+                          'is_female': trio.is_female if getattr(index[trio.s], 'is_female', None) is None
+                          else index[trio.s].is_female}
+                         for i, trio in enumerate(self.trios)]
+        print(f'\n{self.n_trios} complete trios of pedigree {pedigree_file} are in the data')
+
+    def founders(self, mt: hl.MatrixTable) -> hl.BooleanExpression:
+        """Samples that are not the child of a complete trio"""
+        return hl.literal(self.kids, hl.tset(hl.tstr)).contains(mt.s) == False
+
+    def _passing(self, mt: hl.MatrixTable, col_filter: str = None) -> Dict[str, bool]:
+        if not col_filter:
+            return {}
+        return {col.s: col.fail for col in mt.cols().select(fail=mt[col_filter].filters).collect()}
+
+    def mendel_table(self, mt: hl.MatrixTable, row_filter: str = None, col_filter: str = None) -> hl.Table:
+        """
+        One pass over the genotypes of the trios. Per variant passing row_filter:
+            mendel_errors   (trio, code) of every trio with a Mendel error
+            n_errors        number of trios with an error, of the trios whose members all pass col_filter
+            n_trios         number of those trios where the three members have a called genotype
+        """
+        if (row_filter, col_filter) in self._tables:
+            return self._tables[(row_filter, col_filter)]
+
+        fails = self._passing(mt, col_filter)
+        members = [{**member, 'passing': not any(fails.get(getattr(self.trios[member['trio']], field), False)
+                                                 for field in ['s', 'pat_id', 'mat_id'])}
+                   for member in self._members]
+        trio_type = hl.tstruct(trio=hl.tint32, kid=hl.tint32, dad=hl.tint32, mom=hl.tint32, is_female=hl.tbool,
+                               passing=hl.tbool)
+
+        def compute():
+            mt_gt = mt.select_rows(*([row_filter] if row_filter else [])).select_cols().select_entries('GT')
+            ht = mt_gt.localize_entries('entries', 'cols')
+            trios = hl.literal(members, hl.tarray(trio_type))
+
+            def complete(trio):
+                return (hl.is_defined(ht.entries[trio.kid].GT) & hl.is_defined(ht.entries[trio.dad].GT) &
+                        hl.is_defined(ht.entries[trio.mom].GT))
+
+            errors = trios.map(lambda trio: hl.struct(
+                trio=trio.trio,
+                passing=trio.passing,
+                code=hl.or_missing(complete(trio),
+                                   hl.mendel_error_code(ht.locus, trio.is_female, ht.entries[trio.dad].GT,
+                                                        ht.entries[trio.mom].GT, ht.entries[trio.kid].GT))))
+            errors = errors.filter(lambda error: hl.is_defined(error.code))
+            stats = hl.struct(
+                mendel_errors=errors.map(lambda error: error.select('trio', 'code')),
+                n_errors=hl.len(errors.filter(lambda error: error.passing)),
+                n_trios=hl.len(trios.filter(lambda trio: trio.passing & complete(trio))))
+            if row_filter:
+                stats = hl.or_missing(ht[row_filter].filters == False, stats)
+
+            ht = ht.select(stats=stats)
+            return ht.select(**ht.stats)
+
+        if self._cache:
+            key = self._cache.key('mendel', upstream=self._upstream, row_filter=row_filter, col_filter=col_filter,
+                                  trios=[[member['kid'], member['dad'], member['mom']] for member in members
+                                         if member['passing']])
+            ht, _ = self._cache.table('mendel', key, compute)
+        else:
+            ht = compute().checkpoint(hl.utils.new_temp_file('mendel', 'ht'))
+
+        self._tables[(row_filter, col_filter)] = ht
+
+        return ht
+
+    def sample_errors(self, mt: hl.MatrixTable, row_filter: str = None) -> hl.Table:
+        """
+        Number of Mendel errors implicating every trio member (the child in all errors, the parents as in PLINK),
+        over the variants passing row_filter, and the number of those variants
+        """
+        # the errors do not depend on the column filter, so any pass with the same row filter is reused
+        tables = [ht for (row, _), ht in self._tables.items() if row == row_filter]
+        ht = tables[0] if tables else self.mendel_table(mt, row_filter=row_filter)
+
+        dad_codes, mom_codes = hl.literal(set(DAD_CODES)), hl.literal(set(MOM_CODES))
+        counts = ht.aggregate(hl.struct(
+            n_variants=hl.agg.count_where(hl.is_defined(ht.n_trios)),
+            trios=hl.agg.explode(lambda error: hl.agg.group_by(error.trio, hl.struct(
+                kid=hl.agg.count(),
+                dad=hl.agg.count_where(dad_codes.contains(error.code)),
+                mom=hl.agg.count_where(mom_codes.contains(error.code)))), ht.mendel_errors)))
+
+        errors = {}
+        for i, trio in enumerate(self.trios):
+            trio_counts = counts.trios.get(i)
+            for field, role in [('s', 'kid'), ('pat_id', 'dad'), ('mat_id', 'mom')]:
+                s = getattr(trio, field)
+                errors[s] = errors.get(s, 0) + (trio_counts[role] if trio_counts else 0)
+
+        rows = [hl.Struct(s=s, n_errors=n_errors, n_variants=counts.n_variants) for s, n_errors in errors.items()]
+        return hl.Table.parallelize(rows, hl.tstruct(s=hl.tstr, n_errors=hl.tint64, n_variants=hl.tint64), key='s')
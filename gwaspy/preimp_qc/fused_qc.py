@@ -0,0 +1,238 @@
+__author__ = 'Lindo Nkambule'
+
+import hail as hl
+from gwaspy.preimp_qc.aggregators import impute_sex_aggregator
+from gwaspy.preimp_qc.profiling import QCProfiler
+from gwaspy.utils.stages import StageCache
+
+
+class FusedQC:
+    """
+    Computes every per-variant and per-sample statistic needed by the preimp_qc filters in the fewest possible scans
+    over the entries. Filters only depend on each other through the row/column sets they aggregate over, so the
+    statistics are planned into three passes:
+
+        1. variants, all samples: call rate (pre_geno) and allele frequencies (used by the F-stats)
+        2. samples, variants passing pre_geno: call rate (mind), autosomal F-stat (fstat) and chrX F-stat
+           (sex_violations, sex_warnings)
+        3. variants, samples passing mind/fstat/sex_violations: call rate (geno), call rate in cases/controls
+           (cr_diff), allele counts (monomorphic_var) and genotype counts for the HWE tests (hwe_*)
+
+    The statistics of each pass are written to disk and the filters are derived from these (small) tables and
+    annotated onto the MatrixTable, using the same `hl.struct(filters=...)` fields the chained BaseFilter classes
+    produce. With a StageCache, each pass is keyed by its upstream pass and the thresholds it depends on, so passes
+    are only recomputed when their inputs change.
+    """
+    def __init__(self, pre_geno_cr: float = 0.95, mind: float = 0.98, fhet_thresh: float = 0.2,
+                 fstat_x: float = 0.5, fstat_y: float = 0.5, warn_fstat_x: float = 0.8, warn_fstat_y: float = 0.2,
+                 geno_thresh: float = 0.98, cr_diff_thresh: float = 0.02, hwe_filters: dict = None,
+                 chromx: str = 'chrX', chromy: str = 'chrY', chrommt: str = 'chrMT', tmp_dir: str = None,
+                 cache: StageCache = None, profiler: QCProfiler = None):
+        self._pre_geno_cr = pre_geno_cr
+        self._mind = mind
+        self._fhet_th = fhet_thresh
+        self._fstat_x = fstat_x
+        self._fstat_y = fstat_y
+        self._warn_fstat_x = warn_fstat_x
+        self._warn_fstat_y = warn_fstat_y
+        self._geno = geno_thresh
+        self._cr_thresh = cr_diff_thresh
+        # e.g. {'hwe_con': 1e-06, 'hwe_cas': 1e-10}
+        self._hwe_filters = hwe_filters if hwe_filters else {}
+        self._chromx = chromx
+        self._chromy = chromy
+        self._chrommt = chrommt
+        self._tmp_dir = tmp_dir
+        self._cache = cache
+        self._profiler = profiler if profiler else QCProfiler(enabled=False)
+        self.n_passes = 0
+        self.key = None
+        # statistics behind the sample and variant filters of the last run, for the QC metrics store
+        self.sample_metrics = None
+        self.variant_metrics = None
+
+    def _stage(self, name: str, compute, scan: bool = True, **params) -> hl.Table:
+        """Checkpoint the Table returned by compute(). scan is True for stages that read the entries"""
+        with self._profiler.stage(name):
+            if self._cache is None:
+                computed = True
+                path = f'{self._tmp_dir}/{name}.ht' if self._tmp_dir else hl.utils.new_temp_file(name, 'ht')
+                ht = compute().checkpoint(path, overwrite=True)
+            else:
+                self.key = self._cache.key(name, upstream=self.key, **params)
+                ht, computed = self._cache.table(name, self.key, compute)
+
+        if computed and scan:
+            self.n_passes += 1
+            print(f'\nFused QC pass {self.n_passes}: computed {name} statistics')
+
+        return ht
+
+    def _geno_samples(self, mt: hl.MatrixTable) -> hl.BooleanExpression:
+        # we need to compute call rate for chr1-23 and chrY separately since females have no chrY
+        return hl.if_else(mt.locus.contig == self._chromy, mt.is_female == False, True)
+
+    def _hwe_samples(self, mt: hl.MatrixTable) -> hl.BooleanExpression:
+        # for HWE, markers in: (1) autosomes - include males+females; (2) chrX - include ONLY females; (3) exclude chrY
+        return (hl.case()
+                .when(mt.locus.contig == self._chromx, mt.is_female == True)
+                .when((mt.locus.contig == self._chromy) | (mt.locus.contig == self._chrommt), False)
+                .default(True))
+
+    def _hwe_group(self, mt: hl.MatrixTable, name: str) -> hl.BooleanExpression:
+        if name == 'hwe_cas':
+            return mt.is_case == True
+        if name == 'hwe_con':
+            return mt.is_case == False
+        return hl.bool(True)
+
+    def variant_pre_stats(self, mt: hl.MatrixTable) -> hl.Table:
+        """Pass 1: per-variant statistics over all samples"""
+        def compute():
+            mt_stats = mt.select_rows(
+                pre_geno_n=hl.agg.count_where(self._geno_samples(mt)),
+                pre_geno_n_called=hl.agg.count_where(self._geno_samples(mt) & hl.is_defined(mt.GT)),
+                AF=hl.agg.call_stats(mt.GT, mt.alleles).AF)
+            return mt_stats.rows()
+
+        return self._stage('variant_pre', compute)
+
+    def variant_pre_filters(self, ht: hl.Table) -> hl.Table:
+        pre_geno_cr = ht.pre_geno_n_called / ht.pre_geno_n
+
+        return ht.select(
+            pre_geno=hl.struct(filters=hl.coalesce(pre_geno_cr < self._pre_geno_cr, False)),
+            variant_qc=hl.struct(AF=ht.AF),
+            aaf=ht.AF[1])
+
+    def sample_stats(self, mt: hl.MatrixTable) -> hl.Table:
+        """Pass 2: per-sample statistics over variants passing pre_geno"""
+        def compute():
+            mt_stats = mt.select_cols(stats=hl.agg.filter(
+                mt.pre_geno.filters == False,
+                hl.struct(call_rate=hl.agg.fraction(hl.is_defined(mt.GT)),
+                          fhet=hl.agg.inbreeding(mt.GT, hl.min(mt.variant_qc.AF)).f_stat,
+                          sex_fstat=impute_sex_aggregator(mt.GT, mt.aaf).f_stat)))
+            ht = mt_stats.cols()
+            return ht.select(**ht.stats)
+
+        return self._stage('sample', compute, pre_geno_cr=self._pre_geno_cr)
+
+    def sample_filters(self, ht: hl.Table, mt: hl.MatrixTable) -> hl.Table:
+        ht = ht.annotate(**mt.cols()[ht.key].select(*[f for f in ['is_female', 'is_case'] if f in mt.col]))
+
+        def sex_check(fstat_x, fstat_y):
+            return hl.coalesce(hl.if_else(ht.is_female, ht.sex_fstat > fstat_y, ht.sex_fstat < fstat_x), False)
+
+        ht = ht.annotate(
+            mind=hl.struct(filters=hl.coalesce(ht.call_rate < self._mind, False)),
+            fstat=hl.struct(filters=hl.coalesce((ht.fhet < -self._fhet_th) | (ht.fhet > self._fhet_th), False)),
+            sex_violations=hl.struct(filters=sex_check(self._fstat_x, self._fstat_y)),
+            # sex warnings are for ambiguous genotypes (F_male < 0.8, F_female > 0.2) and undefined phenotypes
+            sex_ambiguous=hl.struct(filters=sex_check(self._warn_fstat_x, self._warn_fstat_y)))
+
+        if 'is_case' in ht.row:
+            sex_warnings = ht.sex_ambiguous.filters | hl.is_missing(ht.is_case)
+        else:
+            sex_warnings = ht.sex_ambiguous.filters
+
+        ht = ht.annotate(sex_warnings=hl.struct(filters=sex_warnings),
+                         id_pass=hl.struct(filters=ht.mind.filters | ht.fstat.filters | ht.sex_violations.filters))
+
+        return ht.select('mind', 'fstat', 'sex_violations', 'sex_ambiguous', 'sex_warnings', 'id_pass')
+
+    def variant_stats_expr(self, mt: hl.MatrixTable) -> hl.StructExpression:
+        """Per-variant aggregation of pass 3, over the samples it is filtered to"""
+        called = hl.is_defined(mt.GT)
+        stats = {
+            'geno_n': hl.agg.count_where(self._geno_samples(mt)),
+            'geno_n_called': hl.agg.count_where(self._geno_samples(mt) & called),
+            'AC': hl.agg.call_stats(mt.GT, mt.alleles).AC
+        }
+
+        if 'is_case' in mt.col:
+            stats['case_n'] = hl.agg.count_where(mt.is_case == True)
+            stats['case_n_called'] = hl.agg.count_where((mt.is_case == True) & called)
+            stats['control_n'] = hl.agg.count_where(mt.is_case == False)
+            stats['control_n_called'] = hl.agg.count_where((mt.is_case == False) & called)
+
+        # genotype counts are kept for every group, so changing a HWE threshold does not need a new pass
+        for name in ['hwe_cas', 'hwe_con', 'hwe_all']:
+            if (name != 'hwe_all') & ('is_case' not in mt.col):
+                continue
+            stats[f'{name}_counts'] = hl.agg.filter(
+                self._hwe_group(mt, name) & self._hwe_samples(mt),
+                hl.struct(n_hom_ref=hl.agg.count_where(mt.GT.is_hom_ref()),
+                          n_het=hl.agg.count_where(mt.GT.is_het()),
+                          n_hom_var=hl.agg.count_where(mt.GT.is_hom_var())))
+
+        return hl.struct(**stats)
+
+    def variant_stats(self, mt: hl.MatrixTable) -> hl.Table:
+        """Pass 3: per-variant statistics over samples passing the sample filters"""
+        def compute():
+            mt_stats = mt.select_rows(stats=hl.agg.filter(mt.id_pass.filters == False, self.variant_stats_expr(mt)))
+            ht = mt_stats.rows()
+            return ht.select(**ht.stats)
+
+        return self._stage('variant', compute, mind=self._mind, fhet_thresh=self._fhet_th, fstat_x=self._fstat_x,
+                           fstat_y=self._fstat_y, warn_fstat_x=self._warn_fstat_x, warn_fstat_y=self._warn_fstat_y)
+
+    def variant_filters(self, ht: hl.Table, pre_ht: hl.Table) -> hl.Table:
+        def compute():
+            pre_geno = pre_ht[ht.key].pre_geno.filters
+            geno_cr = ht.geno_n_called / ht.geno_n
+
+            filters = ht.select(
+                geno=hl.struct(filters=(pre_geno == False) & hl.coalesce(geno_cr < self._geno, False)),
+                monomorphic_var=hl.struct(filters=hl.min(ht.AC) == 0))
+
+            if 'case_n' in ht.row:
+                diff = hl.abs(ht.control_n_called / ht.control_n - ht.case_n_called / ht.case_n)
+                filters = filters.annotate(cr_diff=hl.struct(
+                    filters=(filters.geno.filters == False) & (pre_geno == False) &
+                    hl.coalesce(diff > self._cr_thresh, False)))
+            return filters
+
+        return self._stage('variant_filters', compute, scan=False, geno_thresh=self._geno,
+                           cr_diff_thresh=self._cr_thresh)
+
+    def hwe(self, ht: hl.Table, filters_ht: hl.Table) -> hl.Table:
+        def compute():
+            geno = filters_ht[ht.key].geno.filters
+            hwe_ht = ht.select()
+            for name, thresh in self._hwe_filters.items():
+                counts = ht[f'{name}_counts']
+                p_value = hl.or_missing(hl.len(ht.alleles) == 2,
+                                        hl.hardy_weinberg_test(counts.n_hom_ref, counts.n_het,
+                                                               counts.n_hom_var).p_value)
+                hwe_ht = hwe_ht.annotate(**{name: hl.struct(filters=(geno == False) &
+                                                            hl.coalesce(p_value < thresh, False))})
+            return hwe_ht
+
+        return self._stage('hwe', compute, scan=False, hwe_filters=self._hwe_filters)
+
+    def run(self, mt: hl.MatrixTable, upstream: str = None) -> hl.MatrixTable:
+        """
+        :param mt: MatrixTable to QC, with is_female (and is_case) column fields
+        :param upstream: cache key of the stage that produced mt, e.g. the read stage
+        :return: mt annotated with the filter structs. After this call, key holds the cache key of the last stage
+        """
+        self.n_passes = 0
+        self.key = upstream
+
+        pre_ht = self.variant_pre_filters(self.variant_pre_stats(mt))
+        mt = mt.annotate_rows(**pre_ht[mt.row_key])
+
+        sample_ht = self.sample_stats(mt)
+        mt = mt.annotate_cols(**self.sample_filters(sample_ht, mt)[mt.col_key])
+
+        stats_ht = self.variant_stats(mt)
+        filters_ht = self.variant_filters(stats_ht, pre_ht)
+        hwe_ht = self.hwe(stats_ht, filters_ht)
+        mt = mt.annotate_rows(**filters_ht[mt.row_key], **hwe_ht[mt.row_key])
+        self.sample_metrics, self.variant_metrics = sample_ht, stats_ht
+
+        print(f'\nFused QC engine made {self.n_passes} passes over the data')
+
+        return mt
@@ -0,0 +1,161 @@
+__author__ = 'Lindo Nkambule'
+
+import json
+import hail as hl
+from typing import Any, Dict
+from gwaspy.preimp_qc.fused_qc import FusedQC
+
+
+def add_stats(x: hl.Expression, y: hl.Expression, alleles: hl.ArrayExpression) -> hl.Expression:
+    """
+    Sum of two per-variant statistics (counts, allele count arrays or structs of them). A statistic missing on one
+    side, i.e. a variant that was not in one of the batches, counts as zero
+    """
+    if isinstance(x.dtype, hl.tstruct):
+        return hl.struct(**{field: add_stats(x[field], y[field], alleles) for field in x.dtype})
+    if isinstance(x.dtype, hl.tarray):
+        zeros = hl.range(hl.len(alleles)).map(lambda _: hl.literal(0, x.dtype.element_type))
+        return hl.coalesce(x, zeros) + hl.coalesce(y, zeros)
+
+    return hl.coalesce(x, hl.literal(0, x.dtype)) + hl.coalesce(y, hl.literal(0, x.dtype))
+
+
+class IncrementalQC(FusedQC):
+    """
+    preimp_qc of a new batch of samples appended to a cohort that was QC'ed batch by batch. The store directory keeps
+    the additive per-variant statistics of the fused QC passes over every batch so far, and the number of samples in
+    every group the denominators are taken over:
+
+        variant_pre_{k}.ht   pass 1 over all samples: called genotypes (pre_geno) and allele counts (AC, AN)
+        variant_{k}.ht       pass 3 over samples passing the sample filters: called genotypes (geno, cr_diff),
+                             allele counts (monomorphic_var) and genotype counts by case status for the HWE tests
+        samples_{k}.ht       sample filters of batch k
+        filters_{k}.ht       variant filters of the cohort after batch k, to apply to the earlier batches
+        state.json           batches so far, their sample counts and the current version k
+
+    Only the new batch is scanned: its statistics are added to the stored ones and the variant filters (pre_geno,
+    geno, cr_diff, monomorphic_var, hwe_*) are derived from the merged statistics. The sample filters only run on the
+    new samples, over the cohort pre_geno and allele frequencies. Samples of earlier batches keep the sample filters
+    they were given when their batch was added.
+    """
+    def __init__(self, store: str, **kwargs):
+        super().__init__(**kwargs)
+        self._store = store.rstrip('/')
+        self.state = self._read_state()
+        self.version = len(self.state['batches'])
+        self._tmp_dir = f'{self._store}/batch_{self.version}'
+
+    def _read_state(self) -> Dict[str, Any]:
+        state_file = f'{self._store}/state.json'
+        if not hl.hadoop_exists(state_file):
+            return {'batches': [], 'counts': {'pre': {'all': 0, 'male': 0},
+                                              'post': {'all': 0, 'male': 0, 'case': 0, 'control': 0}}}
+        with hl.hadoop_open(state_file, 'r') as f:
+            return json.load(f)
+
+    def _previous(self, name: str) -> hl.Table:
+        return hl.read_table(f'{self._store}/{name}_{self.version - 1}.ht') if self.version > 0 else None
+
+    def _merge(self, name: str, batch_ht: hl.Table) -> hl.Table:
+        """Add the statistics of the new batch to the stored ones, and write them as the next version"""
+        previous = self._previous(name)
+        if previous is None:
+            merged = batch_ht
+        else:
+            ht = previous.select(_previous=previous.row_value).join(batch_ht.select(_batch=batch_ht.row_value),
+                                                                    how='outer')
+            merged = ht.select(**add_stats(ht._previous, ht._batch, ht.alleles))
+
+        return merged.checkpoint(f'{self._store}/{name}_{self.version}.ht', overwrite=True)
+
+    def _check_samples(self, mt: hl.MatrixTable):
+        """Samples already QC'ed in an earlier batch would be counted twice"""
+        if self.version == 0:
+            return
+        previous = hl.Table.union(*[hl.read_table(f'{self._store}/samples_{k}.ht').select()
+                                    for k in range(self.version)])
+        duplicated = mt.aggregate_cols(hl.agg.filter(hl.is_defined(previous[mt.col_key]), hl.agg.collect(mt.s)))
+        if duplicated:
+            raise ValueError(f'{len(duplicated)} samples were already QC\'ed in an earlier batch, e.g. '
+                             f'{duplicated[:10]}')
+
+    def variant_pre_stats(self, mt: hl.MatrixTable) -> hl.Table:
+        """Pass 1 over the new batch, with allele counts instead of frequencies so they can be added up"""
+        def compute():
+            call_stats = hl.agg.call_stats(mt.GT, mt.alleles)
+            mt_stats = mt.select_rows(
+                pre_geno_n_called=hl.agg.count_where(self._geno_samples(mt) & hl.is_defined(mt.GT)),
+                AC=call_stats.AC,
+                AN=call_stats.AN)
+            return mt_stats.rows()
+
+        return self._stage('variant_pre', compute)
+
+    def variant_stats(self, mt: hl.MatrixTable) -> hl.Table:
+        """Pass 3 over the new batch, keeping only the statistics that can be added up"""
+        def compute():
+            stats = self.variant_stats_expr(mt)
+            stats = stats.drop(*[field for field in stats.dtype if field.endswith('_n')])
+            mt_stats = mt.select_rows(stats=hl.agg.filter(mt.id_pass.filters == False, stats))
+            ht = mt_stats.rows()
+            return ht.select(**ht.stats)
+
+        return self._stage('variant', compute)
+
+    def run(self, mt: hl.MatrixTable, batch: str = None, upstream: str = None) -> hl.MatrixTable:
+        """
+        :param mt: new batch, with is_female (and is_case) column fields
+        :param batch: name of the batch, recorded in the store
+        :return: mt annotated with the filter structs, with the variant filters of the whole cohort
+        """
+        self.n_passes = 0
+        self._check_samples(mt)
+        counts = self.state['counts']
+        print(f'\nIncremental QC: adding batch {self.version} ({batch}) to {counts["pre"]["all"]} samples in '
+              f'{self.version} earlier batches')
+
+        batch_pre = mt.aggregate_cols(hl.struct(all=hl.agg.count(), male=hl.agg.count_where(mt.is_female == False)))
+        pre = {group: counts['pre'][group] + batch_pre[group] for group in ['all', 'male']}
+
+        pre_ht = self._merge('variant_pre', self.variant_pre_stats(mt))
+        pre_ht = pre_ht.annotate(
+            pre_geno_n=hl.if_else(pre_ht.locus.contig == self._chromy, pre['male'], pre['all']),
+            AF=hl.or_missing(pre_ht.AN > 0, pre_ht.AC.map(lambda ac: ac / pre_ht.AN)))
+        pre_ht = self.variant_pre_filters(pre_ht)
+        mt = mt.annotate_rows(**pre_ht[mt.row_key])
+
+        sample_ht = self.sample_stats(mt)
+        samples_ht = self.sample_filters(sample_ht, mt)
+        samples_ht = samples_ht.checkpoint(f'{self._store}/samples_{self.version}.ht', overwrite=True)
+        mt = mt.annotate_cols(**samples_ht[mt.col_key])
+
+        passing = mt.id_pass.filters == False
+        batch_post = mt.aggregate_cols(hl.agg.filter(passing, hl.struct(
+            all=hl.agg.count(), male=hl.agg.count_where(mt.is_female == False),
+            case=hl.agg.count_where(mt.is_case == True) if 'is_case' in mt.col else hl.int64(0),
+            control=hl.agg.count_where(mt.is_case == False) if 'is_case' in mt.col else hl.int64(0))))
+        post = {group: counts['post'][group] + batch_post[group] for group in ['all', 'male', 'case', 'control']}
+
+        stats_ht = self._merge('variant', self.variant_stats(mt))
+        n = {'geno_n': hl.if_else(stats_ht.locus.contig == self._chromy, post['male'], post['all'])}
+        if 'case_n_called' in stats_ht.row:
+            n.update(case_n=hl.int64(post['case']), control_n=hl.int64(post['control']))
+        stats_ht = stats_ht.annotate(**n)
+
+        filters_ht = self.variant_filters(stats_ht, pre_ht)
+        hwe_ht = self.hwe(stats_ht, filters_ht)
+        cohort_filters = pre_ht.select('pre_geno').annotate(**filters_ht[pre_ht.key], **hwe_ht[pre_ht.key])
+        cohort_filters.write(f'{self._store}/filters_{self.version}.ht', overwrite=True)
+        mt = mt.annotate_rows(**filters_ht[mt.row_key], **hwe_ht[mt.row_key])
+        self.sample_metrics, self.variant_metrics = sample_ht, stats_ht
+
+        # the state is only updated once every table of the new version is written, so a failed run can be repeated
+        self.state['batches'].append({'batch': batch, 'n_samples': batch_pre['all']})
+        self.state['counts'] = {'pre': pre, 'post': post}
+        with hl.hadoop_open(f'{self._store}/state.json', 'w') as f:
+            json.dump(self.state, f)
+
+        print(f'\nIncremental QC made {self.n_passes} passes over the new batch. Cohort variant filters: '
+              f'{self._store}/filters_{self.version}.ht')
+
+        return mt
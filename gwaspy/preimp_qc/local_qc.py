@@ -0,0 +1,327 @@
+__author__ = 'Lindo Nkambule'
+
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from gwaspy.utils.plink_bed import HOM_REF, HOM_VAR, MISSING, PlinkBed, decode, genotype_counts, hwe_p_values, \
+    pack_mask
+
+X_CONTIGS = {'GRCh37': 'X', 'GRCh38': 'chrX'}
+# chrX pseudoautosomal regions (start inclusive, end exclusive), excluded from the sex check F-stat
+X_PAR = {
+    'GRCh37': [(60001, 2699521), (154931044, 155260561)],
+    'GRCh38': [(10001, 2781480), (155701383, 156030896)]
+}
+
+
+def linear_regression_p(n_called, sum_x, sum_xx, sum_xy, sum_y_called, n: int, sum_y: int) -> np.ndarray:
+    """
+    p-values of the linear regression of a binary phenotype on the dosage, with an intercept and mean-imputed missing
+    genotypes, from the same sufficient statistics as AssociationScan.regression
+    """
+    from scipy import stats
+
+    sum_yy = sum_y
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_x = sum_x / n_called
+        s_x = n * mean_x
+        s_xx = sum_xx + (n - n_called) * mean_x * mean_x
+        s_xy = sum_xy + mean_x * (sum_y - sum_y_called)
+        sxx = s_xx - s_x * s_x / n
+        sxy = s_xy - s_x * sum_y / n
+        syy = sum_yy - sum_y * sum_y / n
+        beta = sxy / sxx
+        df = n - 2
+        t_stat = beta / np.sqrt((syy - beta * sxy) / df / sxx)
+
+    return 2 * stats.t.sf(np.abs(t_stat), df)
+
+
+def qq_local(p_values: np.ndarray, n_tail: int = 10000,
+             k: int = 1000) -> Tuple[np.ndarray, np.ndarray, Optional[float]]:
+    """
+    Expected and observed -log10(p) of the n_tail smallest p-values and k quantiles of the rest, and lambda GC (None
+    without any finite p-value, as plots.qq_lambda_gc)
+    """
+    from scipy import stats
+
+    p = np.sort(p_values[np.isfinite(p_values)])
+    if len(p) == 0:
+        return np.array([]), np.array([]), None
+    index = np.unique(np.concatenate([np.arange(min(n_tail, len(p))), np.linspace(0, len(p) - 1, k).astype(int)]))
+    lambda_gc = round(float(np.median(stats.chi2.isf(p, 1)) / stats.chi2.isf(0.5, 1)), 3)
+
+    return -np.log10((index + 1) / len(p)), -np.log10(p[index]), lambda_gc
+
+
+class LocalQC:
+    """
+    The preimp_qc statistics and filters of FusedQC, computed with NumPy on a memory-mapped PLINK .bed instead of
+    Hail, for datasets small enough that starting Spark costs more than the QC itself. The same three passes are
+    made, over chunks of variants in a thread pool:
+
+        1. per-variant genotype counts over all samples, by counting bits of the packed genotypes against packed
+           sample masks
+        2. per-sample call rate and F-stats over the variants passing pre_geno, from the decoded chunk
+        3. per-variant genotype counts over the samples passing mind/fstat/sex_violations, again by bit counting
+
+    Filters use the same definitions as FusedQC (and so variant_qc_aggregator, agg_call_rate and
+    impute_sex_aggregator), and are returned as boolean columns named after the filters.
+    """
+    def __init__(self, pre_geno_cr: float = 0.95, mind: float = 0.98, fhet_thresh: float = 0.2,
+                 fstat_x: float = 0.5, fstat_y: float = 0.5, warn_fstat_x: float = 0.8, warn_fstat_y: float = 0.2,
+                 geno_thresh: float = 0.98, cr_diff_thresh: float = 0.02, hwe_filters: dict = None,
+                 chromx: str = 'chrX', chromy: str = 'chrY', chrommt: str = 'chrMT', workers: int = None,
+                 chunk_mb: int = 64):
+        self._pre_geno_cr = pre_geno_cr
+        self._mind = mind
+        self._fhet_th = fhet_thresh
+        self._fstat_x = fstat_x
+        self._fstat_y = fstat_y
+        self._warn_fstat_x = warn_fstat_x
+        self._warn_fstat_y = warn_fstat_y
+        self._geno = geno_thresh
+        self._cr_thresh = cr_diff_thresh
+        # e.g. {'hwe_con': 1e-06, 'hwe_cas': 1e-10}
+        self._hwe_filters = hwe_filters if hwe_filters else {}
+        self._chromx = chromx
+        self._chromy = chromy
+        self._chrommt = chrommt
+        self._workers = workers if workers else os.cpu_count()
+        self._chunk_mb = chunk_mb
+
+    def _map(self, bed: PlinkBed, func: Callable[[slice], Any], bytes_per_variant: int) -> List[Any]:
+        """func over consecutive chunks of variants (about chunk_mb of working memory each), in the thread pool"""
+        chunk = max(16, self._chunk_mb * 2 ** 20 // max(bytes_per_variant, 1))
+        chunks = [slice(start, min(start + chunk, bed.n_variants)) for start in range(0, bed.n_variants, chunk)]
+        with ThreadPoolExecutor(max_workers=self._workers) as pool:
+            return list(pool.map(func, chunks))
+
+    def _counts(self, bed: PlinkBed, samples: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        """Genotype counts (n_variants x [n_hom_ref, n_het, n_hom_var]) over every sample set"""
+        masks = {name: pack_mask(np.asarray(selected, dtype=bool)) for name, selected in samples.items()}
+        chunks = self._map(bed, lambda rows: genotype_counts(bed.packed[rows], masks), 4 * bed.n_bytes)
+
+        return {name: np.concatenate([chunk[name] for chunk in chunks]) if chunks else np.zeros((0, 3), dtype=np.int64)
+                for name in samples}
+
+    @staticmethod
+    def _sample_sets(bed: PlinkBed, keep: np.ndarray) -> Dict[str, np.ndarray]:
+        # missing sex/phenotype is in neither group
+        female = bed.is_female.to_numpy(dtype=bool, na_value=False)
+        male = (~bed.is_female).to_numpy(dtype=bool, na_value=False)
+        case = bed.is_case.to_numpy(dtype=bool, na_value=False)
+        control = (~bed.is_case).to_numpy(dtype=bool, na_value=False)
+
+        return {'all': keep, 'male': keep & male, 'female': keep & female, 'case': keep & case,
+                'control': keep & control, 'case_female': keep & case & female,
+                'control_female': keep & control & female}
+
+    def variant_pre_stats(self, bed: PlinkBed) -> Dict[str, Any]:
+        """Pass 1: per-variant genotype counts over all samples"""
+        sets = self._sample_sets(bed, np.ones(bed.n_samples, dtype=bool))
+        sets = {name: sets[name] for name in ['all', 'male', 'case', 'control']}
+
+        return {'counts': self._counts(bed, sets), 'sizes': {name: int(s.sum()) for name, s in sets.items()}}
+
+    def variant_pre_filters(self, bed: PlinkBed, stats: Dict[str, Any]) -> pd.DataFrame:
+        counts, sizes = stats['counts'], stats['sizes']
+        # we need to compute call rate for chr1-23 and chrY separately since females have no chrY
+        is_y = bed.contig == self._chromy
+        n = np.where(is_y, sizes['male'], sizes['all'])
+        n_called = np.where(is_y, counts['male'].sum(axis=1), counts['all'].sum(axis=1))
+        all_called = counts['all'].sum(axis=1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pre_geno_cr = n_called / n
+            aaf = (counts['all'][:, 1] + 2 * counts['all'][:, 2]) / (2 * all_called)
+
+        return pd.DataFrame({'pre_geno': pre_geno_cr < self._pre_geno_cr, 'aaf': aaf})
+
+    def sample_stats(self, bed: PlinkBed, pre: pd.DataFrame) -> pd.DataFrame:
+        """Pass 2: per-sample call rate and F-stats over variants passing pre_geno"""
+        passing = ~pre['pre_geno'].to_numpy()
+        aaf = pre['aaf'].to_numpy()
+        expected_hom = 1 - 2 * aaf * (1 - aaf)
+        # the autosomal F-stat uses min(AF) as the prior, and the sex check F-stat the non-PAR chrX variants with
+        # 0 < AF < 1, as impute_sex_aggregator
+        fhet_used = passing & np.isfinite(aaf)
+        is_x = bed.contig == X_CONTIGS.get(bed.reference, self._chromx)
+        for start, end in X_PAR.get(bed.reference, []):
+            is_x &= ~((bed.position >= start) & (bed.position < end))
+        sex_used = passing & is_x & (aaf > 0) & (aaf < 1)
+        weights = np.stack([passing, fhet_used, np.where(fhet_used, expected_hom, 0), sex_used,
+                            np.where(sex_used, expected_hom, 0)], axis=1).astype(np.float64)
+
+        def chunk_stats(rows: slice):
+            used = np.flatnonzero(weights[rows, 0] > 0) + rows.start
+            codes = decode(bed.packed[used], bed.n_samples)
+            called = (codes != MISSING).astype(np.float64)
+            hom = ((codes == HOM_REF) | (codes == HOM_VAR)).astype(np.float64)
+            return called.T @ weights[used], hom.T @ weights[used][:, [1, 3]]
+
+        chunks = self._map(bed, chunk_stats, 16 * bed.n_samples)
+        called = sum(chunk[0] for chunk in chunks) if chunks else np.zeros((bed.n_samples, 5))
+        hom = sum(chunk[1] for chunk in chunks) if chunks else np.zeros((bed.n_samples, 2))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return pd.DataFrame({
+                's': bed.fam['s'],
+                'call_rate': called[:, 0] / passing.sum(),
+                'fhet': (hom[:, 0] - called[:, 2]) / (called[:, 1] - called[:, 2]),
+                'sex_fstat': (hom[:, 1] - called[:, 4]) / (called[:, 3] - called[:, 4])})
+
+    def sample_filters(self, bed: PlinkBed, ht: pd.DataFrame) -> pd.DataFrame:
+        is_female = bed.is_female.to_numpy(dtype=bool, na_value=False)
+        has_sex = bed.is_female.notna().to_numpy()
+        fhet = ht['fhet'].to_numpy()
+        sex_fstat = ht['sex_fstat'].to_numpy()
+
+        def sex_check(fstat_x, fstat_y):
+            return has_sex & np.where(is_female, sex_fstat > fstat_y, sex_fstat < fstat_x)
+
+        filters = pd.DataFrame({
+            'mind': ht['call_rate'].to_numpy() < self._mind,
+            'fstat': (fhet < -self._fhet_th) | (fhet > self._fhet_th),
+            'sex_violations': sex_check(self._fstat_x, self._fstat_y),
+            # sex warnings are for ambiguous genotypes (F_male < 0.8, F_female > 0.2) and undefined phenotypes
+            'sex_ambiguous': sex_check(self._warn_fstat_x, self._warn_fstat_y)})
+        filters['sex_warnings'] = filters['sex_ambiguous'] | bed.is_case.isna().to_numpy()
+        filters['id_pass'] = filters['mind'] | filters['fstat'] | filters['sex_violations']
+
+        return filters
+
+    def variant_stats(self, bed: PlinkBed, samples: pd.DataFrame) -> Dict[str, Any]:
+        """Pass 3: per-variant genotype counts over samples passing the sample filters"""
+        sets = self._sample_sets(bed, ~samples['id_pass'].to_numpy())
+
+        return {'counts': self._counts(bed, sets), 'sizes': {name: int(s.sum()) for name, s in sets.items()}}
+
+    def variant_filters(self, bed: PlinkBed, stats: Dict[str, Any], pre: pd.DataFrame) -> pd.DataFrame:
+        counts, sizes = stats['counts'], stats['sizes']
+        pre_geno = pre['pre_geno'].to_numpy()
+        is_y = bed.contig == self._chromy
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            geno_cr = np.where(is_y, counts['male'].sum(axis=1) / sizes['male'],
+                               counts['all'].sum(axis=1) / sizes['all'])
+            diff = np.abs(counts['control'].sum(axis=1) / sizes['control'] -
+                          counts['case'].sum(axis=1) / sizes['case'])
+
+        geno = ~pre_geno & (geno_cr < self._geno)
+        all_counts = counts['all']
+        filters = pd.DataFrame({
+            'geno': geno,
+            'monomorphic_var': np.minimum(2 * all_counts[:, 0] + all_counts[:, 1],
+                                          2 * all_counts[:, 2] + all_counts[:, 1]) == 0,
+            'cr_diff': ~geno & ~pre_geno & (diff > self._cr_thresh)})
+
+        for name, thresh in self._hwe_filters.items():
+            filters[name] = ~geno & (self.hwe_p_values(bed, counts, name) < thresh)
+
+        return filters
+
+    def hwe_p_values(self, bed: PlinkBed, counts: Dict[str, np.ndarray], name: str) -> np.ndarray:
+        """p-values of the HWE filter name (hwe_cas, hwe_con or hwe_all) from the genotype counts of pass 3"""
+        # for HWE, markers in: (1) autosomes - include males+females; (2) chrX - include ONLY females; (3) exclude chrY
+        is_x = bed.contig == self._chromx
+        excluded = (bed.contig == self._chromy) | (bed.contig == self._chrommt)
+        group = {'hwe_cas': 'case', 'hwe_con': 'control', 'hwe_all': 'all'}[name]
+        x_group = f'{group}_female' if group != 'all' else 'female'
+        hwe_counts = np.where(is_x[:, None], counts[x_group], np.where(excluded[:, None], 0, counts[group]))
+
+        return hwe_p_values(hwe_counts[:, 0], hwe_counts[:, 1], hwe_counts[:, 2])
+
+    def run(self, bed: PlinkBed) -> Tuple[pd.DataFrame, pd.DataFrame, Dict[str, Any]]:
+        """
+        :return: a DataFrame of the variant filters (one row per .bim line), one of the sample filters and statistics
+        (one row per .fam line), and the genotype counts of passes 1 and 3, which the report association scans use
+        """
+        pre_stats = self.variant_pre_stats(bed)
+        pre = self.variant_pre_filters(bed, pre_stats)
+        print('\nLocal QC pass 1: computed variant_pre statistics')
+
+        sample_ht = self.sample_stats(bed, pre)
+        samples = pd.concat([sample_ht, self.sample_filters(bed, sample_ht)], axis=1)
+        print('Local QC pass 2: computed sample statistics')
+
+        stats = self.variant_stats(bed, samples)
+        variants = pd.concat([pre, self.variant_filters(bed, stats, pre)], axis=1)
+        print('Local QC pass 3: computed variant statistics')
+
+        return variants, samples, {'pre': pre_stats, 'post': stats}
+
+    @staticmethod
+    def _association(counts: Dict[str, np.ndarray], sizes: Dict[str, int]) -> np.ndarray:
+        """p-values of the linear regression of is_case on the dosage, from genotype counts in cases and controls"""
+        pheno = counts['case'] + counts['control']
+        return linear_regression_p(n_called=pheno.sum(axis=1), sum_x=pheno[:, 1] + 2 * pheno[:, 2],
+                                   sum_xx=pheno[:, 1] + 4 * pheno[:, 2],
+                                   sum_xy=counts['case'][:, 1] + 2 * counts['case'][:, 2],
+                                   sum_y_called=counts['case'].sum(axis=1), n=sizes['case'] + sizes['control'],
+                                   sum_y=sizes['case'])
+
+    def report_jobs(self, bed: PlinkBed, variants: pd.DataFrame, samples: pd.DataFrame, counts: Dict[str, Any],
+                    variant_keep: np.ndarray, gwaspy_dir: str, data_type: str = None, mind_thresh: float = 0.98,
+                    fstat_x: float = 0.5, fstat_y: float = 0.5,
+                    geno_thresh: float = 0.98) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """
+        The figures ReportAssets.collect would gather, as render_figure jobs
+        :return: the figures to render, and the number of significant variants and lambda GC before and after QC
+        """
+        jobs, man_results = [], {}
+        is_female = bed.is_female.to_numpy(dtype=object, na_value=None)
+        sex_fstat = samples['sex_fstat'].to_numpy()
+        jobs.append({'path': f'{gwaspy_dir}/gwaspy_fstat_fig.png', 'render': 'fstat_plot',
+                     'kwargs': {'df_female': pd.DataFrame({'filters': sex_fstat[(is_female == True) &
+                                                                                np.isfinite(sex_fstat)]}),
+                                'df_male': pd.DataFrame({'filters': sex_fstat[(is_female == False) &
+                                                                              np.isfinite(sex_fstat)]}),
+                                'f_stat_y': fstat_y, 'f_stat_x': fstat_x, 'figsize': (15, 20)}})
+
+        groups = {'Case-only': [('cas', 'Cases', 'case')], 'Control-only': [('con', 'Controls', 'control')],
+                  'Case-Control': [('con', 'Controls', 'control'), ('cas', 'Cases', 'case')],
+                  'Trio': [('cas_con', 'Cases+Controls', 'all')]}.get(data_type, [])
+        sample_sets = self._sample_sets(bed, np.ones(bed.n_samples, dtype=bool))
+        pre_counts, pre_sizes = counts['pre']['counts'], counts['pre']['sizes']
+        passing = ~variants['pre_geno'].to_numpy()
+        for suffix, title, group in groups:
+            call_rate = samples['call_rate'].to_numpy()[sample_sets[group]]
+            freq, edges = np.histogram(call_rate[np.isfinite(call_rate)], bins=50)
+            jobs.append({'path': f'{gwaspy_dir}/gwaspy_id_{suffix}_pre.png', 'render': 'hist_render',
+                         'kwargs': {'bin_edges': edges, 'bin_freq': freq, 'threshold': mind_thresh, 'title': title,
+                                    'x_label': 'Call Rate'}})
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                var_cr = pre_counts[group][passing].sum(axis=1) / pre_sizes[group]
+            var_cr = var_cr[np.isfinite(var_cr)]
+            freq, edges = np.histogram(var_cr, bins=50, range=(var_cr.min(), var_cr.max()) if len(var_cr) else (0, 1))
+            jobs.append({'path': f'{gwaspy_dir}/gwaspy_var_{suffix}_pre.png', 'render': 'hist_render',
+                         'kwargs': {'bin_edges': edges, 'bin_freq': freq, 'threshold': geno_thresh, 'title': title,
+                                    'x_label': 'Call Rate'}})
+
+        # the association scan needs cases or controls, e.g. trios without a phenotype are not scanned
+        if data_type in ['Case-only', 'Control-only', 'Case-Control']:
+            contigs = list(dict.fromkeys(bed.contig))
+            contig_index = pd.Series(range(len(contigs)), index=contigs)[bed.contig].to_numpy()
+            lengths = pd.Series(bed.position).groupby(contig_index).max()
+            for stage, label, keep in [('pre', 'Pre-QC', np.ones(bed.n_variants, dtype=bool)),
+                                       ('pos', 'Post-QC', variant_keep)]:
+                p_value = self._association(counts[stage]['counts'], counts[stage]['sizes'])[keep]
+                expected_p, observed_p, lambda_gc = qq_local(p_value)
+                man_results[f'n_sig_var_{stage}'] = int((p_value < 5E-8).sum())
+                man_results[f'lambda_gc_{stage}'] = lambda_gc
+                jobs.append({'path': f'{gwaspy_dir}/gwaspy_qq_{stage}.png', 'render': 'qq_render',
+                             'kwargs': {'expected_p': expected_p, 'observed_p': observed_p,
+                                        'title': f'{label} QQ Plot'}})
+                tested = np.isfinite(p_value)
+                jobs.append({'path': f'{gwaspy_dir}/gwaspy_man_{stage}.png', 'render': 'manhattan_render',
+                             'kwargs': {'contig': contig_index[keep][tested], 'position': bed.position[keep][tested],
+                                        'log_p': -np.log10(p_value[tested]),
+                                        'contig_lengths': [int(lengths.get(i, 1)) for i in range(len(contigs))],
+                                        'contig_names': [str(contig).replace('chr', '') for contig in contigs],
+                                        'title': f'{label} Manhattan Plot'}})
+
+        return jobs, man_results
@@ -3,20 +3,29 @@ from hail import Table
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+from typing import Optional
 
 
-def plt_hist(expression: hl.Expression, bins: int = 50, range: list = None, threshold: float = None,
-             title: str = None, x_label: str = None, y_label: str = None, log: bool = False, figsize: tuple = (12, 8)):
-    exprs = expression.collect()
-    df = pd.DataFrame({'col': exprs})
+def _aggregate(expression: hl.Expression, agg_expr: hl.Expression):
+    """Run an aggregation over the Table/MatrixTable axis expression is indexed by"""
+    source = expression._indices.source
+    if isinstance(source, Table):
+        return source.aggregate(agg_expr)
+    if expression._indices.axes == {'row'}:
+        return source.aggregate_rows(agg_expr)
+    if expression._indices.axes == {'column'}:
+        return source.aggregate_cols(agg_expr)
+
+    return source.aggregate_entries(agg_expr)
+
+
+def hist_render(bin_edges, bin_freq, range: list = None, threshold: float = None, title: str = None,
+                x_label: str = None, y_label: str = None, figsize: tuple = (12, 8)):
+    edges = np.array(bin_edges)
 
     title = f'{title}' if title else ''
     fig = plt.figure(figsize=figsize)
-    if log is True:
-        df = df[df['col'] != 0]
-        plt.hist(np.log10(df.col), edgecolor='black', density=False, bins=bins, color='tab:blue')
-    else:
-        plt.hist(df['col'], edgecolor='black', density=False, bins=bins, color='tab:blue')
+    plt.bar(edges[:-1], bin_freq, width=np.diff(edges), align='edge', edgecolor='black', color='tab:blue')
     if threshold:
         plt.axvline(x=threshold, color='red', linestyle='--')
     if range is not None:
@@ -29,6 +38,21 @@ def plt_hist(expression: hl.Expression, bins: int = 50, range: list = None, thre
     return fig
 
 
+def plt_hist(expression: hl.Expression, bins: int = 50, range: list = None, threshold: float = None,
+             title: str = None, x_label: str = None, y_label: str = None, log: bool = False, figsize: tuple = (12, 8)):
+    # binned counts are computed by Hail, so only the bin edges and counts are brought to the driver
+    if log is True:
+        expression = hl.or_missing(expression != 0, hl.log10(expression))
+    stats = _aggregate(expression, hl.agg.stats(expression))
+    start, end = (stats.min, stats.max) if stats.n > 0 else (0, 1)
+    if start == end:
+        start, end = start - 0.5, end + 0.5
+    hist = _aggregate(expression, hl.agg.hist(expression, start, end, bins))
+
+    return hist_render(hist.bin_edges, hist.bin_freq, range=range, threshold=threshold, title=title, x_label=x_label,
+                       y_label=y_label, figsize=figsize)
+
+
 def fstat_plot(df_female, df_male, f_stat_x: float = 0.4, f_stat_y: float = 0.8, figsize: tuple = (12, 8)):
     fig, axs = plt.subplots(2, figsize=figsize)
     axs[0].hist(df_female['filters'], bins=30, histtype='bar', alpha=0.8, fill=True, color='tab:blue', edgecolor="k")
@@ -49,32 +73,53 @@ def fstat_plot(df_female, df_male, f_stat_x: float = 0.4, f_stat_y: float = 0.8,
     return fig
 
 
-def qqplot(pvals, title: str = None, figsize: tuple = (10, 10)):
-    source = pvals._indices.source
-    if isinstance(source, Table):
-        ht = source.select(p_value=pvals)
-    else:
-        ht = source.select_rows(p_value=pvals).rows()
-
-    ht = ht.key_by().select('p_value').key_by('p_value').persist()
-    lambda_gc = hl.lambda_gc(ht['p_value'])
-    n = ht.count()
-    ht = ht.annotate(
-        observed_p=-hl.log10(ht['p_value']),
-        expected_p=-hl.log10((hl.scan.count() + 1) / n),
-        p_val=ht['p_value']
-    ).persist()
-
-    p_val_pd = ht.to_pandas()
-    p_val_pd = p_val_pd.dropna()
-    p_val_pd['observed_p'].values[p_val_pd['observed_p'] > 10] = 10
-    mini = min(p_val_pd['expected_p'].max(), p_val_pd['observed_p'].max())
-    maxi = max(p_val_pd['expected_p'].max(), p_val_pd['observed_p'].max())
+def qq_agg(pvals, n_tail: int = 10000, k: int = 1000) -> hl.StructExpression:
+    """
+    Aggregation behind qqplot: a quantile sketch of the p-values plus the n_tail smallest p-values kept exactly, since
+    that is where the sketch is least accurate and where the plot departs from the diagonal
+    """
+    pvals = hl.or_missing(~hl.is_nan(pvals), pvals)
+
+    return hl.agg.filter(hl.is_defined(pvals), hl.struct(
+        n=hl.agg.count(),
+        cdf=hl.agg.approx_cdf(pvals, k),
+        tail=hl.agg.take(pvals, n_tail, ordering=pvals),
+        median_chisq=hl.agg.approx_median(hl.qchisqtail(pvals, 1))))
+
+
+def qq_lambda_gc(qq) -> Optional[float]:
+    """lambda GC from the result of qq_agg, None without any defined p-value"""
+    if qq.median_chisq is None:
+        return None
+
+    return round(qq.median_chisq / hl.eval(hl.qchisqtail(0.5, 1)), 3)
+
+
+def qq_points(qq):
+    """Expected and observed -log10(p) from the result of qq_agg"""
+    n = max(qq.n, 1)
+    tail = np.array(qq.tail, dtype=float)
+    values = np.array(qq.cdf['values'], dtype=float)
+    ranks = np.array(qq.cdf['ranks'][:len(values)], dtype=float)
+    if len(tail) > 0:
+        keep = values > tail[-1]
+        values, ranks = values[keep], ranks[keep]
+
+    observed_p = -np.log10(np.concatenate([tail, values]))
+    expected_p = -np.log10((np.concatenate([np.arange(len(tail)), ranks]) + 1) / n)
+
+    return expected_p, observed_p
+
+
+def qq_render(expected_p, observed_p, title: str = None, figsize: tuple = (10, 10)):
+    observed_p = np.minimum(observed_p, 10)
+    mini = min(expected_p.max(initial=0), observed_p.max(initial=0))
+    maxi = max(expected_p.max(initial=0), observed_p.max(initial=0))
 
     title = f'{title}' if title else 'QQ Plot'
 
     fig = plt.figure(figsize=figsize)
-    plt.scatter(p_val_pd['expected_p'], p_val_pd['observed_p'], c='black', s=0.5)
+    plt.scatter(expected_p, observed_p, c='black', s=0.5)
     plt.plot((0, mini), (0, mini), 'red')
     plt.xlim([0, maxi + 0.5])
     plt.ylim([0, maxi + 0.5])
@@ -83,55 +128,67 @@ def qqplot(pvals, title: str = None, figsize: tuple = (10, 10)):
     plt.xlabel('Expected -log10(' + r'$p$' + ')', fontsize=15)
     plt.close()
 
-    return fig, round(lambda_gc, 3)
+    return fig
 
 
-def manhattan_plot(pvals, significance_threshold: float = -np.log10(5E-08), title: str = None,
-                   figsize: tuple = (17, 11), annotate_sig: bool = False):
-    source = pvals._indices.source
+def qqplot(pvals, title: str = None, figsize: tuple = (10, 10), n_tail: int = 10000, k: int = 1000):
+    """
+    QQ plot from a quantile sketch of the p-values (see qq_agg). Driver memory is bounded by n_tail + O(k) whatever
+    the number of variants
+    """
+    qq = _aggregate(pvals, qq_agg(pvals, n_tail=n_tail, k=k))
+    expected_p, observed_p = qq_points(qq)
 
-    if isinstance(source, Table):
-        ht = source.select(p_value=pvals)
-    else:
-        ht = source.select_rows(p_value=pvals).rows()
-
-    data = ht.to_pandas()
-    data = data.drop('alleles', 1)  # remove the 'allele' column
-    data['locus'] = data['locus'].astype(str)
-    data[['CHROM', 'POS']] = data.locus.str.split(":", expand=True)
-    data.columns = ['locus', 'p', 'chromosome', 'position'] # rename columns
-    data['position'] = data['position'].astype(int)
-    data['chromosome'].replace({"X": 23, "Y": 24, "MT": 25}, inplace=True)
-    data['chromosome'] = data['chromosome'].astype(int)
-    data.dropna(subset=['p'], inplace=True)  # drop NAs as log10(val) won't work
-
-    data['-log10(p_value)'] = -np.log10(data['p'])  # compute log10(pvals)
-    data['-log10(p_value)'].values[data['-log10(p_value)'] > 199] = 199
-    data['chromosome'] = data['chromosome'].astype('category')
-    data['ind'] = range(len(data))
-    data_grouped = data.groupby('chromosome')
+    return qq_render(expected_p, observed_p, title=title, figsize=figsize), qq_lambda_gc(qq)
 
-    title = f'{title}' if title else 'Manhattan Plot'
 
-    fig = plt.figure(figsize=figsize)
-    ax = fig.add_subplot()
+def manhattan_render(contig: np.ndarray, position: np.ndarray, log_p: np.ndarray, contig_lengths: list,
+                     contig_names: list = None, significance_threshold: float = -np.log10(5E-08),
+                     title: str = None, figsize: tuple = (17, 11), dpi: int = 300, annotate_sig: bool = False,
+                     thin: bool = True, marker_size: float = 10):
+    """
+    Draw a Manhattan plot from numeric arrays in one scatter call
+    :param contig: index of each point's chromosome in contig_lengths (chromosomes in plotting order)
+    :param position: 1-based position of each point on its chromosome
+    :param log_p: -log10(p_value) of each point
+    :param contig_lengths: length of every chromosome, used to lay the chromosomes out end to end
+    :param contig_names: x-axis labels. Default is 1, 2, ...
+    :param thin: keep one non-significant point per marker-radius cell of the saved figure (at dpi). Significant points
+    are always kept
+    """
+    contig = np.asarray(contig, dtype=np.int64)
+    log_p = np.minimum(np.asarray(log_p, dtype=np.float64), 199)
+    lengths = np.asarray(contig_lengths, dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    x = offsets[contig] + np.asarray(position, dtype=np.int64)
 
-    x_labels = []
-    x_labels_pos = []
+    if thin and len(x) > 0:
+        # cells are one marker radius wide: points closer than that overlap in the saved figure anyway
+        cell = max(np.sqrt(marker_size) * dpi / 72 / 2, 1)
+        width, height = int(figsize[0] * dpi / cell), int(figsize[1] * dpi / cell)
+        px = np.minimum((x * width) // max(int(lengths.sum()), 1), width - 1)
+        py = np.minimum((log_p * height / max(log_p.max(), significance_threshold, 1e-12)).astype(np.int64),
+                        height - 1)
+        pixel = px * height + np.maximum(py, 0)
+        # a later point in the same pixel overwrites an earlier one, leaving one index per occupied pixel
+        first = np.full(width * height, -1, dtype=np.int64)
+        first[pixel] = np.arange(len(x))
+        keep = np.zeros(len(x), dtype=bool)
+        keep[first[first >= 0]] = True
+        keep |= log_p >= significance_threshold
+        contig, x, log_p = contig[keep], x[keep], log_p[keep]
 
-    colors = ['tab:orange', 'tab:blue']
+    colors = np.array([[1.0, 0.498, 0.055, 1.0], [0.122, 0.467, 0.706, 1.0]])  # tab:orange, tab:blue
+    title = f'{title}' if title else 'Manhattan Plot'
 
-    for num, (name, group) in enumerate(data_grouped):
-        group.plot(kind='scatter', x='ind', y='-log10(p_value)', marker='o', color=colors[int(name) % len(colors)],
-                   ax=ax, s=10)
-        x_labels.append(name)
-        x_labels_pos.append((group['ind'].iloc[-1] - (group['ind'].iloc[-1] - group['ind'].iloc[0]) / 2))
+    fig = plt.figure(figsize=figsize)
+    ax = fig.add_subplot()
+    ax.scatter(x, log_p, c=colors[contig % 2], marker='o', s=marker_size, linewidths=0)
 
-    ax.set_xticks(x_labels_pos)
-    ax.set_xticklabels(x_labels)
-    # ax.set_xlim([0, len(data)])
+    labels = contig_names if contig_names else [str(i + 1) for i in range(len(lengths))]
+    ax.set_xticks(offsets + lengths / 2)
+    ax.set_xticklabels(labels)
     ax.margins(0.05)
-    # ax.set_ylim([0, data['-log10(p_value)'].max() + 1])
     ax.set_xlabel('Chromosome', fontsize=15)
     ax.set_ylabel('-log10(p_value)', fontsize=15)
     plt.title(title, fontsize=20)
@@ -139,11 +196,67 @@ def manhattan_plot(pvals, significance_threshold: float = -np.log10(5E-08), titl
     plt.xticks(fontsize=10, rotation=90)
     plt.yticks(fontsize=10)
     if annotate_sig is True:
-        for index, row in data.iterrows():
-            if row['-log10(p_value)'] >= significance_threshold:
-                ax.annotate('{}:{}'.format(row['chromosome'], row['position']),
-                            xy=(index, row['-log10(p_value)'] + 0.1),
-                            bbox=dict(boxstyle="round", fc="0.8"))
+        for i in np.flatnonzero(log_p >= significance_threshold):
+            ax.annotate('{}:{}'.format(labels[contig[i]], x[i] - offsets[contig[i]]), xy=(x[i], log_p[i] + 0.1),
+                        bbox=dict(boxstyle="round", fc="0.8"))
     plt.close()
 
     return fig
+
+
+def manhattan_agg(pvals, locus, bin_size: int, exact_threshold: float = 5.0,
+                  max_exact: int = 100000) -> hl.StructExpression:
+    """
+    Aggregation behind manhattan_plot: the largest -log10(p_value) of every bin_size window of each chromosome, and
+    the variants with -log10(p_value) >= exact_threshold as exact points (at most max_exact of them)
+    """
+    log_p = hl.min(-hl.log10(pvals), 199)
+
+    return hl.agg.filter(hl.is_defined(pvals) & ~hl.is_nan(pvals), hl.struct(
+        binned=hl.agg.group_by(hl.struct(contig=locus.contig, bin=locus.position // bin_size), hl.agg.max(log_p)),
+        exact=hl.agg.filter(log_p >= exact_threshold,
+                            hl.agg.take(hl.struct(contig=locus.contig, position=locus.position, log_p=log_p),
+                                        max_exact, ordering=-log_p))))
+
+
+def manhattan_bin_size(rg: hl.ReferenceGenome, n_bins: int = 5000) -> int:
+    return max(1, sum(rg.lengths.values()) // n_bins)
+
+
+def manhattan_points(man, rg: hl.ReferenceGenome, bin_size: int, exact_threshold: float = 5.0,
+                     max_exact: int = 100000) -> dict:
+    """manhattan_render arguments from the result of manhattan_agg"""
+    # order chromosomes as in the reference genome
+    present = {key.contig for key in man.binned}
+    contigs = [contig for contig in rg.contigs if contig in present]
+    contig_index = {contig: i for i, contig in enumerate(contigs)}
+    # windows above exact_threshold are already drawn by their exact points, unless max_exact truncated them
+    exact_complete = len(man.exact) < max_exact
+    points = [(contig_index[key.contig], key.bin * bin_size + bin_size // 2, value)
+              for key, value in man.binned.items() if not (exact_complete and value >= exact_threshold)]
+    points += [(contig_index[point.contig], point.position, point.log_p) for point in man.exact]
+    contig, position, log_p = (np.array(values) for values in zip(*points)) if points else ([], [], [])
+
+    return {'contig': contig, 'position': position, 'log_p': log_p,
+            'contig_lengths': [rg.lengths[contig] for contig in contigs],
+            'contig_names': [contig.replace('chr', '') for contig in contigs]}
+
+
+def manhattan_plot(pvals, significance_threshold: float = -np.log10(5E-08), title: str = None,
+                   figsize: tuple = (17, 11), annotate_sig: bool = False, n_bins: int = 5000,
+                   exact_threshold: float = 5.0, max_exact: int = 100000):
+    """
+    Manhattan plot from per-chromosome bins: the genome is split into n_bins windows and only the largest
+    -log10(p_value) of each window is brought to the driver. Variants with -log10(p_value) >= exact_threshold are kept
+    as exact points (at most max_exact of them), so driver memory does not grow with the number of variants
+    """
+    locus = pvals._indices.source.locus
+    rg = locus.dtype.reference_genome
+    bin_size = manhattan_bin_size(rg, n_bins)
+    man = _aggregate(pvals, manhattan_agg(pvals, locus, bin_size, exact_threshold=exact_threshold,
+                                          max_exact=max_exact))
+
+    return manhattan_render(**manhattan_points(man, rg, bin_size, exact_threshold=exact_threshold,
+                                               max_exact=max_exact),
+                            significance_threshold=significance_threshold, title=title, figsize=figsize,
+                            annotate_sig=annotate_sig)
@@ -1,14 +1,27 @@
 __author__ = 'Lindo Nkambule'
 
 from gwaspy.preimp_qc.annotations import *
-from typing import Tuple, Any, Dict, Union
-from gwaspy.utils.read_file import read_infile
+from gwaspy.preimp_qc.family_index import FamilyIndex
+from gwaspy.preimp_qc.fused_qc import FusedQC
+from gwaspy.preimp_qc.incremental_qc import IncrementalQC
+from gwaspy.preimp_qc.local_qc import LocalQC
+from gwaspy.preimp_qc.profiling import QCProfiler
+from gwaspy.preimp_qc.qc_context import CASE_CONTROL_DATA_TYPES, QCMetricsStore, QCRun, QCThresholds
+from gwaspy.utils.stages import StageCache
+from gwaspy.preimp_qc.sweep import ThresholdSweep, parse_grid, sweep_plot
+from typing import Tuple, Any, Dict, List, Union
+from gwaspy.utils.read_file import read_infile, input_paths, input_fingerprint
+from gwaspy.utils.plink_bed import PlinkBed
+from gwaspy.utils.timing import log_to_stdout
 import argparse
-from gwaspy.preimp_qc.report import MyDocument
+from gwaspy.preimp_qc.report_assets import ReportAssets
+from gwaspy.preimp_qc.association import AssociationScan, BatchedAssociation
 import shutil
 import warnings
 import os
+import tempfile
 import hail as hl
+import pandas as pd
 
 warnings.simplefilter(action='ignore', category=RuntimeWarning)
 
@@ -61,44 +74,53 @@ def summary_stats(mt: hl.MatrixTable) -> Tuple[hl.MatrixTable, Dict[str, Any]]:
     return mt, results
 
 
-def preimp_qc(input_type: str = None, dirname: str = None, basename: str = None, pre_geno_thresh: Union[int, float] = 0.95,
-              mind_thresh: Union[int, float] = 0.98, fhet_aut: Union[int, float] = 0.2, fstat_x: Union[int, float] = 0.5,
-              fstat_y: Union[int, float] = 0.5, geno_thresh: Union[int, float] = 0.98,
-              cr_diff_thresh: Union[int, float] = 0.02, maf_thresh: Union[int, float] = 0.01,
-              hwe_th_con_thresh: Union[int, float] = 1e-6, hwe_th_cas_thresh: Union[int, float] = 1e-10,
-              hwe_th_all_thresh: Union[int, float] = 1e-06, annotations_file: str = None, report: bool = True,
-              export_type: str = 'hail', out_dir: str = None, reference: str = 'GRCh38'):
-    print('\nRunning QC')
-
-    global mt, row_filters, filters, data_type, lambda_gc_pos, lambda_gc_pre, n_sig_var_pre, n_sig_var_pos, man_table_results, remove_fields
-
-    # create temp directory for storing temp files
-    if not os.path.exists('gwaspy_tmp'):
-        os.makedirs('gwaspy_tmp')
+def read_stage(cache: StageCache, input_type: str = None, dirname: str = None, basename: str = None,
+               annotations_file: str = None, reference: str = 'GRCh38',
+               genotype_cache: str = None) -> Tuple[hl.MatrixTable, str]:
+    """
+    Read the input, checkpointing non-Hail inputs as a MatrixTable
+    :param genotype_cache: local directory of a genotype cache to write the input to, for the PCA and relatedness
+    steps, unless it is already cached there
+    :return: MatrixTable and the cache key of the read stage
+    """
+    input_files = input_paths(input_type=input_type, dirname=dirname, basename=basename)
+    if annotations_file:
+        input_files.append(annotations_file)
+    read_key = cache.key('read', input=input_fingerprint(input_files), reference=reference)
+
+    if input_type == 'hail':
+        mt = read_infile(input_type=input_type, dirname=dirname, basename=basename, annotations=annotations_file,
+                         annotations_cache=cache)
+    else:
+        mt, _ = cache.matrix_table('read', read_key,
+                                   lambda: read_infile(input_type=input_type, dirname=dirname, basename=basename,
+                                                       annotations=annotations_file, annotations_cache=cache))
 
-    # LaTex needs full path to files
-    gwaspy_dir = os.getcwd() + '/gwaspy_tmp'
+    if genotype_cache:
+        from gwaspy.utils.genotype_cache import genotype_cache as write_genotype_cache
+        write_genotype_cache(genotype_cache, input_fingerprint(input_files), mt=mt,
+                             plink_prefix=dirname + basename if input_type == 'plink' else None)
 
-    output_directory = out_dir if out_dir else dirname
+    return mt, read_key
 
-    hl.init(default_reference=reference)
 
-    # read input
-    mt = read_infile(input_type=input_type, dirname=dirname, basename=basename, annotations=annotations_file)
-
-    if 'is_case' in mt.col:
-        gwas_pre, n_sig_var_pre = manhattan(qqtitle='Pre-QC QQ Plot', mantitle='Pre-QC Manhattan Plot').filter(mt)
-        qqplt_pre, lambda_gc_pre, manplt_pre = manhattan(qqtitle='Pre-QC QQ Plot',
-                                                         mantitle='Pre-QC Manhattan Plot').plot(gwas_pre)
-        qqplt_pre.savefig('gwaspy_tmp/gwaspy_qq_pre.png', dpi=300)
-        manplt_pre.savefig('gwaspy_tmp/gwaspy_man_pre.png', dpi=300)
+def pre_qc_summary(mt: hl.MatrixTable, cache: StageCache, read_key: str) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    Pre-QC sample/variant counts and the contigs in the data, cached under the read stage key
+    """
+    if cache.exists('pre_qc_counts', read_key, 'json'):
+        summary = cache.read_json('pre_qc_counts', read_key)
+    else:
+        mt, pre_qc_counts = summary_stats(mt)
+        chroms = mt.aggregate_rows(hl.agg.collect_as_set(mt.locus.contig))
+        summary = {'counts': pre_qc_counts, 'chroms': list(chroms)}
+        cache.write_json('pre_qc_counts', read_key, summary)
 
-    mt = mt.annotate_rows(exclude_row=False)
-    mt = mt.annotate_cols(exclude_col=False)
+    return summary['counts'], summary['chroms']
 
-    mt, pre_qc_counts = summary_stats(mt)
 
-    if 'is_case' in mt.col:
+def get_data_type(pre_qc_counts: Dict[str, Any]) -> str:
+    if 'is_case_counts' in pre_qc_counts:
         if (pre_qc_counts['is_case_counts']['case'] > 0) & (pre_qc_counts['is_case_counts']['control'] == 0):
             data_type = 'Case-only'
         elif (pre_qc_counts['is_case_counts']['control'] > 0) & (pre_qc_counts['is_case_counts']['case'] == 0):
@@ -110,30 +132,81 @@ def preimp_qc(input_type: str = None, dirname: str = None, basename: str = None,
     else:
         data_type = 'no-pheno'
 
-    chroms = mt.aggregate_rows(hl.agg.collect_as_set(mt.locus.contig))
-    if ('chrX' or 'chrY' or 'chrMT') in chroms:
-        chromx, chromy, chrommt = 'chrX', 'chrY', 'chrMT'
+    return data_type
+
+
+def sex_chromosomes(chroms: List[str]) -> Tuple[str, str, str]:
+    if any(chrom in chroms for chrom in ('chrX', 'chrY', 'chrMT')):
+        return 'chrX', 'chrY', 'chrMT'
+
+    return 'X', 'Y', 'MT'
+
+
+def filter_names(data_type: str, hwe_th_con_thresh: float = 1e-6, hwe_th_cas_thresh: float = 1e-10,
+                 hwe_th_all_thresh: float = 1e-6, pedigree: bool = False) -> Tuple[List[str], List[str], List[str], Dict[str, float]]:
+    """
+    Filters applied to each type of data
+    :param pedigree: the Mendel error filters are run, and with them HWE over the founders of the trios (hwe_trio)
+    :return: row filters, all filters, helper fields to remove and HWE filters (name: threshold)
+    """
+    row_filters, filters, remove_fields = [], [], []
+    if data_type == 'Case-only':
+        row_filters = ['pre_geno', 'geno', 'cr_diff', 'monomorphic_var', 'hwe_cas']
+        filters = ['pre_geno', 'mind', 'fstat', 'sex_violations', 'sex_warnings', 'geno', 'cr_diff',
+                   'monomorphic_var', 'hwe_cas']
+        remove_fields = ['cr', 'diff', 'hwe_cas_aut', 'hwe_cas_sex']
+        hwe_filters = {'hwe_cas': hwe_th_cas_thresh}
+    elif data_type == 'Control-only':
+        row_filters = ['pre_geno', 'geno', 'cr_diff', 'monomorphic_var', 'hwe_con']
+        filters = ['pre_geno', 'mind', 'fstat', 'sex_violations', 'sex_warnings', 'geno', 'cr_diff',
+                   'monomorphic_var', 'hwe_con']
+        remove_fields = ['cr', 'diff', 'hwe_con_aut', 'hwe_con_sex']
+        hwe_filters = {'hwe_con': hwe_th_con_thresh}
+    elif data_type == 'Case-Control':
+        row_filters = ['pre_geno', 'geno', 'cr_diff', 'monomorphic_var', 'hwe_con', 'hwe_cas']
+        filters = ['pre_geno', 'mind', 'fstat', 'sex_violations', 'sex_warnings', 'geno', 'cr_diff',
+                   'monomorphic_var', 'hwe_con', 'hwe_cas']
+        remove_fields = ['cr', 'diff', 'hwe_cas_aut', 'hwe_cas_sex', 'hwe_con_aut', 'hwe_con_sex']
+        hwe_filters = {'hwe_cas': hwe_th_cas_thresh, 'hwe_con': hwe_th_con_thresh}
+    elif data_type == 'no-pheno':
+        row_filters = ['pre_geno', 'geno', 'monomorphic_var', 'hwe_all']
+        filters = ['pre_geno', 'mind', 'fstat', 'sex_violations', 'sex_warnings', 'geno',
+                   'monomorphic_var', 'hwe_all']
+        remove_fields = ['hwe_all_aut', 'hwe_all_sex']
+        hwe_filters = {'hwe_all': hwe_th_all_thresh}
+    elif data_type == 'Trio':
+        # samples are related, so with a pedigree HWE is only tested in the founders (hwe_trio, added by trio_qc)
+        row_filters = ['pre_geno', 'geno', 'monomorphic_var']
+        filters = ['pre_geno', 'mind', 'fstat', 'sex_violations', 'sex_warnings', 'geno', 'monomorphic_var']
+        hwe_filters = {}
+        if not pedigree:
+            row_filters.append('hwe_all')
+            filters.append('hwe_all')
+            remove_fields = ['hwe_all_aut', 'hwe_all_sex']
+            hwe_filters = {'hwe_all': hwe_th_all_thresh}
     else:
-        chromx, chromy, chrommt = 'X', 'Y', 'MT'
-
-    # we need to compute call rate for chr1-23 and chrY separately since females have no chrY
-    mt = mt.annotate_entries(
-        geno_y_excluded=(hl.case()
-                         .when(mt.locus.contig == chromy, False)
-                         .default(True)
-                         ),
-        geno_y_only=(hl.case()
-                     .when(mt.locus.contig == chromy, mt.is_female == False)
-                     .default(False)
-                     )
-    )
-
-    mt = pre_geno(pre_geno_cr=pre_geno_thresh).filter(mt)
-    mt = id_call_rate(mind=mind_thresh, pre_row_filter='pre_geno').filter(mt)
-
-    mt = fhet_autosomes(pre_row_filter='pre_geno', fhet_thresh=fhet_aut).filter(mt)
-    mt = fhet_sex(pre_row_filter='pre_geno', fstat_x=fstat_x, fstat_y=fstat_y).filter(mt)
-    mt = fhet_sex_warnings(pre_row_filter='pre_geno', pre_col_filter='sex_violations').filter(mt)
+        hwe_filters = {}
+
+    return row_filters, filters, remove_fields, hwe_filters
+
+
+def chained_qc(mt: hl.MatrixTable, pre_geno_thresh: Union[int, float] = 0.95, mind_thresh: Union[int, float] = 0.98,
+               fhet_aut: Union[int, float] = 0.2, fstat_x: Union[int, float] = 0.5, fstat_y: Union[int, float] = 0.5,
+               geno_thresh: Union[int, float] = 0.98, cr_diff_thresh: Union[int, float] = 0.02,
+               hwe_filters: Dict[str, float] = None, data_type: str = None, chromx: str = 'chrX',
+               chromy: str = 'chrY', chrommt: str = 'chrMT', profiler: QCProfiler = None) -> hl.MatrixTable:
+    profiler = profiler if profiler else QCProfiler(enabled=False)
+    # the chrX/chrY masks of the call rate and HWE filters are a row field crossed with is_female, not entry fields
+    mt = annotate_sex_chromosomes(mt, chromx=chromx, chromy=chromy, chrommt=chrommt)
+
+    mt = profiler.filter('pre_geno', pre_geno(pre_geno_cr=pre_geno_thresh), mt)
+    mt = profiler.filter('mind', id_call_rate(mind=mind_thresh, pre_row_filter='pre_geno'), mt)
+
+    mt = profiler.filter('fstat', fhet_autosomes(pre_row_filter='pre_geno', fhet_thresh=fhet_aut), mt)
+    mt = profiler.filter('sex_violations', fhet_sex(pre_row_filter='pre_geno', fstat_x=fstat_x, fstat_y=fstat_y),
+                         mt)
+    mt = profiler.filter('sex_warnings',
+                         fhet_sex_warnings(pre_row_filter='pre_geno', pre_col_filter='sex_violations'), mt)
 
     mt = mt.annotate_cols(**{
         'id_pass': hl.struct(
@@ -141,227 +214,503 @@ def preimp_qc(input_type: str = None, dirname: str = None, basename: str = None,
                      (hl.agg.any(mt['sex_violations'].filters) == True))
         )})
 
-    mt = geno(pre_row_filter='pre_geno', pre_col_filter='id_pass', geno_thresh=geno_thresh, data_type=data_type).filter(mt)
-    mt = invariant(pre_col_filter='id_pass').filter(mt)
-
-    # for HWE, markers in: (1) autosomes - include males+females; (2) chrX - include ONLY females; (3) exclude chrY
-    mt = mt.annotate_entries(
-        hwe_aut=(hl.case()
-                 .when(mt.locus.contig == chromx, False)
-                 .when(mt.locus.contig == chromy, False)
-                 .when(mt.locus.contig == chrommt, False)
-                 .default(True)
-                 ),
-        hwe_sex=(hl.case()
-                 .when(mt.locus.contig == chromx, mt.is_female)
-                 .default(False)
-                 )
-    )
+    mt = profiler.filter('geno', geno(pre_row_filter='pre_geno', pre_col_filter='id_pass', geno_thresh=geno_thresh,
+                                      data_type=data_type), mt)
+    mt = profiler.filter('monomorphic_var', invariant(pre_col_filter='id_pass'), mt)
 
     if 'is_case' in mt.col:
-        mt = call_rate_diff(pre_row_filter='geno', pre_col_filter='id_pass', initial_row_filter='pre_geno',
-                            cr_thresh=cr_diff_thresh).filter(mt)
-
-        # check if data is case-/control-only, case-control, or trio
-        # (a) Case-Only
-        if data_type == 'Case-only':
-            print("\n" + data_type)
-            mt = hwe_cas(pre_col_filter='id_pass', pre_row_filter='geno', hwe_th_ca=1e-6).filter(mt)
-            row_filters = ['pre_geno', 'geno', 'cr_diff', 'monomorphic_var', 'hwe_cas']
-            filters = ['pre_geno', 'mind', 'fstat', 'sex_violations', 'sex_warnings', 'geno', 'cr_diff',
-                       'monomorphic_var', 'hwe_cas']
-            remove_fields = ['cr', 'diff', 'hwe_cas_aut', 'hwe_cas_sex']
-        # (b) Control-Only
-        elif data_type == 'Control-only':
-            print("\n" + data_type)
-            mt = hwe_con(pre_col_filter='id_pass', pre_row_filter='geno', hwe_th_co=1e-6).filter(mt)
-            row_filters = ['pre_geno', 'geno', 'cr_diff', 'monomorphic_var', 'hwe_con']
-            filters = ['pre_geno', 'mind', 'fstat', 'sex_violations', 'sex_warnings', 'geno', 'cr_diff',
-                       'monomorphic_var', 'hwe_con']
-            remove_fields = ['cr', 'diff', 'hwe_con_aut', 'hwe_con_sex']
-        elif data_type == 'Case-Control':
-            print("\n" + data_type)
-            mt = hwe_cas(pre_col_filter='id_pass', pre_row_filter='geno', hwe_th_ca=hwe_th_cas_thresh).filter(mt)
-            mt = hwe_con(pre_col_filter='id_pass', pre_row_filter='geno', hwe_th_co=hwe_th_con_thresh).filter(mt)
-            row_filters = ['pre_geno', 'geno', 'cr_diff', 'monomorphic_var', 'hwe_con', 'hwe_cas']
-            filters = ['pre_geno', 'mind', 'fstat', 'sex_violations', 'sex_warnings', 'geno', 'cr_diff',
-                       'monomorphic_var', 'hwe_con', 'hwe_cas']
-            remove_fields = ['cr', 'diff', 'hwe_cas_aut', 'hwe_cas_sex', 'hwe_con_aut', 'hwe_con_sex']
-        else:
-            # trio data
-            print(data_type)
+        mt = profiler.filter('cr_diff', call_rate_diff(pre_row_filter='geno', pre_col_filter='id_pass',
+                                                       initial_row_filter='pre_geno', cr_thresh=cr_diff_thresh), mt)
+
+    hwe_filters = hwe_filters if hwe_filters else {}
+    if 'hwe_cas' in hwe_filters:
+        mt = profiler.filter('hwe_cas', hwe_cas(pre_col_filter='id_pass', pre_row_filter='geno',
+                                                hwe_th_ca=hwe_filters['hwe_cas']), mt)
+    if 'hwe_con' in hwe_filters:
+        mt = profiler.filter('hwe_con', hwe_con(pre_col_filter='id_pass', pre_row_filter='geno',
+                                                hwe_th_co=hwe_filters['hwe_con']), mt)
+    if 'hwe_all' in hwe_filters:
+        mt = profiler.filter('hwe_all', hwe_all(pre_col_filter='id_pass', pre_row_filter='geno',
+                                                hwe_th_all=hwe_filters['hwe_all']), mt)
+
+    return mt
+
+
+def trio_qc(mt: hl.MatrixTable, pedigree: str, mendel_id_thresh: float = 0.05, mendel_var_thresh: float = 0.1,
+            hwe_th_trio_thresh: float = 1e-6, chromx: str = 'chrX', chromy: str = 'chrY', chrommt: str = 'chrMT',
+            cache: StageCache = None, upstream: str = None,
+            profiler: QCProfiler = None) -> Tuple[hl.MatrixTable, int]:
+    """
+    Mendel error and founder-only HWE filters over the complete trios of a pedigree, run after the sample and variant
+    filters of any engine (they use pre_geno, geno and id_pass)
+    :return: mt annotated with the mendel_id, mendel_var and hwe_trio filter structs, and the number of trios
+    """
+    profiler = profiler if profiler else QCProfiler(enabled=False)
+    family_index = FamilyIndex(pedigree, mt, cache=cache, upstream=upstream)
+    mt = annotate_sex_chromosomes(mt, chromx=chromx, chromy=chromy, chrommt=chrommt)
+
+    # both Mendel filters read the same pass over the trio genotypes
+    mt = profiler.filter('mendel_var', mendel_var(family_index, mendel_thresh=mendel_var_thresh,
+                                                  pre_row_filter='pre_geno', pre_col_filter='id_pass'), mt)
+    mt = profiler.filter('mendel_id', mendel_id(family_index, mendel_thresh=mendel_id_thresh,
+                                                pre_row_filter='pre_geno'), mt)
+    mt = profiler.filter('hwe_trio', hwe_trio(family_index, hwe_th_trio=hwe_th_trio_thresh, pre_row_filter='geno',
+                                              pre_col_filter='id_pass'), mt)
+
+    return mt, family_index.n_trios
+
+
+def plot_files(data_type: str) -> List[str]:
+    files = ['gwaspy_fstat_fig.png']
+    if data_type == 'Case-only':
+        files += ['gwaspy_id_cas_pre.png', 'gwaspy_var_cas_pre.png']
+    if data_type == 'Control-only':
+        files += ['gwaspy_id_con_pre.png', 'gwaspy_var_con_pre.png']
+    if data_type == 'Case-Control':
+        files += ['gwaspy_id_con_pre.png', 'gwaspy_id_cas_pre.png', 'gwaspy_var_con_pre.png', 'gwaspy_var_cas_pre.png']
+    if data_type in ['no-pheno', 'Trio']:
+        files += ['gwaspy_id_cas_con_pre.png', 'gwaspy_var_cas_con_pre.png']
+    if data_type in CASE_CONTROL_DATA_TYPES:
+        files += ['gwaspy_qq_pre.png', 'gwaspy_man_pre.png', 'gwaspy_qq_pos.png', 'gwaspy_man_pos.png']
+
+    return files
+
+
+def report_file(basename: str, report_format: str = 'latex') -> str:
+    return f'{basename}.preimp_qc.report.{"html" if report_format == "html" else "pdf"}'
+
+
+def write_report(run: QCRun, report_format: str = 'latex') -> str:
+    """
+    Write the report of a QC run into its work directory: a LaTeX PDF (latex), or without LaTeX a self-contained HTML
+    file (html) or a PDF drawn with matplotlib (pdf)
+    :return: file name of the report
+    """
+    print('\nWriting report')
+    if report_format == 'latex':
+        # pylatex is only needed for the LaTeX report
+        from gwaspy.preimp_qc.report import MyDocument
+        doc = MyDocument(basename=run.basename)
+        doc.render(run)
+        doc.generate_pdf(f'{run.work_dir}/{run.basename}.preimp_qc.report', clean=True, clean_tex=True)
     else:
-        print('Running HWE filters on whole dataset without spliting by phenotype status')
-        mt = hwe_all(pre_col_filter='id_pass', pre_row_filter='geno', hwe_th_all=1e-08).filter(mt)
-        row_filters = ['pre_geno', 'geno', 'monomorphic_var', 'hwe_all']
-        filters = ['pre_geno', 'mind', 'fstat', 'sex_violations', 'sex_warnings', 'geno',
-                   'monomorphic_var', 'hwe_all']
-        remove_fields = ['hwe_all_aut', 'hwe_all_sex']
-
-    results = {}
-    column_filters = ['mind', 'fstat', 'sex_violations', 'sex_warnings']
-
-    mt.select_entries().select_rows(*row_filters).select_cols(*column_filters).write(f'{output_directory}/temp.mt',
-                                                                                     overwrite=True)
-    mt_temp = hl.read_matrix_table(f'{output_directory}/temp.mt')
-    column_aggregations = mt_temp.aggregate_cols(
-        [hl.agg.counter(mt_temp[filter].filters) for filter in column_filters])
+        from gwaspy.preimp_qc.report_html import HTMLReport
+        doc = HTMLReport(basename=run.basename)
+        doc.render(run)
+        if report_format == 'html':
+            doc.generate_html(f'{run.work_dir}/{report_file(run.basename, report_format)}')
+        else:
+            doc.generate_pdf(f'{run.work_dir}/{report_file(run.basename, report_format)}')
 
-    row_aggregations = mt_temp.aggregate_rows(
-        [hl.agg.counter(mt_temp[filter].filters) for filter in row_filters])
+    return report_file(run.basename, report_format)
 
-    for filt, cont in zip(column_filters, column_aggregations):
-        results[filt] = dict(cont) # aggregate returns a frozendict, convert that back to a dict
 
-    for filt, cont in zip(row_filters, row_aggregations):
-        results[filt] = dict(cont) # # aggregate returns a frozendict, convert that back to a dict
+def filter_results(run: QCRun, samples: Dict[str, Any], variants: Dict[str, Any]):
+    """Number of samples/variants passing and failing each filter, from the counters of each filter flag"""
+    for filt, cont in zip(run.col_filters + run.row_filters, list(samples) + list(variants)):
+        run.results[filt] = {bool(k): int(v) for k, v in cont.items()}
 
-    for i in filters:
+    for i in run.filters:
         # some filters will have zero snps/id filtered, and there won't be a True, so add it
-        if True not in results[i]:
-            results[i][True] = 0
-        for key, value in results.items():
-            if i == key:
-                print(key, ': ', value)
+        run.results[i].setdefault(True, 0)
+        run.results[i].setdefault(False, 0)
+        print(i, ': ', run.results[i])
+
+
+def local_preimp_qc(run: QCRun, dirname: str = None, report: bool = True, export_type: str = 'plink',
+                    reference: str = 'GRCh38', report_format: str = 'latex'):
+    """
+    preimp_qc of a local PLINK fileset with the NumPy engine (LocalQC), without starting Hail. The filters, report
+    and PLINK export are computed locally, so the QC'ed data can only be exported as PLINK
+    """
+    th = run.thresholds
+    bed = PlinkBed(dirname=dirname, basename=run.basename, reference=reference)
+    run.pre_qc_counts = bed.summary()
+    run.data_type = get_data_type(run.pre_qc_counts)
+    chromx, chromy, chrommt = sex_chromosomes(list(set(bed.contig)))
+    run.row_filters, run.filters, run.remove_fields, run.hwe_filters = filter_names(
+        data_type=run.data_type, hwe_th_con_thresh=th.hwe_con, hwe_th_cas_thresh=th.hwe_cas,
+        hwe_th_all_thresh=th.hwe_all)
+    print("\n" + run.data_type)
+
+    engine = LocalQC(pre_geno_cr=th.pre_geno, mind=th.mind, fhet_thresh=th.fhet_aut, fstat_x=th.fstat_x,
+                     fstat_y=th.fstat_y, geno_thresh=th.geno, cr_diff_thresh=th.cr_diff, hwe_filters=run.hwe_filters,
+                     chromx=chromx, chromy=chromy, chrommt=chrommt)
+    variants, samples, counts = engine.run(bed)
+
+    filter_results(run, [samples[filt].value_counts().to_dict() for filt in run.col_filters],
+                   [variants[filt].value_counts().to_dict() for filt in run.row_filters])
+
+    variant_keep = ~variants[run.row_filters].any(axis=1).to_numpy()
+    sample_keep = ~samples[['mind', 'fstat', 'sex_violations']].any(axis=1).to_numpy()
+    run.pos_qc_counts = bed.summary(variant_keep, sample_keep)
+
+    store = QCMetricsStore(run.metrics_dir, local=True)
+    # the same columns as the metrics of the hail engine, where A2 is the reference allele
+    store.write_frames(
+        samples=pd.concat([bed.fam[['s', 'fam_id']], pd.DataFrame({'is_female': bed.is_female,
+                                                                   'is_case': bed.is_case}), samples], axis=1),
+        variants=pd.concat([pd.DataFrame({'contig': bed.contig, 'position': bed.position,
+                                          'alleles': bed.bim['a2'] + ',' + bed.bim['a1'], 'rsid': bed.bim['rsid']}),
+                            variants], axis=1))
 
     if report:
-        fstat_fig = fhet_sex(pre_row_filter='pre_geno', fstat_x=fstat_x, fstat_y=fstat_y, figsize=(15, 20)).plot(mt)
-        fstat_fig.savefig('gwaspy_tmp/gwaspy_fstat_fig.png', dpi=300)
-
-        id_cr_plot = id_call_rate(mind=mind_thresh, pre_row_filter='pre_geno', data_type=data_type).plot(mt)
-        var_cr_plot = geno(pre_row_filter='pre_geno', pre_col_filter='id_pass', geno_thresh=geno_thresh,
-                           data_type=data_type).plot(mt)
+        jobs, run.man_results = engine.report_jobs(bed, variants, samples, counts, variant_keep, run.work_dir,
+                                                   data_type=run.data_type, mind_thresh=th.mind, fstat_x=th.fstat_x,
+                                                   fstat_y=th.fstat_y, geno_thresh=th.geno)
+        ReportAssets(gwaspy_dir=run.work_dir).render(jobs)
+    store.write_run(run)
 
-        if 'is_case' in mt.col:
-            if data_type == 'Case-only':
-                id_cr_plot[0].savefig('gwaspy_tmp/gwaspy_id_cas_pre.png', dpi=300)
-                var_cr_plot[0].savefig('gwaspy_tmp/gwaspy_var_cas_pre.png', dpi=300)
+    if report:
+        filename = write_report(store.read_run(work_dir=run.work_dir), report_format=report_format)
+        shutil.copyfile(f'{run.work_dir}/{filename}', f'{run.output_directory}{filename}')
 
-            if data_type == 'Control-only':
-                id_cr_plot[0].savefig('gwaspy_tmp/gwaspy_id_con_pre.png', dpi=300)
-                var_cr_plot[0].savefig('gwaspy_tmp/gwaspy_var_con_pre.png', dpi=300)
+    if export_type == 'plink':
+        print('\nExporting qced file')
+        os.makedirs(f'{run.output_directory}GWASpy/Preimp_QC', exist_ok=True)
+        bed.write_plink(f'{run.output_directory}GWASpy/Preimp_QC/{run.basename}_qced', variant_keep, sample_keep)
 
-            if data_type == 'Case-Control':
-                id_cr_plot[0].savefig('gwaspy_tmp/gwaspy_id_con_pre.png', dpi=300)
-                id_cr_plot[1].savefig('gwaspy_tmp/gwaspy_id_cas_pre.png', dpi=300)
-                var_cr_plot[0].savefig('gwaspy_tmp/gwaspy_var_con_pre.png', dpi=300)
-                var_cr_plot[1].savefig('gwaspy_tmp/gwaspy_var_cas_pre.png', dpi=300)
 
-        else:
-            id_cr_plot[0].savefig('gwaspy_tmp/gwaspy_id_cas_con_pre.png', dpi=300)
-            var_cr_plot[0].savefig('gwaspy_tmp/gwaspy_var_cas_con_pre.png', dpi=300)
+def preimp_qc(input_type: str = None, dirname: str = None, basename: str = None, pre_geno_thresh: Union[int, float] = 0.95,
+              mind_thresh: Union[int, float] = 0.98, fhet_aut: Union[int, float] = 0.2, fstat_x: Union[int, float] = 0.5,
+              fstat_y: Union[int, float] = 0.5, geno_thresh: Union[int, float] = 0.98,
+              cr_diff_thresh: Union[int, float] = 0.02, maf_thresh: Union[int, float] = 0.01,
+              hwe_th_con_thresh: Union[int, float] = 1e-6, hwe_th_cas_thresh: Union[int, float] = 1e-10,
+              hwe_th_all_thresh: Union[int, float] = 1e-06, annotations_file: str = None, report: bool = True,
+              export_type: str = 'hail', out_dir: str = None, reference: str = 'GRCh38', fused: bool = True,
+              cache_dir: str = None, exact_assoc: bool = False, assoc_test: str = 'linear', pcs_file: str = None,
+              n_pcs: int = 10, engine: str = 'hail', genotype_cache: str = None, incremental: str = None,
+              report_format: str = 'latex', pedigree: str = None, mendel_id_thresh: float = 0.05,
+              mendel_var_thresh: float = 0.1, hwe_th_trio_thresh: float = 1e-6, profile: bool = False) -> QCRun:
+    """
+    :param profile: time every QC stage (the fused passes, or every filter forced on its own with fused=False), and
+    write its Spark metrics to BASENAME.preimp_qc.profile.json/.folded next to the report (see QCProfiler)
+    :return: the QCRun of the cohort. Its metrics (per-sample and per-variant statistics and filter flags) are in
+    QCMetricsStore(run.metrics_dir)
+    """
+    print('\nRunning QC')
 
-    # FILTER OUT ALL SNPs and IDs THAT FAIL QC
-    column_filters = ['mind', 'fstat', 'sex_violations']
-    for row in row_filters:
-        mt = mt.filter_rows(mt[row].filters == True, keep=False)
-    for col in column_filters:
-        mt = mt.filter_cols(mt[col].filters == True, keep=False)
+    # every run has its own state and work directory, so several cohorts can be QC'ed concurrently in one process
+    run = QCRun(basename=basename, output_directory=out_dir if out_dir else dirname,
+                thresholds=QCThresholds(pre_geno=pre_geno_thresh, mind=mind_thresh, fhet_aut=fhet_aut,
+                                        fstat_x=fstat_x, fstat_y=fstat_y, geno=geno_thresh, cr_diff=cr_diff_thresh,
+                                        maf=maf_thresh, hwe_con=hwe_th_con_thresh, hwe_cas=hwe_th_cas_thresh,
+                                        hwe_all=hwe_th_all_thresh, mendel_id=mendel_id_thresh,
+                                        mendel_var=mendel_var_thresh, hwe_trio=hwe_th_trio_thresh))
+
+    if engine == 'local':
+        if incremental:
+            raise ValueError('Incremental QC uses the hail engine')
+        if pedigree:
+            raise ValueError('The Mendel error filters use the hail engine')
+        if profile:
+            raise ValueError('Profiling instruments the Hail jobs of the hail engine')
+        if input_type != 'plink':
+            raise ValueError('The local engine only reads PLINK input. Use --engine hail for other input types')
+        if annotations_file:
+            raise ValueError('The local engine reads sex and phenotype from the .fam. Use --engine hail to add '
+                             'sample annotations')
+        if export_type not in [None, 'plink']:
+            raise ValueError('The local engine only exports PLINK, a Hail or VCF export would start Hail. Use '
+                             '--export-type plink, or --engine hail')
+
+    run.make_work_dir()
+    output_directory = run.output_directory
+
+    if engine == 'local':
+        local_preimp_qc(run, dirname=dirname, report=report, export_type=export_type, reference=reference,
+                        report_format=report_format)
+        shutil.rmtree(run.work_dir)
+        print("\nDone running QC!")
+        return run
+
+    hl.init(default_reference=reference, idempotent=True)
+    profiler = QCProfiler(enabled=profile)
+
+    # every stage (read -> sample filters -> variant filters -> plots -> report -> export) is checkpointed under a key
+    # of its input and thresholds, so a rerun starts from the first stage whose checkpoint is missing
+    cache = StageCache(cache_dir if cache_dir else f'{output_directory}GWASpy/Preimp_QC/cache')
+    mt, read_key = read_stage(cache=cache, input_type=input_type, dirname=dirname, basename=basename,
+                              annotations_file=annotations_file, reference=reference, genotype_cache=genotype_cache)
+    mt_pre = mt
 
-    mt_filtered, pos_qc_counts = summary_stats(mt)
+    mt = mt.annotate_rows(exclude_row=False)
+    mt = mt.annotate_cols(exclude_col=False)
 
-    # drop entry fields we added as they will cause errors when exporting to VCF
-    # e.g. Error summary: HailException: Invalid type for format field 'geno_y_excluded'. Found 'bool'.
-    drop_fields = filters + ['geno_y_excluded', 'geno_y_only', 'pre_geno_noy', 'pre_geno_y', 'hwe_aut', 'hwe_sex',
-                             'exclude_col', 'exclude_row', 'variant_qc', 'aaf', 'geno_noy', 'geno_y', 'sex_ambiguous',
-                             'id_pass'] + remove_fields
-    mt_filtered = mt_filtered.drop(*drop_fields)
+    run.pre_qc_counts, chroms = pre_qc_summary(mt=mt, cache=cache, read_key=read_key)
+    run.data_type = get_data_type(run.pre_qc_counts)
+    chromx, chromy, chrommt = sex_chromosomes(chroms)
+    run.row_filters, run.filters, run.remove_fields, run.hwe_filters = filter_names(
+        data_type=run.data_type, hwe_th_con_thresh=hwe_th_con_thresh, hwe_th_cas_thresh=hwe_th_cas_thresh,
+        hwe_th_all_thresh=hwe_th_all_thresh, pedigree=pedigree is not None)
+
+    sample_metrics, variant_metrics = None, None
+    if incremental:
+        # the input is a new batch: variant filters are updated from the statistics stored for the earlier batches
+        incremental_qc = IncrementalQC(store=incremental, pre_geno_cr=pre_geno_thresh, mind=mind_thresh,
+                                       fhet_thresh=fhet_aut, fstat_x=fstat_x, fstat_y=fstat_y,
+                                       geno_thresh=geno_thresh, cr_diff_thresh=cr_diff_thresh,
+                                       hwe_filters=run.hwe_filters, chromx=chromx, chromy=chromy, chrommt=chrommt,
+                                       profiler=profiler)
+        with profiler.stage('incremental_qc'):
+            mt = incremental_qc.run(mt, batch=basename)
+        filters_key = cache.key('incremental_qc', upstream=read_key, store=incremental,
+                                version=incremental_qc.version)
+        sample_metrics, variant_metrics = incremental_qc.sample_metrics, incremental_qc.variant_metrics
+    elif fused:
+        fused_qc = FusedQC(pre_geno_cr=pre_geno_thresh, mind=mind_thresh, fhet_thresh=fhet_aut, fstat_x=fstat_x,
+                           fstat_y=fstat_y, geno_thresh=geno_thresh, cr_diff_thresh=cr_diff_thresh,
+                           hwe_filters=run.hwe_filters, chromx=chromx, chromy=chromy, chrommt=chrommt, cache=cache,
+                           profiler=profiler)
+        with profiler.stage('fused_qc'):
+            mt = fused_qc.run(mt, upstream=read_key)
+        filters_key = fused_qc.key
+        sample_metrics, variant_metrics = fused_qc.sample_metrics, fused_qc.variant_metrics
+    else:
+        mt = chained_qc(mt=mt, pre_geno_thresh=pre_geno_thresh, mind_thresh=mind_thresh, fhet_aut=fhet_aut,
+                        fstat_x=fstat_x, fstat_y=fstat_y, geno_thresh=geno_thresh, cr_diff_thresh=cr_diff_thresh,
+                        hwe_filters=run.hwe_filters, data_type=run.data_type, chromx=chromx, chromy=chromy,
+                        chrommt=chrommt, profiler=profiler)
+        filters_key = cache.key('chained_qc', upstream=read_key, pre_geno_thresh=pre_geno_thresh,
+                                mind_thresh=mind_thresh, fhet_aut=fhet_aut, fstat_x=fstat_x, fstat_y=fstat_y,
+                                geno_thresh=geno_thresh, cr_diff_thresh=cr_diff_thresh, hwe_filters=run.hwe_filters)
+
+    if pedigree:
+        mt, run.n_trios = trio_qc(mt, pedigree=pedigree, mendel_id_thresh=mendel_id_thresh,
+                                  mendel_var_thresh=mendel_var_thresh, hwe_th_trio_thresh=hwe_th_trio_thresh,
+                                  chromx=chromx, chromy=chromy, chrommt=chrommt, cache=cache, upstream=filters_key,
+                                  profiler=profiler)
+        run.row_filters += ['mendel_var', 'hwe_trio']
+        run.col_filters += ['mendel_id']
+        run.filters += ['mendel_id', 'mendel_var', 'hwe_trio']
+        run.remove_fields += ['id_mendel_errors', 'id_mendel_rate', 'var_mendel_errors', 'var_mendel_rate']
+        filters_key = cache.key('trio_qc', upstream=filters_key, pedigree=input_fingerprint([pedigree]),
+                                mendel_id_thresh=mendel_id_thresh, mendel_var_thresh=mendel_var_thresh,
+                                hwe_th_trio_thresh=hwe_th_trio_thresh)
 
     if 'is_case' in mt.col:
-        gwas_pos, n_sig_var_pos = manhattan(qqtitle='Post-QC QQ Plot', mantitle='Post-QC Manhattan Plot').filter(mt)
-        qqplt_pos, lambda_gc_pos, manplt_pos = manhattan(qqtitle='Post-QC QQ Plot',
-                                                         mantitle='Post-QC Manhattan Plot').plot(gwas_pos)
+        # check if data is case-/control-only, case-control, or trio
+        print("\n" + run.data_type)
+        if (run.data_type == 'Trio') & (not pedigree):
+            print('Use --pedigree to run the Mendel error filters on the trios')
+    else:
+        print('Running HWE filters on whole dataset without spliting by phenotype status')
 
-        ncas_pre = pre_qc_counts['is_case_counts']['case']
-        ncas_pos = pos_qc_counts['is_case_counts']['case']
-        ncon_pre = pre_qc_counts['is_case_counts']['control']
-        ncon_pos = pos_qc_counts['is_case_counts']['control']
-        lambda_thous_pre = 1 + (lambda_gc_pre-1)*(1/ncas_pre+1/ncon_pre)/(1/1000+1/1000)
-        lambda_thous_pos = 1 + (lambda_gc_pos-1)*(1/ncas_pos+1/ncon_pos)/(1/1000+1/1000)
+    # per-sample and per-variant statistics and filter flags, checkpointed once and counted from the checkpoints
+    def sample_table():
+        ht = mt.cols().select(*[f for f in ['is_female', 'is_case', 'id_mendel_errors', 'id_mendel_rate']
+                                if f in mt.col], *run.col_filters)
+        return ht.annotate(**sample_metrics[ht.key]) if sample_metrics is not None else ht
 
-        qqplt_pos.savefig('gwaspy_tmp/gwaspy_qq_pos.png', dpi=300)
-        manplt_pos.savefig('gwaspy_tmp/gwaspy_man_pos.png', dpi=300)
+    def variant_table():
+        ht = mt.rows().select(*[f for f in ['aaf', 'var_mendel_errors', 'var_mendel_rate'] if f in mt.row],
+                              *run.row_filters)
+        return ht.annotate(**variant_metrics[ht.key]) if variant_metrics is not None else ht
+
+    with profiler.stage('metrics'):
+        samples_ht, _ = cache.table('sample_metrics', filters_key, sample_table)
+        variants_ht, _ = cache.table('variant_metrics', filters_key, variant_table)
+        filter_results(run, samples_ht.aggregate([hl.agg.counter(samples_ht[f].filters) for f in run.col_filters]),
+                       variants_ht.aggregate([hl.agg.counter(variants_ht[f].filters) for f in run.row_filters]))
+
+        store = QCMetricsStore(run.metrics_dir)
+        store.write_tables(samples=store.flat_table(samples_ht, run.col_filters),
+                           variants=store.flat_table(variants_ht, run.row_filters))
+
+    # FILTER OUT ALL SNPs and IDs THAT FAIL QC
+    for row in run.row_filters:
+        mt = mt.filter_rows(mt[row].filters == True, keep=False)
+    # sex warnings are reported, but the samples are kept
+    for col in [f for f in run.col_filters if f != 'sex_warnings']:
+        mt = mt.filter_cols(mt[col].filters == True, keep=False)
 
-        man_table_results = [n_sig_var_pre, n_sig_var_pos, lambda_gc_pre, lambda_gc_pos, round(lambda_thous_pre, 3),
-                             round(lambda_thous_pos, 3)]
+    with profiler.stage('post_qc_summary'):
+        mt_filtered, run.pos_qc_counts = summary_stats(mt)
+
+    # drop the fields we added as they will cause errors when exporting to VCF
+    # e.g. Error summary: HailException: Invalid type for INFO field 'pre_geno'. Found 'struct'.
+    drop_fields = run.filters + ['sex_chrom', 'pre_geno_noy', 'pre_geno_y', 'exclude_col', 'exclude_row',
+                                 'variant_qc', 'aaf', 'geno_noy', 'geno_y', 'sex_ambiguous', 'id_pass'] + \
+        run.remove_fields
+    # fields are only dropped if they are present, e.g. the fused engine does not add sex_chrom
+    drop_fields = [field for field in drop_fields if (field in mt_filtered.entry) | (field in mt_filtered.row) |
+                   (field in mt_filtered.col)]
+    mt_filtered = mt_filtered.drop(*drop_fields)
 
-    # report
     if report:
-        print('\nWriting report')
-        doc = MyDocument(basename=basename)
-        if 'is_case' in mt.col:
-            doc.flags_table(pre_qc_counts=pre_qc_counts, pos_qc_counts=pos_qc_counts, results=results,
-                            lambda_gc=lambda_gc_pos, sig_vars=n_sig_var_pos)
-        else:
-            doc.flags_table(pre_qc_counts=pre_qc_counts, pos_qc_counts=pos_qc_counts, results=results)
-        doc.general_info(pre_qc_conts=pre_qc_counts, post_qc_conts=pos_qc_counts,
-                         count_results=results, pre_filter=pre_geno_thresh, id_cr=mind_thresh, fhet_thresh=fhet_aut,
-                         var_cr=geno_thresh, miss_diff=cr_diff_thresh, hwe_con=hwe_th_con_thresh,
-                         hwe_cas=hwe_th_cas_thresh, hwe_all=hwe_th_all_thresh, data_type=data_type)
-        if 'is_case' in mt.col:
-            doc.manhattan_sec(qq_pre_path=f'{gwaspy_dir}/gwaspy_qq_pre.png', qq_pos_path=f'{gwaspy_dir}/gwaspy_qq_pos.png',
-                              man_pre_path=f'{gwaspy_dir}/gwaspy_man_pre.png',
-                              man_pos_path=f'{gwaspy_dir}/gwaspy_man_pos.png',
-                              table_results=man_table_results)
-
-        if data_type == 'Case-only':
-            doc.individual_char(id_con_pre_path='nothing here', id_cas_pre_path=f'{gwaspy_dir}/gwaspy_id_cas_pre.png',
-                                fstat_fig_path=f'{gwaspy_dir}/gwaspy_fstat_fig.png', id_all_path='nothing here',
-                                data_type=data_type)
-            doc.snp_char(var_con_pre_path='nothing here', var_cas_pre_path=f'{gwaspy_dir}/gwaspy_var_cas_pre.png',
-                         var_all_path='nothing here', data_type=data_type)
-        if data_type == 'Control-only':
-            doc.individual_char(id_con_pre_path=f'{gwaspy_dir}/gwaspy_id_con_pre.png', id_cas_pre_path='nothing here',
-                                fstat_fig_path=f'{gwaspy_dir}/gwaspy_fstat_fig.png', id_all_path='nothing here',
-                                data_type=data_type)
-            doc.snp_char(var_con_pre_path=f'{gwaspy_dir}/gwaspy_var_cas_pre.png', var_cas_pre_path='nothing here',
-                         var_all_path='nothing here', data_type=data_type)
-        if data_type == 'Case-Control':
-            doc.individual_char(id_con_pre_path=f'{gwaspy_dir}/gwaspy_id_con_pre.png',
-                                id_cas_pre_path=f'{gwaspy_dir}/gwaspy_id_cas_pre.png',
-                                fstat_fig_path=f'{gwaspy_dir}/gwaspy_fstat_fig.png', id_all_path='nothing here',
-                                data_type=data_type)
-            doc.snp_char(var_con_pre_path=f'{gwaspy_dir}/gwaspy_var_cas_pre.png',
-                         var_cas_pre_path=f'{gwaspy_dir}/gwaspy_var_cas_pre.png',
-                         var_all_path='nothing here', data_type=data_type)
-        if data_type == 'no-pheno':
-            doc.individual_char(id_con_pre_path='nothing here', id_cas_pre_path='nothing here',
-                                fstat_fig_path=f'{gwaspy_dir}/gwaspy_fstat_fig.png',
-                                id_all_path=f'{gwaspy_dir}/gwaspy_id_cas_con_pre.png', data_type=data_type)
-            doc.snp_char(var_con_pre_path='nothing here', var_cas_pre_path=f'nothing here',
-                         var_all_path=f'{gwaspy_dir}/gwaspy_var_cas_con_pre.png', data_type=data_type)
-        doc.generate_pdf(f'{gwaspy_dir}/{basename}.preimp_qc.report', clean=True, clean_tex=True)
+        plots_key = cache.key('plots', upstream=filters_key, data_type=run.data_type, mind_thresh=mind_thresh,
+                              fstat_x=fstat_x, fstat_y=fstat_y, geno_thresh=geno_thresh, exact_assoc=exact_assoc,
+                              assoc_test=assoc_test, pcs=input_fingerprint([pcs_file]) if pcs_file else None,
+                              n_pcs=n_pcs)
+        with profiler.stage('plots'):
+            if cache.fetch_files('plots', plots_key, run.work_dir, plot_files(run.data_type)):
+                run.man_results = cache.read_json('plots', plots_key)
+            else:
+                if assoc_test == 'linear':
+                    scan = AssociationScan(cache=cache, upstream=read_key, exact=exact_assoc)
+                else:
+                    scan = BatchedAssociation(test=assoc_test, pcs_file=pcs_file, n_pcs=n_pcs)
+                assets = ReportAssets(gwaspy_dir=run.work_dir, data_type=run.data_type, mind_thresh=mind_thresh,
+                                      fstat_x=fstat_x, fstat_y=fstat_y, geno_thresh=geno_thresh, scan=scan)
+                # the fused engines already have the sample call rates and F-stats the figures need
+                run.man_results = assets.run(mt_pre=mt_pre, mt=mt, mt_post=mt_filtered,
+                                             sample_metrics=samples_ht if sample_metrics is not None else None)
+                cache.store_files('plots', plots_key, run.work_dir, plot_files(run.data_type))
+                cache.write_json('plots', plots_key, run.man_results)
+    store.write_run(run)
+
+    # report, rendered from the run summary in the metrics store
+    if report:
+        report_key = cache.key('report', upstream=plots_key, basename=basename, summary=run.to_json(),
+                               report_format=report_format)
+        filename = report_file(basename, report_format)
+        with profiler.stage('report'):
+            if not cache.fetch_files('report', report_key, run.work_dir, [filename]):
+                write_report(store.read_run(work_dir=run.work_dir), report_format=report_format)
+                cache.store_files('report', report_key, run.work_dir, [filename])
 
     print('\nExporting qced file')
     if export_type:
-        from gwaspy.utils.export_file import export_qced_file
-        export_qced_file(mt=mt_filtered, out_dir=output_directory, basename=basename, export_type=export_type)
-
-    if output_directory.startswith('gs://'):
-        hl.hadoop_copy(f'file://{gwaspy_dir}/{basename}.preimp_qc.report.pdf',
-                       f'{output_directory}GWASpy/Preimp_QC/{basename}.preimp_qc.report.pdf')
-    else:
-        shutil.copyfile(f'{gwaspy_dir}/{basename}.preimp_qc.report.pdf',
-                        f'{output_directory}{basename}.preimp_qc.report.pdf')
+        export_key = cache.key('export', upstream=filters_key, export_type=export_type, out_dir=output_directory,
+                               basename=basename)
+        from gwaspy.utils.export_file import export_qced_file, exported_files
+        # the stage is only skipped while its output is still there, e.g. not after out_dir was cleaned up
+        if cache.exists('export', export_key, 'json') & all(hl.hadoop_exists(path) for path in
+                                                            exported_files(output_directory, basename, export_type)):
+            print(f'\nQC\'ed file was already exported: {cache.path("export", export_key, "json")}')
+        else:
+            with profiler.stage('export'):
+                export_qced_file(mt=mt_filtered, out_dir=output_directory, basename=basename,
+                                 export_type=export_type)
+            cache.write_json('export', export_key, {'export_type': export_type, 'out_dir': output_directory})
+
+    outputs = [filename] if report else []
+    if profile:
+        print(f'\nProfile of the QC stages\n{profiler.summary()}')
+        outputs += [os.path.basename(path) for path in
+                    profiler.write(f'{run.work_dir}/{basename}.preimp_qc.profile', basename=basename,
+                                   engine='incremental' if incremental else 'fused' if fused else 'chained',
+                                   pedigree=pedigree)]
+
+    for output in outputs:
+        if output_directory.startswith('gs://'):
+            hl.hadoop_copy(f'file://{run.work_dir}/{output}', f'{output_directory}GWASpy/Preimp_QC/{output}')
+        else:
+            shutil.copyfile(f'{run.work_dir}/{output}', f'{output_directory}{output}')
 
     # clean-up
     print('\nCleaning up')
-    shutil.rmtree('gwaspy_tmp')
+    shutil.rmtree(run.work_dir)
 
     print("\nDone running QC!")
 
+    return run
+
+
+def threshold_sweep(input_type: str = None, dirname: str = None, basename: str = None,
+                    pre_geno_thresh: Union[int, float] = 0.95, mind_grid: List[float] = None,
+                    fhet_aut: Union[int, float] = 0.2, fstat_x: Union[int, float] = 0.5,
+                    fstat_y: Union[int, float] = 0.5, geno_grid: List[float] = None, cr_diff_grid: List[float] = None,
+                    hwe_th_con_grid: List[float] = None, hwe_th_cas_grid: List[float] = None,
+                    hwe_th_all_grid: List[float] = None, hwe_th_con_thresh: Union[int, float] = 1e-6,
+                    hwe_th_cas_thresh: Union[int, float] = 1e-10, hwe_th_all_thresh: Union[int, float] = 1e-6,
+                    annotations_file: str = None, out_dir: str = None, reference: str = 'GRCh38',
+                    cache_dir: str = None):
+    """
+    Report how many samples and variants every combination of the mind, geno, midi and HWE thresholds would filter,
+    computing the QC statistics once. Writes a TSV with one row per combination and a plot comparing the survivors.
+    A grid left as None uses the threshold preimp_qc would apply
+    """
+    print('\nRunning QC threshold sweep')
+
+    output_directory = out_dir if out_dir else dirname
+
+    hl.init(default_reference=reference, idempotent=True)
+
+    cache = StageCache(cache_dir if cache_dir else f'{output_directory}GWASpy/Preimp_QC/cache')
+    mt, read_key = read_stage(cache=cache, input_type=input_type, dirname=dirname, basename=basename,
+                              annotations_file=annotations_file, reference=reference)
+
+    pre_qc_counts, chroms = pre_qc_summary(mt=mt, cache=cache, read_key=read_key)
+    data_type = get_data_type(pre_qc_counts)
+    chromx, chromy, chrommt = sex_chromosomes(chroms)
+    _, _, _, hwe_filters = filter_names(data_type=data_type, hwe_th_con_thresh=hwe_th_con_thresh,
+                                        hwe_th_cas_thresh=hwe_th_cas_thresh, hwe_th_all_thresh=hwe_th_all_thresh)
+    print("\n" + data_type)
+
+    hwe_grids = {'hwe_con': hwe_th_con_grid, 'hwe_cas': hwe_th_cas_grid, 'hwe_all': hwe_th_all_grid}
+    hwe_grids = {name: hwe_grids[name] if hwe_grids[name] else [thresh] for name, thresh in hwe_filters.items()}
+
+    sweep = ThresholdSweep(mind_grid=mind_grid if mind_grid else [0.98], geno_grid=geno_grid if geno_grid else [0.98],
+                           cr_diff_grid=cr_diff_grid if cr_diff_grid else [0.02], hwe_grids=hwe_grids,
+                           pre_geno_cr=pre_geno_thresh, fhet_thresh=fhet_aut, fstat_x=fstat_x, fstat_y=fstat_y,
+                           chromx=chromx, chromy=chromy, chrommt=chrommt, cache=cache)
+    df = sweep.run_sweep(mt, upstream=read_key)
+
+    sweep_dir = f'{output_directory}GWASpy/Preimp_QC/'
+    work_dir = tempfile.mkdtemp(prefix=f'gwaspy_{os.path.basename(basename)}_', dir=os.getcwd())
+    df.to_csv(f'{work_dir}/{basename}.preimp_qc.sweep.tsv', sep='\t', index=False)
+    sweep_plot(df, f'{work_dir}/{basename}.preimp_qc.sweep.png')
+    for ext in ['tsv', 'png']:
+        hl.hadoop_copy(f'file://{work_dir}/{basename}.preimp_qc.sweep.{ext}',
+                       f'{sweep_dir}{basename}.preimp_qc.sweep.{ext}')
+    shutil.rmtree(work_dir)
+
+    print(df.to_string(index=False))
+    print(f'\nThreshold sweep results written to {sweep_dir}{basename}.preimp_qc.sweep.tsv')
+
+    return df
+
 
 def main():
     parser = argparse.ArgumentParser(description='preimp_qc')
     parser.add_argument('--dirname', type=str, required=True)
     parser.add_argument('--basename', type=str, required=True)
-    parser.add_argument('--input-type', type=str, required=True, choices=['vcf', 'plink', 'hail'])
-    parser.add_argument('--export-type', type=str, default='hail', choices=['vcf', 'plink', 'hail'])
+    parser.add_argument('--input-type', type=str, required=True, choices=['vcf', 'plink', 'bgen', 'hail'])
+    parser.add_argument('--export-type', type=str, default=None, choices=['vcf', 'plink', 'hail'],
+                        help="default is hail, and plink with the local engine")
     parser.add_argument('--out-dir', type=str, default=None)
     parser.add_argument('--annotations', type=str)
     parser.add_argument('--reference', type=str, default='GRCh38')
     parser.add_argument('--report', action='store_false')
+    parser.add_argument('--report-format', type=str, default='latex', choices=['latex', 'html', 'pdf'],
+                        help="latex needs a LaTeX install. html writes one self-contained HTML file and pdf a PDF "
+                             "drawn with matplotlib, both without LaTeX")
+    parser.add_argument('--no-fused', action='store_false',
+                        help="run each QC filter as its own aggregation instead of the fused QC engine")
+    parser.add_argument('--engine', type=str, default='hail', choices=['hail', 'local'],
+                        help="local runs the QC with NumPy on a memory-mapped PLINK .bed, without starting Hail/Spark. "
+                             "Only for local PLINK input")
+    parser.add_argument('--incremental', type=str, default=None,
+                        help="directory of the per-variant QC statistics of the batches QC'ed so far. The input is "
+                             "QC'ed as a new batch and its statistics are added to the directory")
+    parser.add_argument('--genotype-cache', type=str, default=None,
+                        help="local directory to write the input to as a genotype cache, which the PCA can then "
+                             "read from with its --genotype-cache")
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help="directory for stage checkpoints. Default is OUT_DIR/GWASpy/Preimp_QC/cache")
+    parser.add_argument('--exact-assoc', action='store_true',
+                        help="rerun the post-QC association scan from scratch instead of deriving it from the "
+                             "cached pre-QC statistics")
+    parser.add_argument('--assoc-test', type=str, default='linear', choices=['linear', 'wald', 'lrt', 'score', 'firth'],
+                        help="association test of is_case for the report QQ/Manhattan plots. The logistic tests "
+                             "(wald, lrt, score, firth) can use PCs as covariates")
+    parser.add_argument('--pcs-file', type=str, default=None,
+                        help="PC scores file from gwaspy pca, whose top PCs are used as covariates by the logistic tests")
+    parser.add_argument('--n-pcs', type=int, default=10, help="number of PCs to use as covariates")
     # parser.add_argument('--qc_round', type=str, required=True)
+    parser.add_argument('--sweep', action='store_true',
+                        help="only report how many samples/variants each combination of the --sweep-* thresholds "
+                             "filters, without filtering or exporting the data")
+    parser.add_argument('--sweep-mind', type=str, default=None, help="comma-separated --mind values to sweep")
+    parser.add_argument('--sweep-geno', type=str, default=None, help="comma-separated --geno values to sweep")
+    parser.add_argument('--sweep-midi', type=str, default=None, help="comma-separated --midi values to sweep")
+    parser.add_argument('--sweep-hwe-th-con', type=str, default=None,
+                        help="comma-separated --hwe-th-con values to sweep")
+    parser.add_argument('--sweep-hwe-th-cas', type=str, default=None,
+                        help="comma-separated --hwe-th-cas values to sweep")
+    parser.add_argument('--sweep-hwe-th-all', type=str, default=None,
+                        help="comma-separated --hwe-th-all values to sweep")
 
     # required for QC
     parser.add_argument('--pre-geno', type=float, default=0.95,
@@ -381,13 +730,49 @@ def main():
     parser.add_argument('--hwe-th-cas', type=float, default=1e-10, help="HWE cases < NUM")
     parser.add_argument('--hwe-th-all', type=float, default=1e-06, help="HWE cases + controls < NUM")
 
-    arg = parser.parse_args()
+    # trio QC, with a pedigree
+    parser.add_argument('--pedigree', type=str, default=None,
+                        help="PLINK .fam pedigree. The complete trios in the data are checked for Mendel errors")
+    parser.add_argument('--mendel-id', type=float, default=0.05,
+                        help="exclude IDs with more than NUM Mendel errors per SNP, over the trios they are in")
+    parser.add_argument('--mendel-var', type=float, default=0.1,
+                        help="exclude SNPs with Mendel errors in a fraction > NUM of the trios")
+    parser.add_argument('--hwe-th-trio', type=float, default=1e-06, help="HWE founders < NUM")
+    parser.add_argument('--profile', action='store_true',
+                        help="time every QC stage (the fused passes, or every filter forced on its own with "
+                             "--no-fused), with its Spark tasks and bytes, and write "
+                             "BASENAME.preimp_qc.profile.json/.folded next to the report")
 
+    arg = parser.parse_args()
+    log_to_stdout()
+
+    if arg.sweep:
+        def grid(values, default):
+            return parse_grid(values) if values else [default]
+
+        threshold_sweep(input_type=arg.input_type, dirname=arg.dirname, basename=arg.basename,
+                        pre_geno_thresh=arg.pre_geno, mind_grid=grid(arg.sweep_mind, arg.mind), fhet_aut=arg.fhet_aut,
+                        fstat_x=arg.fstat_x, fstat_y=arg.fstat_y, geno_grid=grid(arg.sweep_geno, arg.geno),
+                        cr_diff_grid=grid(arg.sweep_midi, arg.midi),
+                        hwe_th_con_grid=parse_grid(arg.sweep_hwe_th_con) if arg.sweep_hwe_th_con else None,
+                        hwe_th_cas_grid=parse_grid(arg.sweep_hwe_th_cas) if arg.sweep_hwe_th_cas else None,
+                        hwe_th_all_grid=parse_grid(arg.sweep_hwe_th_all) if arg.sweep_hwe_th_all else None,
+                        hwe_th_con_thresh=arg.hwe_th_con, hwe_th_cas_thresh=arg.hwe_th_cas,
+                        hwe_th_all_thresh=arg.hwe_th_all, annotations_file=arg.annotations, out_dir=arg.out_dir,
+                        reference=arg.reference, cache_dir=arg.cache_dir)
+        return
+
+    export_type = arg.export_type if arg.export_type else ('plink' if arg.engine == 'local' else 'hail')
     preimp_qc(input_type=arg.input_type, dirname=arg.dirname, basename=arg.basename, pre_geno_thresh=arg.pre_geno,
               mind_thresh=arg.mind, fhet_aut=arg.fhet_aut, fstat_x=arg.fstat_x, fstat_y=arg.fstat_y,
               geno_thresh=arg.geno, cr_diff_thresh=arg.midi, maf_thresh=arg.maf, hwe_th_con_thresh=arg.hwe_th_con,
               hwe_th_cas_thresh=arg.hwe_th_cas, hwe_th_all_thresh=arg.hwe_th_all, annotations_file=arg.annotations,
-              report=arg.report, export_type=arg.export_type, out_dir=arg.out_dir, reference=arg.reference)
+              report=arg.report, export_type=export_type, out_dir=arg.out_dir, reference=arg.reference,
+              fused=arg.no_fused, cache_dir=arg.cache_dir, exact_assoc=arg.exact_assoc, assoc_test=arg.assoc_test,
+              pcs_file=arg.pcs_file, n_pcs=arg.n_pcs, engine=arg.engine, genotype_cache=arg.genotype_cache,
+              incremental=arg.incremental, report_format=arg.report_format, pedigree=arg.pedigree,
+              mendel_id_thresh=arg.mendel_id, mendel_var_thresh=arg.mendel_var, hwe_th_trio_thresh=arg.hwe_th_trio,
+              profile=arg.profile)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,136 @@
+__author__ = 'Lindo Nkambule'
+
+import json
+import time
+import urllib.request
+import hail as hl
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+# Spark stage metrics summed for each profiled QC stage: REST API field -> profile field
+SPARK_METRICS = {'numTasks': 'tasks', 'executorRunTime': 'executor_run_ms', 'inputBytes': 'input_bytes',
+                 'outputBytes': 'output_bytes', 'shuffleReadBytes': 'shuffle_read_bytes',
+                 'shuffleWriteBytes': 'shuffle_write_bytes'}
+
+
+class QCProfiler:
+    """
+    Instrumentation mode of preimp_qc. The filters are lazy and fused into the aggregations that force them, so a
+    profiled filter is forced on its own: the row and column fields it adds are checkpointed and annotated back, and
+    the filters after it read the checkpoint. Each profiled stage records its wall time and the Spark stages it ran
+    (tasks, executor time and bytes read, written and shuffled), read from the Spark UI REST API of the Hail session.
+
+    Forcing every filter separately is slower than a normal run, so the profile tells which filters are costly
+    relative to each other, not how long an unprofiled run takes. Only the chained filters go through filter(): the
+    fused engine already writes each of its passes, which are timed with stage(). With profiling disabled, stage()
+    and filter() add nothing to the run
+    """
+    def __init__(self, enabled: bool = True, root: str = 'preimp_qc'):
+        self.enabled = enabled
+        self._path = [root]
+        self.stages = []
+        self._ui = None
+
+    def _spark_stages(self) -> Optional[Dict[tuple, Dict[str, Any]]]:
+        """Stages of the Spark application by (id, attempt), or None if the Spark UI is not reachable"""
+        try:
+            if self._ui is None:
+                sc = hl.spark_context()
+                self._ui = f'{sc.uiWebUrl}/api/v1/applications/{sc.applicationId}/stages' if sc.uiWebUrl else ''
+            if not self._ui:
+                return None
+            with urllib.request.urlopen(self._ui, timeout=30) as response:
+                stages = json.load(response)
+        except Exception as e:
+            print(f'\nSpark stage metrics are not available: {e}')
+            self._ui = ''
+            return None
+
+        return {(stage['stageId'], stage['attemptId']): stage for stage in stages}
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time the block, and the Spark stages it runs, as a stage of the profile. Stages can be nested"""
+        if not self.enabled:
+            yield
+            return
+
+        before = self._spark_stages()
+        self._path.append(name)
+        path = ';'.join(self._path)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self._path.pop()
+            record = {'stage': name, 'path': path, 'seconds': round(seconds, 3), 'spark': None}
+
+            after = self._spark_stages() if before is not None else None
+            if after is not None:
+                new = [stage for key, stage in after.items()
+                       if (key not in before) & (stage.get('status') in ['COMPLETE', 'FAILED'])]
+                record['spark'] = {'stages': len(new),
+                                   **{field: sum(stage.get(metric, 0) for stage in new)
+                                      for metric, field in SPARK_METRICS.items()}}
+            self.stages.append(record)
+
+    def filter(self, name: str, filt, mt: hl.MatrixTable) -> hl.MatrixTable:
+        """Apply a BaseFilter and, when profiling, force it on its own (see the class docstring)"""
+        if not self.enabled:
+            return filt.filter(mt)
+
+        with self.stage(name):
+            rows, cols = set(mt.row), set(mt.col)
+            mt = filt.filter(mt)
+            new_rows = [field for field in mt.row if field not in rows]
+            new_cols = [field for field in mt.col if field not in cols]
+            if new_rows:
+                ht = mt.rows().select(*new_rows).checkpoint(hl.utils.new_temp_file(f'profile_{name}', 'ht'))
+                mt = mt.drop(*new_rows)
+                mt = mt.annotate_rows(**ht[mt.row_key])
+            if new_cols:
+                ht = mt.cols().select(*new_cols).checkpoint(hl.utils.new_temp_file(f'profile_{name}', 'ht'))
+                mt = mt.drop(*new_cols)
+                mt = mt.annotate_cols(**ht[mt.col_key])
+
+        return mt
+
+    def folded(self) -> List[str]:
+        """
+        The profile as folded stacks (one 'root;parent;stage milliseconds' line per stage), the input of flame graph
+        tools such as flamegraph.pl and speedscope. The time of a stage excludes its nested stages
+        """
+        nested = {}
+        for record in self.stages:
+            parent = record['path'].rsplit(';', 1)[0]
+            nested[parent] = nested.get(parent, 0) + record['seconds']
+
+        return [f"{record['path']} {max(int(round((record['seconds'] - nested.get(record['path'], 0)) * 1000)), 0)}"
+                for record in self.stages]
+
+    def summary(self, width: int = 40) -> str:
+        """Stages from the slowest, with their share of the profiled time as a bar"""
+        top = [record for record in self.stages if record['path'].count(';') == 1]
+        total = sum(record['seconds'] for record in top) or 1
+        lines = [f'{"stage":<40}{"seconds":>10}{"tasks":>8}{"shuffled MB":>13}  share']
+        for record in sorted(self.stages, key=lambda r: -r['seconds']):
+            spark = record['spark'] or {}
+            shuffled = (spark.get('shuffle_read_bytes', 0) + spark.get('shuffle_write_bytes', 0)) / 1e6
+            name = record['path'].split(';', 1)[1].replace(';', ' > ')
+            lines.append(f'{name:<40}{record["seconds"]:>10.1f}{spark.get("tasks", 0):>8}{shuffled:>13.1f}  '
+                         f'{"#" * int(round(width * record["seconds"] / total))}')
+
+        return '\n'.join(lines)
+
+    def write(self, prefix: str, **info) -> List[str]:
+        """
+        Write PREFIX.json (the stages with their Spark metrics and info) and PREFIX.folded
+        :return: the written files
+        """
+        with open(f'{prefix}.json', 'w') as f:
+            json.dump({**info, 'stages': self.stages}, f, indent=2)
+        with open(f'{prefix}.folded', 'w') as f:
+            f.write('\n'.join(self.folded()) + '\n')
+
+        return [f'{prefix}.json', f'{prefix}.folded']
@@ -0,0 +1,177 @@
+__author__ = 'Lindo Nkambule'
+
+import json
+import os
+import tempfile
+import hail as hl
+import pandas as pd
+from typing import Any, Dict, List, Optional
+
+# data types with cases or controls, the ones the association scan and the Manhattan section of the report are run for
+CASE_CONTROL_DATA_TYPES = ['Case-only', 'Control-only', 'Case-Control']
+
+
+class QCThresholds:
+    def __init__(self, pre_geno: float = 0.95, mind: float = 0.98, fhet_aut: float = 0.2, fstat_x: float = 0.5,
+                 fstat_y: float = 0.5, geno: float = 0.98, cr_diff: float = 0.02, maf: float = 0.01,
+                 hwe_con: float = 1e-6, hwe_cas: float = 1e-10, hwe_all: float = 1e-6, mendel_id: float = 0.05,
+                 mendel_var: float = 0.1, hwe_trio: float = 1e-6):
+        self.pre_geno = pre_geno
+        self.mind = mind
+        self.fhet_aut = fhet_aut
+        self.fstat_x = fstat_x
+        self.fstat_y = fstat_y
+        self.geno = geno
+        self.cr_diff = cr_diff
+        self.maf = maf
+        self.hwe_con = hwe_con
+        self.hwe_cas = hwe_cas
+        self.hwe_all = hwe_all
+        self.mendel_id = mendel_id
+        self.mendel_var = mendel_var
+        self.hwe_trio = hwe_trio
+
+    def to_dict(self) -> Dict[str, float]:
+        return dict(vars(self))
+
+
+class QCRun:
+    """
+    Everything one preimp_qc run produces and passes between its stages (filter names, counts before and after QC,
+    filter results, association results), so several cohorts can be QC'ed in one process without sharing state.
+    Each run gets its own local work directory for the report figures and LaTeX files
+    """
+    def __init__(self, basename: str, output_directory: str, thresholds: QCThresholds = None, work_dir: str = None,
+                 data_type: str = None, row_filters: List[str] = None, col_filters: List[str] = None,
+                 filters: List[str] = None, remove_fields: List[str] = None, hwe_filters: Dict[str, float] = None,
+                 pre_qc_counts: Dict[str, Any] = None, pos_qc_counts: Dict[str, Any] = None,
+                 results: Dict[str, Dict[bool, int]] = None, man_results: Dict[str, Any] = None,
+                 n_trios: int = None):
+        self.basename = basename
+        self.output_directory = output_directory
+        self.thresholds = thresholds if thresholds else QCThresholds()
+        self.work_dir = work_dir
+        self.data_type = data_type
+        self.row_filters = row_filters if row_filters else []
+        self.col_filters = (col_filters if col_filters is not None else
+                            ['mind', 'fstat', 'sex_violations', 'sex_warnings'])
+        self.filters = filters if filters else []
+        self.remove_fields = remove_fields if remove_fields else []
+        self.hwe_filters = hwe_filters if hwe_filters else {}
+        self.pre_qc_counts = pre_qc_counts if pre_qc_counts else {}
+        self.pos_qc_counts = pos_qc_counts if pos_qc_counts else {}
+        # filter name -> {False: number passing, True: number failing}
+        self.results = results if results else {}
+        self.man_results = man_results if man_results else {}
+        # complete trios of the pedigree in the data, if the Mendel error filters were run
+        self.n_trios = n_trios
+
+    def make_work_dir(self) -> str:
+        # LaTeX needs full paths to the figures
+        self.work_dir = tempfile.mkdtemp(prefix=f'gwaspy_{os.path.basename(self.basename)}_', dir=os.getcwd())
+        return self.work_dir
+
+    @property
+    def metrics_dir(self) -> str:
+        return f'{self.output_directory}GWASpy/Preimp_QC/{self.basename}.metrics'
+
+    def man_table(self) -> Optional[List]:
+        """Number of GWAS hits, lambda GC and lambda 1000 before and after QC, for the report"""
+        if not self.man_results:
+            return None
+        lambda_gc_pre, lambda_gc_pos = self.man_results['lambda_gc_pre'], self.man_results['lambda_gc_pos']
+
+        ncas_pre = self.pre_qc_counts['is_case_counts']['case']
+        ncas_pos = self.pos_qc_counts['is_case_counts']['case']
+        ncon_pre = self.pre_qc_counts['is_case_counts']['control']
+        ncon_pos = self.pos_qc_counts['is_case_counts']['control']
+
+        def lambda_thous(lambda_gc, ncas, ncon):
+            # lambda GC is None without any p-value, e.g. with cases or controls only
+            if (lambda_gc is None) or (ncas == 0) or (ncon == 0):
+                return None
+            return round(1 + (lambda_gc-1)*(1/ncas+1/ncon)/(1/1000+1/1000), 3)
+
+        return [self.man_results['n_sig_var_pre'], self.man_results['n_sig_var_pos'], lambda_gc_pre, lambda_gc_pos,
+                lambda_thous(lambda_gc_pre, ncas_pre, ncon_pre), lambda_thous(lambda_gc_pos, ncas_pos, ncon_pos)]
+
+    def to_json(self) -> Dict[str, Any]:
+        summary = {name: value for name, value in vars(self).items() if name != 'work_dir'}
+        summary['thresholds'] = self.thresholds.to_dict()
+        # JSON keys are strings, so the filter results are written as fail/pass counts
+        summary['results'] = {name: {'fail': counts.get(True, 0), 'pass': counts.get(False, 0)}
+                              for name, counts in self.results.items()}
+
+        return summary
+
+    @staticmethod
+    def from_json(summary: Dict[str, Any], work_dir: str = None) -> 'QCRun':
+        summary = dict(summary)
+        summary['thresholds'] = QCThresholds(**summary['thresholds'])
+        summary['results'] = {name: {True: counts['fail'], False: counts['pass']}
+                              for name, counts in summary['results'].items()}
+
+        return QCRun(work_dir=work_dir, **summary)
+
+
+class QCMetricsStore:
+    """
+    Columnar store of one QC run: the per-sample and per-variant statistics and filter flags as Parquet, and the run
+    summary (QCRun) the report is rendered from. Each run writes to its own directory (QCRun.metrics_dir):
+
+        samples.parquet    one row per sample: sex, phenotype, call rate, F-stats and one boolean column per filter
+        variants.parquet   one row per variant: locus, alleles, call rates, allele counts and one column per filter
+        summary.json       QCRun, with the number of samples/variants failing each filter
+
+    The hail engine reads and writes through the Hadoop filesystem of Hail. With local=True (the local engine) the
+    store is a local directory read and written without Hail, so no JVM is started
+    """
+    def __init__(self, path: str, local: bool = False):
+        self._path = path.rstrip('/')
+        self._local = local
+
+    def path(self, name: str) -> str:
+        return f'{self._path}/{name}'
+
+    @staticmethod
+    def flat_table(ht: hl.Table, flags: List[str]) -> hl.Table:
+        """Filter structs to boolean columns and locus/alleles to strings, so the table has Parquet types"""
+        ht = ht.annotate(**{flag: ht[flag].filters for flag in flags if flag in ht.row})
+        if 'locus' in ht.row:
+            ht = ht.key_by(contig=ht.locus.contig, position=ht.locus.position, alleles=hl.delimit(ht.alleles, ','))
+            ht = ht.drop('locus')
+
+        return ht.flatten()
+
+    def write_tables(self, samples: hl.Table, variants: hl.Table):
+        """Write the metrics of the Hail engine, through Spark so the variants are not collected on the driver"""
+        for name, ht in [('samples', samples), ('variants', variants)]:
+            ht.to_spark().write.mode('overwrite').parquet(self.path(f'{name}.parquet'))
+
+    def write_frames(self, samples: pd.DataFrame, variants: pd.DataFrame):
+        """Write the metrics of the local engine"""
+        os.makedirs(self._path, exist_ok=True)
+        samples.to_parquet(self.path('samples.parquet'), index=False)
+        variants.to_parquet(self.path('variants.parquet'), index=False)
+
+    def _open(self, name: str, mode: str):
+        if self._local:
+            if 'w' in mode:
+                os.makedirs(self._path, exist_ok=True)
+            return open(self.path(name), mode)
+
+        return hl.hadoop_open(self.path(name), mode)
+
+    def write_run(self, run: QCRun):
+        with self._open('summary.json', 'w') as f:
+            json.dump(run.to_json(), f, default=str)
+
+    def read_run(self, work_dir: str = None) -> QCRun:
+        with self._open('summary.json', 'r') as f:
+            return QCRun.from_json(json.load(f), work_dir=work_dir)
+
+    def samples(self, columns: List[str] = None) -> pd.DataFrame:
+        return pd.read_parquet(self.path('samples.parquet'), columns=columns)
+
+    def variants(self, columns: List[str] = None) -> pd.DataFrame:
+        return pd.read_parquet(self.path('variants.parquet'), columns=columns)
@@ -0,0 +1,240 @@
+__author__ = 'Lindo Nkambule'
+
+import multiprocessing
+import os
+import time
+import hail as hl
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Tuple
+from gwaspy.preimp_qc import plots
+from gwaspy.preimp_qc.association import AssociationScan
+from gwaspy.preimp_qc.aggregators import impute_sex_aggregator
+from gwaspy.preimp_qc.qc_context import CASE_CONTROL_DATA_TYPES
+from gwaspy.utils.timing import logger
+
+
+def render_figure(job: Dict[str, Any]) -> Tuple[str, float]:
+    """Render one report figure from its plot data and save it. Runs in a worker process"""
+    start = time.perf_counter()
+    fig = getattr(plots, job['render'])(**job['kwargs'])
+    fig.savefig(job['path'], dpi=300)
+
+    return os.path.basename(job['path']), time.perf_counter() - start
+
+
+def rebin(bin_edges, bin_freq, start: float, end: float, bins: int = 50) -> Tuple[np.ndarray, np.ndarray]:
+    """Merge a fine histogram into `bins` bins between start and end, assigning each fine bin by its centre"""
+    if start == end:
+        start, end = start - 0.5, end + 0.5
+    edges = np.linspace(start, end, bins + 1)
+    fine_edges = np.array(bin_edges)
+    centres = (fine_edges[:-1] + fine_edges[1:]) / 2
+    index = np.clip(np.searchsorted(edges, centres, side='right') - 1, 0, bins - 1)
+    freq = np.bincount(index, weights=np.array(bin_freq, dtype=float), minlength=bins)
+
+    return edges, freq
+
+
+class ReportAssets:
+    """
+    Builds the preimp_qc report figures. All the plot data (sample call rates and F-stats, variant call rates, QQ and
+    Manhattan data of the pre- and post-QC association scans) comes from one Hail aggregation over the variants,
+    instead of one Hail job per figure. The figures are then rendered in parallel in a process pool.
+
+    The sample statistics are aggregated per column of the localized entries (hl.agg.array_agg), next to the variant
+    statistics. Statistics an earlier stage already has are not read from the entries again: the sample call rates and
+    F-stats come from the sample metrics of the fused QC (as a global), and the call rates of cases and controls from
+    the pre-QC association statistics (AssociationScan.pre_stats). With both, the entries are not read at all.
+    """
+    def __init__(self, gwaspy_dir: str, data_type: str = None, mind_thresh: float = 0.98, fstat_x: float = 0.5,
+                 fstat_y: float = 0.5, geno_thresh: float = 0.98, workers: int = None, fine_bins: int = 1000,
+                 scan: AssociationScan = None):
+        self._gwaspy_dir = gwaspy_dir
+        self._data_type = data_type
+        self._mind = mind_thresh
+        self._fstat_x = fstat_x
+        self._fstat_y = fstat_y
+        self._geno = geno_thresh
+        self._workers = workers if workers else os.cpu_count()
+        self._fine_bins = fine_bins
+        self._scan = scan if scan else AssociationScan()
+
+    def _groups(self, cols: hl.StructExpression) -> List[Tuple[str, str, hl.BooleanExpression]]:
+        """(file suffix, title, column filter) of the call rate histograms, from the column fields of one sample"""
+        if ('is_case' not in cols) | (self._data_type == 'Trio'):
+            return [('cas_con', 'Cases+Controls', hl.bool(True))]
+        if self._data_type == 'Case-only':
+            return [('cas', 'Cases', cols.is_case == True)]
+        if self._data_type == 'Control-only':
+            return [('con', 'Controls', cols.is_case == False)]
+        if self._data_type == 'Case-Control':
+            return [('con', 'Controls', cols.is_case == False), ('cas', 'Cases', cols.is_case == True)]
+
+        return []
+
+    def plot_data(self, mt: hl.MatrixTable, sample_metrics: hl.Table = None, gwas_pre: hl.Table = None,
+                  gwas_pos: hl.Table = None, bin_size: int = None, assoc_stats: hl.Table = None,
+                  assoc_samples: hl.Struct = None) -> hl.Struct:
+        """
+        The data of every figure, in one aggregation over the variants
+        :param mt: MatrixTable annotated with the QC filters
+        :param sample_metrics: per-sample call_rate and sex_fstat of the fused QC, with is_female and is_case
+        :param gwas_pre: association results before QC, keyed by locus and alleles
+        :param gwas_pos: association results after QC
+        :param bin_size: Manhattan bin size
+        :param assoc_stats: pre-QC association statistics of a case/control phenotype (n_called and sum_y_called)
+        :param assoc_samples: number of samples (n) and cases (sum_y) of the pre-QC association scan
+        :return: samples (F-stats of females and males, call rates per group) and the variant call rate histograms,
+            QQ and Manhattan data
+        """
+        groups = self._groups(mt.col)
+        if (sample_metrics is None) | (assoc_stats is None):
+            ht = mt.select_entries('GT').localize_entries('_entries', '_cols')
+            entries = hl.zip(ht._entries, ht._cols)
+        else:
+            ht = mt.rows()
+
+        # call rates and F-stats of the samples, over variants passing pre_geno
+        if sample_metrics is None:
+            per_sample = hl.agg.array_agg(lambda e: hl.agg.filter(ht.pre_geno.filters == False, hl.struct(
+                call_rate=hl.agg.filter(~(ht.exclude_row | e[1].exclude_col),
+                                        hl.agg.count_where(hl.is_defined(e[0].GT)) / hl.agg.count()),
+                fstat=impute_sex_aggregator(e[0].GT, ht.aaf).f_stat)), entries)
+            samples = hl.zip(ht._cols, per_sample).map(lambda s: s[0].annotate(_call_rate=s[1].call_rate,
+                                                                                  _fstat=s[1].fstat))
+        else:
+            ht = ht.annotate_globals(_samples=sample_metrics.collect(_localize=False))
+            samples = ht._samples.map(lambda s: s.annotate(_call_rate=s.call_rate, _fstat=s.sex_fstat))
+
+        def collect_where(keep, field: str) -> hl.ArrayExpression:
+            return samples.filter(lambda s: hl.coalesce(keep(s), False)).map(lambda s: s[field])
+
+        sample_data = hl.struct(
+            female=collect_where(lambda s: s.is_female == True, '_fstat'),
+            male=collect_where(lambda s: s.is_female == False, '_fstat'),
+            call_rate=hl.struct(**{suffix: collect_where(lambda s, i=i: self._groups(s)[i][2], '_call_rate')
+                                   for i, (suffix, _, _) in enumerate(groups)}))
+
+        # call rates of the variants in each group of samples
+        if assoc_stats is not None:
+            stats = assoc_stats[ht.key]
+            # the phenotype is 1 for cases, so sum_y_called is the number of called cases
+            n_called = {'cas': stats.sum_y_called, 'con': stats.n_called - stats.sum_y_called}
+            n = {'cas': assoc_samples.sum_y, 'con': assoc_samples.n - assoc_samples.sum_y}
+            ht = ht.annotate(**{
+                f'_call_rate_{suffix}': hl.or_missing(ht.pre_geno.filters == False,
+                                                      hl.float64(n_called[suffix]) / n[suffix])
+                for suffix, _, _ in groups})
+        else:
+            def variant_call_rate(i: int) -> hl.Float64Expression:
+                used = entries.filter(lambda e: hl.coalesce(self._groups(e[1])[i][2], False) &
+                                      ~(ht.exclude_row | e[1].exclude_col))
+                return hl.or_missing(ht.pre_geno.filters == False,
+                                     hl.float64(used.filter(lambda e: hl.is_defined(e[0].GT)).length()) /
+                                     used.length())
+
+            ht = ht.annotate(**{f'_call_rate_{suffix}': variant_call_rate(i)
+                                for i, (suffix, _, _) in enumerate(groups)})
+
+        aggs = {'samples': sample_data, 'call_rate': hl.struct(**{
+            suffix: hl.struct(min=hl.agg.min(ht[f'_call_rate_{suffix}']),
+                              max=hl.agg.max(ht[f'_call_rate_{suffix}']),
+                              hist=hl.agg.hist(ht[f'_call_rate_{suffix}'], 0, 1, self._fine_bins))
+            for suffix, _, _ in groups})}
+        if gwas_pre is not None:
+            ht = ht.annotate(_p_pre=gwas_pre[ht.key].p_value, _p_pos=gwas_pos[ht.key].p_value)
+            for stage in ['pre', 'pos']:
+                p_value = ht[f'_p_{stage}']
+                aggs[f'n_sig_var_{stage}'] = hl.agg.count_where(p_value < 5E-8)
+                aggs[f'qq_{stage}'] = plots.qq_agg(p_value)
+                aggs[f'man_{stage}'] = plots.manhattan_agg(p_value, ht.locus, bin_size)
+
+        return ht.aggregate(hl.struct(**aggs))
+
+    def collect(self, mt_pre: hl.MatrixTable, mt: hl.MatrixTable, mt_post: hl.MatrixTable,
+                sample_metrics: hl.Table = None) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """
+        :param sample_metrics: per-sample call_rate and sex_fstat of the fused QC, if it was run
+        :return: the figures to render, and the number of significant variants and lambda GC before and after QC
+        """
+        jobs, man_results = [], {}
+        groups = self._groups(mt.col)
+
+        # the association scan needs cases or controls, e.g. trios without a phenotype are not scanned
+        case_control = ('is_case' in mt.col) & (self._data_type in CASE_CONTROL_DATA_TYPES)
+        gwas_pre, gwas_pos, rg, bin_size, assoc_stats, assoc_samples = None, None, None, None, None, None
+        if case_control:
+            gwas_pre, gwas_pos = self._scan.run(mt_pre, mt_post)
+            rg = mt.locus.dtype.reference_genome
+            bin_size = plots.manhattan_bin_size(rg)
+            # only the linear scan from sufficient statistics keeps them (see AssociationScan.pre_stats)
+            assoc_stats = getattr(self._scan, 'pre_stats', None)
+            assoc_samples = getattr(self._scan, 'pre_samples', None)
+
+        start = time.perf_counter()
+        data = self.plot_data(mt, sample_metrics=sample_metrics, gwas_pre=gwas_pre, gwas_pos=gwas_pos,
+                              bin_size=bin_size, assoc_stats=assoc_stats, assoc_samples=assoc_samples)
+        logger.info('Report figures: aggregation took %.1fs', time.perf_counter() - start)
+        samples = data.samples
+
+        jobs.append({'path': f'{self._gwaspy_dir}/gwaspy_fstat_fig.png', 'render': 'fstat_plot',
+                     'kwargs': {'df_female': pd.DataFrame({'filters': [f for f in samples.female if f is not None]}),
+                                'df_male': pd.DataFrame({'filters': [f for f in samples.male if f is not None]}),
+                                'f_stat_y': self._fstat_y, 'f_stat_x': self._fstat_x, 'figsize': (15, 20)}})
+
+        for suffix, title, _ in groups:
+            call_rate = np.array([cr for cr in samples.call_rate[suffix] if cr is not None], dtype=float)
+            freq, edges = np.histogram(call_rate[np.isfinite(call_rate)], bins=50)
+            jobs.append({'path': f'{self._gwaspy_dir}/gwaspy_id_{suffix}_pre.png', 'render': 'hist_render',
+                         'kwargs': {'bin_edges': edges, 'bin_freq': freq, 'threshold': self._mind, 'title': title,
+                                    'x_label': 'Call Rate'}})
+
+            var_cr = data.call_rate[suffix]
+            if var_cr.min is None:
+                edges, freq = rebin(var_cr.hist.bin_edges, var_cr.hist.bin_freq, 0, 1)
+            else:
+                edges, freq = rebin(var_cr.hist.bin_edges, var_cr.hist.bin_freq, var_cr.min, var_cr.max)
+            jobs.append({'path': f'{self._gwaspy_dir}/gwaspy_var_{suffix}_pre.png', 'render': 'hist_render',
+                         'kwargs': {'bin_edges': edges, 'bin_freq': freq, 'threshold': self._geno, 'title': title,
+                                    'x_label': 'Call Rate'}})
+
+        if case_control:
+            for stage, label in [('pre', 'Pre-QC'), ('pos', 'Post-QC')]:
+                qq = data[f'qq_{stage}']
+                expected_p, observed_p = plots.qq_points(qq)
+                man_results[f'n_sig_var_{stage}'] = data[f'n_sig_var_{stage}']
+                man_results[f'lambda_gc_{stage}'] = plots.qq_lambda_gc(qq)
+                jobs.append({'path': f'{self._gwaspy_dir}/gwaspy_qq_{stage}.png', 'render': 'qq_render',
+                             'kwargs': {'expected_p': expected_p, 'observed_p': observed_p,
+                                        'title': f'{label} QQ Plot'}})
+                jobs.append({'path': f'{self._gwaspy_dir}/gwaspy_man_{stage}.png', 'render': 'manhattan_render',
+                             'kwargs': {**plots.manhattan_points(data[f'man_{stage}'], rg, bin_size),
+                                        'title': f'{label} Manhattan Plot'}})
+
+        return jobs, man_results
+
+    def render(self, jobs: List[Dict[str, Any]]):
+        start = time.perf_counter()
+        # spawn, so the workers do not inherit the driver's connection to the JVM
+        with ProcessPoolExecutor(max_workers=min(self._workers, len(jobs)),
+                                 mp_context=multiprocessing.get_context('spawn')) as pool:
+            for filename, seconds in pool.map(render_figure, jobs):
+                logger.info('Report figures: rendered %s in %.1fs', filename, seconds)
+        logger.info('Report figures: rendered %d figures in %.1fs', len(jobs), time.perf_counter() - start)
+
+    def run(self, mt_pre: hl.MatrixTable, mt: hl.MatrixTable, mt_post: hl.MatrixTable,
+            sample_metrics: hl.Table = None) -> Dict[str, Any]:
+        """
+        Save the report figures to gwaspy_dir
+        :param mt_pre: MatrixTable before QC
+        :param mt: MatrixTable annotated with the QC filters
+        :param mt_post: MatrixTable with the variants and samples that failed QC removed
+        :param sample_metrics: per-sample call_rate and sex_fstat of the fused QC, with is_female and is_case
+        :return: number of significant variants and lambda GC before and after QC, if there is a phenotype
+        """
+        jobs, man_results = self.collect(mt_pre, mt, mt_post, sample_metrics=sample_metrics)
+        self.render(jobs)
+
+        return man_results
@@ -0,0 +1,212 @@
+__author__ = 'Lindo Nkambule'
+
+import base64
+import datetime
+import html
+import io
+from typing import List
+from gwaspy.preimp_qc.report_tables import ReportSections, call_rate_figures, count_rows, exclusion_rows, flags_rows,\
+    manhattan_rows
+
+CSS = """
+body {font-family: Helvetica, Arial, sans-serif; max-width: 60em; margin: 2em auto; color: #222;}
+h1 {text-align: center;} p.date {text-align: center;}
+table {border-collapse: collapse; margin: 1em auto;}
+th, td {border: 1px solid #444; padding: 0.25em 0.75em;}
+img {display: block; margin: 1em auto;}
+"""
+
+# widest figure side, in pixels, kept in the report. The plots are drawn at 300 dpi and 15+ inches wide
+MAX_PIXELS = 2000
+
+
+def compressed_png(path: str, max_pixels: int = MAX_PIXELS) -> bytes:
+    """A figure downscaled to max_pixels and quantised to a 256-colour palette PNG, as the plots only use a few
+    colours"""
+    from PIL import Image
+
+    with Image.open(path) as img:
+        img = img.convert('RGB')
+        img.thumbnail((max_pixels, max_pixels))
+        buffer = io.BytesIO()
+        img.quantize(colors=256).save(buffer, format='PNG', optimize=True)
+
+    return buffer.getvalue()
+
+
+class HTMLReport(ReportSections):
+    """
+    preimp_qc report without LaTeX: a single HTML file with the figures embedded, or a PDF drawn with matplotlib. The
+    sections are the ones of MyDocument, kept as a list of parts (('heading', level, text), ('table', header, rows,
+    colours), ('image', path, width)) that are only written out by generate_html/generate_pdf, one figure at a time
+    """
+    def __init__(self, basename):
+        self._basename = basename
+        self.parts = []
+
+    def _heading(self, level: int, text: str):
+        self.parts.append(('heading', level, text))
+
+    def _table(self, header: List[str], rows: List[List], colours: List[str] = None):
+        self.parts.append(('table', header, rows, colours))
+
+    def _image(self, path: str, width: float = 1.0):
+        self.parts.append(('image', path, width))
+
+    def flags_table(self, pre_qc_counts=None, pos_qc_counts=None, results=None, lambda_gc=None, sig_vars=None):
+        tbl = flags_rows(pre_qc_counts, pos_qc_counts, results, lambda_gc=lambda_gc, sig_vars=sig_vars)
+
+        self._heading(1, 'Flags')
+        self._table(['Flagname', 'Value', 'yellow-th', 'red-th', 'flag', 'color'], [row[:6] for row in tbl],
+                    colours=[row[5] for row in tbl])
+
+    def general_info(self, pre_qc_conts, post_qc_conts, count_results, pre_filter, id_cr, fhet_thresh, var_cr,
+                     miss_diff, hwe_con, hwe_cas, hwe_all, data_type, mendel_id=None, mendel_var=None, hwe_trio=None,
+                     n_trios=None):
+        self._heading(1, 'General Info')
+        self._table(['Test', 'pre QC', 'post QC', 'exlcusion-N'], count_rows(pre_qc_conts, post_qc_conts))
+        self._table(['Filter', 'N'], exclusion_rows(count_results, pre_filter=pre_filter, id_cr=id_cr,
+                                                    fhet_thresh=fhet_thresh, var_cr=var_cr, miss_diff=miss_diff,
+                                                    hwe_con=hwe_con, hwe_cas=hwe_cas, hwe_all=hwe_all,
+                                                    data_type=data_type, mendel_id=mendel_id, mendel_var=mendel_var,
+                                                    hwe_trio=hwe_trio, n_trios=n_trios))
+
+    def manhattan_sec(self, qq_pre_path, qq_pos_path, man_pre_path, man_pos_path, table_results):
+        self._heading(1, 'Manhattan')
+        self._heading(2, 'Basic stats')
+        self._table(['Description', 'Pre-QC', 'Post-QC'], manhattan_rows(table_results))
+
+        self._heading(2, 'Manhattan Plot - pre-QC')
+        self._image(man_pre_path)
+        self._image(qq_pre_path, width=0.85)
+
+        self._heading(2, 'Manhattan Plot - post-QC')
+        self._image(man_pos_path)
+        self._image(qq_pos_path, width=0.85)
+
+    def individual_char(self, id_con_pre_path, id_cas_pre_path, id_all_path, fstat_fig_path, data_type):
+        self._heading(1, 'Per Individual Characteristics Analysis')
+        self._heading(2, 'Missing Rates - pre-QC')
+        for path in call_rate_figures(data_type, id_con_pre_path, id_cas_pre_path, id_all_path):
+            self._image(path)
+
+        self._heading(2, 'Fstat - Sex Violations')
+        self._image(fstat_fig_path)
+
+    def snp_char(self, var_con_pre_path, var_cas_pre_path, var_all_path, data_type):
+        self._heading(1, 'Per SNP Characteristics Analysis')
+        self._heading(2, 'Missing Rates - pre-QC')
+        for path in call_rate_figures(data_type, var_con_pre_path, var_cas_pre_path, var_all_path):
+            self._image(path)
+
+    def generate_html(self, path: str):
+        """
+        Write the report as one HTML file. Figures are compressed and base64-encoded one at a time, straight into the
+        file, so only one figure is ever held in memory
+        """
+        with open(path, 'w') as f:
+            f.write(f'<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+                    f'<title>QC Report of {html.escape(self._basename)}</title>\n<style>{CSS}</style>\n</head>\n'
+                    f'<body>\n<h1>QC Report of {html.escape(self._basename)}</h1>\n'
+                    f'<p class="date">{datetime.date.today():%B %d, %Y}</p>\n')
+
+            for part in self.parts:
+                if part[0] == 'heading':
+                    _, level, text = part
+                    f.write(f'<h{level + 1}>{html.escape(text)}</h{level + 1}>\n')
+                elif part[0] == 'table':
+                    _, header, rows, colours = part
+                    f.write('<table>\n<tr>' + ''.join(f'<th>{html.escape(str(cell))}</th>' for cell in header) +
+                            '</tr>\n')
+                    for i, row in enumerate(rows):
+                        cells = [f'<td>{html.escape(str(cell))}</td>' for cell in row]
+                        if colours:
+                            cells[-1] = f'<td style="color: {colours[i]}">{html.escape(str(row[-1]))}</td>'
+                        f.write('<tr>' + ''.join(cells) + '</tr>\n')
+                    f.write('</table>\n')
+                else:
+                    _, image_path, width = part
+                    png = compressed_png(image_path)
+                    f.write(f'<img style="width: {int(width * 100)}%" src="data:image/png;base64,')
+                    # chunks of a multiple of 3 bytes encode without padding, so they can be concatenated
+                    for start in range(0, len(png), 3 * 2 ** 16):
+                        f.write(base64.b64encode(png[start:start + 3 * 2 ** 16]).decode('ascii'))
+                    f.write('">\n')
+                    del png
+
+            f.write('</body>\n</html>\n')
+
+    def generate_pdf(self, path: str):
+        """
+        Write the report as a PDF with matplotlib, the headings, tables and figures flowed onto A4 pages. Figures are
+        downscaled as in the HTML report and a page is written out as soon as it is full
+        """
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        import numpy as np
+        from PIL import Image
+        from matplotlib.backends.backend_pdf import PdfPages
+
+        margin, line = 0.06, 0.025
+        state = {'fig': None, 'y': 1 - margin}
+
+        def new_page(pdf):
+            if state['fig'] is not None:
+                pdf.savefig(state['fig'])
+                plt.close(state['fig'])
+            state['fig'] = plt.figure(figsize=(8.27, 11.69))
+            state['y'] = 1 - margin
+
+        def make_room(pdf, height):
+            if state['fig'] is None or state['y'] - height < margin:
+                new_page(pdf)
+
+        with PdfPages(path) as pdf:
+            new_page(pdf)
+            state['fig'].text(0.5, state['y'], f'QC Report of {self._basename}', ha='center', va='top', fontsize=18)
+            state['fig'].text(0.5, state['y'] - 1.5 * line, f'{datetime.date.today():%B %d, %Y}', ha='center',
+                              va='top', fontsize=11)
+            state['y'] -= 3 * line
+
+            for part in self.parts:
+                if part[0] == 'heading':
+                    _, level, text = part
+                    if level == 1 and state['y'] < 1 - 4 * margin:
+                        new_page(pdf)
+                    make_room(pdf, 2 * line)
+                    state['fig'].text(margin, state['y'], text, va='top', fontsize=15 if level == 1 else 12,
+                                      weight='bold')
+                    state['y'] -= 1.75 * line
+                elif part[0] == 'table':
+                    _, header, rows, colours = part
+                    height = 0.6 * line * (len(rows) + 1)
+                    make_room(pdf, height)
+                    ax = state['fig'].add_axes([margin, state['y'] - height, 1 - 2 * margin, height])
+                    ax.axis('off')
+                    table = ax.table(cellText=[[str(cell) for cell in row] for row in rows], colLabels=header,
+                                     loc='upper center', cellLoc='center')
+                    table.auto_set_font_size(False)
+                    table.set_fontsize(7)
+                    for i, colour in enumerate(colours or []):
+                        table[i + 1, len(header) - 1].get_text().set_color(colour)
+                    state['y'] -= height + line
+                else:
+                    _, image_path, width = part
+                    with Image.open(image_path) as img:
+                        img = img.convert('RGB')
+                        img.thumbnail((MAX_PIXELS, MAX_PIXELS))
+                        img = np.asarray(img)
+                    ax_width = (1 - 2 * margin) * width
+                    # figure coordinates are relative to the page, which is taller than it is wide
+                    height = ax_width * img.shape[0] / img.shape[1] * 8.27 / 11.69
+                    height = min(height, 1 - 2 * margin)
+                    make_room(pdf, height)
+                    ax = state['fig'].add_axes([(1 - ax_width) / 2, state['y'] - height, ax_width, height])
+                    ax.imshow(img)
+                    ax.axis('off')
+                    state['y'] -= height + line
+                    del img
+
+            pdf.savefig(state['fig'])
+            plt.close(state['fig'])
@@ -0,0 +1,190 @@
+__author__ = 'Lindo Nkambule'
+
+from typing import Any, Dict, List
+from gwaspy.preimp_qc.qc_context import QCRun
+
+
+def flags_rows(pre_qc_counts: Dict[str, Any], pos_qc_counts: Dict[str, Any], results: Dict[str, Dict[bool, int]],
+               lambda_gc: float = None, sig_vars: int = None) -> List[List]:
+    """
+    [flag name, value, yellow threshold, red threshold, flag, colour] of every row of the Flags table. The case/control
+    rows are shown with the association results (sig_vars), i.e. for data with cases or controls
+    """
+    nids_lost = (pre_qc_counts['n_samples'] - pos_qc_counts['n_samples']) / pre_qc_counts['n_samples']
+    nids_lost = round(nids_lost, 4)
+    nids_sex_check = results['sex_warnings'][True] / pre_qc_counts['n_samples']
+    nids_sex_check = round(nids_sex_check, 4)
+
+    if ('is_case_counts' in pre_qc_counts.keys() | pos_qc_counts.keys()) & (sig_vars is not None):
+        n_controls = pos_qc_counts['is_case_counts']['control']
+        cas_con_ratio = round(pos_qc_counts['is_case_counts']['case'] / n_controls, 4) if n_controls else 'n/a'
+
+        tbl = [['Number of SNPs Post-QC', pos_qc_counts['n_variants'], 250000, 200000, 0, 'green'],
+               ['Number of Cases Post-QC', pos_qc_counts['is_case_counts']['case'], 100, 50, 0, 'green'],
+               ['Number of Controls Post-QC', pos_qc_counts['is_case_counts']['control'], 100, 50, 0, 'green'],
+               ['Case-Control ratio Post-QC', cas_con_ratio, 0.0625, 0.0278, 0, 'green'],
+               ['Number of IDs lost ratio', nids_lost, 0.01, 0.1, 0, 'green'],
+               ['Number of IDs with no Phenotype Post-QC', pos_qc_counts['is_case_counts']['unknown'], 0, 10, 0, 'green'],
+               ['Ratio of IDs that failed sex checks', nids_sex_check, 0.005, 0.025, 0, 'green'],
+               ['Lambda GC Post-QC', 'n/a' if lambda_gc is None else lambda_gc, 1.1, 1.2, 0, 'green'],
+               ['Number of Significant GWAS hits Post-QC', sig_vars, 0, 1, 0, 'green']]
+
+    else:
+        tbl = [['Number of SNPs Post-QC', pos_qc_counts['n_variants'], 250000, 200000, 0, 'green'],
+               ['Number of IDs lost ratio', nids_lost, 0.01, 0.1, 0, 'green'],
+               ['Ratio of IDs that failed sex checks', nids_sex_check, 0.005, 0.025, 0, 'green']]
+
+    for i in tbl:
+        if i[1] == 'n/a':
+            # a value that cannot be computed, e.g. lambda GC without any p-value, is worth a look but not a failure
+            i[4] = 1
+            i[5] = 'orange'
+            continue
+        if (i[0] == 'Number of SNPs Post-QC') | (i[0] == 'Number of Cases Post-QC') |\
+                (i[0] == 'Number of Controls Post-QC') | (i[0] == 'Case-Control ratio Post-QC'):
+            if (i[1] <= i[2]) & (i[1] >= i[3]):
+                i[4] = 1
+                i[5] = 'orange'
+            elif i[1] < i[3]:
+                i[4] = 2
+                i[5] = 'red'
+            else:
+                i[4] = 0
+                i[5] = 'green'
+
+        if i[0] == 'Number of IDs lost ratio':
+            if (i[1] > i[2]) & (i[1] <= i[3]):
+                i[4] = 1
+                i[5] = 'orange'
+            elif i[1] > i[3]:
+                i[4] = 2
+                i[5] = 'red'
+            else:
+                i[4] = 0
+                i[5] = 'green'
+
+        if (i[0] == 'Ratio of IDs that failed sex checks') | (i[0] == 'Lambda GC Post-QC'):
+            if (i[1] >= i[2]) & (i[1] <= i[3]):
+                i[4] = 1
+                i[5] = 'orange'
+            elif i[1] > i[3]:
+                i[4] = 2
+                i[5] = 'red'
+            else:
+                i[4] = 0
+                i[5] = 'green'
+
+        if (i[0] == 'Number of Significant GWAS hits Post-QC') | (i[0] == 'Number of IDs with no Phenotype Post-QC'):
+            if i[1] == i[2]:
+                i[4] = 0
+                i[5] = 'green'
+            elif (i[1] > i[2]) & (i[1] <= i[3]):
+                i[4] = 1
+                i[5] = 'orange'
+            else:
+                i[4] = 2
+                i[5] = 'red'
+
+    return tbl
+
+
+def count_rows(pre_qc_conts: Dict[str, Any], post_qc_conts: Dict[str, Any]) -> List[List]:
+    """[test, pre QC, post QC, exclusion-N] rows of the sample/SNP counts table"""
+    def counts(qc_counts: Dict[str, int], groups: List[str]) -> str:
+        return ', '.join(str(qc_counts[group]) for group in groups)
+
+    def diffs(field: str, groups: List[str]) -> str:
+        return ', '.join(str(pre_qc_conts[field][group] - post_qc_conts[field][group]) for group in groups)
+
+    rows = []
+    if 'is_case_counts' in pre_qc_conts.keys() | post_qc_conts.keys():
+        groups = ['case', 'control', 'unknown']
+        rows.append(['Cases, Controls, Missing', counts(pre_qc_conts['is_case_counts'], groups),
+                     counts(post_qc_conts['is_case_counts'], groups), diffs('is_case_counts', groups)])
+
+    groups = ['male', 'female', 'unknown']
+    rows.append(['Males, Females, Unspec', counts(pre_qc_conts['is_female_counts'], groups),
+                 counts(post_qc_conts['is_female_counts'], groups), diffs('is_female_counts', groups)])
+    rows.append(['SNPs', pre_qc_conts['n_variants'], post_qc_conts['n_variants'],
+                 pre_qc_conts['n_variants'] - post_qc_conts['n_variants']])
+
+    return rows
+
+
+def exclusion_rows(count_results: Dict[str, Dict[bool, int]], pre_filter: float, id_cr: float, fhet_thresh: float,
+                   var_cr: float, miss_diff: float, hwe_con: float, hwe_cas: float, hwe_all: float,
+                   data_type: str, mendel_id: float = None, mendel_var: float = None, hwe_trio: float = None,
+                   n_trios: int = None) -> List[List]:
+    """[filter, N] rows of the exclusion overview table"""
+    rows = [['SNPs: call rate < {} (pre - filter)'.format(pre_filter), count_results['pre_geno'][True]],
+            ['IDs: call rate (cases/controls) < {}'.format(id_cr), count_results['mind'][True]],
+            ['IDs: FHET outside +- {} (cases/controls)'.format(fhet_thresh), count_results['fstat'][True]],
+            ['IDs: Sex violations -excluded- (N-tested)', count_results['sex_violations'][True]],
+            ['IDs: Sex warnings (undefined phenotype / ambiguous genotypes)', count_results['sex_warnings'][True]],
+            ['SNPs: call rate < {}'.format(var_cr), count_results['geno'][True]]]
+    if 'cr_diff' in count_results:
+        rows.append(['SNPs: missing diference > {}'.format(miss_diff), count_results['cr_diff'][True]])
+    rows.append(['SNPs: without valid association p-value (invariant)', count_results['monomorphic_var'][True]])
+    if data_type in ["Control-only", "Case-Control"]:
+        rows.append(['SNPs: HWE-controls < {}'.format(hwe_con), count_results['hwe_con'][True]])
+    if data_type in ["Case-only", "Case-Control"]:
+        rows.append(['SNPs: HWE-cases < {}'.format(hwe_cas), count_results['hwe_cas'][True]])
+    if 'hwe_all' in count_results:
+        rows.append(['SNPs: HWE < {}'.format(hwe_all), count_results['hwe_all'][True]])
+    if 'mendel_id' in count_results:
+        rows.append(['IDs: Mendel errors per SNP > {} ({} trios)'.format(mendel_id, n_trios),
+                     count_results['mendel_id'][True]])
+        rows.append(['SNPs: Mendel errors in > {} of trios'.format(mendel_var), count_results['mendel_var'][True]])
+        rows.append(['SNPs: HWE-founders < {}'.format(hwe_trio), count_results['hwe_trio'][True]])
+
+    return rows
+
+
+def manhattan_rows(table_results: List) -> List[List]:
+    """[description, pre-QC, post-QC] rows of the Manhattan basic stats table. Missing lambdas are shown as n/a"""
+    values = ['n/a' if value is None else value for value in table_results]
+
+    return [['Number of GWAS hits', values[0], values[1]],
+            ['Lambda GC', values[2], values[3]],
+            ['Lambda 1000', values[4], values[5]]]
+
+
+def call_rate_figures(data_type: str, con_path: str, cas_path: str, all_path: str) -> List[str]:
+    """Pre-QC call rate histograms shown for each type of data"""
+    return {'Case-only': [cas_path], 'Control-only': [con_path], 'no-pheno': [all_path], 'Trio': [all_path],
+            'Case-Control': [con_path, cas_path]}.get(data_type, [])
+
+
+class ReportSections:
+    """
+    Order and content of the preimp_qc report sections. A report backend (MyDocument for LaTeX, HTMLReport) only
+    implements how each section is drawn
+    """
+    def render(self, run: QCRun):
+        """Add every section of the report from a QC run summary, e.g. QCMetricsStore.read_run()"""
+        th, figures = run.thresholds, run.work_dir
+        # man_table is None when the association scan was not run, i.e. without cases or controls
+        man_table_results = run.man_table()
+        if man_table_results is not None:
+            self.flags_table(pre_qc_counts=run.pre_qc_counts, pos_qc_counts=run.pos_qc_counts, results=run.results,
+                             lambda_gc=man_table_results[3], sig_vars=man_table_results[1])
+        else:
+            self.flags_table(pre_qc_counts=run.pre_qc_counts, pos_qc_counts=run.pos_qc_counts, results=run.results)
+        self.general_info(pre_qc_conts=run.pre_qc_counts, post_qc_conts=run.pos_qc_counts,
+                          count_results=run.results, pre_filter=th.pre_geno, id_cr=th.mind, fhet_thresh=th.fhet_aut,
+                          var_cr=th.geno, miss_diff=th.cr_diff, hwe_con=th.hwe_con, hwe_cas=th.hwe_cas,
+                          hwe_all=th.hwe_all, data_type=run.data_type, mendel_id=th.mendel_id,
+                          mendel_var=th.mendel_var, hwe_trio=th.hwe_trio, n_trios=run.n_trios)
+        if man_table_results is not None:
+            self.manhattan_sec(qq_pre_path=f'{figures}/gwaspy_qq_pre.png', qq_pos_path=f'{figures}/gwaspy_qq_pos.png',
+                               man_pre_path=f'{figures}/gwaspy_man_pre.png',
+                               man_pos_path=f'{figures}/gwaspy_man_pos.png', table_results=man_table_results)
+
+        # figures that are not drawn for the data type are never read
+        paths = {group: {kind: f'{figures}/gwaspy_{kind}_{group}_pre.png' for kind in ['id', 'var']}
+                 for group in ['con', 'cas', 'cas_con']}
+        self.individual_char(id_con_pre_path=paths['con']['id'], id_cas_pre_path=paths['cas']['id'],
+                             id_all_path=paths['cas_con']['id'], fstat_fig_path=f'{figures}/gwaspy_fstat_fig.png',
+                             data_type=run.data_type)
+        self.snp_char(var_con_pre_path=paths['con']['var'], var_cas_pre_path=paths['cas']['var'],
+                      var_all_path=paths['cas_con']['var'], data_type=run.data_type)
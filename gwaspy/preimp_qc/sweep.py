@@ -0,0 +1,155 @@
+__author__ = 'Lindo Nkambule'
+
+import itertools
+import hail as hl
+import matplotlib.pyplot as plt
+import pandas as pd
+from typing import Dict, List
+from gwaspy.preimp_qc.fused_qc import FusedQC
+
+
+class ThresholdSweep(FusedQC):
+    """
+    Counts how many samples and variants each combination of mind, geno, midi (cr_diff) and HWE thresholds would
+    remove, without rerunning QC for every combination. The statistics are computed once by the FusedQC passes; the
+    only pass that depends on a swept threshold is pass 3, whose statistics depend on the samples passing mind. Pass 3
+    therefore aggregates over the passing samples of every mind value in a single scan, and the rest of the grid is
+    evaluated in one aggregation over the (small) per-variant statistics table.
+    """
+    def __init__(self, mind_grid: List[float], geno_grid: List[float], cr_diff_grid: List[float],
+                 hwe_grids: Dict[str, List[float]], **kwargs):
+        super().__init__(**kwargs)
+        self._mind_grid = sorted(set(mind_grid))
+        self._geno_grid = sorted(set(geno_grid))
+        self._cr_diff_grid = sorted(set(cr_diff_grid))
+        # e.g. {'hwe_con': [1e-06, 1e-08], 'hwe_cas': [1e-10]}
+        self._hwe_grids = {name: sorted(set(grid)) for name, grid in hwe_grids.items()}
+
+    def sweep_variant_stats(self, mt: hl.MatrixTable) -> hl.Table:
+        """Pass 3 for every mind value: levels[i] holds the statistics over samples passing mind_grid[i]"""
+        def compute():
+            stats = self.variant_stats_expr(mt)
+            mt_stats = mt.select_rows(levels=hl.array([hl.agg.filter(mt.sweep_fail[i] == False, stats)
+                                                       for i in range(len(self._mind_grid))]))
+            return mt_stats.rows()
+
+        return self._stage('sweep_variant', compute, mind_grid=self._mind_grid, fhet_thresh=self._fhet_th,
+                           fstat_x=self._fstat_x, fstat_y=self._fstat_y)
+
+    def sample_counts(self, ht: hl.Table) -> List[Dict[str, int]]:
+        return ht.aggregate(hl.array([
+            hl.struct(n_mind=hl.agg.count_where(hl.coalesce(ht.call_rate < mind, False)),
+                      n_fstat=hl.agg.count_where(ht.fstat.filters),
+                      n_sex_violations=hl.agg.count_where(ht.sex_violations.filters),
+                      n_samples_pass=hl.agg.count_where(ht.sweep_fail[i] == False))
+            for i, mind in enumerate(self._mind_grid)]))
+
+    def variant_counts(self, ht: hl.Table, pre_ht: hl.Table) -> list:
+        """One aggregation over the variant statistics for the whole grid"""
+        pre_geno = pre_ht[ht.key].pre_geno.filters
+        biallelic = hl.len(ht.alleles) == 2
+
+        def level_stats(s):
+            derived = {'geno_cr': s.geno_n_called / s.geno_n, 'monomorphic_var': hl.min(s.AC) == 0}
+            if 'case_n' in s.dtype:
+                derived['diff'] = hl.abs(s.control_n_called / s.control_n - s.case_n_called / s.case_n)
+            for name in self._hwe_grids:
+                counts = s[f'{name}_counts']
+                derived[name] = hl.or_missing(biallelic, hl.hardy_weinberg_test(counts.n_hom_ref, counts.n_het,
+                                                                                counts.n_hom_var).p_value)
+            return hl.struct(**derived)
+
+        ht = ht.select(pre_geno=pre_geno, levels=ht.levels.map(level_stats))
+
+        hwe_names = list(self._hwe_grids)
+        grid = list(itertools.product(range(len(self._mind_grid)), self._geno_grid, self._cr_diff_grid,
+                                      *[self._hwe_grids[name] for name in hwe_names]))
+
+        counts = []
+        for i, geno, cr_diff, *hwe_threshs in grid:
+            s = ht.levels[i]
+            geno_fail = (ht.pre_geno == False) & hl.coalesce(s.geno_cr < geno, False)
+            fails = {'geno': geno_fail, 'monomorphic_var': s.monomorphic_var}
+            if 'diff' in s.dtype:
+                fails['cr_diff'] = (geno_fail == False) & (ht.pre_geno == False) & hl.coalesce(s.diff > cr_diff, False)
+            for name, thresh in zip(hwe_names, hwe_threshs):
+                fails[name] = (geno_fail == False) & hl.coalesce(s[name] < thresh, False)
+
+            variant_fail = ht.pre_geno
+            for fail in fails.values():
+                variant_fail = variant_fail | fail
+            counts.append(hl.struct(**{f'n_{name}': hl.agg.count_where(fail) for name, fail in fails.items()},
+                                    n_variants_pass=hl.agg.count_where(variant_fail == False)))
+
+        n_pre_geno = hl.agg.count_where(ht.pre_geno)
+        results = ht.aggregate(hl.struct(n_pre_geno=n_pre_geno, counts=hl.array(counts)))
+
+        rows = []
+        for (i, geno, cr_diff, *hwe_threshs), row_counts in zip(grid, results.counts):
+            row = {'mind': self._mind_grid[i], 'geno': geno}
+            if 'cr_diff' in row_counts:
+                row['midi'] = cr_diff
+            row.update(dict(zip(hwe_names, hwe_threshs)))
+            row['n_pre_geno'] = results.n_pre_geno
+            row.update(dict(row_counts))
+            rows.append(row)
+
+        return rows
+
+    def run_sweep(self, mt: hl.MatrixTable, upstream: str = None) -> pd.DataFrame:
+        """
+        :param mt: MatrixTable to QC, with is_female (and is_case) column fields
+        :param upstream: cache key of the stage that produced mt, e.g. the read stage
+        :return: one row per threshold combination with the number of samples/variants each filter removes and the
+        number of samples/variants that pass all of them
+        """
+        self.n_passes = 0
+        self.key = upstream
+
+        pre_ht = self.variant_pre_filters(self.variant_pre_stats(mt))
+        mt = mt.annotate_rows(**pre_ht[mt.row_key])
+
+        sample_stats = self.sample_stats(mt)
+        sample_ht = self.sample_filters(sample_stats, mt)
+        sample_ht = sample_ht.annotate(call_rate=sample_stats[sample_ht.key].call_rate)
+        sample_ht = sample_ht.annotate(sweep_fail=hl.array([
+            hl.coalesce(sample_ht.call_rate < mind, False) | sample_ht.fstat.filters |
+            sample_ht.sex_violations.filters for mind in self._mind_grid]))
+        mt = mt.annotate_cols(sweep_fail=sample_ht[mt.col_key].sweep_fail)
+
+        samples = self.sample_counts(sample_ht)
+        variants = self.variant_counts(self.sweep_variant_stats(mt), pre_ht)
+
+        print(f'\nThreshold sweep made {self.n_passes} passes over the data')
+
+        rows = []
+        for row in variants:
+            row_samples = samples[self._mind_grid.index(row['mind'])]
+            rows.append({**{k: v for k, v in row.items() if not k.startswith('n_')}, **dict(row_samples),
+                         **{k: v for k, v in row.items() if k.startswith('n_')}})
+
+        return pd.DataFrame(rows)
+
+
+def parse_grid(values: str) -> List[float]:
+    """'0.95,0.98' -> [0.95, 0.98]"""
+    return [float(value) for value in values.split(',') if value.strip()]
+
+
+def sweep_plot(df: pd.DataFrame, outfile: str):
+    """Samples and variants passing QC for every threshold combination"""
+    threshold_cols = [col for col in df.columns if not col.startswith('n_')]
+    labels = [', '.join(f'{col}={row[col]:g}' for col in threshold_cols) for _, row in df.iterrows()]
+
+    fig, axs = plt.subplots(2, 1, figsize=(10, max(6, 0.5 * len(df))), sharex=False)
+    axs[0].barh(labels, df['n_samples_pass'], color='#1f77b4')
+    axs[0].set_title('Samples passing QC')
+    axs[1].barh(labels, df['n_variants_pass'], color='#ff7f0e')
+    axs[1].set_title('Variants passing QC')
+    for ax in axs:
+        ax.tick_params(axis='y', labelsize=7)
+        ax.invert_yaxis()
+
+    fig.tight_layout()
+    fig.savefig(outfile, dpi=150)
+    plt.close(fig)
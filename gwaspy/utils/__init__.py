@@ -1,2 +1,10 @@
-from gwaspy.utils import read_file
-__all__ = ['read_file']
\ No newline at end of file
+import importlib
+
+__all__ = ['read_file']
+
+
+def __getattr__(name):
+    # submodules are imported on first use, so the Hail-free ones (plink_bed) can be imported without Hail
+    if name in __all__:
+        return importlib.import_module(f'{__name__}.{name}')
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,4 +1,5 @@
 import hail as hl
+from typing import List
 
 
 def export_qced_file(mt: hl.MatrixTable, out_dir: str, basename: str, export_type='hail'):
@@ -14,3 +15,15 @@ def export_qced_file(mt: hl.MatrixTable, out_dir: str, basename: str, export_typ
 
     else:
         hl.export_vcf(mt, '{}GWASpy/Preimp_QC/{}.vcf.bgz'.format(out_dir, outname))
+
+
+def exported_files(out_dir: str, basename: str, export_type='hail') -> List[str]:
+    """Files export_qced_file writes last for an export type, which are only there if the export finished"""
+    prefix = '{}GWASpy/Preimp_QC/{}_qced'.format(out_dir, basename)
+
+    if export_type == 'hail':
+        return ['{}.mt/_SUCCESS'.format(prefix)]
+    if export_type == 'plink':
+        return ['{}.{}'.format(prefix, ext) for ext in ['bed', 'bim', 'fam']]
+
+    return ['{}.vcf.bgz'.format(prefix)]
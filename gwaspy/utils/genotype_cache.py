@@ -0,0 +1,217 @@
+__author__ = 'Lindo Nkambule'
+
+import json
+import os
+import shutil
+import hail as hl
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Tuple
+from gwaspy.utils.plink_bed import PlinkBed, genotype_counts, pack_mask, hwe_p_values
+
+
+def local_dir(path: str) -> str:
+    """
+    Local filesystem path of a genotype cache directory. The cache is memory-mapped with NumPy on the driver, so it
+    cannot be on a bucket or HDFS
+    """
+    if path.startswith('file://'):
+        path = path[len('file://'):]
+    elif '://' in path:
+        raise ValueError(f'The genotype cache has to be a local directory of the driver, not {path}')
+
+    return path.rstrip('/')
+
+
+def sites_table(df: pd.DataFrame, reference: str) -> hl.Table:
+    """Table keyed by locus and alleles of the variants in df (contig, position, ref and alt)"""
+    ht = hl.Table.from_pandas(df[['contig', 'position', 'ref', 'alt']])
+    ht = ht.select(locus=hl.locus(ht.contig, hl.int32(ht.position), reference_genome=reference),
+                   alleles=hl.array([ht.ref, ht.alt]))
+
+    return ht.key_by('locus', 'alleles')
+
+
+class GenotypeCache:
+    """
+    GWASpy's on-disk genotype cache, written once when the input is read (see read_infile) and shared by preimp_qc,
+    PCA and the relatedness checks. A cache directory holds:
+
+        genotypes.bed/.bim/.fam  the genotypes 2-bit packed as a variant-major PLINK fileset, so the cache can be
+                                 memory-mapped with NumPy and imported by hl.import_plink
+        variant_stats.npz        MAF, call rate and HWE p-value (as hl.variant_qc computes them) of every variant
+        chunks.json              chunks of chunk_size consecutive variants with the range of their statistics, the
+                                 fingerprint of the input the cache was written from and its reference genome
+
+    Readers can skip whole chunks from their stored statistics without reading or decoding their genotypes.
+    The cache directory has to be on the local filesystem of the driver (see local_dir). Hail only reads the variants
+    passing the filters from it (sites), never the cached genotypes
+    """
+    def __init__(self, path: str, reference: str = None):
+        """
+        :param reference: reference genome the data is expected on. Default is the one the cache was written for
+        """
+        self._path = local_dir(path)
+        with open(f'{self._path}/chunks.json', 'r') as f:
+            self.meta = json.load(f)
+        self.reference = self.meta.get('reference', 'GRCh38')
+        if reference and reference != self.reference:
+            raise ValueError(f'Genotype cache {self._path} was written for {self.reference}, not {reference}')
+        self.bed = PlinkBed(dirname=f'{self._path}/', basename='genotypes', reference=self.reference)
+        stats = np.load(f'{self._path}/variant_stats.npz')
+        self.maf, self.call_rate, self.p_hwe = stats['maf'], stats['call_rate'], stats['p_hwe']
+
+    @staticmethod
+    def is_current(path: str, source: list, reference: str = None) -> bool:
+        """If a cache was written at path from the input with this fingerprint (and for this reference genome)"""
+        meta_file = f'{local_dir(path)}/chunks.json'
+        if not os.path.exists(meta_file):
+            return False
+        with open(meta_file, 'r') as f:
+            meta = json.load(f)
+
+        if meta['source'] != json.loads(json.dumps(source)):
+            return False
+
+        return (reference is None) or (meta.get('reference', 'GRCh38') == reference)
+
+    @staticmethod
+    def write(path: str, source: list, mt: hl.MatrixTable = None, plink_prefix: str = None,
+              chunk_size: int = 4096, workers: int = None, reference: str = 'GRCh38') -> 'GenotypeCache':
+        """
+        Write the cache from a PLINK fileset (copied as is) or, for other inputs, from mt (exported with
+        hl.export_plink, so it must be bi-allelic), then compute the variant and chunk statistics
+        :param source: fingerprint of the input files, see input_fingerprint
+        :param reference: reference genome of the data, which the PLINK contigs are recoded for when the cache is read
+        """
+        path = local_dir(path)
+        os.makedirs(path, exist_ok=True)
+        if not plink_prefix:
+            # exported to the Hail temporary directory, which the workers can write to, and copied from the driver
+            fam_fields = {field: mt[field] for field in ['is_female'] if field in mt.col}
+            if 'is_case' in mt.col:
+                fam_fields['pheno'] = mt.is_case
+            plink_prefix = hl.utils.new_temp_file('genotype_cache', 'plink')
+            hl.export_plink(mt, plink_prefix, **fam_fields)
+        for ext in ['bed', 'bim', 'fam']:
+            hl.hadoop_copy(f'{plink_prefix}.{ext}', f'file://{os.path.abspath(path)}/genotypes.{ext}')
+
+        bed = PlinkBed(dirname=f'{path}/', basename='genotypes', reference=reference)
+        mask = {'all': pack_mask(np.ones(bed.n_samples, dtype=bool))}
+        chunks = [slice(start, min(start + chunk_size, bed.n_variants))
+                  for start in range(0, bed.n_variants, chunk_size)]
+        with ThreadPoolExecutor(max_workers=workers if workers else os.cpu_count()) as pool:
+            counts = list(pool.map(lambda rows: genotype_counts(bed.packed[rows], mask)['all'], chunks))
+        counts = np.concatenate(counts) if counts else np.zeros((0, 3), dtype=np.int64)
+
+        n_called = counts.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            aaf = (counts[:, 1] + 2 * counts[:, 2]) / (2 * n_called)
+        maf = np.minimum(aaf, 1 - aaf)
+        call_rate = n_called / max(bed.n_samples, 1)
+        p_hwe = hwe_p_values(counts[:, 0], counts[:, 1], counts[:, 2])
+        np.savez(f'{path}/variant_stats.npz', maf=maf, call_rate=call_rate, p_hwe=p_hwe)
+
+        def value_range(values: np.ndarray) -> List[float]:
+            values = values[np.isfinite(values)]
+            return [float(values.min()), float(values.max())] if len(values) else [None, None]
+
+        meta = {'source': json.loads(json.dumps(source)), 'reference': reference, 'chunk_size': chunk_size,
+                'n_variants': bed.n_variants, 'n_samples': bed.n_samples,
+                'chunks': [{'start': rows.start, 'end': rows.stop, 'maf': value_range(maf[rows]),
+                            'call_rate': value_range(call_rate[rows]), 'p_hwe': value_range(p_hwe[rows])}
+                           for rows in chunks]}
+        with open(f'{path}/chunks.json', 'w') as f:
+            json.dump(meta, f)
+        print(f'\nWrote genotype cache {path}: {bed.n_variants} variants in {len(chunks)} chunks')
+
+        return GenotypeCache(path, reference=reference)
+
+    @staticmethod
+    def _chunk_passes(chunk: dict, maf: float = None, call_rate: float = None, hwe: float = None) -> bool:
+        """False if no variant of the chunk can pass the thresholds, from the chunk statistics alone"""
+        max_maf, max_call_rate, max_p_hwe = chunk['maf'][1], chunk['call_rate'][1], chunk['p_hwe'][1]
+        if maf is not None and (max_maf is None or max_maf <= maf):
+            return False
+        if call_rate is not None and (max_call_rate is None or max_call_rate < call_rate):
+            return False
+        if hwe is not None and (max_p_hwe is None or max_p_hwe <= hwe):
+            return False
+
+        return True
+
+    def chunks(self, maf: float = None, call_rate: float = None,
+               hwe: float = None) -> Iterator[Tuple[slice, np.ndarray]]:
+        """
+        (rows, packed genotypes) of every chunk that can have variants passing the thresholds (MAF > maf,
+        call rate >= call_rate, HWE p-value > hwe). The other chunks are not read
+        """
+        for chunk in self.meta['chunks']:
+            if self._chunk_passes(chunk, maf=maf, call_rate=call_rate, hwe=hwe):
+                rows = slice(chunk['start'], chunk['end'])
+                yield rows, self.bed.packed[rows]
+
+    def variants(self, maf: float = None, call_rate: float = None, hwe: float = None) -> np.ndarray:
+        """Boolean mask of the variants passing the thresholds, from the stored statistics"""
+        keep = np.zeros(self.meta['n_variants'], dtype=bool)
+        for chunk in self.meta['chunks']:
+            if not self._chunk_passes(chunk, maf=maf, call_rate=call_rate, hwe=hwe):
+                continue
+            rows = slice(chunk['start'], chunk['end'])
+            passes = np.ones(rows.stop - rows.start, dtype=bool)
+            if maf is not None:
+                passes &= self.maf[rows] > maf
+            if call_rate is not None:
+                passes &= self.call_rate[rows] >= call_rate
+            if hwe is not None:
+                passes &= self.p_hwe[rows] > hwe
+            keep[rows] = passes
+
+        return keep
+
+    def write_plink(self, prefix: str, maf: float = None, call_rate: float = None, hwe: float = None) -> int:
+        """
+        Write the variants passing the thresholds as a PLINK fileset. The packed rows are copied as they are, without
+        decoding, and skipped chunks are not read
+        :return: number of variants written
+        """
+        keep = self.variants(maf=maf, call_rate=call_rate, hwe=hwe)
+        self.bed.bim[keep].to_csv(f'{prefix}.bim', sep='\t', header=False, index=False)
+        self.bed.fam.to_csv(f'{prefix}.fam', sep=' ', header=False, index=False)
+        with open(f'{prefix}.bed', 'wb') as f:
+            f.write(b'\x6c\x1b\x01')
+            for rows, packed in self.chunks(maf=maf, call_rate=call_rate, hwe=hwe):
+                f.write(np.ascontiguousarray(packed[keep[rows]]).tobytes())
+
+        return int(keep.sum())
+
+    def sites(self, maf: float = None, call_rate: float = None, hwe: float = None) -> hl.Table:
+        """
+        Table keyed by locus and alleles of the variants passing the thresholds, from the stored statistics, to
+        semi-join the rows of the input with
+        """
+        keep = self.variants(maf=maf, call_rate=call_rate, hwe=hwe)
+        print(f"\n{int(keep.sum())} of the {self.meta['n_variants']} variants of the genotype cache pass MAF > {maf}, "
+              f"call rate >= {call_rate} and HWE p-value > {hwe}")
+        # hl.import_plink makes A2 the reference allele
+        df = pd.DataFrame({'contig': self.bed.contig[keep], 'position': self.bed.position[keep],
+                           'ref': self.bed.bim['a2'].to_numpy()[keep], 'alt': self.bed.bim['a1'].to_numpy()[keep]})
+
+        return sites_table(df, self.reference)
+
+
+def genotype_cache(path: str, source: list, mt: hl.MatrixTable = None, plink_prefix: str = None) -> GenotypeCache:
+    """
+    The genotype cache at path, written first if it is missing or was written from another input or for another
+    reference genome. The reference genome is the one of mt
+    """
+    path = local_dir(path)
+    reference = mt.locus.dtype.reference_genome.name if mt is not None else 'GRCh38'
+    if GenotypeCache.is_current(path, source, reference=reference):
+        print(f'\nUsing genotype cache {path}')
+        return GenotypeCache(path, reference=reference)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+    return GenotypeCache.write(path, source, mt=mt, plink_prefix=plink_prefix, reference=reference)
@@ -0,0 +1,142 @@
+__author__ = 'Lindo Nkambule'
+
+import numpy as np
+import pandas as pd
+from typing import Any, Dict
+
+# 2-bit PLINK .bed genotype codes. hl.import_plink makes A2 the reference allele, so 00 (homozygous A1) is hom-var
+HOM_VAR, MISSING, HET, HOM_REF = 0, 1, 2, 3
+
+# contig names hl.import_plink gives the .bim contigs by default
+CONTIG_RECODING = {
+    'GRCh37': {'23': 'X', '24': 'Y', '25': 'X', '26': 'MT'},
+    'GRCh38': {**{str(i): f'chr{i}' for i in range(1, 23)},
+               'X': 'chrX', 'Y': 'chrY', 'MT': 'chrM', '23': 'chrX', '24': 'chrY', '25': 'chrX', '26': 'chrM'}
+}
+
+# (genotype code of each of the 4 samples in a byte) for every byte value
+DECODE = np.array([[(byte >> (2 * i)) & 3 for i in range(4)] for byte in range(256)], dtype=np.uint8)
+POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+
+def popcount(packed: np.ndarray) -> np.ndarray:
+    """Number of set bits in every row"""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(packed).sum(axis=1, dtype=np.int64)
+
+    return POPCOUNT[packed].sum(axis=1, dtype=np.int64)
+
+
+def pack_mask(samples: np.ndarray) -> np.ndarray:
+    """Packed mask of a boolean sample array: the low bit of every included sample's 2-bit slot is set"""
+    padded = np.zeros(-(-len(samples) // 4) * 4, dtype=np.uint8)
+    padded[:len(samples)] = samples
+
+    return (padded.reshape(-1, 4) << np.array([0, 2, 4, 6], dtype=np.uint8)).sum(axis=1, dtype=np.uint8)
+
+
+def genotype_counts(packed: np.ndarray, masks: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """(n_hom_ref, n_het, n_hom_var) of every variant (row) of packed, over the samples of every packed mask"""
+    low = packed & 0x55
+    high = (packed >> 1) & 0x55
+    hom_ref, het, hom_var = low & high, high & ~low, ~(low | high) & 0x55
+
+    return {name: np.stack([popcount(hom_ref & mask), popcount(het & mask), popcount(hom_var & mask)], axis=1)
+            for name, mask in masks.items()}
+
+
+def decode(packed: np.ndarray, n_samples: int) -> np.ndarray:
+    """Genotype code of every variant (row) and sample (column)"""
+    return DECODE[packed].reshape(len(packed), 4 * packed.shape[1])[:, :n_samples]
+
+
+def hwe_p_values(n_hom_ref: np.ndarray, n_het: np.ndarray, n_hom_var: np.ndarray) -> np.ndarray:
+    """
+    Two-sided exact HWE test with the mid-p-value correction, as hl.hardy_weinberg_test. The Levene-Haldane
+    distribution of every distinct genotype count is built from the ratios of consecutive heterozygote counts
+    """
+    counts = np.stack([n_hom_ref, n_het, n_hom_var], axis=1).astype(np.int64)
+    unique, inverse = np.unique(counts, axis=0, return_inverse=True)
+    p_values = np.empty(len(unique))
+
+    for i, (hom_ref, het, hom_var) in enumerate(unique):
+        n = hom_ref + het + hom_var
+        n_rare = min(2 * hom_ref + het, 2 * hom_var + het)
+        hets = np.arange(n_rare % 2, n_rare + 1, 2, dtype=np.float64)
+        # P(h + 2) / P(h) = 4 * n_rare_hom * n_common_hom / ((h + 1) * (h + 2))
+        rare_hom = (n_rare - hets[:-1]) / 2
+        common_hom = n - rare_hom - hets[:-1]
+        log_prob = np.concatenate([[0], np.cumsum(np.log(4 * rare_hom * common_hom) -
+                                                  np.log((hets[:-1] + 1) * (hets[:-1] + 2)))])
+        prob = np.exp(log_prob - log_prob.max())
+        prob /= prob.sum()
+        observed = prob[(het - n_rare % 2) // 2]
+        tie = np.isclose(prob, observed, rtol=1e-9, atol=0)
+        p_values[i] = min(1.0, prob[(prob < observed) & ~tie].sum() + 0.5 * prob[tie].sum())
+
+    return p_values[inverse.ravel()]
+
+
+class PlinkBed:
+    """
+    A PLINK fileset read without Hail: the .bim and .fam with pandas, and the .bed memory-mapped, so the genotypes
+    stay 2-bit packed (one row of ceil(n_samples / 4) bytes per variant) and are only paged in chunk by chunk.
+    Contigs are recoded and sex/phenotype parsed as hl.import_plink does.
+    """
+    def __init__(self, dirname: str, basename: str, reference: str = 'GRCh38'):
+        prefix = f'{dirname}{basename}'
+        self.prefix = prefix
+        self.reference = reference
+        self.bim = pd.read_csv(f'{prefix}.bim', sep=r'\s+', header=None, dtype=str, keep_default_na=False,
+                               names=['contig', 'rsid', 'cm_position', 'position', 'a1', 'a2'])
+        self.fam = pd.read_csv(f'{prefix}.fam', sep=r'\s+', header=None, dtype=str, keep_default_na=False,
+                               names=['fam_id', 's', 'pat_id', 'mat_id', 'sex', 'pheno'])
+        self.n_variants, self.n_samples = len(self.bim), len(self.fam)
+        self.n_bytes = -(-self.n_samples // 4)
+
+        with open(f'{prefix}.bed', 'rb') as f:
+            if f.read(3) != b'\x6c\x1b\x01':
+                raise ValueError(f'{prefix}.bed is not a variant-major PLINK .bed file')
+        if self.n_variants > 0:
+            self.packed = np.memmap(f'{prefix}.bed', dtype=np.uint8, mode='r', offset=3,
+                                    shape=(self.n_variants, self.n_bytes))
+        else:
+            self.packed = np.zeros((0, self.n_bytes), dtype=np.uint8)
+
+        recoding = CONTIG_RECODING.get(reference, {})
+        self.contig = self.bim['contig'].map(lambda contig: recoding.get(contig, contig)).to_numpy()
+        self.position = self.bim['position'].astype(np.int64).to_numpy()
+        # True/False, or missing for unknown sex (0) and phenotype (0, -9, NA)
+        self.is_female = self.fam['sex'].map({'2': True, '1': False}).astype('boolean')
+        self.is_case = self.fam['pheno'].map({'2': True, '1': False}).astype('boolean')
+
+    def summary(self, variants: np.ndarray = None, samples: np.ndarray = None) -> Dict[str, Any]:
+        """The counts summary_stats reports, for a subset of the variants and samples"""
+        samples = samples if samples is not None else np.ones(self.n_samples, dtype=bool)
+        n_variants = int(variants.sum()) if variants is not None else self.n_variants
+        is_case, is_female = self.is_case[samples], self.is_female[samples]
+
+        return {
+            'is_case_counts': {'case': int((is_case == True).sum()), 'control': int((is_case == False).sum()),
+                               'unknown': int(is_case.isna().sum())},
+            'is_female_counts': {'female': int((is_female == True).sum()), 'male': int((is_female == False).sum()),
+                                 'unknown': int(is_female.isna().sum())},
+            'n_variants': n_variants,
+            'n_samples': int(samples.sum())
+        }
+
+    def write_plink(self, prefix: str, variants: np.ndarray, samples: np.ndarray, chunk_size: int = 4096):
+        """Write the given variants and samples as a PLINK fileset, repacking the kept samples chunk by chunk"""
+        self.bim[variants].to_csv(f'{prefix}.bim', sep='\t', header=False, index=False)
+        self.fam[samples].to_csv(f'{prefix}.fam', sep=' ', header=False, index=False)
+
+        n_keep = int(samples.sum())
+        shifts = np.array([0, 2, 4, 6], dtype=np.uint8)
+        rows = np.flatnonzero(variants)
+        with open(f'{prefix}.bed', 'wb') as f:
+            f.write(b'\x6c\x1b\x01')
+            for start in range(0, len(rows), chunk_size):
+                codes = decode(self.packed[rows[start:start + chunk_size]], self.n_samples)[:, samples]
+                padded = np.zeros((len(codes), -(-n_keep // 4) * 4), dtype=np.uint8)
+                padded[:, :n_keep] = codes
+                f.write((padded.reshape(len(codes), -1, 4) << shifts).sum(axis=2, dtype=np.uint8).tobytes())
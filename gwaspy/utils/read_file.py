@@ -1,39 +1,183 @@
+import json
+import math
+import os
+import threading
 import hail as hl
+from typing import Callable, List, Tuple
+from gwaspy.utils.get_file_size import bytes_to_gb
 from gwaspy.utils.sample_annotations import add_sample_annotations
 
+# Hail flags are process-wide: VCF conversions running in other threads share one no_whole_stage_codegen setting,
+# which is restored once the last of them has finished
+_codegen_lock = threading.Lock()
+_codegen_users = {'count': 0, 'saved': None}
 
-def read_plink(dirname: str, basename: str) -> hl.MatrixTable:
+
+def input_fingerprint(paths: List[str]) -> List[Tuple[str, int, str]]:
+    """
+    Identify input files by path, size and modification time, without reading them
+    :param paths: input files. For Hail MatrixTables/Tables, pass the directory and its _SUCCESS file is used
+    :return: a list of (path, size, modification time)
+    """
+    fingerprint = []
+    for path in paths:
+        if path.rstrip('/').endswith(('.mt', '.ht')):
+            path = f"{path.rstrip('/')}/_SUCCESS"
+        file_info = hl.utils.hadoop_stat(path)
+        fingerprint.append((path, file_info['size_bytes'], str(file_info['modification_time'])))
+
+    return fingerprint
+
+
+def n_cores() -> int:
+    try:
+        return hl.spark_context().defaultParallelism
+    except Exception:
+        # not running on the Spark backend
+        return os.cpu_count()
+
+
+def n_partitions(paths: List[str], cores: int = None, partition_mb: int = 128) -> int:
+    """
+    Number of partitions to import the input files with: enough for partitions of about partition_mb of input, and at
+    least two per core so all cores are busy, but never partitions smaller than 1MB of input
+    :param paths: input files
+    :param cores: number of cores. Default is the Spark default parallelism
+    """
+    size_mb = sum(bytes_to_gb(path) for path in paths) * 1024
+    cores = cores if cores else n_cores()
+    n = max(2 * cores, math.ceil(size_mb / partition_mb))
+
+    return max(1, min(n, math.ceil(size_mb)))
+
+
+def converted_mt(source_paths: List[str], mt_path: str, convert: Callable[[], hl.MatrixTable]) -> hl.MatrixTable:
+    """
+    Read the MatrixTable converted from source_paths if the sources have the same size and modification time as when
+    it was written, otherwise convert them again. The source fingerprint is kept in {mt_path}.source.json
+    """
+    fingerprint = json.loads(json.dumps(input_fingerprint(source_paths)))
+    source_file = f'{mt_path}.source.json'
+
+    if hl.hadoop_exists(f'{mt_path}/_SUCCESS') and hl.hadoop_exists(source_file):
+        with hl.hadoop_open(source_file, 'r') as f:
+            if json.load(f) == fingerprint:
+                print(f'Reusing {mt_path}, converted from unchanged input')
+                return hl.read_matrix_table(mt_path)
+
+    convert().write(mt_path, overwrite=True)
+    with hl.hadoop_open(source_file, 'w') as f:
+        json.dump(fingerprint, f)
+
+    return hl.read_matrix_table(mt_path)
+
+
+def read_plink(dirname: str, basename: str, n_parts: int = None) -> hl.MatrixTable:
+    paths = input_paths('plink', dirname, basename)
 
     in_mt: hl.MatrixTable = hl.import_plink(bed=dirname + basename + '.bed',
                                             bim=dirname + basename + '.bim',
                                             fam=dirname + basename + '.fam',
-                                            block_size=16)
+                                            n_partitions=n_parts if n_parts else n_partitions(paths))
 
     return in_mt
 
 
-def read_vcf(dirname: str, basename: str) -> hl.MatrixTable:
-    hl._set_flags(no_whole_stage_codegen='1')
+def read_bgen(dirname: str, basename: str, n_parts: int = None) -> hl.MatrixTable:
+    from gwaspy.utils.plink_bed import CONTIG_RECODING
+
+    bgen_file = f'{dirname}{basename}.bgen'
+    sample_file = f'{dirname}{basename}.sample'
+
+    # import_bgen needs an index, which only has to be built once per input and reference. The index holds the loci,
+    # so its contigs are recoded as import_plink recodes them
+    reference = hl.default_reference().name
+    index = {'source': json.loads(json.dumps(input_fingerprint([bgen_file]))), 'reference': reference}
+    index_file = f'{bgen_file}.idx2.source.json'
+    current = False
+    if hl.hadoop_exists(f'{bgen_file}.idx2') and hl.hadoop_exists(index_file):
+        with hl.hadoop_open(index_file, 'r') as f:
+            current = json.load(f) == index
+    if not current:
+        hl.index_bgen(bgen_file, reference_genome=reference, contig_recoding=CONTIG_RECODING.get(reference))
+        with hl.hadoop_open(index_file, 'w') as f:
+            json.dump(index, f)
+
+    in_mt: hl.MatrixTable = hl.import_bgen(bgen_file, entry_fields=['GT'],
+                                           sample_file=sample_file if hl.hadoop_exists(sample_file) else None,
+                                           n_partitions=n_parts if n_parts else n_partitions([bgen_file]))
+
+    return in_mt
+
+
+def read_vcf(dirname: str, basename: str, n_parts: int = None) -> hl.MatrixTable:
     vcf_file = '{}{}.vcf.gz'.format(dirname, basename)
-    hl.import_vcf(vcf_file, force_bgz=True, block_size=16).write('{}GWASpy.preimpQC.mt'.format(dirname), overwrite=True)
-    in_mt = hl.read_matrix_table('{}GWASpy.preimpQC.mt'.format(dirname))
+
+    def convert():
+        return hl.import_vcf(vcf_file, force_bgz=True,
+                             min_partitions=n_parts if n_parts else n_partitions([vcf_file]))
+
+    # whole-stage code generation is only turned off while VCFs are converted, and restored afterwards
+    with _codegen_lock:
+        if _codegen_users['count'] == 0:
+            _codegen_users['saved'] = hl._get_flags('no_whole_stage_codegen')['no_whole_stage_codegen']
+            hl._set_flags(no_whole_stage_codegen='1')
+        _codegen_users['count'] += 1
+    try:
+        in_mt = converted_mt([vcf_file], '{}{}.GWASpy.preimpQC.mt'.format(dirname, basename), convert)
+    finally:
+        with _codegen_lock:
+            _codegen_users['count'] -= 1
+            if _codegen_users['count'] == 0:
+                hl._set_flags(no_whole_stage_codegen=_codegen_users['saved'])
 
     # Unlike array data, a VCF might have multi-allelic sites
     # split multi-allelic sites into bi-allelic
     print("Checking for multi-allelic sites")
-    pre_filt_multi_n = in_mt.count_rows()
-    bi = in_mt.filter_rows(hl.len(in_mt.alleles) == 2)
-    bi = bi.annotate_rows(a_index=hl.missing(hl.tint))  # when we update Hail version, use hl.missing instead of hl.null
-    bi = bi.annotate_rows(was_split=False)
+    stats = split_stats(in_mt, [vcf_file], '{}{}.GWASpy.preimpQC.mt.split.json'.format(dirname, basename))
+    print("Number of multi-allelic SNPs in VCF file: {}".format(stats['n_multi_allelic']))
+
+    if stats['n_multi_allelic'] > 0:
+        # split in place, so rows keep their order and partitioning. The split alleles of a multi-allelic site that
+        # shares its locus with another site can be out of order with it, and only then are the rows shuffled
+        in_mt = hl.split_multi_hts(in_mt, permit_shuffle=stats['n_multi_allelic_shared_locus'] > 0)
+        # a_index is only defined on split rows, as for a VCF without multi-allelic sites
+        in_mt = in_mt.annotate_rows(a_index=hl.or_missing(in_mt.was_split, in_mt.a_index))
+    else:
+        in_mt = in_mt.annotate_rows(a_index=hl.missing(hl.tint), was_split=False)
 
-    multi = in_mt.filter_rows(hl.len(in_mt.alleles) > 2)
-    split = hl.split_multi_hts(multi)
+    return in_mt
 
-    in_mt = split.union_rows(bi)
-    pos_filt_multi_n = in_mt.count_rows()
-    print("Number of multi-allelic SNPs in VCF file: {}".format(pos_filt_multi_n-pre_filt_multi_n))
 
-    return in_mt
+def split_stats(mt: hl.MatrixTable, source_paths: List[str], stats_file: str) -> dict:
+    """
+    Variant and multi-allelic site counts of mt, and the number of multi-allelic sites sharing their locus with another
+    site, from one aggregation over its rows. They are saved to stats_file with the fingerprint of the source files,
+    and read back while the sources are unchanged
+    """
+    fingerprint = json.loads(json.dumps(input_fingerprint(source_paths)))
+    if hl.hadoop_exists(stats_file):
+        with hl.hadoop_open(stats_file, 'r') as f:
+            stats = json.load(f)
+        if (stats['source'] == fingerprint) & ('n_multi_allelic_shared_locus' in stats):
+            return stats
+
+    multi = hl.len(mt.alleles) > 2
+    # rows are ordered by locus, so the sites sharing a locus are next to each other
+    prev = hl.scan._prev_nonnull(hl.struct(locus=mt.locus, multi=multi))
+    mt = mt.annotate_rows(_shared_locus=hl.coalesce((prev.locus == mt.locus) & (multi | prev.multi), False))
+    counts = mt.aggregate_rows(hl.struct(
+        n_variants=hl.agg.count(),
+        n_multi_allelic=hl.agg.count_where(multi),
+        n_split_variants=hl.agg.filter(multi, hl.agg.sum(hl.len(mt.alleles) - 1)),
+        n_multi_allelic_shared_locus=hl.agg.count_where(mt._shared_locus)))
+    stats = {'source': fingerprint, **counts}
+    # variants after splitting: bi-allelic sites, plus one per alternate allele of the multi-allelic ones
+    stats['n_variants_after_split'] = stats['n_variants'] - stats['n_multi_allelic'] + stats['n_split_variants']
+    with hl.hadoop_open(stats_file, 'w') as f:
+        json.dump(stats, f)
+
+    return stats
 
 
 def read_mt(dirname: str, basename: str) -> hl.MatrixTable:
@@ -43,26 +187,62 @@ def read_mt(dirname: str, basename: str) -> hl.MatrixTable:
     return in_mt
 
 
+def input_paths(input_type: str = None, dirname: str = None, basename: str = None) -> List[str]:
+    """
+    Paths of the files read for an input type
+    """
+    if input_type == 'plink':
+        return [f'{dirname}{basename}.bed', f'{dirname}{basename}.bim', f'{dirname}{basename}.fam']
+    if input_type == 'vcf':
+        return [f'{dirname}{basename}.vcf.gz']
+    if input_type == 'bgen':
+        # the .sample file is optional, and holds the sample IDs when it is there
+        sample_file = f'{dirname}{basename}.sample'
+        return [f'{dirname}{basename}.bgen'] + ([sample_file] if hl.hadoop_exists(sample_file) else [])
+
+    return [f'{dirname}{basename}.mt']
+
+
+def input_source(input_type: str = None, dirname: str = None, basename: str = None,
+                 annotations: str = None) -> List[Tuple[str, int, str]]:
+    """
+    Fingerprint of the files read for an input and its sample annotations, the source a genotype cache is written from
+    """
+    return input_fingerprint(input_paths(input_type, dirname, basename) + ([annotations] if annotations else []))
+
+
 def read_infile(
         input_type: str = None,
         dirname: str = None, basename: str = None,
-        **kwargs):
-
-    global mt
+        **kwargs) -> hl.MatrixTable:
 
     # vcf = kwargs.get('vcf')
     annotations = kwargs.get('annotations')
+    # stage cache of the run, where the parsed annotations are kept
+    annotations_cache = kwargs.get('annotations_cache')
+    # number of partitions to import plink/bgen/vcf input with. Default is picked from the input size and cores
+    n_parts = kwargs.get('n_partitions')
 
     if input_type == 'plink':
-        mt = read_plink(dirname, basename)
+        mt = read_plink(dirname, basename, n_parts)
 
     elif input_type == 'vcf':
-        mt = read_vcf(dirname, basename)
+        mt = read_vcf(dirname, basename, n_parts)
+
+    elif input_type == 'bgen':
+        mt = read_bgen(dirname, basename, n_parts)
 
     else:
         mt = read_mt(dirname, basename)
 
     if annotations:
-        mt = add_sample_annotations(mt, annotations)
+        mt = add_sample_annotations(mt, annotations, cache=annotations_cache)
+
+    # write the input to a GWASpy genotype cache at this path, unless it was already cached from the same input
+    cache_path = kwargs.get('genotype_cache')
+    if cache_path:
+        from gwaspy.utils.genotype_cache import genotype_cache
+        genotype_cache(cache_path, input_source(input_type, dirname, basename, annotations), mt=mt,
+                       plink_prefix=dirname + basename if input_type == 'plink' else None)
 
     return mt
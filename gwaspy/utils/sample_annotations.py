@@ -1,34 +1,116 @@
 __author__ = 'Lindo Nkambule'
 
 import hail as hl
-import sys
+import pandas as pd
+from typing import TYPE_CHECKING
 
+if TYPE_CHECKING:
+    from gwaspy.utils.stages import StageCache
 
-def add_sample_annotations(mt: hl.MatrixTable, annotations: str) -> hl.MatrixTable:
+# codes are matched after stripping whitespace and upper-casing
+SEX_CODES = {'F': True, 'FEMALE': True, '2': True, 'TRUE': True,
+             'M': False, 'MALE': False, '1': False, 'FALSE': False}
+PHENO_CODES = {'CASE': True, '2': True, 'TRUE': True,
+               'CONTROL': False, '1': False, 'FALSE': False}
+MISSING_CODES = {'', '0', '-9', 'NA', 'NAN', 'NONE', 'U', 'UNKNOWN'}
+
+
+def read_annotations(annotations: str) -> pd.DataFrame:
+    """
+    Read a TSV (default), CSV or Parquet annotations file with every column as a string. Whole numbers in numeric
+    Parquet columns are written without a decimal part, so a Sex of 2.0 reads as the code 2
+    """
+    if annotations.endswith('.parquet'):
+        with hl.hadoop_open(annotations, 'rb') as f:
+            df = pd.read_parquet(f)
+        for column in df.columns:
+            values = df[column]
+            if pd.api.types.is_float_dtype(values) and (values.dropna() % 1 == 0).all():
+                df[column] = values.astype('Int64')
+        return df.astype('string').fillna('')
+
+    sep = ',' if annotations.endswith(('.csv', '.csv.gz')) else '\t'
+    compression = 'gzip' if annotations.endswith('.gz') else None
+    with hl.hadoop_open(annotations, 'rb') as f:
+        df = pd.read_csv(f, sep=sep, dtype=str, keep_default_na=False, compression=compression)
+
+    return df.astype('string')
+
+
+def normalise_codes(values: pd.Series, codes: dict, column: str) -> pd.Series:
+    """
+    Map sex/phenotype codes to True/False/missing through a lookup table. All unrecognised codes are reported at once
+    """
+    normalised = values.str.strip().str.upper()
+    unknown = sorted(set(normalised[~normalised.isin(codes.keys()) & ~normalised.isin(MISSING_CODES)]))
+    if unknown:
+        raise ValueError(f'Unrecognised {column} codes in annotations file: {unknown}. '
+                         f'Expected one of {sorted(codes)}, or a missing value code {sorted(MISSING_CODES)}')
+
+    return normalised.map(codes).astype('boolean')
+
+
+def parse_annotations(annotations: str) -> hl.Table:
+    """Parse the annotations file into a Table keyed by Sample with is_female and is_case (if Pheno is present)"""
+    df = read_annotations(annotations)
+    if 'Sample' not in df.columns:
+        raise ValueError(f'Sample column is missing from annotations file {annotations}')
+    duplicated = sorted(set(df['Sample'][df['Sample'].duplicated()]))
+    if duplicated:
+        raise ValueError(f'Duplicate sample IDs in annotations file: {duplicated[:10]}')
+
+    # string columns become tstr and the nullable booleans tbool, with missing values
+    if 'Sex' in df.columns:
+        df['is_female'] = normalise_codes(df['Sex'], SEX_CODES, 'Sex')
+    if 'Pheno' in df.columns:
+        df['is_case'] = normalise_codes(df['Pheno'], PHENO_CODES, 'Pheno')
+
+    return hl.Table.from_pandas(df, key='Sample')
+
+
+def load_annotations(annotations: str, cache: 'StageCache' = None) -> hl.Table:
+    """
+    Parsed annotations Table. With a cache (the stage cache of the run), it is stored there and reused while the
+    annotations file has the same size and modification time
+    """
+    if cache is None:
+        return parse_annotations(annotations)
+
+    from gwaspy.utils.read_file import input_fingerprint
+    key = cache.key('annotations', input=input_fingerprint([annotations]))
+    ht, _ = cache.table('annotations', key, lambda: parse_annotations(annotations))
+
+    return ht
+
+
+def add_sample_annotations(mt: hl.MatrixTable, annotations: str, cache: 'StageCache' = None) -> hl.MatrixTable:
     # use annotations file to annotate VCF
-    ann = hl.import_table(annotations, impute=False,
-                          types={'Sample': hl.tstr, 'Sex': hl.tstr, 'Pheno': hl.tstr}).key_by('Sample')
+    ann = load_annotations(annotations, cache=cache)
     ann_cols = dict(ann.row)
 
+    if ('is_female' not in mt.col) & ('is_female' not in ann_cols):
+        raise ValueError('Sex column is missing from annotations file. Please add it and run GWASpy again')
+
     mt = mt.annotate_cols(annotations=ann[mt.s])
 
+    # sample overlap between the data and the annotations file, from the same join
+    overlap = mt.aggregate_cols(hl.struct(
+        n_samples=hl.agg.count(),
+        n_annotated=hl.agg.count_where(hl.is_defined(mt.annotations)),
+        not_annotated=hl.agg.filter(hl.is_missing(mt.annotations), hl.agg.take(mt.s, 10))))
+    if overlap.n_annotated == 0:
+        raise ValueError(f'None of the {overlap.n_samples} samples in the data are in annotations file {annotations}')
+    if overlap.n_annotated < overlap.n_samples:
+        print(f'{overlap.n_samples - overlap.n_annotated} of {overlap.n_samples} samples are not in the annotations '
+              f'file, e.g. {overlap.not_annotated}. Their sex and phenotype will be missing')
+    n_file = ann.count()
+    if n_file > overlap.n_annotated:
+        print(f'{n_file - overlap.n_annotated} samples in the annotations file are not in the data')
+
     if 'is_female' not in mt.col:
-        if 'Sex' in ann_cols:
-            mt = mt.annotate_cols(is_female=hl.if_else(((mt.annotations.Sex == 'F') |
-                                                        (mt.annotations.Sex == str(2)) |
-                                                        (mt.annotations.Sex == 'True') |
-                                                        (mt.annotations.Sex == 'Female')),
-                                                       True, False))
-        else:
-            print('Sex column is missing from annotations file. Please add it and run GWASpy again')
-            sys.exit(2)
-
-    if 'is_case' not in mt.col:
-        if 'Pheno' in ann_cols:
-            mt = mt.annotate_cols(is_case=hl.if_else(((mt.annotations.Pheno == str(2)) |
-                                                      (mt.annotations.Pheno == 'True') |
-                                                      (mt.annotations.Pheno == 'Case')),
-                                                     True, False))
+        mt = mt.annotate_cols(is_female=mt.annotations.is_female)
 
-    return mt
+    if ('is_case' not in mt.col) & ('is_case' in ann_cols):
+        mt = mt.annotate_cols(is_case=mt.annotations.is_case)
 
+    return mt
@@ -0,0 +1,74 @@
+__author__ = 'Lindo Nkambule'
+
+import hashlib
+import json
+import hail as hl
+from typing import Callable, List, Tuple
+
+
+class StageCache:
+    """
+    Content-addressed store for the outputs of preimp_qc and PCA stages. Every stage output is written under a key
+    that hashes the stage name, the parameters (thresholds) the stage depends on and the key of its upstream stage,
+    so a rerun with the same input and thresholds reuses the stored output, and changing one threshold only
+    invalidates the stages downstream of where it is used.
+    """
+    def __init__(self, cache_dir: str):
+        self._cache_dir = cache_dir.rstrip('/')
+
+    @staticmethod
+    def key(stage: str, upstream: str = None, **params) -> str:
+        payload = json.dumps({'stage': stage, 'upstream': upstream, 'params': params}, sort_keys=True, default=str)
+
+        return hashlib.sha1(payload.encode()).hexdigest()[:16]
+
+    def path(self, stage: str, key: str, ext: str) -> str:
+        return f'{self._cache_dir}/{stage}-{key}.{ext}'
+
+    def exists(self, stage: str, key: str, ext: str) -> bool:
+        path = self.path(stage, key, ext)
+        if ext in ['ht', 'mt']:
+            return hl.hadoop_exists(f'{path}/_SUCCESS')
+
+        return hl.hadoop_exists(path)
+
+    def table(self, stage: str, key: str, compute: Callable[[], hl.Table]) -> Tuple[hl.Table, bool]:
+        """Read the stage Table if it was cached, otherwise compute and checkpoint it. Also returns if it was computed"""
+        path = self.path(stage, key, 'ht')
+        if self.exists(stage, key, 'ht'):
+            print(f'\nUsing cached {stage} stage: {path}')
+            return hl.read_table(path), False
+
+        return compute().checkpoint(path, overwrite=True), True
+
+    def matrix_table(self, stage: str, key: str,
+                     compute: Callable[[], hl.MatrixTable]) -> Tuple[hl.MatrixTable, bool]:
+        """Read the stage MatrixTable if it was cached, otherwise compute and checkpoint it"""
+        path = self.path(stage, key, 'mt')
+        if self.exists(stage, key, 'mt'):
+            print(f'\nUsing cached {stage} stage: {path}')
+            return hl.read_matrix_table(path), False
+
+        return compute().checkpoint(path, overwrite=True), True
+
+    def read_json(self, stage: str, key: str) -> dict:
+        with hl.hadoop_open(self.path(stage, key, 'json'), 'r') as f:
+            return json.load(f)
+
+    def write_json(self, stage: str, key: str, content: dict):
+        with hl.hadoop_open(self.path(stage, key, 'json'), 'w') as f:
+            json.dump(content, f, default=str)
+
+    def fetch_files(self, stage: str, key: str, local_dir: str, filenames: List[str]) -> bool:
+        """Copy the cached files of a stage into local_dir. Returns False if any of them is missing"""
+        if not all(self.exists(stage, key, f'{filename}') for filename in filenames):
+            return False
+        print(f'\nUsing cached {stage} stage: {self.path(stage, key, "*")}')
+        for filename in filenames:
+            hl.hadoop_copy(self.path(stage, key, filename), f'file://{local_dir}/{filename}')
+
+        return True
+
+    def store_files(self, stage: str, key: str, local_dir: str, filenames: List[str]):
+        for filename in filenames:
+            hl.hadoop_copy(f'file://{local_dir}/{filename}', self.path(stage, key, filename))
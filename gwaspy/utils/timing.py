@@ -0,0 +1,18 @@
+__author__ = 'Lindo Nkambule'
+
+import logging
+import sys
+
+# wall times of the steps that are not a QCProfiler stage, e.g. LD pruning and the report figures. They are logged at
+# INFO, which the command-line tools print (log_to_stdout), and library callers configure as any other logger
+logger = logging.getLogger('gwaspy.timing')
+
+
+def log_to_stdout():
+    """Print the timings on stdout, next to the rest of the command-line output"""
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(logging.INFO)
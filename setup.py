@@ -38,11 +38,14 @@ setup(name='gwaspy',
               'preimp_qc = gwaspy.preimp_qc.preimp_qc:main',
               'pca = gwaspy.pca.pca:main',
               'imputation = gwaspy.imputation.imputation:main',
-              'phasing = gwaspy.phasing.phasing:main'
+              'phasing = gwaspy.phasing.phasing:main',
+              'association = gwaspy.preimp_qc.association:main',
+              'preimp_qc_batch = gwaspy.preimp_qc.batch:main',
+              'pca_ref_bundle = gwaspy.pca.reference_bundle:main'
           ]
       },
       classifiers=classifiers,
       keywords='',
-      install_requires=['hail', 'matplotlib', 'numpy', 'pandas', 'pylatex', 'plotly'],
+      install_requires=['hail', 'matplotlib', 'numpy', 'pandas', 'pyarrow', 'pylatex', 'plotly', 'scipy'],
       zip_safe=False
       )
@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+# 2-bit PLINK .bed codes of the A1 allele count (0, 1, 2) and of a missing genotype
+BED_CODES = np.array([3, 2, 0], dtype=np.uint8)
+BED_MISSING = 1
+
+
+def simulate_genotypes(n_samples: int, n_variants: int, n_x: int, is_female: np.ndarray,
+                       rng: np.random.Generator) -> np.ndarray:
+    """
+    A1 allele counts (variants x samples, -1 for missing) with a spread of call rates, so every preimp_qc filter
+    flags something: HWE genotypes, a few variants with many missing calls or out of HWE, a monomorphic variant, a
+    few samples with many missing calls, and hemizygous males on the last n_x (chrX) variants
+    """
+    af = rng.uniform(0.05, 0.5, size=n_variants)
+    genotypes = rng.binomial(2, af[:, None], size=(n_variants, n_samples)).astype(np.int8)
+
+    # chrX: males carry one allele, coded as homozygous
+    x = slice(n_variants - n_x, n_variants)
+    genotypes[x, ~is_female] = 2 * rng.binomial(1, af[x, None], size=(n_x, int((~is_female).sum())))
+
+    genotypes[0] = 0
+    genotypes[1:4, :] = 1
+    missing = rng.random((n_variants, n_samples)) < 0.005
+    missing[4:10] |= rng.random((6, n_samples)) < 0.1
+    missing[:, :2] |= rng.random((n_variants, 2)) < 0.2
+    genotypes[missing] = -1
+
+    return genotypes
+
+
+def write_plink(prefix: str, genotypes: np.ndarray, is_female: np.ndarray, is_case: np.ndarray, n_x: int,
+                sample_prefix: str = 'S'):
+    """
+    Write variant-major PLINK files, the autosomal variants on contigs 1 and 2 and the last n_x on 23 (X). is_case
+    is None for samples without a phenotype
+    """
+    n_variants, n_samples = genotypes.shape
+    n_auto = n_variants - n_x
+    contigs = np.array(['1'] * (n_auto // 2) + ['2'] * (n_auto - n_auto // 2) + ['23'] * n_x)
+    # chrX positions start after the GRCh37 and GRCh38 pseudoautosomal region
+    positions = np.concatenate([np.arange(1, n_auto // 2 + 1), np.arange(1, n_auto - n_auto // 2 + 1),
+                                3_000_000 + np.arange(n_x)]) * 1000
+    pd.DataFrame({'contig': contigs, 'rsid': [f'rs{i}' for i in range(n_variants)], 'cm': 0,
+                  'position': positions, 'a1': 'A', 'a2': 'G'}).to_csv(f'{prefix}.bim', sep='\t', header=False,
+                                                                       index=False)
+    samples = [f'{sample_prefix}{i}' for i in range(n_samples)]
+    pheno = np.where(is_case, 2, 1) if is_case is not None else -9
+    pd.DataFrame({'fam_id': samples, 's': samples, 'pat_id': 0, 'mat_id': 0, 'sex': np.where(is_female, 2, 1),
+                  'pheno': pheno}).to_csv(f'{prefix}.fam', sep=' ', header=False, index=False)
+
+    codes = np.where(genotypes < 0, BED_MISSING, BED_CODES[np.clip(genotypes, 0, 2)]).astype(np.uint8)
+    padded = np.zeros((n_variants, -(-n_samples // 4) * 4), dtype=np.uint8)
+    padded[:, :n_samples] = codes
+    with open(f'{prefix}.bed', 'wb') as f:
+        f.write(b'\x6c\x1b\x01')
+        f.write((padded.reshape(n_variants, -1, 4) << np.array([0, 2, 4, 6], dtype=np.uint8)).sum(
+            axis=2, dtype=np.uint8).tobytes())
+
+
+@pytest.fixture
+def plink_fileset(tmp_path):
+    """
+    Factory of small PLINK filesets in a temporary directory
+    :return: a function of (basename, n_samples, n_variants, n_x, seed, sample_prefix, phenotype) returning
+    (dirname, basename). Samples with an even index are female, and without a phenotype none is a case or control
+    """
+    def make(basename: str = 'cohort', n_samples: int = 80, n_variants: int = 400, n_x: int = 60, seed: int = 0,
+             sample_prefix: str = 'S', phenotype: bool = True):
+        rng = np.random.default_rng(seed)
+        is_female = np.arange(n_samples) % 2 == 0
+        is_case = np.arange(n_samples) % 4 < 2 if phenotype else None
+        genotypes = simulate_genotypes(n_samples, n_variants, n_x, is_female, rng)
+        write_plink(f'{tmp_path}/{basename}', genotypes, is_female, is_case, n_x, sample_prefix=sample_prefix)
+        return f'{tmp_path}/', basename
+
+    return make
+
+
+@pytest.fixture(scope='session')
+def hail_context(tmp_path_factory):
+    hl = pytest.importorskip('hail')
+    hl.init(default_reference='GRCh38', idempotent=True, quiet=True,
+            tmp_dir=str(tmp_path_factory.mktemp('hail')))
+
+    return hl
@@ -0,0 +1,27 @@
+import numpy as np
+
+
+def test_downdated_post_qc_scan_matches_linear_regression(hail_context, plink_fileset):
+    hl = hail_context
+    from gwaspy.preimp_qc.association import AssociationScan
+    from gwaspy.utils.read_file import read_plink
+
+    dirname, basename = plink_fileset('assoc', n_samples=150, n_variants=300, n_x=40)
+    mt_pre = read_plink(dirname, basename)
+    # post-QC: a subset of the samples, including cases and controls, and of the variants
+    mt_post = mt_pre.filter_cols(hl.int(mt_pre.s[1:]) % 7 != 3)
+    mt_post = mt_post.filter_rows(mt_post.locus.position % 3000 != 0)
+
+    gwas_pre, gwas_pos = AssociationScan().run(mt_pre, mt_post)
+    exact_pre, exact_pos = AssociationScan(exact=True).run(mt_pre, mt_post)
+
+    for fast, exact, mt in [(gwas_pre, exact_pre, mt_pre), (gwas_pos, exact_pos, mt_post)]:
+        assert fast.count() == exact.count() == mt.count_rows()
+        ht = fast.annotate(exact=exact[fast.key])
+        df = ht.select(**{f'{field}_fast': ht[field] for field in ['beta', 'standard_error', 'p_value']},
+                       **{f'{field}_exact': ht.exact[field] for field in ['beta', 'standard_error', 'p_value']}
+                       ).to_pandas()
+        for field in ['beta', 'standard_error', 'p_value']:
+            np.testing.assert_allclose(df[f'{field}_fast'].to_numpy(dtype=float, na_value=np.nan),
+                                       df[f'{field}_exact'].to_numpy(dtype=float, na_value=np.nan), rtol=1e-6,
+                                       atol=1e-12, err_msg=field)
@@ -0,0 +1,67 @@
+import pandas as pd
+
+
+def test_concurrent_cohorts_are_qced_on_their_own_data(hail_context, plink_fileset, tmp_path):
+    from gwaspy.preimp_qc.batch import BatchQC
+    from gwaspy.preimp_qc.preimp_qc import preimp_qc
+    from gwaspy.preimp_qc.qc_context import QCMetricsStore
+
+    # two cohorts of different sizes and with different sample IDs, QC'ed at the same time
+    sizes = {'cohort_a': (60, 300), 'cohort_b': (100, 500)}
+    cohorts = []
+    for i, (name, (n_samples, n_variants)) in enumerate(sizes.items()):
+        dirname, basename = plink_fileset(name, n_samples=n_samples, n_variants=n_variants, seed=i,
+                                          sample_prefix=f'{name}_')
+        cohorts.append({'cohort': name, 'kwargs': {'dirname': dirname, 'basename': basename, 'input_type': 'plink',
+                                                   'export_type': None}})
+
+    out_dir = f'{tmp_path}/batch/'
+    summary = BatchQC(out_dir=out_dir, workers=2, report=False).run(cohorts).set_index('cohort')
+
+    assert (summary['status'] == 'done').all(), summary['error'].to_dict()
+    for cohort in cohorts:
+        name = cohort['cohort']
+        n_samples, n_variants = sizes[name]
+        assert summary.loc[name, 'n_samples_pre'] == n_samples
+        assert summary.loc[name, 'n_variants_pre'] == n_variants
+
+        # the post-QC counts and metrics are those of the cohort QC'ed on its own
+        alone = preimp_qc(out_dir=f'{tmp_path}/{name}/', report=False, **cohort['kwargs'])
+        assert summary.loc[name, 'n_samples_post'] == alone.pos_qc_counts['n_samples']
+        assert summary.loc[name, 'n_variants_post'] == alone.pos_qc_counts['n_variants']
+
+        samples = QCMetricsStore(summary.loc[name, 'metrics']).samples()
+        assert len(samples) == n_samples
+        assert samples['s'].str.startswith(f'{name}_').all()
+        variants = QCMetricsStore(summary.loc[name, 'metrics']).variants(columns=['contig'])
+        assert len(variants) == n_variants
+
+    written = pd.read_csv(f'{out_dir}GWASpy/Preimp_QC/preimp_qc_batch.summary.tsv', sep='\t')
+    assert sorted(written['cohort']) == sorted(sizes)
+
+
+def test_failed_cohorts_do_not_stop_the_batch_and_finished_ones_are_skipped(hail_context, plink_fileset, tmp_path):
+    from gwaspy.preimp_qc.batch import BatchQC, read_manifest
+
+    dirname, basename = plink_fileset('batch_ok', n_samples=60, n_variants=300)
+    manifest = f'{tmp_path}/manifest.tsv'
+    pd.DataFrame({'cohort': ['ok', 'missing'], 'dirname': [dirname, f'{tmp_path}/nowhere/'],
+                  'basename': [basename, 'missing'], 'input_type': ['plink', 'plink'], 'export_type': ['', ''],
+                  'mind': ['0.95', '']}).to_csv(manifest, sep='\t', index=False)
+    cohorts = read_manifest(manifest)
+    # empty cells take the preimp_qc defaults, and values are typed by their preimp_qc argument
+    assert cohorts[0]['kwargs'] == {'dirname': dirname, 'basename': basename, 'input_type': 'plink',
+                                    'mind_thresh': 0.95}
+    assert 'mind_thresh' not in cohorts[1]['kwargs']
+
+    batch = BatchQC(out_dir=f'{tmp_path}/batch/', workers=2, report=False)
+    summary = batch.run(cohorts).set_index('cohort')
+    assert summary.loc['ok', 'status'] == 'done'
+    assert summary.loc['missing', 'status'] == 'failed'
+    assert summary.loc['missing', 'error']
+
+    # a rerun skips the cohort that finished with the same arguments, and retries the failed one
+    summary = batch.run(cohorts).set_index('cohort')
+    assert summary.loc['ok', 'status'] == 'skipped'
+    assert summary.loc['ok', 'n_samples_pre'] == 60
+    assert summary.loc['missing', 'status'] == 'failed'
@@ -0,0 +1,27 @@
+import numpy as np
+
+
+def test_batched_scans_match_one_regression_per_trait(hail_context, plink_fileset):
+    hl = hail_context
+    from gwaspy.preimp_qc.association import BatchedAssociation
+    from gwaspy.utils.read_file import read_plink
+
+    dirname, basename = plink_fileset('batched', n_samples=200, n_variants=120, n_x=20)
+    mt = read_plink(dirname, basename)
+    mt = mt.filter_rows(hl.agg.fraction(hl.is_defined(mt.GT)) > 0.95)
+    mt = mt.annotate_cols(trait=hl.rand_bool(0.4, seed=1), age=hl.rand_norm(50, 10, seed=2))
+
+    # two covariate sets and no tmp_dir: the dosages go to a Hail temporary file
+    engine = BatchedAssociation(test='wald', phenotypes=['is_case', 'trait'],
+                                covariate_sets={'base': [], 'age': ['age']})
+    results = engine.scan_all(mt)
+    assert set(results) == {'base', 'age'}
+
+    for name, covariates in [('base', [1.0]), ('age', [1.0, mt.age])]:
+        for pheno in ['is_case', 'trait']:
+            single = hl.logistic_regression_rows(test='wald', y=hl.float64(mt[pheno]),
+                                                 x=hl.float64(mt.GT.n_alt_alleles()), covariates=covariates)
+            ht = results[name]
+            ht = ht.select(batched=ht[pheno].p_value, single=single[ht.key].p_value).collect()
+            np.testing.assert_allclose([row.batched for row in ht], [row.single for row in ht], rtol=1e-6,
+                                       err_msg=f'{name} {pheno}')
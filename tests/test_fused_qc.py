@@ -0,0 +1,45 @@
+def test_fused_qc_checkpoints_to_hail_temp_files(hail_context, plink_fileset):
+    hl = hail_context
+    from gwaspy.preimp_qc.fused_qc import FusedQC
+    from gwaspy.utils.read_file import read_plink
+
+    dirname, basename = plink_fileset('fused')
+    mt = read_plink(dirname, basename)
+
+    # without a tmp_dir or a stage cache, the passes are written to Hail's temporary directory
+    fused = FusedQC(hwe_filters={'hwe_cas': 1e-3, 'hwe_con': 1e-3})
+    mt = fused.run(mt)
+    assert fused.n_passes == 3
+
+    n_samples, n_variants = mt.count_cols(), mt.count_rows()
+    for filt in ['mind', 'fstat', 'sex_violations', 'id_pass']:
+        counts = mt.aggregate_cols(hl.agg.counter(mt[filt].filters))
+        assert sum(counts.values()) == n_samples
+    for filt in ['pre_geno', 'geno', 'monomorphic_var', 'hwe_cas', 'hwe_con']:
+        counts = mt.aggregate_rows(hl.agg.counter(mt[filt].filters))
+        assert sum(counts.values()) == n_variants
+    assert mt.aggregate_rows(hl.agg.count_where(mt.monomorphic_var.filters)) > 0
+
+
+def test_fused_filters_match_the_chained_filters(hail_context, plink_fileset):
+    hl = hail_context
+    from gwaspy.preimp_qc.fused_qc import FusedQC
+    from gwaspy.preimp_qc.preimp_qc import chained_qc
+    from gwaspy.utils.read_file import read_plink
+
+    dirname, basename = plink_fileset('fused_chained', n_samples=120)
+    mt = read_plink(dirname, basename).annotate_rows(exclude_row=False).annotate_cols(exclude_col=False)
+    hwe_filters = {'hwe_cas': 1e-3, 'hwe_con': 1e-3}
+
+    # every filter of the chained engine is a separate aggregation, the fused engine computes them in three passes
+    chained = chained_qc(mt, hwe_filters=hwe_filters, data_type='Case-Control')
+    fused = FusedQC(hwe_filters=hwe_filters).run(mt)
+
+    col_filters = ['mind', 'fstat', 'sex_violations', 'sex_warnings', 'id_pass']
+    row_filters = ['pre_geno', 'geno', 'monomorphic_var', 'cr_diff', 'hwe_cas', 'hwe_con']
+    expected = chained.cols().select(**{f: chained[f].filters for f in col_filters}).collect()
+    assert fused.cols().select(**{f: fused[f].filters for f in col_filters}).collect() == expected
+    expected = chained.rows().select(**{f: chained[f].filters for f in row_filters}).collect()
+    assert fused.rows().select(**{f: fused[f].filters for f in row_filters}).collect() == expected
+    # the simulated data has samples and variants failing the call rate filters
+    assert any(row.geno for row in expected) and any(row.pre_geno for row in expected)
@@ -0,0 +1,61 @@
+import json
+import pytest
+
+
+def test_cache_filters_keep_the_input_samples(hail_context, plink_fileset, tmp_path):
+    hl = hail_context
+    from gwaspy.pca.pca_filter_snps import pca_qc_mt
+    from gwaspy.utils.read_file import input_source, read_infile
+
+    dirname, basename = plink_fileset('cohort', n_samples=60, n_variants=300, n_x=40)
+    path = f'{tmp_path}/genotype_cache'
+    mt = read_infile(input_type='plink', dirname=dirname, basename=basename, genotype_cache=path)
+    mt = mt.annotate_cols(batch=hl.int(mt.s[1:]) % 3)
+    source = input_source(input_type='plink', dirname=dirname, basename=basename)
+
+    cached = pca_qc_mt(mt, maf=0.05, hwe=1e-3, call_rate=0.95, genotype_cache=path, source=source)
+    direct = pca_qc_mt(mt, maf=0.05, hwe=1e-3, call_rate=0.95)
+    # the cached statistics pick the same variants as hl.variant_qc, and the columns are those of the input
+    assert cached.rows().select().collect() == direct.rows().select().collect()
+    assert cached.count_rows() > 0
+    assert cached.cols().select('batch').collect() == mt.cols().select('batch').collect()
+
+
+def test_cache_has_to_be_local(tmp_path):
+    pytest.importorskip('hail')
+    from gwaspy.utils.genotype_cache import GenotypeCache, local_dir
+
+    assert local_dir(f'file://{tmp_path}/cache/') == f'{tmp_path}/cache'
+    with pytest.raises(ValueError, match='local directory'):
+        GenotypeCache.is_current('gs://bucket/cache', source=[])
+
+
+def test_cache_records_its_input_and_reference(hail_context, plink_fileset, tmp_path):
+    from gwaspy.pca.pca_filter_snps import pca_filter_mt
+    from gwaspy.utils.genotype_cache import GenotypeCache
+    from gwaspy.utils.read_file import input_source, read_infile
+
+    dirname, basename = plink_fileset('cohort')
+    other_dirname, other_basename = plink_fileset('other', seed=1)
+    path = f'{tmp_path}/genotype_cache'
+    mt = read_infile(input_type='plink', dirname=dirname, basename=basename, genotype_cache=path)
+
+    with open(f'{path}/chunks.json', 'r') as f:
+        meta = json.load(f)
+    assert meta['reference'] == 'GRCh38'
+    source = input_source(input_type='plink', dirname=dirname, basename=basename)
+    assert GenotypeCache.is_current(path, source, reference='GRCh38')
+    assert not GenotypeCache.is_current(path, source, reference='GRCh37')
+    with pytest.raises(ValueError, match='GRCh38'):
+        GenotypeCache(path, reference='GRCh37')
+
+    cache = GenotypeCache(path)
+    assert cache.bed.contig[0] == 'chr1'
+    assert cache.sites().locus.dtype.reference_genome.name == 'GRCh38'
+
+    # the PCA filters read from the cache, so it has to be written from the input being filtered
+    other_source = input_source(input_type='plink', dirname=other_dirname, basename=other_basename)
+    with pytest.raises(ValueError, match='not written from the input'):
+        pca_filter_mt(in_mt=mt, genotype_cache=path, source=other_source)
+    with pytest.raises(ValueError, match='not written from the input'):
+        pca_filter_mt(in_mt=mt, genotype_cache=path)
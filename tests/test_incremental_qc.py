@@ -0,0 +1,73 @@
+import pytest
+
+HWE_FILTERS = {'hwe_cas': 1e-3, 'hwe_con': 1e-3}
+
+
+def test_merged_batches_match_the_whole_cohort(hail_context, plink_fileset, tmp_path):
+    hl = hail_context
+    from gwaspy.preimp_qc.fused_qc import FusedQC
+    from gwaspy.preimp_qc.incremental_qc import IncrementalQC
+    from gwaspy.utils.read_file import read_plink
+
+    dirname, basename = plink_fileset('cohort', n_samples=120, n_variants=400, n_x=60)
+    cohort = read_plink(dirname, basename)
+    # two batches of samples; the second one misses a few variants, which count as zero in the merged statistics
+    batches = [cohort.filter_cols(hl.int(cohort.s[1:]) < 70), cohort.filter_cols(hl.int(cohort.s[1:]) >= 70)]
+    batches[1] = batches[1].filter_rows(batches[1].locus.position != 5000)
+
+    store = f'{tmp_path}/store'
+    for i, batch in enumerate(batches):
+        IncrementalQC(store=store, hwe_filters=HWE_FILTERS).run(batch, batch=f'batch{i}')
+
+    incremental = IncrementalQC(store=store, hwe_filters=HWE_FILTERS)
+    assert incremental.version == 2
+    assert [b['n_samples'] for b in incremental.state['batches']] == [70, 50]
+    assert incremental.state['counts']['pre']['all'] == 120
+
+    # pass 1 covers all samples, so the merged statistics are those of the whole cohort
+    merged_pre = hl.read_table(f'{store}/variant_pre_1.ht')
+    whole = cohort.semi_join_rows(batches[1].rows())
+    expected = whole.select_rows(n_called=hl.agg.count_where(hl.is_defined(whole.GT)),
+                                 AC=hl.agg.call_stats(whole.GT, whole.alleles).AC).rows()
+    ht = expected.annotate(merged=merged_pre[expected.key])
+    assert ht.aggregate(hl.agg.all((ht.merged.pre_geno_n_called == ht.n_called) & (ht.merged.AC == ht.AC)))
+    # the variants missing from the second batch only have the statistics of the first one
+    dropped = merged_pre.filter(merged_pre.locus.position == 5000)
+    first = batches[0].filter_rows(batches[0].locus.position == 5000)
+    first = first.select_rows(n_called=hl.agg.count_where(hl.is_defined(first.GT))).rows()
+    assert dropped.count() == first.count() == 2
+    assert sorted(dropped.pre_geno_n_called.collect()) == sorted(first.n_called.collect())
+
+    # pass 3 covers the samples passing the filters of their own batch
+    samples = hl.read_table(f'{store}/samples_0.ht').union(hl.read_table(f'{store}/samples_1.ht'))
+    whole = whole.annotate_cols(id_pass=samples[whole.col_key].id_pass)
+    fused = FusedQC(hwe_filters=HWE_FILTERS)
+    expected = whole.select_rows(stats=hl.agg.filter(whole.id_pass.filters == False,
+                                                     fused.variant_stats_expr(whole))).rows()
+    merged = hl.read_table(f'{store}/variant_1.ht')
+    fields = [field for field in merged.row_value if field in expected.stats.dtype]
+    assert {'geno_n_called', 'AC', 'hwe_cas_counts', 'hwe_con_counts', 'hwe_all_counts'} <= set(fields)
+    ht = expected.annotate(merged=merged[expected.key])
+    mismatches = ht.aggregate(hl.agg.count_where(
+        hl.any([ht.merged[field] != ht.stats[field] for field in fields])))
+    assert mismatches == 0
+
+    # the variant filters of the cohort are derived from the merged statistics
+    filters = hl.read_table(f'{store}/filters_1.ht')
+    assert filters.count() == cohort.count_rows()
+    pre_geno = filters.aggregate(hl.agg.counter(filters.pre_geno.filters))
+    assert pre_geno[True] > 0
+
+
+def test_a_sample_cannot_be_added_twice(hail_context, plink_fileset, tmp_path):
+    from gwaspy.preimp_qc.incremental_qc import IncrementalQC
+    from gwaspy.utils.read_file import read_plink
+
+    dirname, basename = plink_fileset('cohort', n_samples=40, n_variants=100, n_x=20)
+    batch = read_plink(dirname, basename)
+    store = f'{tmp_path}/store'
+    IncrementalQC(store=store).run(batch, batch='first')
+
+    with pytest.raises(ValueError, match='already QC'):
+        IncrementalQC(store=store).run(batch, batch='again')
+    assert IncrementalQC(store=store).version == 1
@@ -0,0 +1,24 @@
+def test_shared_sites_are_cached_per_reference_and_input(hail_context, tmp_path):
+    hl = hail_context
+    from gwaspy.pca.intersect import intersect_ref, pca_cache
+    from gwaspy.utils.read_file import input_fingerprint
+
+    ref = hl.balding_nichols_model(2, 20, 300, n_partitions=3)
+    ref.write(f'{tmp_path}/ref.mt')
+    # data on every other reference site, plus sites the reference does not have
+    data = hl.balding_nichols_model(2, 10, 600, n_partitions=2, seed=1)
+    data = data.filter_rows((data.locus.position % 2 == 0) | (data.locus.position > 300))
+    expected = {row.locus.position for row in data.rows().collect() if row.locus.position <= 300}
+
+    cache = pca_cache(f'{tmp_path}/')
+    data_mt, ref_mt = intersect_ref(ref_dirname=f'{tmp_path}/', ref_basename='ref', data_mt=data, cache=cache,
+                                    upstream='data')
+    assert {locus.position for locus in data_mt.locus.collect()} == expected
+    assert {locus.position for locus in ref_mt.locus.collect()} == expected
+    assert (data_mt.count_cols(), ref_mt.count_cols()) == (10, 20)
+
+    # the shared sites are read back for the same reference and input, not recomputed from the row keys
+    key = cache.key('shared_sites', upstream='data', reference=input_fingerprint([f'{tmp_path}/ref.mt']))
+    assert cache.exists('shared_sites', key, 'ht')
+    _, computed = cache.table('shared_sites', key, lambda: None)
+    assert not computed
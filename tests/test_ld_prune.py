@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+
+def greedy_prune(z: np.ndarray, positions: np.ndarray, r2: float, bp_window: int) -> list:
+    """Windowed greedy pruning over every pair of variants, the definition prune_contig implements"""
+    kept = []
+    for i in range(len(z)):
+        window = [j for j in kept if positions[j] >= positions[i] - bp_window]
+        if all((z[j] @ z[i] / z.shape[1]) ** 2 < r2 for j in window):
+            kept.append(i)
+
+    return kept
+
+
+@pytest.mark.parametrize('bp_window', [0, 5000, 10 ** 9])
+def test_prune_contig_matches_greedy_pruning(plink_fileset, bp_window):
+    pytest.importorskip('hail')
+    from gwaspy.pca.ld_prune import prune_contig, standardised
+    from gwaspy.utils.plink_bed import PlinkBed
+
+    # enough kept variants in the widest window for the ring buffer to wrap and grow
+    dirname, basename = plink_fileset('ld', n_samples=100, n_variants=1200, n_x=0)
+    bed = PlinkBed(dirname=dirname, basename=basename)
+    rows = np.flatnonzero(bed.contig == 'chr1')
+    z = standardised(np.asarray(bed.packed[rows]), bed.n_samples)
+
+    kept = prune_contig(bed.packed, rows, bed.position[rows], bed.n_samples, r2=0.2, bp_window=bp_window,
+                        chunk_size=100)
+    assert kept == list(rows[greedy_prune(z, bed.position[rows], r2=0.2, bp_window=bp_window)])
+    if bp_window == 10 ** 9:
+        assert len(kept) > 256
+
+
+def test_pruned_sites_are_timed_once_per_cache_key(hail_context, tmp_path, caplog):
+    hl = hail_context
+    from gwaspy.pca.ld_prune import pruned_sites
+    from gwaspy.utils.stages import StageCache
+
+    mt = hl.balding_nichols_model(2, 50, 400, n_partitions=2)
+    cache = StageCache(f'{tmp_path}/cache')
+    with caplog.at_level('INFO', logger='gwaspy.timing'):
+        first = pruned_sites(mt, cache=cache, upstream='data')
+        second = pruned_sites(mt, cache=cache, upstream='data')
+    assert first.count() == second.count() > 0
+    # the second call reads the cached sites, so only the first one prunes and is timed
+    assert [record.getMessage().split(' took ')[0] for record in caplog.records] == ['LD pruning']
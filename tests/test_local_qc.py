@@ -0,0 +1,114 @@
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+HWE_FILTERS = {'hwe_cas': 1e-3, 'hwe_con': 1e-3, 'hwe_all': 1e-3}
+SAMPLE_FILTERS = ['mind', 'fstat', 'sex_violations', 'sex_ambiguous', 'sex_warnings', 'id_pass']
+VARIANT_FILTERS = ['pre_geno', 'geno', 'cr_diff', 'monomorphic_var', *HWE_FILTERS]
+
+
+def test_local_qc_matches_fused_qc(hail_context, plink_fileset, tmp_path):
+    hl = hail_context
+    from gwaspy.preimp_qc.fused_qc import FusedQC
+    from gwaspy.preimp_qc.local_qc import LocalQC
+    from gwaspy.utils.plink_bed import PlinkBed
+    from gwaspy.utils.read_file import read_plink
+
+    dirname, basename = plink_fileset('parity', n_samples=120, n_variants=600, n_x=80)
+    thresholds = dict(pre_geno_cr=0.95, mind=0.98, fhet_thresh=0.2, fstat_x=0.5, fstat_y=0.5, geno_thresh=0.98,
+                      cr_diff_thresh=0.02, hwe_filters=HWE_FILTERS, chromx='chrX', chromy='chrY', chrommt='chrM')
+
+    bed = PlinkBed(dirname=dirname, basename=basename)
+    local = LocalQC(**thresholds, workers=2)
+    local_variants, local_samples, counts = local.run(bed)
+    local_variants['rsid'] = bed.bim['rsid']
+    for name in HWE_FILTERS:
+        local_variants[f'{name}_p'] = local.hwe_p_values(bed, counts['post']['counts'], name)
+
+    fused = FusedQC(**thresholds, tmp_dir=str(tmp_path))
+    mt = fused.run(read_plink(dirname, basename))
+
+    samples = mt.cols()
+    samples = samples.select(**{filt: samples[filt].filters for filt in SAMPLE_FILTERS},
+                             **fused.sample_metrics[samples.key])
+    samples = samples.to_pandas().set_index('s').loc[bed.fam['s']]
+
+    variants = mt.rows()
+    stats = fused.variant_metrics[variants.key]
+    variants = variants.select(
+        'rsid', aaf=variants.aaf, **{filt: variants[filt].filters for filt in VARIANT_FILTERS},
+        **{f'{name}_p': hl.hardy_weinberg_test(stats[f'{name}_counts'].n_hom_ref, stats[f'{name}_counts'].n_het,
+                                               stats[f'{name}_counts'].n_hom_var).p_value
+           for name in HWE_FILTERS})
+    variants = variants.to_pandas().set_index('rsid').loc[bed.bim['rsid']]
+
+    # the simulated data fails every filter somewhere, so the flags are compared on both outcomes
+    for filt in ['mind', 'fstat', 'sex_warnings']:
+        assert local_samples[filt].any() & ~local_samples[filt].all(), filt
+    for filt in ['pre_geno', 'geno', 'cr_diff', 'monomorphic_var']:
+        assert local_variants[filt].any() & ~local_variants[filt].all(), filt
+
+    for filt in SAMPLE_FILTERS:
+        np.testing.assert_array_equal(local_samples[filt].to_numpy(), samples[filt].to_numpy(dtype=bool),
+                                      err_msg=filt)
+    for stat in ['call_rate', 'fhet', 'sex_fstat']:
+        np.testing.assert_allclose(local_samples[stat].to_numpy(),
+                                   samples[stat].to_numpy(dtype=float, na_value=np.nan), rtol=1e-9, err_msg=stat)
+
+    for filt in VARIANT_FILTERS:
+        np.testing.assert_array_equal(local_variants[filt].to_numpy(), variants[filt].to_numpy(dtype=bool),
+                                      err_msg=filt)
+    for stat in ['aaf', *[f'{name}_p' for name in HWE_FILTERS]]:
+        np.testing.assert_allclose(local_variants[stat].to_numpy(),
+                                   variants[stat].to_numpy(dtype=float, na_value=np.nan), rtol=1e-6, err_msg=stat)
+
+
+@pytest.mark.parametrize('counts', [(10, 0, 0), (25, 50, 25), (50, 0, 50), (81, 18, 1), (3, 40, 7), (0, 1, 0)])
+def test_hwe_p_values_are_a_probability(counts):
+    pytest.importorskip('scipy')
+    from gwaspy.utils.plink_bed import hwe_p_values
+
+    p_value = hwe_p_values(*[np.array([n]) for n in counts])[0]
+    assert 0 <= p_value <= 1
+    # genotype counts in HWE proportions are not rejected, and ones without heterozygotes are
+    if counts in [(25, 50, 25), (81, 18, 1)]:
+        assert p_value > 0.5
+    if counts == (50, 0, 50):
+        assert p_value < 1e-20
+
+
+def test_plink_bed_round_trip(plink_fileset, tmp_path):
+    from gwaspy.utils.plink_bed import PlinkBed, decode
+
+    dirname, basename = plink_fileset('round_trip', n_samples=37, n_variants=50, n_x=10)
+    bed = PlinkBed(dirname=dirname, basename=basename)
+    variants = np.arange(bed.n_variants) % 3 != 0
+    samples = np.arange(bed.n_samples) % 5 != 0
+    bed.write_plink(f'{tmp_path}/subset', variants, samples)
+
+    subset = PlinkBed(dirname=f'{tmp_path}/', basename='subset')
+    assert (subset.n_variants, subset.n_samples) == (variants.sum(), samples.sum())
+    pd.testing.assert_frame_equal(subset.bim, bed.bim[variants].reset_index(drop=True))
+    assert (subset.fam['s'].to_numpy() == bed.fam['s'][samples].to_numpy()).all()
+    np.testing.assert_array_equal(decode(np.asarray(subset.packed), subset.n_samples),
+                                  decode(np.asarray(bed.packed), bed.n_samples)[variants][:, samples])
+
+
+def test_local_engine_is_imported_without_hail():
+    # a fresh interpreter, as other tests may have imported Hail already
+    code = 'import sys; import gwaspy.preimp_qc.local_qc, gwaspy.utils.plink_bed; assert "hail" not in sys.modules'
+    subprocess.run([sys.executable, '-c', code], check=True)
+
+
+@pytest.mark.parametrize('option', [{'annotations_file': 'annotations.tsv'}, {'export_type': 'vcf'}])
+def test_local_engine_rejects_options_that_need_hail(plink_fileset, tmp_path, option):
+    pytest.importorskip('hail')
+    from gwaspy.preimp_qc.preimp_qc import preimp_qc
+
+    dirname, basename = plink_fileset('options', n_samples=20, n_variants=40, n_x=10)
+    kwargs = {'export_type': 'plink', **option}
+    with pytest.raises(ValueError, match='local engine'):
+        preimp_qc(input_type='plink', dirname=dirname, basename=basename, engine='local', report=False,
+                  out_dir=f'{tmp_path}/', **kwargs)
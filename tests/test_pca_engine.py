@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+
+def test_randomized_engine_recovers_the_exact_pcs(hail_context):
+    hl = hail_context
+    from gwaspy.pca.pca_engine import PCAEngine
+
+    mt = hl.balding_nichols_model(3, 150, 2000, n_partitions=4, fst=[0.1, 0.1, 0.1])
+    exact_evals, exact_scores, _ = PCAEngine('exact').pca(mt.GT, k=3)
+    rand_evals, rand_scores, rand_loadings = PCAEngine('randomized', power_iterations=6).pca(mt.GT, k=3,
+                                                                                            compute_loadings=True)
+    assert rand_loadings.count() == 2000
+
+    np.testing.assert_allclose(rand_evals, exact_evals, rtol=1e-3)
+    scores = rand_scores.annotate(exact=exact_scores[rand_scores.key].scores)
+    scores = scores.collect()
+    exact = np.array([row.exact for row in scores])
+    randomized = np.array([row.scores for row in scores])
+    # PCs are only defined up to their sign
+    for pc in range(3):
+        assert abs(np.corrcoef(exact[:, pc], randomized[:, pc])[0, 1]) > 0.999
+
+
+def test_randomized_engine_needs_a_recent_hail(monkeypatch):
+    hl = pytest.importorskip('hail')
+    from gwaspy.pca.pca_engine import PCAEngine
+
+    monkeypatch.setattr(hl, '__version__', '0.2.61-3c86d3ba497a')
+    with pytest.raises(ValueError, match='Hail >= 0.2.90'):
+        PCAEngine('randomized')
+    assert PCAEngine('exact').name == 'exact'
+
+    with pytest.raises(ValueError, match='must be one of'):
+        PCAEngine('svd')
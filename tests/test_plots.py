@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('hail')
+pytest.importorskip('matplotlib')
+
+
+def test_manhattan_render_lays_out_contigs_and_keeps_significant_points():
+    from gwaspy.preimp_qc.plots import manhattan_render
+
+    rng = np.random.default_rng(0)
+    n = 200000
+    contig = rng.integers(0, 3, size=n)
+    lengths = [1000000, 500000, 2000000]
+    position = rng.integers(1, 500001, size=n)
+    log_p = rng.exponential(1, size=n)
+    log_p[:5] = [8, 9, 10, 12, 250]
+
+    fig = manhattan_render(contig, position, log_p, contig_lengths=lengths, contig_names=['1', '2', '3'],
+                           figsize=(4, 3), dpi=50)
+    points = fig.axes[0].collections[0]
+    xy = points.get_offsets()
+    # the dense non-significant points are thinned to at most one per cell of the saved figure
+    assert len(xy) < n / 10
+
+    # chromosomes are laid out end to end, so the x of a point is its contig's offset plus its position
+    offsets = np.array([0, 1000000, 1500000])
+    significant = xy[xy[:, 1] >= -np.log10(5E-08)]
+    expected = np.stack([offsets[contig[:5]] + position[:5], [8, 9, 10, 12, 199]], axis=1)
+    np.testing.assert_array_equal(significant[np.argsort(significant[:, 1])], expected)
+    np.testing.assert_allclose(fig.axes[0].get_xticks(), offsets + np.array(lengths) / 2)
+
+    # neighbouring chromosomes alternate colours
+    colors = points.get_facecolors()
+    kept_contig = np.searchsorted(offsets, xy[:, 0], side='left') - 1
+    assert len({tuple(c) for c in colors[kept_contig % 2 == 0]}) == 1
+    assert {tuple(c) for c in colors[kept_contig % 2 == 0]} != {tuple(c) for c in colors[kept_contig % 2 == 1]}
+
+    # without thinning every point is drawn
+    fig = manhattan_render(contig[:1000], position[:1000], log_p[:1000], contig_lengths=lengths, thin=False)
+    assert len(fig.axes[0].collections[0].get_offsets()) == 1000
+
+
+def test_qq_and_manhattan_data_come_from_bounded_aggregations(hail_context):
+    hl = hail_context
+    from gwaspy.preimp_qc.plots import manhattan_agg, manhattan_points, qq_agg, qq_lambda_gc, qq_points
+
+    n = 20000
+    ht = hl.utils.range_table(n, n_partitions=4)
+    # uniform p-values, a few strong hits and a few NaNs that are not p-values
+    p = hl.if_else(ht.idx % 5000 == 7, 1e-12, (ht.idx * 7919 % n + 0.5) / n)
+    ht = ht.annotate(p=hl.if_else(ht.idx % 4000 == 3, hl.float64('nan'), p),
+                     locus=hl.locus(hl.if_else(ht.idx < n // 2, 'chr1', 'chr2'), 1 + ht.idx * 1000))
+    ht = ht.checkpoint(hl.utils.new_temp_file('pvalues', 'ht'))
+    pvals = ht.aggregate(hl.agg.filter(~hl.is_nan(ht.p), hl.agg.collect(ht.p)))
+
+    qq = ht.aggregate(qq_agg(ht.p, n_tail=100, k=200))
+    assert qq.n == len(pvals)
+    # the smallest p-values are kept exactly, the rest only as a sketch
+    assert qq.tail == sorted(pvals)[:100]
+    expected_p, observed_p = qq_points(qq)
+    assert len(observed_p) < len(pvals) / 10
+    np.testing.assert_allclose(observed_p[:100], -np.log10(sorted(pvals)[:100]))
+    np.testing.assert_allclose(expected_p[:100], -np.log10(np.arange(1, 101) / len(pvals)))
+    # uniform p-values have a lambda GC close to 1
+    assert abs(qq_lambda_gc(qq) - 1) < 0.05
+
+    bin_size = 1000000
+    man = ht.aggregate(manhattan_agg(ht.p, ht.locus, bin_size))
+    assert len(man.exact) == 4
+    np.testing.assert_allclose([point.log_p for point in man.exact], 12)
+    points = manhattan_points(man, hl.get_reference('GRCh38'), bin_size)
+    assert points['contig_names'] == ['1', '2']
+    # one point per window without a hit, and the hits at their exact position
+    hits = points['log_p'] > 11
+    assert (~hits).sum() == len(man.binned) - 4
+    np.testing.assert_array_equal(np.sort(points['position'][hits]),
+                                  [1 + i * 1000 for i in range(n) if i % 5000 == 7])
+
+
+def test_histograms_are_binned_by_hail(hail_context):
+    hl = hail_context
+    from gwaspy.preimp_qc.plots import plt_hist
+
+    ht = hl.utils.range_table(1000, n_partitions=2)
+    ht = ht.annotate(x=hl.float64(ht.idx % 97) / 96)
+    fig = plt_hist(ht.x, bins=10)
+    heights = [patch.get_height() for patch in fig.axes[0].patches]
+    expected, _ = np.histogram([(i % 97) / 96 for i in range(1000)], bins=10, range=(0, 1))
+    assert heights == list(expected)
@@ -0,0 +1,47 @@
+import pytest
+
+pytest.importorskip('hail')
+
+
+@pytest.mark.parametrize('data_type, expected', [
+    ('Case-only', {'hwe_cas': 1e-9}), ('Control-only', {'hwe_con': 1e-5}),
+    ('Case-Control', {'hwe_cas': 1e-9, 'hwe_con': 1e-5}), ('no-pheno', {'hwe_all': 1e-7}),
+    ('Trio', {'hwe_all': 1e-7})])
+def test_filter_names_apply_the_given_hwe_thresholds(data_type, expected):
+    from gwaspy.preimp_qc.preimp_qc import filter_names
+
+    row_filters, filters, _, hwe_filters = filter_names(data_type, hwe_th_con_thresh=1e-5, hwe_th_cas_thresh=1e-9,
+                                                        hwe_th_all_thresh=1e-7)
+    assert hwe_filters == expected
+    assert set(hwe_filters) <= set(row_filters) <= set(filters)
+
+
+@pytest.mark.parametrize('chroms, expected', [
+    (['chr1', 'chrX'], ('chrX', 'chrY', 'chrMT')), (['chr1', 'chrY'], ('chrX', 'chrY', 'chrMT')),
+    (['chr1', 'chrMT'], ('chrX', 'chrY', 'chrMT')), (['1', 'X', 'Y'], ('X', 'Y', 'MT'))])
+def test_sex_chromosome_names_follow_the_contigs(chroms, expected):
+    from gwaspy.preimp_qc.preimp_qc import sex_chromosomes
+
+    assert sex_chromosomes(chroms) == expected
+
+
+def test_export_is_redone_when_its_output_is_gone(hail_context, plink_fileset, tmp_path):
+    import os
+    from gwaspy.preimp_qc.preimp_qc import preimp_qc
+    from gwaspy.utils.export_file import exported_files
+
+    dirname, basename = plink_fileset('export', n_samples=60, n_variants=300)
+    kwargs = {'dirname': dirname, 'basename': basename, 'input_type': 'plink', 'export_type': 'plink',
+              'out_dir': f'{tmp_path}/out/', 'cache_dir': f'{tmp_path}/cache', 'report': False}
+    files = exported_files(kwargs['out_dir'], basename, 'plink')
+
+    preimp_qc(**kwargs)
+    written = {path: os.path.getmtime(path) for path in files}
+    # an unchanged rerun skips the export
+    preimp_qc(**kwargs)
+    assert {path: os.path.getmtime(path) for path in files} == written
+
+    # the export stage is cached, but its output was deleted
+    os.remove(files[0])
+    preimp_qc(**kwargs)
+    assert all(os.path.exists(path) for path in files)
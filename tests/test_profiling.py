@@ -0,0 +1,68 @@
+import json
+import pytest
+from types import SimpleNamespace
+
+pytest.importorskip('hail')
+
+
+def test_nested_stages_fold_into_their_own_time(tmp_path, monkeypatch):
+    from gwaspy.preimp_qc import profiling
+    from gwaspy.preimp_qc.profiling import QCProfiler
+
+    clock = iter([0.0, 1.0, 3.0, 4.0, 10.0, 12.0])
+    monkeypatch.setattr(profiling, 'time', SimpleNamespace(perf_counter=lambda: next(clock)))
+    profiler = QCProfiler()
+    # without a Spark UI, the stages are still timed
+    monkeypatch.setattr(profiler, '_spark_stages', lambda: None)
+
+    with profiler.stage('fused_qc'):
+        with profiler.stage('pass_1'):
+            pass
+    with profiler.stage('plots'):
+        pass
+
+    assert [(r['path'], r['seconds'], r['spark']) for r in profiler.stages] == [
+        ('preimp_qc;fused_qc;pass_1', 2.0, None), ('preimp_qc;fused_qc', 4.0, None), ('preimp_qc;plots', 2.0, None)]
+    # a parent's folded time excludes its nested stages
+    assert profiler.folded() == ['preimp_qc;fused_qc;pass_1 2000', 'preimp_qc;fused_qc 2000', 'preimp_qc;plots 2000']
+    summary = profiler.summary(width=10).splitlines()
+    assert summary[1].startswith('fused_qc ') and summary[1].endswith('#' * 7)
+    assert summary[2].startswith('fused_qc > pass_1')
+
+    json_file, folded_file = profiler.write(f'{tmp_path}/run.profile', basename='run')
+    with open(json_file) as f:
+        assert json.load(f) == {'basename': 'run', 'stages': profiler.stages}
+    with open(folded_file) as f:
+        assert f.read().splitlines() == profiler.folded()
+
+
+def test_profiled_filters_are_forced_on_their_own(hail_context, monkeypatch):
+    hl = hail_context
+    from gwaspy.preimp_qc.profiling import QCProfiler
+
+    class CallRate:
+        def filter(self, mt):
+            mt = mt.annotate_rows(cr=hl.agg.fraction(hl.is_defined(mt.GT)))
+            return mt.annotate_cols(n_called=hl.agg.count_where(hl.is_defined(mt.GT)))
+
+    mt = hl.balding_nichols_model(2, 20, 100, n_partitions=2)
+    mt = mt.filter_entries((mt.sample_idx + mt.locus.position) % 7 != 0)
+    mt = mt.checkpoint(hl.utils.new_temp_file('profiled', 'mt'))
+
+    # disabled, the filter is applied as is
+    disabled = QCProfiler(enabled=False)
+    plain = disabled.filter('cr', CallRate(), mt)
+    assert disabled.stages == []
+
+    profiler = QCProfiler()
+    monkeypatch.setattr(profiler, '_spark_stages', lambda: None)
+    checkpoints = []
+    new_temp_file = hl.utils.new_temp_file
+    monkeypatch.setattr(hl.utils, 'new_temp_file', lambda *args: checkpoints.append(args) or new_temp_file(*args))
+    forced = profiler.filter('cr', CallRate(), mt)
+
+    # the new row and column fields are checkpointed, and read back with the same values
+    assert checkpoints == [('profile_cr', 'ht'), ('profile_cr', 'ht')]
+    assert [r['stage'] for r in profiler.stages] == ['cr']
+    assert forced.cr.collect() == plain.cr.collect()
+    assert forced.n_called.collect() == plain.n_called.collect()
@@ -0,0 +1,30 @@
+import numpy as np
+
+
+def test_projection_matches_hail_pc_project(hail_context):
+    hl = hail_context
+    from gwaspy.pca.projection import LoadingsProjector, pc_project
+
+    mt = hl.balding_nichols_model(3, 100, 800, n_partitions=4, fst=[0.1, 0.1, 0.1])
+    _, _, loadings = hl.hwe_normalized_pca(mt.GT, k=4, compute_loadings=True)
+    loadings = loadings.annotate(pca_af=mt.annotate_rows(af=hl.agg.mean(mt.GT.n_alt_alleles()) / 2).rows()[
+        loadings.key].af)
+
+    # other samples, with missing genotypes and only some of the loadings sites
+    data = hl.balding_nichols_model(3, 60, 800, n_partitions=3, fst=[0.1, 0.1, 0.1], seed=1)
+    data = data.filter_entries(hl.rand_bool(0.05, seed=2), keep=False)
+    data = data.filter_rows(data.locus.position % 4 != 0)
+
+    expected = hl.experimental.pc_project(data.GT, loadings.loadings, loadings.pca_af)
+    ours = pc_project(mt=data, loadings_ht=loadings)
+    ht = ours.annotate(expected=expected[ours.key].scores).collect()
+    np.testing.assert_allclose(np.array([row.scores for row in ht]), np.array([row.expected for row in ht]),
+                               rtol=1e-9, atol=1e-12)
+
+    # without missing genotypes, imputing the mean dosage changes nothing
+    complete = data.filter_rows(hl.agg.all(hl.is_defined(data.GT)))
+    projector = LoadingsProjector(loadings, n_variants=loadings.count())
+    by_impute = projector.project_many({'af': complete}, impute='af')
+    mean = projector.project(complete, impute='mean')
+    ht = mean.annotate(af=by_impute['af'][mean.key].scores).collect()
+    np.testing.assert_allclose(np.array([row.scores for row in ht]), np.array([row.af for row in ht]), rtol=1e-9)
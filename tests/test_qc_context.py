@@ -0,0 +1,38 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip('hail')
+
+
+def test_run_summary_round_trips_through_the_local_store(tmp_path):
+    from gwaspy.preimp_qc.qc_context import QCMetricsStore, QCRun, QCThresholds
+
+    run = QCRun(basename='cohort', output_directory=f'{tmp_path}/', thresholds=QCThresholds(mind=0.9, hwe_all=1e-8),
+                data_type='Case-Control', row_filters=['geno', 'hwe_all'], hwe_filters={'hwe_all': 1e-8},
+                results={'mind': {True: 3, False: 97}, 'hwe_all': {False: 1000}}, n_trios=0)
+    store = QCMetricsStore(run.metrics_dir, local=True)
+    store.write_run(run)
+
+    read = store.read_run(work_dir='figures')
+    assert read.work_dir == 'figures'
+    assert (read.thresholds.mind, read.thresholds.hwe_all, read.thresholds.geno) == (0.9, 1e-8, 0.98)
+    # JSON has string keys only, the filter results come back keyed by whether the samples/variants failed
+    assert read.results == {'mind': {True: 3, False: 97}, 'hwe_all': {True: 0, False: 1000}}
+    assert read.col_filters == ['mind', 'fstat', 'sex_violations', 'sex_warnings']
+    assert read.to_json() == run.to_json()
+    # runs do not share their mutable fields
+    read.row_filters.append('cr_diff')
+    assert QCRun(basename='other', output_directory='/').row_filters == []
+
+
+def test_local_store_writes_the_metrics_as_parquet(tmp_path):
+    pytest.importorskip('pyarrow')
+    from gwaspy.preimp_qc.qc_context import QCMetricsStore
+
+    samples = pd.DataFrame({'s': ['S0', 'S1'], 'call_rate': [0.99, 0.8], 'mind': [False, True]})
+    variants = pd.DataFrame({'contig': ['chr1', 'chrX'], 'position': [1000, 2000], 'geno': [False, False]})
+    store = QCMetricsStore(f'{tmp_path}/cohort.metrics/', local=True)
+    store.write_frames(samples, variants)
+
+    pd.testing.assert_frame_equal(store.samples(), samples)
+    pd.testing.assert_frame_equal(store.variants(columns=['contig', 'geno']), variants[['contig', 'geno']])
@@ -0,0 +1,115 @@
+import os
+import pytest
+
+VCF_HEADER = '''##fileformat=VCFv4.2
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+##contig=<ID=chr1,length=248956422>
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\tS2\tS3
+'''
+
+
+def write_vcf(hl, tmp_path, basename: str, rows: list) -> str:
+    """Write rows (position, ref, alt, genotypes) as the block-gzipped {basename}.vcf.gz read_vcf reads"""
+    with open(f'{tmp_path}/{basename}.vcf', 'w') as f:
+        f.write(VCF_HEADER)
+        for position, ref, alt, genotypes in rows:
+            f.write(f'chr1\t{position}\t.\t{ref}\t{alt}\t.\tPASS\t.\tGT\t' + '\t'.join(genotypes) + '\n')
+    mt = hl.import_vcf(f'{tmp_path}/{basename}.vcf', reference_genome='GRCh38')
+    hl.export_vcf(mt, f'{tmp_path}/{basename}.vcf.bgz')
+    hl.hadoop_copy(f'{tmp_path}/{basename}.vcf.bgz', f'{tmp_path}/{basename}.vcf.gz')
+
+    return f'{tmp_path}/'
+
+
+def test_read_vcf_splits_multi_allelic_sites(hail_context, tmp_path):
+    hl = hail_context
+    from gwaspy.utils.read_file import read_vcf
+
+    # the multi-allelic site at 200 shares its locus with a bi-allelic one, and its A/T split sorts after it
+    dirname = write_vcf(hl, tmp_path, 'multi', [
+        (100, 'A', 'G', ['0/0', '0/1', '1/1']),
+        (200, 'A', 'C,T', ['0/1', '0/2', '1/2']),
+        (200, 'A', 'G', ['0/0', '0/0', '0/1']),
+        (300, 'C', 'T', ['0/1', '0/0', '0/0'])])
+    mt = read_vcf(dirname, 'multi', n_parts=1)
+    rows = mt.rows().collect()
+    assert [(row.locus.position, row.alleles) for row in rows] == [
+        (100, ['A', 'G']), (200, ['A', 'C']), (200, ['A', 'G']), (200, ['A', 'T']), (300, ['C', 'T'])]
+    assert [row.a_index for row in rows] == [None, 1, None, 2, None]
+    assert [row.was_split for row in rows] == [False, True, False, True, False]
+    # the second alternate allele is the alt of its split row
+    assert [call.n_alt_alleles() for call in mt.filter_rows(mt.alleles[1] == 'T').GT.collect()] == [0, 1, 1]
+
+
+def test_read_vcf_without_multi_allelic_sites_keeps_a_index_missing(hail_context, tmp_path):
+    hl = hail_context
+    from gwaspy.utils.read_file import read_vcf
+
+    dirname = write_vcf(hl, tmp_path, 'bi', [
+        (100, 'A', 'G', ['0/0', '0/1', '1/1']),
+        (300, 'C', 'T', ['0/1', '0/0', '0/0'])])
+    mt = read_vcf(dirname, 'bi', n_parts=1)
+    rows = mt.rows().collect()
+    assert [row.a_index for row in rows] == [None, None]
+    assert [row.was_split for row in rows] == [False, False]
+
+
+def test_partitions_follow_the_input_size_and_cores(monkeypatch):
+    pytest.importorskip('hail')
+    from gwaspy.utils import read_file
+
+    sizes_gb = {'small.bed': 0.5 / 1024, 'medium.bed': 5 / 1024, 'large.bed': 10.0, 'half.bed': 0.5}
+    monkeypatch.setattr(read_file, 'bytes_to_gb', lambda path: sizes_gb[path])
+
+    # never partitions smaller than 1MB of input
+    assert read_file.n_partitions(['small.bed'], cores=8) == 1
+    assert read_file.n_partitions(['medium.bed'], cores=8) == 5
+    # two per core while the input is small enough, then about 128MB each
+    assert read_file.n_partitions(['half.bed'], cores=8) == 16
+    assert read_file.n_partitions(['large.bed'], cores=8) == 80
+    assert read_file.n_partitions(['large.bed', 'half.bed'], cores=8, partition_mb=512) == 21
+
+
+def test_converted_input_is_reused_until_the_source_changes(hail_context, tmp_path):
+    hl = hail_context
+    from gwaspy.utils.read_file import converted_mt
+
+    source = f'{tmp_path}/source.txt'
+    with open(source, 'w') as f:
+        f.write('1')
+    calls = []
+
+    def convert():
+        calls.append(1)
+        return hl.utils.range_matrix_table(4, 3)
+
+    assert converted_mt([source], f'{tmp_path}/converted.mt', convert).count() == (4, 3)
+    assert converted_mt([source], f'{tmp_path}/converted.mt', convert).count() == (4, 3)
+    assert len(calls) == 1
+
+    with open(source, 'w') as f:
+        f.write('12')
+    os.utime(source, (0, 0))
+    converted_mt([source], f'{tmp_path}/converted.mt', convert)
+    assert len(calls) == 2
+
+
+def test_bgen_is_indexed_once_per_input_and_reference(hail_context, tmp_path, monkeypatch):
+    hl = hail_context
+    from gwaspy.utils.read_file import read_bgen
+
+    mt = hl.balding_nichols_model(2, 10, 50, n_partitions=2, reference_genome='GRCh38')
+    mt = mt.key_cols_by(s=hl.str(mt.sample_idx))
+    gp = hl.literal([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]])[mt.GT.n_alt_alleles()]
+    hl.export_bgen(mt, f'{tmp_path}/cohort', gp=gp)
+
+    index_bgen, calls = hl.index_bgen, []
+    monkeypatch.setattr(hl, 'index_bgen', lambda *args, **kwargs: calls.append(kwargs) or index_bgen(*args, **kwargs))
+
+    in_mt = read_bgen(f'{tmp_path}/', 'cohort', n_parts=2)
+    assert in_mt.count() == (50, 10)
+    assert in_mt.s.collect() == [str(i) for i in range(10)]
+    assert in_mt.locus.dtype.reference_genome.name == 'GRCh38'
+    read_bgen(f'{tmp_path}/', 'cohort', n_parts=2)
+    assert len(calls) == 1
+    assert calls[0]['reference_genome'] == 'GRCh38'
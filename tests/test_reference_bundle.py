@@ -0,0 +1,35 @@
+import numpy as np
+
+
+def scores_matrix(ht, npcs: int) -> np.ndarray:
+    df = ht.to_pandas().sort_values('s')
+    return df[[f'PC{i}' for i in range(1, npcs + 1)]].to_numpy()
+
+
+def test_projection_renormalises_by_the_sites_it_uses(hail_context, tmp_path):
+    hl = hail_context
+    from gwaspy.pca.reference_bundle import ReferenceBundle
+
+    mt = hl.balding_nichols_model(3, 120, 1500, n_partitions=4, fst=[0.1, 0.1, 0.1])
+    mt = mt.key_cols_by(s=hl.str(mt.sample_idx)).select_cols().select_rows().select_globals()
+    mt.write(f'{tmp_path}/ref.mt')
+    bundle = ReferenceBundle.build(f'{tmp_path}/bundle', ref_dirname=f'{tmp_path}/', ref_basename='ref', npcs=3)
+    reference = scores_matrix(bundle.reference_scores(3), 3)
+
+    # the reference samples projected on every site are their own PC scores
+    full = scores_matrix(bundle.project(mt, npcs=3), 3)
+    np.testing.assert_allclose(full, reference, atol=1e-6 * np.abs(reference).max())
+
+    # with a third of the sites missing, the rescaled PCs keep the scale of the reference ones
+    shared = mt.filter_rows(mt.locus.position % 3 != 0)
+    partial = scores_matrix(bundle.project(shared, npcs=3, min_overlap=0.1), 3)
+    for pc in range(3):
+        assert np.corrcoef(partial[:, pc], reference[:, pc])[0, 1] > 0.95
+        assert 0.8 < partial[:, pc].std() / reference[:, pc].std() < 1.25
+
+    # sites with a reference allele frequency of 0 or 1 are not projected on, so they are not part of the coverage
+    # either: they weigh the same as sites missing from the data
+    bundle.loadings = bundle.loadings.annotate(
+        pca_af=hl.if_else(bundle.loadings.locus.position % 3 == 0, 0.0, bundle.loadings.pca_af))
+    fixed = scores_matrix(bundle.project(mt, npcs=3, min_overlap=0.1), 3)
+    np.testing.assert_allclose(fixed, partial, rtol=1e-9, atol=1e-12)
@@ -0,0 +1,65 @@
+import numpy as np
+
+
+def test_figure_data_from_stored_statistics_matches_the_entries(hail_context, plink_fileset, tmp_path):
+    hl = hail_context
+    from gwaspy.preimp_qc.association import AssociationScan
+    from gwaspy.preimp_qc.fused_qc import FusedQC
+    from gwaspy.preimp_qc.report_assets import ReportAssets
+    from gwaspy.utils.read_file import read_plink
+
+    dirname, basename = plink_fileset('assets', n_samples=120)
+    mt_pre = read_plink(dirname, basename)
+    fused = FusedQC(hwe_filters={'hwe_cas': 1e-3, 'hwe_con': 1e-3}, tmp_dir=str(tmp_path))
+    mt = fused.run(mt_pre.annotate_rows(exclude_row=False).annotate_cols(exclude_col=False))
+    mt_post = mt_pre.semi_join_cols(mt.filter_cols(mt.id_pass.filters == False).cols())
+    samples = mt.cols().select('is_female', 'is_case')
+    samples = samples.annotate(**fused.sample_metrics[samples.key])
+
+    assets = ReportAssets(gwaspy_dir=str(tmp_path), data_type='Case-Control')
+    scan = AssociationScan()
+    scan.run(mt_pre, mt_post)
+    # every figure's data from the entries, or with the statistics of the fused QC and association scan
+    scanned = assets.plot_data(mt)
+    stored = assets.plot_data(mt, sample_metrics=samples, assoc_stats=scan.pre_stats, assoc_samples=scan.pre_samples)
+    for field in ['female', 'male']:
+        np.testing.assert_allclose(sorted(f for f in scanned.samples[field] if f is not None),
+                                   sorted(f for f in stored.samples[field] if f is not None), rtol=1e-9)
+    for suffix in ['cas', 'con']:
+        np.testing.assert_allclose(sorted(scanned.samples.call_rate[suffix]),
+                                   sorted(stored.samples.call_rate[suffix]), rtol=1e-9)
+        np.testing.assert_allclose([scanned.call_rate[suffix].min, scanned.call_rate[suffix].max],
+                                   [stored.call_rate[suffix].min, stored.call_rate[suffix].max], rtol=1e-9)
+        assert scanned.call_rate[suffix].hist.bin_freq == stored.call_rate[suffix].hist.bin_freq
+    assert len(scanned.samples.call_rate['cas']) + len(scanned.samples.call_rate['con']) == mt.count_cols()
+
+
+def test_report_assets_aggregate_once(hail_context, plink_fileset, tmp_path, monkeypatch):
+    hl = hail_context
+    from gwaspy.preimp_qc.association import AssociationScan
+    from gwaspy.preimp_qc.fused_qc import FusedQC
+    from gwaspy.preimp_qc import plots
+    from gwaspy.preimp_qc.report_assets import ReportAssets
+    from gwaspy.utils.read_file import read_plink
+
+    dirname, basename = plink_fileset('assets_once', n_samples=80)
+    mt_pre = read_plink(dirname, basename)
+    mt = FusedQC(tmp_dir=str(tmp_path)).run(mt_pre.annotate_rows(exclude_row=False).annotate_cols(exclude_col=False))
+
+    gwas_pre, gwas_pos = AssociationScan().run(mt_pre, mt_pre)
+    rg = mt.locus.dtype.reference_genome
+
+    calls = []
+    for cls in [hl.Table, hl.MatrixTable]:
+        for method in ['aggregate', 'aggregate_rows', 'aggregate_cols', 'aggregate_entries']:
+            if hasattr(cls, method):
+                original = getattr(cls, method)
+                monkeypatch.setattr(cls, method, lambda self, *args, _f=original, _m=method, **kwargs:
+                                    calls.append(_m) or _f(self, *args, **kwargs))
+
+    assets = ReportAssets(gwaspy_dir=str(tmp_path), data_type='Case-Control')
+    data = assets.plot_data(mt, gwas_pre=gwas_pre, gwas_pos=gwas_pos, bin_size=plots.manhattan_bin_size(rg))
+    assert calls == ['aggregate']
+    assert len(data.samples.female) + len(data.samples.male) <= mt.count_cols()
+    assert set(data.call_rate) == {'cas', 'con'}
+    assert data.n_sig_var_pre == gwas_pre.aggregate(hl.agg.count_where(gwas_pre.p_value < 5E-8))
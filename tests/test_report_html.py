@@ -0,0 +1,70 @@
+import base64
+import io
+import re
+import pytest
+
+pytest.importorskip('hail')
+Image = pytest.importorskip('PIL.Image')
+
+FIGURES = ['gwaspy_qq_pre', 'gwaspy_qq_pos', 'gwaspy_man_pre', 'gwaspy_man_pos', 'gwaspy_id_con_pre',
+           'gwaspy_id_cas_pre', 'gwaspy_fstat_fig', 'gwaspy_var_con_pre', 'gwaspy_var_cas_pre']
+
+
+def case_control_run(work_dir: str):
+    from gwaspy.preimp_qc.qc_context import QCRun
+
+    counts = {'n_samples': 1000, 'n_variants': 300000,
+              'is_case_counts': {'case': 500, 'control': 500, 'unknown': 0},
+              'is_female_counts': {'female': 500, 'male': 500, 'unknown': 0}}
+    run = QCRun(basename='cohort <1>', output_directory=f'{work_dir}/', work_dir=work_dir, data_type='Case-Control',
+                pre_qc_counts=counts, pos_qc_counts=counts,
+                results={name: {True: 3, False: 997} for name in ['pre_geno', 'mind', 'fstat', 'sex_violations',
+                                                                   'sex_warnings', 'geno', 'cr_diff', 'monomorphic_var',
+                                                                   'hwe_con', 'hwe_cas']},
+                man_results={'n_sig_var_pre': 4, 'n_sig_var_pos': 2, 'lambda_gc_pre': 1.3, 'lambda_gc_pos': 1.02})
+    # figures as large as the 300 dpi plots, in one colour each
+    for i, name in enumerate(FIGURES):
+        Image.new('RGB', (4500, 3000), (20 * i, 100, 200)).save(f'{work_dir}/{name}.png')
+
+    return run
+
+
+def test_html_report_embeds_every_figure_downscaled(tmp_path):
+    from gwaspy.preimp_qc.report_html import MAX_PIXELS, HTMLReport
+
+    run = case_control_run(str(tmp_path))
+    doc = HTMLReport(basename=run.basename)
+    doc.render(run)
+    doc.generate_html(f'{tmp_path}/report.html')
+    with open(f'{tmp_path}/report.html') as f:
+        report = f.read()
+
+    # the basename is escaped, and there is no LaTeX or external file left in the report
+    assert '<h1>QC Report of cohort &lt;1&gt;</h1>' in report
+    images = re.findall(r'src="data:image/png;base64,([^"]+)"', report)
+    assert len(images) == len(FIGURES)
+    for encoded in images:
+        with Image.open(io.BytesIO(base64.b64decode(encoded))) as img:
+            assert img.mode == 'P'
+            assert max(img.size) == MAX_PIXELS
+            assert img.size == (MAX_PIXELS, MAX_PIXELS * 2 // 3)
+
+    # the Lambda GC flag is coloured by its threshold
+    assert re.search(r'<td>Lambda GC Post-QC</td><td>1.02</td>.*<td style="color: green">green</td>', report)
+    assert '<h2>Manhattan</h2>' in report and '<h3>Manhattan Plot - post-QC</h3>' in report
+
+
+def test_pdf_report_is_drawn_without_latex(tmp_path):
+    pytest.importorskip('matplotlib')
+    from gwaspy.preimp_qc.report_html import HTMLReport
+
+    run = case_control_run(str(tmp_path))
+    doc = HTMLReport(basename=run.basename)
+    doc.render(run)
+    doc.generate_pdf(f'{tmp_path}/report.pdf')
+
+    with open(f'{tmp_path}/report.pdf', 'rb') as f:
+        pdf = f.read()
+    assert pdf.startswith(b'%PDF')
+    # headings, tables and nine figures do not fit on one A4 page
+    assert len(re.findall(rb'/Type\s*/Page\b', pdf)) > 2
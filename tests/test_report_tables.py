@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip('hail')
+
+
+def case_only_run():
+    from gwaspy.preimp_qc.qc_context import QCRun
+
+    counts = {'n_samples': 100, 'n_variants': 300000,
+              'is_case_counts': {'case': 100, 'control': 0, 'unknown': 0},
+              'is_female_counts': {'female': 50, 'male': 50, 'unknown': 0}}
+    # a case-only scan has no defined p-value, so no lambda GC
+    return QCRun(basename='cases', output_directory='/tmp/', data_type='Case-only', pre_qc_counts=counts,
+                 pos_qc_counts=counts, results={'sex_warnings': {True: 0, False: 100}},
+                 man_results={'n_sig_var_pre': 0, 'n_sig_var_pos': 0, 'lambda_gc_pre': None, 'lambda_gc_pos': None})
+
+
+def test_missing_lambda_gc_is_reported_as_not_available():
+    from gwaspy.preimp_qc.report_tables import flags_rows, manhattan_rows
+
+    run = case_only_run()
+    man_table = run.man_table()
+    assert man_table == [0, 0, None, None, None, None]
+    assert manhattan_rows(man_table)[1:] == [['Lambda GC', 'n/a', 'n/a'], ['Lambda 1000', 'n/a', 'n/a']]
+
+    rows = {row[0]: row for row in flags_rows(run.pre_qc_counts, run.pos_qc_counts, run.results,
+                                               lambda_gc=man_table[3], sig_vars=man_table[1])}
+    assert rows['Lambda GC Post-QC'][1] == 'n/a'
+    assert rows['Lambda GC Post-QC'][4:] == [1, 'orange']
+    # without controls there is no case-control ratio either
+    assert rows['Case-Control ratio Post-QC'][1] == 'n/a'
+
+
+def test_lambda_gc_is_flagged_by_its_thresholds():
+    from gwaspy.preimp_qc.report_tables import flags_rows
+
+    run = case_only_run()
+    run.pos_qc_counts = {**run.pos_qc_counts, 'is_case_counts': {'case': 500, 'control': 500, 'unknown': 0}}
+    for lambda_gc, flag in [(1.02, [0, 'green']), (1.15, [1, 'orange']), (1.3, [2, 'red'])]:
+        rows = {row[0]: row for row in flags_rows(run.pre_qc_counts, run.pos_qc_counts, run.results,
+                                                   lambda_gc=lambda_gc, sig_vars=0)}
+        assert rows['Lambda GC Post-QC'][4:] == flag
@@ -0,0 +1,83 @@
+import os
+import pandas as pd
+import pytest
+
+ANNOTATIONS = pd.DataFrame({'Sample': ['S0', 'S1', 'S2', 'S3'], 'Sex': [2.0, 1.0, None, 2.0],
+                            'Pheno': [2.0, 1.0, 1.0, None], 'Age': [30.5, 41.0, 52.0, 63.0]})
+
+
+@pytest.mark.parametrize('extension', ['tsv', 'csv', 'parquet'])
+def test_numeric_codes_are_parsed_in_every_format(hail_context, tmp_path, extension):
+    hl = hail_context
+    from gwaspy.utils.sample_annotations import parse_annotations
+
+    path = f'{tmp_path}/annotations.{extension}'
+    if extension == 'parquet':
+        pytest.importorskip('pyarrow')
+        ANNOTATIONS.to_parquet(path)
+    else:
+        # text files write the missing codes as NA and the whole numbers without a decimal part
+        ANNOTATIONS.astype({'Sex': 'Int64', 'Pheno': 'Int64'}).to_csv(
+            path, sep=',' if extension == 'csv' else '\t', index=False, na_rep='NA')
+
+    ht = parse_annotations(path)
+    assert ht.is_female.dtype == hl.tbool
+    assert ht.is_case.dtype == hl.tbool
+    df = ht.to_pandas().set_index('Sample').loc[ANNOTATIONS['Sample']]
+    assert df['is_female'].astype('boolean').tolist() == [True, False, pd.NA, True]
+    assert df['is_case'].astype('boolean').tolist() == [True, False, False, pd.NA]
+    # other columns are kept as strings
+    assert df['Age'].tolist() == ['30.5', '41.0', '52.0', '63.0']
+
+
+def test_parsed_annotations_are_cached_with_the_run(hail_context, tmp_path):
+    from gwaspy.utils.stages import StageCache
+    from gwaspy.utils.sample_annotations import load_annotations
+
+    os.makedirs(f'{tmp_path}/input')
+    path = f'{tmp_path}/input/annotations.tsv'
+    ANNOTATIONS.astype({'Sex': 'Int64', 'Pheno': 'Int64'}).to_csv(path, sep='\t', index=False, na_rep='NA')
+
+    cache = StageCache(f'{tmp_path}/out/cache')
+    assert load_annotations(path, cache=cache).count() == 4
+    # nothing is written next to the input
+    assert os.listdir(f'{tmp_path}/input') == ['annotations.tsv']
+    stored = [name for name in os.listdir(f'{tmp_path}/out/cache') if not name.startswith('.')]
+    assert [name.split('-')[0] for name in stored] == ['annotations']
+    # a second run reads the stored Table
+    assert load_annotations(path, cache=cache).count() == 4
+    assert [name for name in os.listdir(f'{tmp_path}/out/cache') if not name.startswith('.')] == stored
+
+
+def test_unrecognised_codes_and_duplicates_are_reported(hail_context, tmp_path):
+    from gwaspy.utils.sample_annotations import parse_annotations
+
+    path = f'{tmp_path}/annotations.tsv'
+    pd.DataFrame({'Sample': ['S0', 'S1', 'S2'], 'Sex': ['F', 'male', 'X'], 'Pheno': ['case', '3', 'unknown']}).to_csv(
+        path, sep='\t', index=False)
+    with pytest.raises(ValueError, match=r"Unrecognised Sex codes in annotations file: \['X'\]"):
+        parse_annotations(path)
+
+    pd.DataFrame({'Sample': ['S0', 'S1', 'S0'], 'Sex': ['F', 'M', 'F']}).to_csv(path, sep='\t', index=False)
+    with pytest.raises(ValueError, match=r"Duplicate sample IDs in annotations file: \['S0'\]"):
+        parse_annotations(path)
+
+
+def test_annotations_are_joined_on_the_samples_they_share_with_the_data(hail_context, tmp_path, capsys):
+    hl = hail_context
+    from gwaspy.utils.sample_annotations import add_sample_annotations
+
+    mt = hl.utils.range_matrix_table(2, 6)
+    mt = mt.key_cols_by(s=hl.str('S') + hl.str(mt.col_idx))
+    path = f'{tmp_path}/annotations.tsv'
+    ANNOTATIONS.astype({'Sex': 'Int64', 'Pheno': 'Int64'}).to_csv(path, sep='\t', index=False, na_rep='NA')
+
+    annotated = add_sample_annotations(mt, path)
+    cols = {row.s: (row.is_female, row.is_case) for row in annotated.cols().collect()}
+    assert cols == {'S0': (True, True), 'S1': (False, False), 'S2': (None, False), 'S3': (True, None),
+                    'S4': (None, None), 'S5': (None, None)}
+    assert '2 of 6 samples are not in the annotations file' in capsys.readouterr().out
+
+    other = mt.key_cols_by(s=hl.str('T') + hl.str(mt.col_idx))
+    with pytest.raises(ValueError, match='None of the 6 samples in the data are in annotations file'):
+        add_sample_annotations(other, path)
@@ -0,0 +1,45 @@
+import pytest
+
+
+def test_stage_keys_only_change_with_their_inputs():
+    pytest.importorskip('hail')
+    from gwaspy.utils.stages import StageCache
+
+    read = StageCache.key('read', input=[['a.bed', 10, 1.0]], reference='GRCh38')
+    assert read == StageCache.key('read', reference='GRCh38', input=[['a.bed', 10, 1.0]])
+    assert read != StageCache.key('read', input=[['a.bed', 11, 1.0]], reference='GRCh38')
+
+    samples = StageCache.key('sample_filters', upstream=read, mind=0.98)
+    variants = StageCache.key('variant_filters', upstream=samples, geno=0.98)
+    # a threshold invalidates its own stage and, through the upstream keys, the stages after it
+    other_samples = StageCache.key('sample_filters', upstream=read, mind=0.95)
+    assert other_samples != samples
+    assert StageCache.key('variant_filters', upstream=other_samples, geno=0.98) != variants
+    assert StageCache.key('sample_filters', upstream=read, mind=0.98) == samples
+
+
+def test_cached_stages_are_computed_once(hail_context, tmp_path):
+    hl = hail_context
+    from gwaspy.utils.stages import StageCache
+
+    cache = StageCache(f'{tmp_path}/cache/')
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return hl.utils.range_table(10)
+
+    key = cache.key('counts', n=10)
+    ht, computed = cache.table('counts', key, compute)
+    assert computed and ht.count() == 10
+    ht, computed = cache.table('counts', key, compute)
+    assert not computed and ht.count() == 10
+    assert len(calls) == 1
+
+    # an interrupted write has no _SUCCESS file, so the stage is recomputed
+    hl.hadoop_open(f'{cache.path("partial", key, "ht")}/metadata.json.gz', 'w').close()
+    assert not cache.exists('partial', key, 'ht')
+
+    cache.write_json('summary', key, {'n': 10})
+    assert cache.exists('summary', key, 'json')
+    assert cache.read_json('summary', key) == {'n': 10}
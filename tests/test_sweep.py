@@ -0,0 +1,23 @@
+def test_sweep_counts_match_a_qc_run_at_each_threshold(hail_context, plink_fileset, tmp_path):
+    hl = hail_context
+    from gwaspy.preimp_qc.fused_qc import FusedQC
+    from gwaspy.preimp_qc.preimp_qc import threshold_sweep
+    from gwaspy.utils.read_file import read_plink
+
+    # without cases or controls every variant is tested for HWE over all samples, at hwe_th_all_thresh
+    dirname, basename = plink_fileset('sweep', n_samples=100, n_variants=400, phenotype=False)
+    df = threshold_sweep(input_type='plink', dirname=dirname, basename=basename, mind_grid=[0.9, 0.98],
+                         geno_grid=[0.95, 0.98], hwe_th_all_thresh=1e-4, out_dir=f'{tmp_path}/')
+    assert len(df) == 4
+    assert (df['hwe_all'] == 1e-4).all()
+    # more stringent thresholds never keep more samples or variants
+    assert df.groupby('geno')['n_variants_pass'].min()[0.98] <= df.groupby('geno')['n_variants_pass'].min()[0.95]
+
+    mt = read_plink(dirname, basename)
+    for _, row in df.iterrows():
+        qced = FusedQC(mind=row['mind'], geno_thresh=row['geno'], hwe_filters={'hwe_all': 1e-4}).run(mt)
+        sample_fail = qced.mind.filters | qced.fstat.filters | qced.sex_violations.filters
+        variant_fail = (qced.pre_geno.filters | qced.geno.filters | qced.monomorphic_var.filters |
+                        qced.hwe_all.filters)
+        assert qced.aggregate_cols(hl.agg.count_where(~sample_fail)) == row['n_samples_pass']
+        assert qced.aggregate_rows(hl.agg.count_where(~variant_fail)) == row['n_variants_pass']
@@ -0,0 +1,49 @@
+import os
+import pytest
+
+pytest.importorskip('hail')
+
+
+def write_pedigree(path: str, n_trios: int, sample_prefix: str = 'S'):
+    """Trio t: mother 6t and father 6t + 1 (even indices are female) and child 6t + 2"""
+    with open(path, 'w') as f:
+        for t in range(n_trios):
+            mom, dad, kid = (f'{sample_prefix}{6 * t + i}' for i in range(3))
+            f.write(f'F{t} {mom} 0 0 2 -9\nF{t} {dad} 0 0 1 -9\nF{t} {kid} {dad} {mom} 0 -9\n')
+
+
+def test_trio_data_runs_end_to_end(hail_context, plink_fileset, tmp_path):
+    from gwaspy.preimp_qc.preimp_qc import preimp_qc
+
+    dirname, basename = plink_fileset('trios', n_samples=60, phenotype=False)
+    pedigree = f'{tmp_path}/trios.ped.fam'
+    write_pedigree(pedigree, n_trios=10)
+
+    run = preimp_qc(input_type='plink', dirname=dirname, basename=basename, pedigree=pedigree, export_type=None,
+                    report=True, report_format='html', out_dir=f'{tmp_path}/out/')
+
+    assert run.data_type == 'Trio'
+    assert run.n_trios == 10
+    assert run.row_filters == ['pre_geno', 'geno', 'monomorphic_var', 'mendel_var', 'hwe_trio']
+    for filt in run.filters:
+        assert sum(run.results[filt].values()) in (run.pre_qc_counts['n_samples'], run.pre_qc_counts['n_variants'])
+    # the simulated data has variants failing pre_geno and a monomorphic variant
+    assert run.results['pre_geno'][True] > 0
+    assert run.results['monomorphic_var'][True] > 0
+    assert run.pos_qc_counts['n_variants'] < run.pre_qc_counts['n_variants']
+    # trios have no case/control phenotype, so there is no association scan
+    assert run.man_table() is None
+    assert os.path.exists(f'{tmp_path}/out/{basename}.preimp_qc.report.html')
+
+
+def test_trio_filters_without_pedigree():
+    from gwaspy.preimp_qc.preimp_qc import filter_names
+
+    row_filters, filters, _, hwe_filters = filter_names('Trio')
+    assert row_filters == ['pre_geno', 'geno', 'monomorphic_var', 'hwe_all']
+    assert set(row_filters) <= set(filters)
+    assert list(hwe_filters) == ['hwe_all']
+
+    row_filters, _, _, hwe_filters = filter_names('Trio', pedigree=True)
+    assert 'hwe_all' not in row_filters
+    assert hwe_filters == {}